@@ -104,6 +104,10 @@ class WebSocketManager {
                     this.reconnectAttempts = 0;
                     updateConnectionStatus(true);
                     showToast('Connected to server', 'success');
+                    // New sid after a reconnect: re-attach to the running job, replaying missed events
+                    if (this.activeJob) {
+                        this.socket.emit('resume_job', { job_id: this.activeJob.id, since: this.activeJob.seq });
+                    }
                     resolve();
                 });
 
@@ -121,9 +125,10 @@ class WebSocketManager {
                 });
 
                 // Handle server events
-                this.socket.on('progress', (data) => updateProgress(data));
-                this.socket.on('complete', (data) => handleGenerationComplete(data));
-                this.socket.on('error', (data) => handleError(data));
+                this.socket.on('queued', (data) => this.trackJob(data));
+                this.socket.on('progress', (data) => this.trackJob(data) && updateProgress(data));
+                this.socket.on('complete', (data) => this.trackJob(data, true) && handleGenerationComplete(data));
+                this.socket.on('error', (data) => this.trackJob(data, true) && handleError(data));
                 this.socket.on('models_list', (data) => handleModelsList(data));
                 this.socket.on('gallery_data', (data) => handleGalleryData(data));
                 this.socket.on('prompt_enhanced', (data) => handlePromptEnhanced(data));
@@ -143,6 +148,18 @@ class WebSocketManager {
         });
     }
 
+    // Remember the running job and the last event seq; false for an event already seen
+    trackJob(data, finished = false) {
+        if (!data || !data.job_id || data.seq === undefined) return true;
+        if (!this.activeJob || this.activeJob.id !== data.job_id) {
+            this.activeJob = { id: data.job_id, seq: 0 };
+        }
+        if (data.seq <= this.activeJob.seq) return false;
+        this.activeJob.seq = data.seq;
+        if (finished) this.activeJob = null;
+        return true;
+    }
+
     disconnect() {
         if (this.socket) {
             this.socket.disconnect();
@@ -0,0 +1,86 @@
+"""
+Production server: python-socketio AsyncServer and the Flask REST API under uvicorn
+
+Socket event handlers from colab_server.py run on the uvicorn event loop
+(coroutine handlers) or on the default thread pool (plain handlers); REST
+routes are served by the Flask app through a WSGI adapter. Idle connections
+need no thread, so one process holds thousands of clients
+(benchmarks/bench_connections.py).
+
+Usage:
+    python asgi_server.py                    # or: python colab_server.py (SERVER_MODE=asgi)
+    uvicorn asgi_server:app --host 0.0.0.0 --port 5000
+"""
+
+import os
+import asyncio
+import logging
+import resource
+from pathlib import Path
+
+import socketio
+from a2wsgi import WSGIMiddleware
+
+import colab_server
+from socket_transport import AsgiTransport
+
+logger = logging.getLogger(__name__)
+
+def raise_open_file_limit(target: int = 65536) -> int:
+    """Raise the soft open-file limit (one descriptor per connection); returns the new limit"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY:
+        target = min(target, hard)
+    if soft != resource.RLIM_INFINITY and soft < target:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+            return target
+        except (ValueError, OSError) as e:
+            logger.warning("Could not raise open file limit: %s", e)
+    return soft
+
+def create_app():
+    """ASGI app: Socket.IO on /socket.io, everything else to Flask"""
+    sio = socketio.AsyncServer(
+        async_mode='asgi',
+        cors_allowed_origins='*',
+        ping_interval=int(os.environ.get('WS_PING_INTERVAL', 25)),
+        ping_timeout=int(os.environ.get('WS_PING_TIMEOUT', 60)),
+        # Images are sent base64-encoded in socket messages
+        max_http_buffer_size=int(os.environ.get('MAX_UPLOAD_SIZE', 100)) * 1024 * 1024
+    )
+    transport = AsgiTransport(sio)
+    transport.register(colab_server.socket_handlers)
+    colab_server.transport = transport
+
+    async def on_startup():
+        transport.loop = asyncio.get_running_loop()
+        Path('./outputs').mkdir(exist_ok=True)
+        await colab_server.initialize_server()
+
+    flask_app = WSGIMiddleware(colab_server.app, workers=int(os.environ.get('WSGI_THREADS', 16)))
+    return socketio.ASGIApp(sio, other_asgi_app=flask_app, on_startup=on_startup)
+
+app = create_app()
+
+def run(host: str = '0.0.0.0', port: int = None):
+    """Serve with uvicorn (uvloop / httptools when installed)"""
+    import uvicorn
+
+    limit = raise_open_file_limit()
+    port = port or int(os.environ.get('PORT', 5000))
+    logger.info("Starting ASGI server on port %s (open file limit %s)", port, limit)
+    uvicorn.run(
+        app,
+        host=host,
+        port=port,
+        backlog=int(os.environ.get('SERVER_BACKLOG', 2048)),
+        # Engine.IO sends its own pings
+        ws_ping_interval=None,
+        log_level=os.environ.get('LOG_LEVEL', 'info').lower(),
+        # No handlers of uvicorn's own: its records go through the queued pipeline of structured_logging
+        log_config=None
+    )
+
+if __name__ == '__main__':
+    run()
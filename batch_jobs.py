@@ -0,0 +1,439 @@
+"""
+Bulk batch generation from JSONL / CSV
+
+A batch is a list of generation specs (one request per JSONL line or CSV
+row, plus optional shared defaults; CSV cells of loras / axes / controlnet
+are JSON). BatchManager feeds the items to the job runner a few at a time,
+ordered by model and LoRAs so consecutive jobs reuse the loaded pipeline,
+and writes everything under BATCH_DIR/<batch id>/:
+
+    batch.json     - manifest (settings, status, throughput)
+    specs.jsonl    - the items with the defaults applied, validated and
+                     normalized once at creation, in their original order
+    results.jsonl  - one line per finished item, appended as it finishes
+    *.png          - the generated images (also recorded in the gallery)
+
+results.jsonl is the checkpoint: a batch resumed after an interruption (for
+example a Colab disconnect) skips every item that has a 'completed' line and
+retries the others.
+
+Usage:
+    python batch_jobs.py prompts.jsonl [--server URL] [--defaults '{"steps": 25}']
+    python batch_jobs.py --resume <batch id> [--server URL]
+    python batch_jobs.py --status <batch id> [--server URL]
+"""
+
+import io
+import os
+import csv
+import json
+import time
+import uuid
+import logging
+import threading
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+BATCH_DIR = Path(os.environ.get('BATCH_DIR', './outputs/batches'))
+# Jobs of one batch queued or running at a time
+BATCH_WINDOW = int(os.environ.get('BATCH_WINDOW', 4))
+# Log throughput every N finished items
+BATCH_LOG_EVERY = int(os.environ.get('BATCH_LOG_EVERY', 10))
+
+# CSV columns holding JSON (lists / objects); all other cells are numbers or text
+JSON_COLUMNS = ('loras', 'axes', 'controlnet')
+# CSV columns that stay text even when they look like numbers
+TEXT_COLUMNS = ('prompt', 'negative_prompt', 'model', 'sampler', 'scheduler')
+
+def _parse_value(name: str, value: str):
+    """CSV cell -> JSON for JSON_COLUMNS, else int, float or string"""
+    value = value.strip()
+    if name in JSON_COLUMNS:
+        try:
+            return json.loads(value)
+        except ValueError as e:
+            raise ValueError(f"Column {name}: invalid JSON ({e})")
+    if name in TEXT_COLUMNS:
+        return value
+    for cast in (int, float):
+        try:
+            return cast(value)
+        except ValueError:
+            pass
+    return value
+
+def parse_specs(text: str, fmt: Optional[str] = None) -> List[Dict]:
+    """Generation specs from JSONL or CSV text (header row = parameter names)"""
+    if fmt is None:
+        fmt = 'jsonl' if text.lstrip()[:1] in ('{', '') else 'csv'
+    specs = []
+    if fmt == 'jsonl':
+        for number, line in enumerate(text.splitlines(), 1):
+            if not line.strip() or line.lstrip().startswith('#'):
+                continue
+            try:
+                spec = json.loads(line)
+            except ValueError as e:
+                raise ValueError(f"Line {number}: invalid JSON ({e})")
+            if not isinstance(spec, dict):
+                raise ValueError(f"Line {number}: expected an object")
+            specs.append(spec)
+    elif fmt == 'csv':
+        # Row numbers count the header as row 1
+        for number, row in enumerate(csv.DictReader(io.StringIO(text)), 2):
+            try:
+                specs.append({k.strip(): _parse_value(k.strip(), v) for k, v in row.items()
+                              if k and v is not None and v.strip()})
+            except ValueError as e:
+                raise ValueError(f"Row {number}: {e}")
+    else:
+        raise ValueError(f"Unknown batch format: {fmt}")
+    return specs
+
+def _order_key(spec: Dict):
+    """Group items by model and LoRAs so the runner swaps them as rarely as possible"""
+    return (str(spec.get('model', '')), json.dumps(spec.get('loras', []), sort_keys=True))
+
+class BatchJob:
+    """One batch: its files, checkpoint and progress counters"""
+
+    def __init__(self, batch_id: str, directory: Path):
+        self.id = batch_id
+        self.directory = directory
+        self.manifest = json.loads((directory / 'batch.json').read_text())
+        self.specs = parse_specs((directory / 'specs.jsonl').read_text(), 'jsonl')
+        self.results = self._load_results()
+        done = [r for r in self.results.values() if r['status'] == 'completed']
+        self.completed = len(done)
+        self.failed = 0
+        self.cached = sum(1 for r in done if r.get('cached'))
+        self.images = sum(len(r.get('paths', [])) for r in done)
+        self.in_flight = {}  # job id -> item index
+        self.cancelled = False
+        self.thread = None
+        self.started_at = None
+        self.run_completed = 0  # items / images finished by this run, for throughput
+        self.run_images = 0
+        self._lock = threading.Lock()
+
+    def _load_results(self) -> Dict[int, Dict]:
+        """Latest result per item; a torn last line from a crash is ignored"""
+        results = {}
+        path = self.directory / 'results.jsonl'
+        if path.exists():
+            for line in path.read_text().splitlines():
+                try:
+                    result = json.loads(line)
+                except ValueError:
+                    continue
+                results[result['index']] = result
+        return results
+
+    def pending(self) -> List[int]:
+        """Items without a completed result, in run order"""
+        indices = [i for i in range(len(self.specs))
+                   if self.results.get(i, {}).get('status') != 'completed']
+        return sorted(indices, key=lambda i: _order_key(self.item_params(i)))
+
+    def item_params(self, index: int) -> Dict:
+        params = dict(self.manifest.get('defaults', {}), **self.specs[index])
+        params.setdefault('task', 'txt2img')
+        return params
+
+    def record(self, result: Dict):
+        """Append a result line and flush it to disk before counting the item as done"""
+        with self._lock:
+            with open(self.directory / 'results.jsonl', 'a') as f:
+                f.write(json.dumps(result) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self.results[result['index']] = result
+            if result['status'] == 'completed':
+                self.completed += 1
+                self.images += len(result.get('paths', []))
+                self.run_images += len(result.get('paths', []))
+                self.cached += bool(result.get('cached'))
+            else:
+                self.failed += 1
+            self.run_completed += 1
+
+    def write_manifest(self, **updates):
+        self.manifest.update(updates)
+        tmp = self.directory / 'batch.json.tmp'
+        tmp.write_text(json.dumps(self.manifest, indent=2))
+        os.replace(tmp, self.directory / 'batch.json')
+
+    def stats(self) -> Dict:
+        total = len(self.specs)
+        end = time.time() if self.manifest.get('status') == 'running' else self.manifest.get('finished_at', time.time())
+        elapsed = max(end - self.started_at, 0.0) if self.started_at else 0.0
+        rate = self.run_completed / elapsed if elapsed > 0 else 0.0
+        remaining = total - self.completed
+        return {
+            'total': total,
+            'completed': self.completed,
+            'failed': self.failed,
+            'cached': self.cached,
+            'in_flight': len(self.in_flight),
+            'images': self.images,
+            'elapsed_s': round(elapsed, 1),
+            'items_per_min': round(rate * 60, 2),
+            'images_per_s': round(self.run_images / elapsed, 3) if elapsed > 0 else 0.0,
+            'eta_s': round(remaining / rate, 1) if rate > 0 else None
+        }
+
+    def status(self) -> Dict:
+        return {
+            'id': self.id,
+            'status': self.manifest.get('status'),
+            'name': self.manifest.get('name'),
+            'created_at': self.manifest.get('created_at'),
+            'directory': str(self.directory),
+            **self.stats()
+        }
+
+class BatchManager:
+    """Create, run, resume and cancel batches on top of the job runner
+
+    `submit(job, listener)` queues a job and calls `listener(event, data)`
+    with its 'progress' / 'complete' / 'error' events (JobRunner.submit).
+    `prepare(params)` validates and normalizes one item the way a single
+    request is (ValueError if invalid); it runs on every item when the batch
+    is created, so a bad row rejects the batch before anything is queued.
+    `on_progress(batch, stats)` is called after every finished item.
+    """
+
+    def __init__(self, submit: Callable, directory: Optional[Path] = None, window: Optional[int] = None,
+                 on_progress: Optional[Callable] = None, prepare: Optional[Callable] = None):
+        self.submit = submit
+        self.prepare = prepare
+        self.directory = Path(directory or BATCH_DIR)
+        self.window = window or BATCH_WINDOW
+        self.on_progress = on_progress
+        self.batches = {}  # id -> BatchJob
+        self._lock = threading.Lock()
+
+    def create(self, specs: List[Dict], defaults: Optional[Dict] = None, name: Optional[str] = None,
+               start: bool = True) -> BatchJob:
+        """Write a new batch to disk and start it"""
+        if not specs:
+            raise ValueError("Batch has no items")
+        defaults = defaults or {}
+        items = []
+        for number, spec in enumerate(specs, 1):
+            if not isinstance(spec, dict):
+                raise ValueError(f"Item {number}: expected an object")
+            params = dict(defaults, **spec)
+            params.setdefault('task', 'txt2img')
+            if not params.get('prompt'):
+                raise ValueError(f"Item {number}: missing prompt")
+            if self.prepare is not None:
+                try:
+                    params = self.prepare(params)
+                except ValueError as e:
+                    raise ValueError(f"Item {number}: {e}")
+            items.append(params)
+
+        batch_id = f"{time.strftime('%Y%m%d-%H%M%S')}_{uuid.uuid4().hex[:6]}"
+        directory = self.directory / batch_id
+        directory.mkdir(parents=True, exist_ok=True)
+        # Stored prepared: a resumed batch runs exactly the same requests (e.g. sweep base seeds)
+        (directory / 'specs.jsonl').write_text(''.join(json.dumps(item) + '\n' for item in items))
+        (directory / 'batch.json').write_text(json.dumps({
+            'id': batch_id,
+            'name': name,
+            'defaults': defaults,
+            'total': len(specs),
+            'status': 'created',
+            'created_at': time.time()
+        }, indent=2))
+
+        batch = BatchJob(batch_id, directory)
+        with self._lock:
+            self.batches[batch_id] = batch
+        logger.info("📦 Batch %s: %s items", batch_id, len(specs))
+        if start:
+            self.start(batch_id)
+        return batch
+
+    def get(self, batch_id: str) -> Optional[BatchJob]:
+        """Batch by id, loaded from disk if this process has not seen it yet"""
+        with self._lock:
+            batch = self.batches.get(batch_id)
+            if batch is None:
+                directory = self.directory / Path(batch_id).name
+                if not (directory / 'batch.json').exists():
+                    return None
+                batch = self.batches[batch_id] = BatchJob(batch_id, directory)
+            return batch
+
+    def list(self) -> List[Dict]:
+        if self.directory.exists():
+            for path in sorted(self.directory.glob('*/batch.json')):
+                self.get(path.parent.name)
+        return [batch.status() for batch in self.batches.values()]
+
+    def start(self, batch_id: str) -> BatchJob:
+        """Run (or resume) a batch in the background; finished items are skipped"""
+        batch = self.get(batch_id)
+        if batch is None:
+            raise KeyError(batch_id)
+        if batch.thread and batch.thread.is_alive():
+            return batch
+        batch.cancelled = False
+        batch.thread = threading.Thread(target=self._run, args=(batch,), name=f'batch-{batch_id}', daemon=True)
+        batch.thread.start()
+        return batch
+
+    def cancel(self, batch_id: str) -> Optional[BatchJob]:
+        """Stop submitting items; jobs already queued still finish and are recorded"""
+        batch = self.get(batch_id)
+        if batch is not None:
+            batch.cancelled = True
+        return batch
+
+    def resume_unfinished(self) -> List[str]:
+        """Restart batches that were running when the process stopped"""
+        resumed = []
+        if self.directory.exists():
+            for path in sorted(self.directory.glob('*/batch.json')):
+                try:
+                    status = json.loads(path.read_text()).get('status')
+                except ValueError:
+                    continue
+                if status == 'running':
+                    self.start(path.parent.name)
+                    resumed.append(path.parent.name)
+        return resumed
+
+    def _run(self, batch: BatchJob):
+        pending = batch.pending()
+        batch.started_at = time.time()
+        batch.run_completed = 0
+        batch.run_images = 0
+        batch.failed = 0
+        batch.write_manifest(status='running')
+        logger.info("▶️ Batch %s: %s of %s items to run", batch.id, len(pending), len(batch.specs))
+
+        slots = threading.Semaphore(self.window)
+        for index in pending:
+            slots.acquire()
+            if batch.cancelled:
+                slots.release()
+                break
+            self._submit_item(batch, index, slots)
+
+        # Wait for the jobs still in flight
+        for _ in range(self.window):
+            slots.acquire()
+
+        status = 'cancelled' if batch.cancelled else ('completed' if batch.completed == len(batch.specs) else 'failed')
+        batch.write_manifest(status=status, finished_at=time.time(), stats=batch.stats())
+        logger.info("🏁 Batch %s %s: %s", batch.id, status, batch.stats())
+        if self.on_progress:
+            self.on_progress(batch, batch.stats())
+
+    def _submit_item(self, batch: BatchJob, index: int, slots: threading.Semaphore):
+        params = batch.item_params(index)
+        params['output_dir'] = str(batch.directory)
+        params['filename_prefix'] = f"item{index:05d}"
+        job_id = uuid.uuid4().hex
+
+        def listener(event: str, data: Dict):
+            if event not in ('complete', 'error'):
+                return
+            batch.in_flight.pop(job_id, None)
+            try:
+                self._record(batch, index, params, event, data)
+            finally:
+                slots.release()
+
+        while not batch.cancelled:
+            batch.in_flight[job_id] = index
+            job = self.submit({'id': job_id, 'params': params, 'sid': None}, listener=listener)
+            if job['status'] != 'rejected':
+                return
+            if job.get('reject_reason'):
+                # Refused by admission control: retrying cannot help
+                listener('error', {'message': job['reject_reason'], 'job_id': job_id})
+                return
+            # Queue full: wait for other clients' jobs to drain
+            batch.in_flight.pop(job_id, None)
+            time.sleep(1.0)
+        slots.release()
+
+    def _record(self, batch: BatchJob, index: int, params: Dict, event: str, data: Dict):
+        result = {'index': index, 'finished_at': time.time()}
+        if event == 'complete':
+            # Cache hits and coalesced requests are saved under this item's output_dir too
+            result.update(status='completed', paths=data.get('paths', []), seed=params.get('seed', -1),
+                          cached=bool(data.get('cached')))
+        else:
+            result.update(status='failed', error=data.get('message'))
+        batch.record(result)
+
+        stats = batch.stats()
+        finished = batch.completed + batch.failed
+        if finished % BATCH_LOG_EVERY == 0 or finished == stats['total']:
+            logger.info("📦 Batch %s: %s/%s done, %s items/min, %s img/s, ETA %ss", batch.id, batch.completed,
+                        stats['total'], stats['items_per_min'], stats['images_per_s'], stats['eta_s'])
+        if self.on_progress:
+            self.on_progress(batch, stats)
+
+# ==================== CLI ====================
+
+def _request(method: str, url: str, payload: Optional[Dict] = None) -> Dict:
+    import requests
+
+    response = requests.request(method, url, json=payload, timeout=60)
+    if response.status_code >= 400:
+        raise SystemExit(f"{response.status_code}: {response.text}")
+    return response.json()
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Run a batch of generations on a server')
+    parser.add_argument('specs', nargs='?', help='JSONL or CSV file of generation specs')
+    parser.add_argument('--server', default=os.environ.get('SERVER_URL', 'http://localhost:5000'))
+    parser.add_argument('--format', choices=['jsonl', 'csv'], help='default: from the file extension')
+    parser.add_argument('--defaults', default='{}', help='JSON parameters shared by all items')
+    parser.add_argument('--name', help='batch name')
+    parser.add_argument('--resume', metavar='BATCH_ID', help='resume an interrupted batch')
+    parser.add_argument('--status', metavar='BATCH_ID', help='show a batch and exit')
+    parser.add_argument('--interval', type=float, default=5.0, help='seconds between progress polls')
+    args = parser.parse_args()
+    server = args.server.rstrip('/')
+
+    if args.status:
+        print(json.dumps(_request('GET', f"{server}/api/batch/{args.status}"), indent=2))
+        return
+    if args.resume:
+        batch = _request('POST', f"{server}/api/batch/{args.resume}/resume")
+    elif args.specs:
+        path = Path(args.specs)
+        fmt = args.format or ('csv' if path.suffix.lower() == '.csv' else 'jsonl')
+        specs = parse_specs(path.read_text(), fmt)
+        batch = _request('POST', f"{server}/api/batch", {
+            'items': specs, 'defaults': json.loads(args.defaults), 'name': args.name or path.stem
+        })
+    else:
+        parser.error('specs file, --resume or --status required')
+
+    print(f"Batch {batch['id']}: {batch['total']} items -> {batch['directory']}")
+    try:
+        while True:
+            time.sleep(args.interval)
+            batch = _request('GET', f"{server}/api/batch/{batch['id']}")
+            eta = f"{batch['eta_s']:.0f}s" if batch['eta_s'] is not None else '?'
+            print(f"[{batch['status']}] {batch['completed']}/{batch['total']} done, {batch['failed']} failed, "
+                  f"{batch['items_per_min']} items/min, {batch['images_per_s']} img/s, ETA {eta}")
+            if batch['status'] not in ('created', 'running'):
+                break
+    except KeyboardInterrupt:
+        print(f"\nDetached; the batch keeps running on the server. Resume watching with --status {batch['id']}")
+
+if __name__ == '__main__':
+    main()
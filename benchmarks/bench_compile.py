@@ -0,0 +1,93 @@
+"""
+torch.compile benchmark on CPU: compile cost and steady-state per-step speedup
+
+Runs txt2img eagerly, compiles the (model, bucket, batch) key through
+CompiledPipelineCache, then runs the same request with the compiled UNet and
+VAE decoder. Uses a tiny random-weight pipeline by default.
+
+Usage:
+    python benchmarks/bench_compile.py [--model PATH] [--size 512] [--steps 10] [--runs 5]
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+def _time_runs(loop, manager, params, runs):
+    """Median and min latency of repeated generations"""
+    latencies = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        loop.run_until_complete(manager.generate(params))
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return latencies[len(latencies) // 2], latencies[0]
+
+def main():
+    parser = argparse.ArgumentParser(description='torch.compile benchmark (CPU)')
+    parser.add_argument('--model', default=None, help='Model id or path (default: tiny random pipeline)')
+    parser.add_argument('--size', type=int, default=512)
+    parser.add_argument('--steps', type=int, default=10)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--precision', default='fp32')
+    parser.add_argument('--output', default=None, help='Write results JSON here')
+    args = parser.parse_args()
+
+    os.environ['DEVICE'] = 'cpu'
+    os.environ['ENABLE_TORCH_COMPILE'] = 'true'
+    os.environ['RESOLUTION_BUCKETS'] = f"{args.size}x{args.size}"
+    sys.path.insert(0, str(REPO_ROOT))
+    sys.path.insert(0, str(Path(__file__).resolve().parent))
+    import colab_server
+    from tiny_pipeline import build_tiny_pipeline
+
+    model = args.model or build_tiny_pipeline()
+    manager = colab_server.sd_manager
+    cache = manager.compile_cache
+    params = {'task': 'txt2img', 'prompt': 'a lighthouse at dusk', 'model': model, 'precision': args.precision,
+              'width': args.size, 'height': args.size, 'steps': args.steps, 'seed': 0}
+
+    loop = asyncio.new_event_loop()
+    # First eager run warms up and schedules compilation; time eager runs before it finishes
+    cache.enabled = False
+    loop.run_until_complete(manager.generate(params))
+    eager_median, eager_min = _time_runs(loop, manager, params, args.runs)
+
+    cache.enabled = True
+    loop.run_until_complete(manager.generate(params))
+    cache.wait()
+    entry = next(iter(cache.entries.values()))
+    if entry['status'] != 'ready':
+        print(f"Compilation {entry['status']}")
+        return 1
+
+    # First compiled call may still pay for guard setup
+    loop.run_until_complete(manager.generate(params))
+    compiled_median, compiled_min = _time_runs(loop, manager, params, args.runs)
+
+    results = {
+        'size': args.size,
+        'steps': args.steps,
+        'precision': args.precision,
+        'compile_s': entry['compile_s'],
+        'eager_step_ms': round(eager_median / args.steps * 1000, 2),
+        'compiled_step_ms': round(compiled_median / args.steps * 1000, 2),
+        'eager_latency_s': round(eager_median, 4),
+        'compiled_latency_s': round(compiled_median, 4),
+        'speedup': round(eager_median / compiled_median, 3),
+        'break_even_requests': round(entry['compile_s'] / max(eager_median - compiled_median, 1e-9), 1),
+        'compiled_hits': entry['hits'],
+    }
+    print(json.dumps(results, indent=2))
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
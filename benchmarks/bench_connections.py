@@ -0,0 +1,204 @@
+"""
+Connection-scaling benchmark for the Socket.IO server
+
+Starts the server in a subprocess (SERVER_MODE=asgi by default), then opens
+idle WebSocket clients in steps (e.g. 100, 500, 1000, 2000) and at each step
+measures connect time, failed connects, server RSS, /health latency and the
+round-trip time of a cheap socket event (get_gallery) while the idle clients
+stay connected and answer Engine.IO pings.
+
+Clients speak the Engine.IO v4 / Socket.IO v5 protocol directly over the
+websockets package so one benchmark process can hold thousands of them.
+
+Usage:
+    python benchmarks/bench_connections.py [--mode asgi|threading] [--steps 100,500,1000,2000]
+"""
+
+import os
+import sys
+import json
+import time
+import signal
+import asyncio
+import argparse
+import resource
+import subprocess
+import urllib.request
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+def _percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+def _rss_mb(pid: int) -> float:
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return round(int(line.split()[1]) / 1024, 1)
+    return 0.0
+
+class IdleClient:
+    """Socket.IO client that connects, answers pings and can send one event"""
+
+    def __init__(self, url: str):
+        self.url = url
+        self.ws = None
+        self.task = None
+        self.waiters = {}
+
+    async def connect(self, timeout: float):
+        import websockets
+
+        self.ws = await asyncio.wait_for(websockets.connect(self.url, max_size=None), timeout)
+        packet = await asyncio.wait_for(self.ws.recv(), timeout)
+        if not packet.startswith('0'):
+            raise RuntimeError(f"Unexpected open packet: {packet[:40]}")
+        await self.ws.send('40')
+        while True:
+            packet = await asyncio.wait_for(self.ws.recv(), timeout)
+            if packet.startswith('40'):
+                break
+        self.task = asyncio.create_task(self._read_loop())
+
+    async def _read_loop(self):
+        try:
+            async for packet in self.ws:
+                if packet == '2':
+                    await self.ws.send('3')
+                elif packet.startswith('42'):
+                    event = json.loads(packet[2:])[0]
+                    future = self.waiters.pop(event, None)
+                    if future and not future.done():
+                        future.set_result(time.perf_counter())
+        except Exception:
+            pass
+
+    async def round_trip(self, event: str, data, reply: str, timeout: float) -> float:
+        future = asyncio.get_running_loop().create_future()
+        self.waiters[reply] = future
+        start = time.perf_counter()
+        await self.ws.send('42' + json.dumps([event, data]))
+        return await asyncio.wait_for(future, timeout) - start
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+        if self.ws:
+            await self.ws.close()
+
+def _health_latency(base_url: str, samples: int):
+    latencies = []
+    for _ in range(samples):
+        start = time.perf_counter()
+        with urllib.request.urlopen(f"{base_url}/health/live", timeout=10) as response:
+            response.read()
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+async def run_steps(port: int, pid: int, steps, concurrency: int, timeout: float, samples: int):
+    base_url = f"http://127.0.0.1:{port}"
+    ws_url = f"ws://127.0.0.1:{port}/socket.io/?EIO=4&transport=websocket"
+    clients = []
+    results = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def open_one():
+        client = IdleClient(ws_url)
+        async with semaphore:
+            try:
+                await client.connect(timeout)
+                return client
+            except Exception:
+                await client.close()
+                return None
+
+    for target in steps:
+        start = time.perf_counter()
+        opened = await asyncio.gather(*(open_one() for _ in range(target - len(clients))))
+        connect_s = time.perf_counter() - start
+        failed = sum(1 for c in opened if c is None)
+        clients.extend(c for c in opened if c is not None)
+
+        health = await asyncio.to_thread(_health_latency, base_url, samples)
+        rtts = []
+        dropped = 0
+        for client in clients[:: max(len(clients) // samples, 1)][:samples]:
+            try:
+                rtts.append(await client.round_trip('get_gallery', {'page': 0, 'limit': 1}, 'gallery_data', timeout))
+            except Exception:
+                dropped += 1
+
+        step = {
+            'target': target,
+            'connected': len(clients),
+            'failed_connects': failed,
+            'connect_s': round(connect_s, 2),
+            'connects_per_s': round((len(opened) - failed) / max(connect_s, 1e-9), 1),
+            'server_rss_mb': _rss_mb(pid),
+            'health_p50_ms': round(_percentile(health, 0.5) * 1000, 2),
+            'health_p99_ms': round(_percentile(health, 0.99) * 1000, 2),
+            'event_rtt_p50_ms': round(_percentile(rtts, 0.5) * 1000, 2) if rtts else None,
+            'event_rtt_p99_ms': round(_percentile(rtts, 0.99) * 1000, 2) if rtts else None,
+            'event_timeouts': dropped,
+        }
+        print(json.dumps(step))
+        results.append(step)
+
+    await asyncio.gather(*(c.close() for c in clients), return_exceptions=True)
+    return results
+
+def _wait_ready(port: int, process, timeout: float = 60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with code {process.returncode}")
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/health/live", timeout=1).read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("Server did not start")
+
+def main():
+    parser = argparse.ArgumentParser(description='Socket.IO connection-scaling benchmark')
+    parser.add_argument('--mode', default='asgi', choices=['asgi', 'threading'])
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--steps', default='100,500,1000,2000', help='Comma-separated connection counts')
+    parser.add_argument('--concurrency', type=int, default=200, help='Connects in flight at once')
+    parser.add_argument('--timeout', type=float, default=20.0)
+    parser.add_argument('--samples', type=int, default=20, help='Latency samples per step')
+    parser.add_argument('--output', default=None, help='Write results JSON here')
+    args = parser.parse_args()
+
+    steps = sorted(int(s) for s in args.steps.split(','))
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = steps[-1] + 256
+    if soft < wanted:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(wanted, hard), hard))
+
+    env = dict(os.environ, SERVER_MODE=args.mode, PORT=str(args.port), DEVICE='cpu',
+               PRELOAD_MODELS='', LOG_LEVEL='warning')
+    process = subprocess.Popen([sys.executable, str(REPO_ROOT / 'colab_server.py')], cwd=str(REPO_ROOT),
+                               env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        _wait_ready(args.port, process)
+        results = asyncio.run(run_steps(args.port, process.pid, steps, args.concurrency,
+                                        args.timeout, args.samples))
+    finally:
+        process.send_signal(signal.SIGINT)
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+    report = {'mode': args.mode, 'steps': results}
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,225 @@
+"""
+Generation benchmark suite (offline, CPU) with baseline regression check
+
+Builds tiny random-weight pipelines (benchmarks/tiny_pipeline.py) and drives
+StableDiffusionManager.generate for txt2img, img2img, inpaint and ControlNet
+across resolutions and batch sizes. Each task runs in its own subprocess so
+peak RSS is per task. For every case the report has latency percentiles,
+images/s, the per-stage breakdown from metrics.py (prompt encode, denoise,
+per step, VAE decode, and whatever else the call spent, e.g. loading the
+img2img / inpaint / ControlNet pipeline variant) and peak RSS.
+
+With --baseline, cases whose p50 latency or peak RSS grew by more than
+--tolerance fail the run (exit code 1), and so does a missing baseline.
+Write one with --save-baseline (make bench-baseline) on the machine that
+will run the check; timings do not carry over between machines.
+
+Usage:
+    python benchmarks/bench_generation.py [--quick] [--output report.json]
+    python benchmarks/bench_generation.py --baseline benchmarks/baseline.json [--tolerance 0.25]
+    python benchmarks/bench_generation.py --save-baseline benchmarks/baseline.json
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import base64
+import asyncio
+import argparse
+import platform
+import resource
+import subprocess
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+TASKS = ('txt2img', 'img2img', 'inpaint', 'controlnet')
+# Only txt2img honours num_images; the other tasks always return one image
+BATCHED_TASKS = ('txt2img',)
+
+def _png_base64(image) -> str:
+    buffered = io.BytesIO()
+    image.save(buffered, format='PNG')
+    return base64.b64encode(buffered.getvalue()).decode()
+
+def _inputs(size: int) -> dict:
+    """Init image (a gradient with a bright square, so canny finds edges) and an inpaint mask"""
+    from PIL import Image, ImageDraw
+
+    image = Image.linear_gradient('L').resize((size, size)).convert('RGB')
+    ImageDraw.Draw(image).rectangle((size // 4, size // 4, size * 3 // 4, size * 3 // 4), fill='white')
+    mask = Image.new('L', (size, size), 0)
+    ImageDraw.Draw(mask).rectangle((size // 4, size // 4, size * 3 // 4, size * 3 // 4), fill=255)
+    return {'image': _png_base64(image), 'mask': _png_base64(mask)}
+
+def _percentile(values, q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+def _stage_ms(drained: dict, name: str):
+    """Mean milliseconds per observation of a drained histogram (all label sets)"""
+    total = count = 0
+    for _, sum_, n in drained.get(name, {}).values():
+        total += sum_
+        count += n
+    return round(total / count * 1000, 2) if count else None
+
+def run_task(task: str, model: str, controlnet: str, sizes, batches, steps: int, runs: int) -> list:
+    """Time every (size, batch) case of one task in this process"""
+    os.environ['DEVICE'] = 'cpu'
+    os.environ.setdefault('ENABLE_TORCH_COMPILE', 'false')
+    sys.path.insert(0, str(REPO_ROOT))
+    import colab_server
+    import metrics
+
+    for controlnet_type in colab_server.CONTROLNET_MODELS:
+        colab_server.CONTROLNET_MODELS[controlnet_type] = controlnet
+    manager = colab_server.sd_manager
+    loop = asyncio.new_event_loop()
+
+    results = []
+    for size in sizes:
+        inputs = _inputs(size)
+        for batch in (batches if task in BATCHED_TASKS else [1]):
+            params = {'task': task, 'prompt': 'a lighthouse at dusk', 'negative_prompt': 'blurry',
+                      'model': model, 'width': size, 'height': size, 'steps': steps, 'seed': 0,
+                      'num_images': batch, 'strength': 1.0, 'controlnet_type': 'canny', **inputs}
+            # Warm-up: model load, first-call kernel selection
+            loop.run_until_complete(manager.generate(params))
+            metrics.REGISTRY.drain()
+
+            latencies = []
+            images = 0
+            for _ in range(runs):
+                start = time.perf_counter()
+                images += len(loop.run_until_complete(manager.generate(params)))
+                latencies.append(time.perf_counter() - start)
+            drained = metrics.REGISTRY.drain()
+
+            p50 = _percentile(latencies, 0.5)
+            stages = {
+                'prompt_encode_ms': _stage_ms(drained, 'sd_prompt_encode_seconds'),
+                'denoise_ms': _stage_ms(drained, 'sd_denoise_seconds'),
+                'step_ms': _stage_ms(drained, 'sd_step_seconds'),
+                'vae_decode_ms': _stage_ms(drained, 'sd_vae_decode_seconds'),
+            }
+            measured = sum(stages[k] or 0 for k in ('prompt_encode_ms', 'denoise_ms', 'vae_decode_ms'))
+            stages['other_ms'] = round(sum(latencies) / runs * 1000 - measured, 2)
+            results.append({
+                'case': f"{task}/{size}x{size}/b{batch}",
+                'task': task,
+                'size': size,
+                'batch': batch,
+                'steps': steps,
+                'runs': runs,
+                'latency_p50_s': round(p50, 4),
+                'latency_p90_s': round(_percentile(latencies, 0.9), 4),
+                'latency_p99_s': round(_percentile(latencies, 0.99), 4),
+                'latency_mean_s': round(sum(latencies) / runs, 4),
+                'images_per_s': round(images / sum(latencies), 3),
+                'stages': stages,
+            })
+    peak_rss_mb = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    for result in results:
+        result['peak_rss_mb'] = peak_rss_mb
+    return results
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list:
+    """Regressions of report against baseline: (case, metric, baseline, current)"""
+    regressions = []
+    for case, current in report['cases'].items():
+        base = baseline.get('cases', {}).get(case)
+        if base is None:
+            continue
+        for metric in ('latency_p50_s', 'peak_rss_mb'):
+            if base.get(metric) and current[metric] > base[metric] * (1 + tolerance):
+                regressions.append((case, metric, base[metric], current[metric]))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Generation benchmark suite (CPU, offline)')
+    parser.add_argument('--tasks', default=','.join(TASKS))
+    parser.add_argument('--sizes', default='64,128', help='Square resolutions (multiples of 16)')
+    parser.add_argument('--batches', default='1,2', help='Batch sizes (txt2img)')
+    parser.add_argument('--steps', type=int, default=4)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--quick', action='store_true', help='One size, batch 1, 3 runs')
+    parser.add_argument('--model', default=None, help='Model path (default: tiny random pipeline)')
+    parser.add_argument('--output', default=None, help='Write the report JSON here')
+    parser.add_argument('--baseline', default=None, help='Compare against this report')
+    parser.add_argument('--save-baseline', default=None, help='Write the report here as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed relative growth (0.25 = +25%%)')
+    parser.add_argument('--child', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--controlnet', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.quick:
+        args.sizes, args.batches, args.runs = args.sizes.split(',')[0], '1', 3
+    sizes = [int(s) for s in args.sizes.split(',')]
+    batches = [int(b) for b in args.batches.split(',')]
+
+    if args.child:
+        results = run_task(args.child, args.model, args.controlnet, sizes, batches, args.steps, args.runs)
+        print(json.dumps(results))
+        return 0
+
+    sys.path.insert(0, str(Path(__file__).resolve().parent))
+    from tiny_pipeline import build_tiny_pipeline, build_tiny_controlnet
+    model = args.model or build_tiny_pipeline()
+    controlnet = build_tiny_controlnet()
+
+    cases = {}
+    failed = []
+    for task in args.tasks.split(','):
+        cmd = [sys.executable, __file__, '--child', task, '--model', model, '--controlnet', controlnet,
+               '--sizes', args.sizes, '--batches', args.batches, '--steps', str(args.steps),
+               '--runs', str(args.runs)]
+        proc = subprocess.run(cmd, capture_output=True, text=True, env=dict(os.environ, HF_HUB_OFFLINE='1'))
+        if proc.returncode != 0:
+            print(f"{task}: failed\n{proc.stderr[-1500:]}")
+            failed.append(task)
+            continue
+        for result in json.loads(proc.stdout.strip().splitlines()[-1]):
+            cases[result['case']] = result
+
+    report = {
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'machine': {'python': platform.python_version(), 'processor': platform.processor() or platform.machine(),
+                    'cpus': os.cpu_count()},
+        'model': 'tiny' if args.model is None else args.model,
+        'cases': cases
+    }
+
+    print(f"{'case':<26} {'p50 s':>8} {'p90 s':>8} {'img/s':>7} {'encode':>7} {'step':>7} "
+          f"{'decode':>7} {'other':>8} {'RSS MB':>8}")
+    for case, r in cases.items():
+        stages = r['stages']
+        print(f"{case:<26} {r['latency_p50_s']:>8} {r['latency_p90_s']:>8} {r['images_per_s']:>7} "
+              f"{stages['prompt_encode_ms'] or '-':>7} {stages['step_ms'] or '-':>7} "
+              f"{stages['vae_decode_ms'] or '-':>7} {stages['other_ms']:>8} {r['peak_rss_mb']:>8}")
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2))
+    if args.save_baseline:
+        Path(args.save_baseline).write_text(json.dumps(report, indent=2))
+        print(f"Baseline written to {args.save_baseline}")
+
+    status = 1 if failed else 0
+    if args.baseline:
+        if not Path(args.baseline).exists():
+            print(f"No baseline at {args.baseline}; create one with --save-baseline {args.baseline}")
+            status = 1
+        else:
+            regressions = compare(report, json.loads(Path(args.baseline).read_text()), args.tolerance)
+            for case, metric, base, current in regressions:
+                print(f"REGRESSION {case} {metric}: {base} -> {current} (+{(current / base - 1) * 100:.0f}%)")
+            if regressions:
+                status = 1
+            else:
+                print(f"No regressions beyond {args.tolerance * 100:.0f}% against {args.baseline}")
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main())
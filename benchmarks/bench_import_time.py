@@ -0,0 +1,135 @@
+"""
+Import-time and cold-start benchmark for colab_server
+
+Runs `python -X importtime -c "import colab_server"` in a fresh interpreter,
+reports the slowest imports and the time until the first /health response,
+and fails if heavy dependencies are imported eagerly or the budget is exceeded.
+
+Usage:
+    python benchmarks/bench_import_time.py [--budget-ms 1000] [--update-baseline]
+"""
+
+import sys
+import json
+import argparse
+import subprocess
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+BASELINE_PATH = Path(__file__).resolve().parent / 'baselines' / 'import_time.json'
+
+# Modules that must only be imported on first use
+HEAVY_MODULES = ['torch', 'diffusers', 'transformers', 'cv2', 'numpy', 'googleapiclient']
+
+COLD_START_SCRIPT = """
+import time, json
+start = time.perf_counter()
+import colab_server
+imported = time.perf_counter()
+response = colab_server.app.test_client().get('/health')
+done = time.perf_counter()
+print(json.dumps({
+    'import_ms': (imported - start) * 1000,
+    'first_health_ms': (done - start) * 1000,
+    'health_status': response.status_code
+}))
+"""
+
+def parse_importtime(stderr: str):
+    """Parse `-X importtime` output into {module: (self_us, cumulative_us)}"""
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        try:
+            _, timings = line.split(':', 1)
+            self_us, cumulative_us, name = timings.split('|')
+            # Nested imports keep their extra indentation
+            modules[name[1:].rstrip()] = (int(self_us), int(cumulative_us))
+        except ValueError:
+            continue
+    return modules
+
+def run_importtime():
+    """Import colab_server in a clean interpreter with -X importtime"""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import colab_server'],
+        cwd=REPO_ROOT, capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing colab_server failed:\n{result.stderr[-2000:]}")
+    return parse_importtime(result.stderr)
+
+def run_cold_start():
+    """Measure import plus the first /health request in a clean interpreter"""
+    result = subprocess.run(
+        [sys.executable, '-c', COLD_START_SCRIPT],
+        cwd=REPO_ROOT, capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Cold start failed:\n{result.stderr[-2000:]}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description='colab_server import-time benchmark')
+    parser.add_argument('--runs', type=int, default=5, help='Cold-start repetitions')
+    parser.add_argument('--budget-ms', type=float, default=1000, help='Max time to first /health')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed regression vs baseline')
+    parser.add_argument('--top', type=int, default=15, help='Number of slowest imports to show')
+    parser.add_argument('--output', default=None, help='Write results JSON here')
+    parser.add_argument('--update-baseline', action='store_true')
+    args = parser.parse_args()
+
+    modules = run_importtime()
+    top_level = {name: t for name, t in modules.items() if not name.startswith(' ')}
+    slowest = sorted(top_level.items(), key=lambda kv: kv[1][1], reverse=True)[:args.top]
+    imported = {name.strip() for name in modules}
+    eager_heavy = [m for m in HEAVY_MODULES if m in imported]
+
+    runs = [run_cold_start() for _ in range(args.runs)]
+    first_health = sorted(r['first_health_ms'] for r in runs)
+    import_ms = sorted(r['import_ms'] for r in runs)
+
+    results = {
+        'import_ms_median': round(import_ms[len(import_ms) // 2], 1),
+        'first_health_ms_median': round(first_health[len(first_health) // 2], 1),
+        'first_health_ms_max': round(first_health[-1], 1),
+        'eager_heavy_modules': eager_heavy,
+        'slowest_imports_ms': {name: round(cum / 1000, 1) for name, (_, cum) in slowest}
+    }
+
+    print("Slowest top-level imports (cumulative):")
+    for name, (_, cum) in slowest:
+        print(f"  {cum / 1000:8.1f} ms  {name}")
+    print(f"\nImport colab_server: {results['import_ms_median']} ms (median of {args.runs})")
+    print(f"First /health:       {results['first_health_ms_median']} ms (median of {args.runs})")
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2))
+
+    if args.update_baseline:
+        BASELINE_PATH.parent.mkdir(parents=True, exist_ok=True)
+        BASELINE_PATH.write_text(json.dumps(results, indent=2) + '\n')
+        print(f"Baseline written to {BASELINE_PATH}")
+        return 0
+
+    failures = []
+    if eager_heavy:
+        failures.append(f"heavy modules imported eagerly: {eager_heavy}")
+    if results['first_health_ms_median'] > args.budget_ms:
+        failures.append(f"first /health {results['first_health_ms_median']} ms > budget {args.budget_ms} ms")
+    if BASELINE_PATH.exists():
+        baseline = json.loads(BASELINE_PATH.read_text())
+        limit = baseline['first_health_ms_median'] * (1 + args.tolerance)
+        if results['first_health_ms_median'] > limit:
+            failures.append(
+                f"first /health regressed: {results['first_health_ms_median']} ms "
+                f"> {limit:.1f} ms (baseline {baseline['first_health_ms_median']} ms)"
+            )
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
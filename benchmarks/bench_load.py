@@ -0,0 +1,268 @@
+"""
+Socket.IO load test with a stub inference backend
+
+Starts colab_server in a subprocess with benchmarks/stub_pipeline.py in place
+of the diffusion pipeline (fixed per-step latency, noise images), then runs N
+concurrent clients for each concurrency step. Every client loops over a
+request mix of generate / get_gallery / upscale_image / enhance_prompt and
+waits for each reply before sending the next (closed loop, optional think
+time). Per step it reports throughput, latency percentiles per event,
+rejected requests (server busy, rate limited), dropped requests (no reply
+within --timeout or connection lost) and server CPU / RSS.
+
+Each client sends its own X-Forwarded-For address (the server runs with
+RATE_LIMIT_TRUST_PROXY=true), so rate limits apply per simulated client as
+they would behind a proxy; --rate-limit off disables them.
+
+Usage:
+    python benchmarks/bench_load.py [--concurrency 1,4,16,64] [--duration 20] [--step-ms 50]
+        [--mix generate=4,get_gallery=3,enhance_prompt=2,upscale_image=1] [--output results.json]
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import base64
+import random
+import signal
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from bench_connections import REPO_ROOT, _percentile, _rss_mb, _wait_ready
+
+DEFAULT_MIX = 'generate=4,get_gallery=3,enhance_prompt=2,upscale_image=1'
+
+# Reply events that end a request, and replies that mean it was turned away
+REPLIES = {
+    'generate': ('complete', 'error'),
+    'get_gallery': ('gallery_data', 'error'),
+    'enhance_prompt': ('prompt_enhanced', 'error'),
+    'upscale_image': ('upscale_complete', 'error'),
+}
+REJECTIONS = {'Server is busy, try again later': 'busy', 'Rate limit exceeded': 'rate_limited'}
+
+def _small_png(size: int = 128) -> str:
+    from PIL import Image
+
+    buffered = io.BytesIO()
+    Image.effect_noise((size, size), 64).convert('RGB').save(buffered, format='PNG')
+    return base64.b64encode(buffered.getvalue()).decode()
+
+def _cpu_seconds(pid: int) -> float:
+    """User + system CPU time of a process (all threads)"""
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+class LoadClient:
+    """Socket.IO client sending one request at a time and waiting for its reply"""
+
+    def __init__(self, url: str, address: str):
+        self.url = url
+        self.address = address
+        self.ws = None
+        self.task = None
+        self.pending = None  # (reply events, future)
+
+    async def connect(self, timeout: float):
+        import websockets
+
+        headers = {'X-Forwarded-For': self.address}
+        self.ws = await asyncio.wait_for(websockets.connect(self.url, max_size=None, extra_headers=headers),
+                                         timeout)
+        packet = await asyncio.wait_for(self.ws.recv(), timeout)
+        if not packet.startswith('0'):
+            raise RuntimeError(f"Unexpected open packet: {packet[:40]}")
+        await self.ws.send('40')
+        while not (await asyncio.wait_for(self.ws.recv(), timeout)).startswith('40'):
+            pass
+        self.task = asyncio.create_task(self._read_loop())
+
+    async def _read_loop(self):
+        try:
+            async for packet in self.ws:
+                if packet == '2':
+                    await self.ws.send('3')
+                elif packet.startswith('42') and self.pending:
+                    event, *args = json.loads(packet[2:])
+                    replies, future = self.pending
+                    if event in replies and not future.done():
+                        future.set_result((event, args[0] if args else None))
+        except Exception:
+            pass
+        finally:
+            if self.pending and not self.pending[1].done():
+                self.pending[1].set_exception(ConnectionError('connection closed'))
+
+    async def request(self, event: str, data, timeout: float):
+        """(reply event, reply data) of one request"""
+        future = asyncio.get_running_loop().create_future()
+        self.pending = (REPLIES[event], future)
+        await self.ws.send('42' + json.dumps([event, data]))
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.pending = None
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+        if self.ws:
+            await self.ws.close()
+
+def _payload(event: str, gen_steps: int, size: int, image: str):
+    if event == 'generate':
+        # Distinct seeds: the result cache would otherwise answer repeats
+        return {'task': 'txt2img', 'prompt': 'a lighthouse at dusk', 'steps': gen_steps,
+                'width': size, 'height': size, 'seed': random.randint(0, 2**31)}
+    if event == 'get_gallery':
+        return {'page': 0, 'limit': 20}
+    if event == 'enhance_prompt':
+        return {'prompt': 'a portrait of an old sailor'}
+    return {'image': image, 'scale': 2, 'method': 'lanczos'}
+
+async def run_step(ws_url: str, pid: int, clients_n: int, args, mix, image: str, offset: int) -> dict:
+    events, weights = zip(*mix)
+    stats = {event: {'latencies': [], 'ok': 0, 'busy': 0, 'rate_limited': 0, 'errors': 0, 'dropped': 0}
+             for event in events}
+    failed_connects = 0
+
+    clients = [LoadClient(ws_url, f"10.{(offset + i) // 65536 % 256}.{(offset + i) // 256 % 256}.{(offset + i) % 256}")
+               for i in range(clients_n)]
+    results = await asyncio.gather(*(c.connect(args.timeout) for c in clients), return_exceptions=True)
+    connected = [c for c, r in zip(clients, results) if not isinstance(r, Exception)]
+    failed_connects = clients_n - len(connected)
+
+    cpu_start = _cpu_seconds(pid)
+    start = time.perf_counter()
+    deadline = start + args.duration
+
+    async def client_loop(client):
+        while time.perf_counter() < deadline:
+            event = random.choices(events, weights)[0]
+            entry = stats[event]
+            sent = time.perf_counter()
+            try:
+                reply, data = await client.request(event, _payload(event, args.gen_steps, args.size, image),
+                                                   args.timeout)
+            except (asyncio.TimeoutError, ConnectionError):
+                entry['dropped'] += 1
+                return
+            if reply == 'error':
+                reason = REJECTIONS.get((data or {}).get('message'))
+                entry[reason or 'errors'] += 1
+                if reason:
+                    await asyncio.sleep(min(float((data or {}).get('retry_after', 1)), args.duration))
+                continue
+            entry['ok'] += 1
+            entry['latencies'].append(time.perf_counter() - sent)
+            if args.think_ms:
+                await asyncio.sleep(random.expovariate(1000 / args.think_ms))
+
+    await asyncio.gather(*(client_loop(c) for c in connected))
+    elapsed = time.perf_counter() - start
+    cpu = _cpu_seconds(pid) - cpu_start
+    await asyncio.gather(*(c.close() for c in clients), return_exceptions=True)
+
+    step = {
+        'clients': clients_n,
+        'failed_connects': failed_connects,
+        'duration_s': round(elapsed, 2),
+        'requests_per_s': round(sum(s['ok'] for s in stats.values()) / elapsed, 2),
+        'rejected': sum(s['busy'] + s['rate_limited'] for s in stats.values()),
+        'dropped': sum(s['dropped'] for s in stats.values()),
+        'server_cpu_percent': round(cpu / elapsed * 100, 1),
+        'server_rss_mb': _rss_mb(pid),
+        'events': {}
+    }
+    for event, s in stats.items():
+        latencies = s.pop('latencies')
+        step['events'][event] = dict(
+            s,
+            per_s=round(s['ok'] / elapsed, 2),
+            p50_ms=round(_percentile(latencies, 0.5) * 1000, 1) if latencies else None,
+            p95_ms=round(_percentile(latencies, 0.95) * 1000, 1) if latencies else None,
+            p99_ms=round(_percentile(latencies, 0.99) * 1000, 1) if latencies else None,
+        )
+    return step
+
+def _print_step(step: dict):
+    print(f"\n{step['clients']} clients: {step['requests_per_s']} req/s, rejected {step['rejected']}, "
+          f"dropped {step['dropped']}, failed connects {step['failed_connects']}, "
+          f"server CPU {step['server_cpu_percent']}%, RSS {step['server_rss_mb']} MB")
+    print(f"  {'event':<16} {'ok':>6} {'per s':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+          f"{'busy':>5} {'limited':>7} {'errors':>6} {'dropped':>7}")
+    for event, e in step['events'].items():
+        print(f"  {event:<16} {e['ok']:>6} {e['per_s']:>7} {e['p50_ms'] or '-':>8} {e['p95_ms'] or '-':>8} "
+              f"{e['p99_ms'] or '-':>8} {e['busy']:>5} {e['rate_limited']:>7} {e['errors']:>6} {e['dropped']:>7}")
+
+async def run_load(port: int, pid: int, args, mix) -> list:
+    ws_url = f"ws://127.0.0.1:{port}/socket.io/?EIO=4&transport=websocket"
+    image = _small_png()
+    results = []
+    offset = 0
+    for clients_n in args.concurrency:
+        step = await run_step(ws_url, pid, clients_n, args, mix, image, offset)
+        # Fresh addresses per step: rate-limit buckets do not carry over
+        offset += clients_n
+        _print_step(step)
+        results.append(step)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Socket.IO load test with a stub pipeline')
+    parser.add_argument('--mode', default='asgi', choices=['asgi', 'threading'])
+    parser.add_argument('--port', type=int, default=5056)
+    parser.add_argument('--concurrency', default='1,4,16,64', help='Comma-separated client counts')
+    parser.add_argument('--duration', type=float, default=20.0, help='Seconds per concurrency step')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='event=weight,...')
+    parser.add_argument('--think-ms', type=float, default=0, help='Mean pause between requests of a client')
+    parser.add_argument('--timeout', type=float, default=60.0, help='Reply timeout; later replies count as dropped')
+    parser.add_argument('--step-ms', type=float, default=50, help='Stub latency per denoising step')
+    parser.add_argument('--gen-steps', type=int, default=20, help='Steps per generate request')
+    parser.add_argument('--size', type=int, default=512, help='Requested image size')
+    parser.add_argument('--image-size', type=int, default=0, help='Stub output size (default: requested size)')
+    parser.add_argument('--rate-limit', default='per-client', choices=['per-client', 'off'])
+    parser.add_argument('--output', default=None, help='Write results JSON here')
+    args = parser.parse_args()
+
+    args.concurrency = sorted(int(c) for c in args.concurrency.split(','))
+    mix = []
+    for item in args.mix.split(','):
+        event, _, weight = item.partition('=')
+        if event not in REPLIES:
+            parser.error(f"Unknown event in --mix: {event} (known: {', '.join(REPLIES)})")
+        mix.append((event, float(weight or 1)))
+
+    workdir = tempfile.mkdtemp(prefix='sd_load_')
+    env = dict(os.environ, SERVER_MODE=args.mode, PORT=str(args.port), DEVICE='cpu', PRELOAD_MODELS='',
+               LOG_LEVEL='warning', PYTHONPATH=str(REPO_ROOT), STUB_STEP_MS=str(args.step_ms),
+               STUB_IMAGE_SIZE=str(args.image_size), RATE_LIMIT_TRUST_PROXY='true',
+               RATE_LIMIT_ENABLED='false' if args.rate_limit == 'off' else 'true')
+    process = subprocess.Popen([sys.executable, str(Path(__file__).resolve().parent / 'stub_pipeline.py')],
+                               cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        _wait_ready(args.port, process)
+        results = asyncio.run(run_load(args.port, process.pid, args, mix))
+    finally:
+        process.send_signal(signal.SIGINT)
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+    report = {'mode': args.mode, 'step_ms': args.step_ms, 'gen_steps': args.gen_steps, 'size': args.size,
+              'mix': dict(mix), 'steps': results}
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,113 @@
+"""
+Model load / unload cycles: memory growth and leak check
+
+Loads the tiny random-weight pipeline (or --model), runs one job of every
+task on it (txt2img on the base pipeline; img2img, inpaint and ControlNet
+on the per-job variants), unloads it, and repeats. After each cycle it
+records process RSS and asks the memory tracker whether anything survived:
+a pipeline still registered, a variant alive after its job, or memory not
+given back on unload.
+
+The run fails (exit code 1) when the tracker reports a leak or RSS grew by
+more than --max-growth-mb between the end of the warm-up cycles and the
+last cycle; allocator caches and lazily imported modules settle during
+warm-up.
+
+Usage:
+    python benchmarks/bench_memory.py [--cycles 10] [--warmup 2] [--max-growth-mb 32] [--output results.json]
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from bench_generation import REPO_ROOT, _inputs
+
+TASKS = ('txt2img', 'img2img', 'inpaint', 'controlnet')
+
+def run_cycles(model: str, controlnet: str, cycles: int, size: int, steps: int) -> list:
+    os.environ['DEVICE'] = 'cpu'
+    os.environ.setdefault('ENABLE_TORCH_COMPILE', 'false')
+    os.environ.setdefault('PRELOAD_MODELS', '')
+    sys.path.insert(0, str(REPO_ROOT))
+    import colab_server
+    from memory_tracker import memory_tracker, memory_snapshot
+
+    for controlnet_type in colab_server.CONTROLNET_MODELS:
+        colab_server.CONTROLNET_MODELS[controlnet_type] = controlnet
+    manager = colab_server.sd_manager
+    loop = asyncio.new_event_loop()
+    inputs = _inputs(size)
+
+    results = []
+    for cycle in range(cycles):
+        start = time.perf_counter()
+        for task in TASKS:
+            params = {'task': task, 'prompt': 'a lighthouse at dusk', 'model': model, 'width': size,
+                      'height': size, 'steps': steps, 'seed': cycle, 'strength': 1.0,
+                      'controlnet_type': 'canny', **inputs}
+            loop.run_until_complete(manager.generate(params))
+        loaded = memory_tracker.status()['tracked_bytes']
+        loop.run_until_complete(manager.unload_model(model))
+        leaks = memory_tracker.check(grace=0)
+        status = memory_tracker.status()
+        results.append({
+            'cycle': cycle,
+            'seconds': round(time.perf_counter() - start, 2),
+            'rss_mb': round(memory_snapshot()['rss'] / 1024 ** 2, 1),
+            'tracked_loaded_mb': round(loaded / 1024 ** 2, 2),
+            'pipelines_after_unload': status['pipelines'],
+            'leaks': status['leaks'],
+            'new_leaks': [leak['reason'] for leak in leaks]
+        })
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Model load / unload memory cycles')
+    parser.add_argument('--cycles', type=int, default=10)
+    parser.add_argument('--warmup', type=int, default=2, help='Cycles excluded from the growth check')
+    parser.add_argument('--max-growth-mb', type=float, default=32.0)
+    parser.add_argument('--size', type=int, default=64)
+    parser.add_argument('--steps', type=int, default=2)
+    parser.add_argument('--model', default=None, help='Model path (default: tiny random pipeline)')
+    parser.add_argument('--output', default=None, help='Write results JSON here')
+    args = parser.parse_args()
+    if args.cycles <= args.warmup:
+        parser.error('--cycles must be larger than --warmup')
+
+    from tiny_pipeline import build_tiny_pipeline, build_tiny_controlnet
+    os.environ['HF_HUB_OFFLINE'] = '1'
+    model = args.model or build_tiny_pipeline()
+    results = run_cycles(model, build_tiny_controlnet(), args.cycles, args.size, args.steps)
+
+    print(f"{'cycle':>5} {'s':>6} {'RSS MB':>8} {'loaded MB':>10} {'left':>5} {'leaks':>5}")
+    for r in results:
+        print(f"{r['cycle']:>5} {r['seconds']:>6} {r['rss_mb']:>8} {r['tracked_loaded_mb']:>10} "
+              f"{r['pipelines_after_unload']:>5} {r['leaks']:>5}  {', '.join(r['new_leaks'])}")
+
+    # RSS at the end of the last warm-up cycle (or of the first cycle) is the reference
+    growth = results[-1]['rss_mb'] - results[max(args.warmup, 1) - 1]['rss_mb']
+    failures = []
+    if results[-1]['leaks']:
+        failures.append(f"{results[-1]['leaks']} leak(s) reported")
+    if results[-1]['pipelines_after_unload']:
+        failures.append(f"{results[-1]['pipelines_after_unload']} pipeline(s) alive after unload")
+    if growth > args.max_growth_mb:
+        failures.append(f"RSS grew {growth:.1f} MB after warm-up (limit {args.max_growth_mb} MB)")
+    print(f"RSS growth after warm-up: {growth:.1f} MB over {args.cycles - max(args.warmup, 1)} cycles")
+    for failure in failures:
+        print(f"FAIL {failure}")
+
+    if args.output:
+        Path(args.output).write_text(json.dumps({'cycles': results, 'rss_growth_mb': round(growth, 1),
+                                                 'failures': failures}, indent=2))
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
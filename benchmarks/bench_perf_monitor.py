@@ -0,0 +1,111 @@
+"""
+PerformanceMonitor record cost and quantile accuracy
+
+Records N synthetic generation durations (log-normal, spread over a few
+task / model / resolution series) and reports the cost per record, the size
+of the monitor's state (which must stay flat as samples grow) and p50 / p95 /
+p99 against exact quantiles. The old list-based monitor is timed on a small
+sample for comparison: its record was O(n), so it cannot run at 10M.
+
+Usage:
+    python benchmarks/bench_perf_monitor.py [--samples 10000000] [--output results.json]
+"""
+
+import sys
+import json
+import time
+import random
+import argparse
+from array import array
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from utils import PerformanceMonitor
+
+SERIES = [('txt2img', 'sd15', '512x512'), ('txt2img', 'sdxl', '1024x1024'),
+          ('img2img', 'sd15', '512x512'), ('inpaint', 'sd15', '768x768')]
+
+class ListMonitor:
+    """The previous PerformanceMonitor.record_generation, for comparison"""
+
+    def __init__(self):
+        self.generation_time = []
+        self.average_time = 0
+
+    def record_generation(self, duration, success=True):
+        self.generation_time.append(duration)
+        self.average_time = sum(self.generation_time) / len(self.generation_time)
+
+def _durations(n: int, seed: int = 0) -> array:
+    rng = random.Random(seed)
+    return array('d', (rng.lognormvariate(1.5, 0.5) for _ in range(n)))
+
+def bench_record(samples: int, chunk: int = 1_000_000) -> dict:
+    monitor = PerformanceMonitor()
+    exact = array('d')
+    sizes = []  # serialized monitor size after each chunk: flat if memory is constant
+    elapsed = 0.0
+    done = 0
+    while done < samples:
+        n = min(chunk, samples - done)
+        durations = _durations(n, seed=done)
+        labels = [SERIES[i % len(SERIES)] for i in range(n)]
+        exact.extend(durations)
+        record = monitor.record_generation
+        start = time.perf_counter()
+        for duration, (task, model, resolution) in zip(durations, labels):
+            record(duration, True, task, model, resolution)
+        elapsed += time.perf_counter() - start
+        done += n
+        sizes.append(len(json.dumps(monitor.snapshot())))
+
+    report = monitor.get_report()
+    exact = sorted(exact)
+    errors = {}
+    for name, q in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99)):
+        true = exact[int(q * (len(exact) - 1))]
+        errors[name] = {'sketch': report[name], 'exact': round(true, 3),
+                        'relative_error': round(abs(report[name] - true) / true, 5)}
+
+    return {
+        'samples': samples,
+        'series': len(monitor.series),
+        'ns_per_record': round(elapsed / samples * 1e9, 1),
+        'records_per_s': round(samples / elapsed),
+        'snapshot_kb_first_chunk': round(sizes[0] / 1024, 1),
+        'snapshot_kb': round(sizes[-1] / 1024, 1),
+        'quantiles': errors,
+    }
+
+def bench_list(samples: int) -> dict:
+    monitor = ListMonitor()
+    durations = _durations(samples)
+    start = time.perf_counter()
+    for duration in durations:
+        monitor.record_generation(duration)
+    elapsed = time.perf_counter() - start
+    return {'samples': samples, 'ns_per_record': round(elapsed / samples * 1e9, 1)}
+
+def main():
+    parser = argparse.ArgumentParser(description='PerformanceMonitor micro-benchmark')
+    parser.add_argument('--samples', type=int, default=10_000_000)
+    parser.add_argument('--list-samples', type=int, default=20_000, help='Samples for the old list-based monitor')
+    parser.add_argument('--output', default=None, help='Write results JSON here')
+    args = parser.parse_args()
+
+    results = {'streaming': bench_record(args.samples), 'list': bench_list(args.list_samples)}
+    streaming = results['streaming']
+    print(f"Streaming monitor: {streaming['samples']:,} samples in {streaming['series']} series")
+    print(f"  {streaming['ns_per_record']} ns/record ({streaming['records_per_s']:,}/s), "
+          f"state {streaming['snapshot_kb']} KB (after the first chunk: {streaming['snapshot_kb_first_chunk']} KB)")
+    for name, q in streaming['quantiles'].items():
+        print(f"  {name}: {q['sketch']} (exact {q['exact']}, error {q['relative_error'] * 100:.2f}%)")
+    print(f"List monitor: {results['list']['ns_per_record']} ns/record at {results['list']['samples']:,} samples")
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
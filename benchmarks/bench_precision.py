@@ -0,0 +1,106 @@
+"""
+Latency and memory per precision mode on CPU
+
+Each mode runs in its own subprocess so peak RSS is not shared between modes.
+Uses a tiny random-weight pipeline by default; pass --model to benchmark a
+real checkpoint.
+
+Usage:
+    python benchmarks/bench_precision.py [--modes fp32,bf16,int8] [--size 256] [--steps 10]
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import resource
+import subprocess
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+def _peak_rss_mb() -> float:
+    """Peak resident set size of this process"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def run_mode(model: str, mode: str, size: int, steps: int, runs: int) -> dict:
+    """Load the model in one precision mode and time txt2img generations"""
+    sys.path.insert(0, str(REPO_ROOT))
+    os.environ['DEVICE'] = 'cpu'
+    import colab_server
+
+    rss_before = _peak_rss_mb()
+    load_start = time.perf_counter()
+    loop = asyncio.new_event_loop()
+    if not loop.run_until_complete(colab_server.sd_manager.load_model(model, precision_mode=mode)):
+        raise RuntimeError(f"Could not load {model} in {mode}")
+    load_s = time.perf_counter() - load_start
+
+    params = {'task': 'txt2img', 'prompt': 'a lighthouse at dusk', 'model': model,
+              'precision': mode, 'width': size, 'height': size, 'steps': steps, 'seed': 0}
+    # First run includes one-off kernel selection
+    loop.run_until_complete(colab_server.sd_manager.generate(params))
+
+    latencies = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        loop.run_until_complete(colab_server.sd_manager.generate(params))
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+
+    report = colab_server.sd_manager.memory_reports[model]
+    return {
+        'mode': report['precision'],
+        'load_s': round(load_s, 3),
+        'latency_median_s': round(latencies[len(latencies) // 2], 4),
+        'latency_min_s': round(latencies[0], 4),
+        'step_ms': round(latencies[len(latencies) // 2] / steps * 1000, 2),
+        'weights_mb': round(report['memory_bytes'] / 2**20, 2),
+        'saved_percent': report['saved_percent'],
+        'peak_rss_mb': round(_peak_rss_mb(), 1),
+        'rss_growth_mb': round(_peak_rss_mb() - rss_before, 1),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Precision mode benchmark (CPU)')
+    parser.add_argument('--model', default=None, help='Model id or path (default: tiny random pipeline)')
+    parser.add_argument('--modes', default='fp32,bf16,int8')
+    parser.add_argument('--size', type=int, default=256)
+    parser.add_argument('--steps', type=int, default=10)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--output', default=None, help='Write results JSON here')
+    parser.add_argument('--child', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_mode(args.model, args.child, args.size, args.steps, args.runs)))
+        return 0
+
+    if args.model is None:
+        sys.path.insert(0, str(Path(__file__).resolve().parent))
+        from tiny_pipeline import build_tiny_pipeline
+        args.model = build_tiny_pipeline()
+
+    results = []
+    for mode in args.modes.split(','):
+        cmd = [sys.executable, __file__, '--child', mode, '--model', args.model,
+               '--size', str(args.size), '--steps', str(args.steps), '--runs', str(args.runs)]
+        proc = subprocess.run(cmd, capture_output=True, text=True)
+        if proc.returncode != 0:
+            print(f"{mode}: failed\n{proc.stderr[-1500:]}")
+            continue
+        results.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+
+    print(f"{'mode':<6} {'median s':>9} {'step ms':>8} {'weights MB':>11} {'saved %':>8} {'peak RSS MB':>12}")
+    for r in results:
+        print(f"{r['mode']:<6} {r['latency_median_s']:>9} {r['step_ms']:>8} {r['weights_mb']:>11} "
+              f"{r['saved_percent']:>8} {r['peak_rss_mb']:>12}")
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,86 @@
+"""
+Sampling profiler overhead
+
+Times a CPU-bound pure-Python workload (the worst case: every sample takes
+the GIL from it) on one thread while a few idle threads sit in waits, as the
+server's heartbeat / fan-out / puller threads do, first without and then with
+a profiling session at each interval. Reports the slowdown, the overhead the
+session measured itself, the interval it settled on and the samples taken.
+
+Usage:
+    python benchmarks/bench_profiler.py [--seconds 3] [--intervals 1,5,10] [--output results.json]
+"""
+
+import sys
+import json
+import time
+import argparse
+import threading
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import profiler
+
+def _work(n: int) -> float:
+    total = 0.0
+    for i in range(n):
+        total += (i % 7) * 0.5
+    return total
+
+def _timed(rounds: int, n: int) -> float:
+    """Best of `rounds` runs of the workload"""
+    best = float('inf')
+    for _ in range(rounds):
+        start = time.perf_counter()
+        _work(n)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description='Sampling profiler overhead benchmark')
+    parser.add_argument('--seconds', type=float, default=3.0, help='Approximate length of one timed run')
+    parser.add_argument('--intervals', default='1,5,10', help='Requested sampling intervals (ms)')
+    parser.add_argument('--idle-threads', type=int, default=8)
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--output', default=None, help='Write results JSON here')
+    args = parser.parse_args()
+
+    stop = threading.Event()
+    for i in range(args.idle_threads):
+        threading.Thread(target=stop.wait, name=f'idle-{i}', daemon=True).start()
+
+    # Size the workload to about --seconds
+    start = time.perf_counter()
+    _work(1_000_000)
+    n = int(1_000_000 * args.seconds / (time.perf_counter() - start))
+
+    baseline = _timed(args.rounds, n)
+    print(f"Baseline: {baseline:.3f} s ({args.idle_threads} idle threads)")
+    results = {'baseline_s': round(baseline, 4), 'idle_threads': args.idle_threads, 'intervals': []}
+    for interval_ms in (float(i) for i in args.intervals.split(',')):
+        session = profiler.profiler.start(seconds=profiler.MAX_SECONDS, interval=interval_ms / 1000)
+        profiled = _timed(args.rounds, n)
+        session.stop()
+        status = session.status()
+        result = {
+            'interval_ms': interval_ms,
+            'settled_interval_ms': status['interval_ms'],
+            'profiled_s': round(profiled, 4),
+            'slowdown_percent': round((profiled / baseline - 1) * 100, 2),
+            'measured_overhead_percent': status['overhead_percent'],
+            'samples': status['samples'],
+            'stacks': status['stacks'],
+        }
+        results['intervals'].append(result)
+        print(f"  {interval_ms:>5} ms -> {result['settled_interval_ms']:>6} ms: {profiled:.3f} s, "
+              f"slowdown {result['slowdown_percent']}%, measured {result['measured_overhead_percent']}%, "
+              f"{result['samples']} samples")
+    stop.set()
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,132 @@
+"""
+Sampler quality versus steps (offline, CPU)
+
+Runs txt2img through StableDiffusionManager.generate with every sampler at
+several step counts, same prompt and seed, and compares each image with a
+reference rendered by --reference-sampler at --reference-steps. The table
+has seconds per image and PSNR against the reference (higher is closer to
+the converged image; inf means identical), so it shows how many steps each
+sampler needs to get within a given distance of convergence. It also times
+swapping a scheduler onto the loaded pipeline, first build and cached.
+
+By default the tiny random-weight pipeline (benchmarks/tiny_pipeline.py) is
+used: the numbers then measure how fast each scheduler converges, not image
+quality, and the LCM rows run without the LCM-LoRA. With --model pointing at
+a real SD 1.5 / SDXL checkpoint, the LCM rows use the LCM-LoRA (or an LCM
+distilled model) as in production. Samplers the installed diffusers cannot
+run (e.g. LCM before 0.22) are skipped.
+
+Usage:
+    python benchmarks/bench_samplers.py [--samplers euler,euler_a,dpmpp_2m_karras,unipc,lcm]
+                                        [--steps 2,4,8,15,25] [--size 64] [--model PATH] [--output results.json]
+"""
+
+import os
+import sys
+import json
+import time
+import math
+import asyncio
+import argparse
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from bench_generation import REPO_ROOT
+
+DEFAULT_SAMPLERS = 'euler,euler_a,heun,dpmpp_2m,dpmpp_2m_karras,dpmpp_2m_sde,unipc,ddim,lcm'
+
+def psnr(image, reference) -> float:
+    """Peak signal-to-noise ratio of two RGB images in dB"""
+    import numpy as np
+
+    a = np.asarray(image, dtype=np.float64)
+    b = np.asarray(reference, dtype=np.float64)
+    mse = float(((a - b) ** 2).mean())
+    return math.inf if mse == 0 else 10 * math.log10(255 ** 2 / mse)
+
+def main():
+    parser = argparse.ArgumentParser(description='Sampler quality versus steps')
+    parser.add_argument('--samplers', default=DEFAULT_SAMPLERS, help='Comma-separated sampler names')
+    parser.add_argument('--steps', default='2,4,8,15,25', help='Comma-separated step counts')
+    parser.add_argument('--reference-sampler', default='dpmpp_2m')
+    parser.add_argument('--reference-steps', type=int, default=100)
+    parser.add_argument('--size', type=int, default=64)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--model', default=None, help='Model path (default: tiny random pipeline)')
+    parser.add_argument('--output', default=None, help='Write results JSON here')
+    args = parser.parse_args()
+
+    os.environ['DEVICE'] = 'cpu'
+    os.environ['HF_HUB_OFFLINE'] = '1'
+    os.environ.setdefault('ENABLE_TORCH_COMPILE', 'false')
+    os.environ.setdefault('PRELOAD_MODELS', '')
+    if args.model is None:
+        # Random weights: there is no LCM-LoRA to match them
+        os.environ['LCM_LORA_SD15'] = ''
+    from tiny_pipeline import build_tiny_pipeline
+    model = args.model or build_tiny_pipeline()
+
+    sys.path.insert(0, str(REPO_ROOT))
+    import colab_server
+
+    manager = colab_server.sd_manager
+    loop = asyncio.new_event_loop()
+
+    def render(sampler: str, steps: int):
+        params = {'task': 'txt2img', 'prompt': 'a lighthouse on a cliff at dusk', 'model': model,
+                  'width': args.size, 'height': args.size, 'steps': steps, 'seed': args.seed,
+                  'cfg_scale': 7.5, 'sampler': sampler}
+        start = time.perf_counter()
+        images = loop.run_until_complete(manager.generate(params))
+        return images[0], time.perf_counter() - start
+
+    # Load the model and warm up before anything is timed
+    render('euler', 2)
+    reference, _ = render(args.reference_sampler, args.reference_steps)
+
+    pipeline = manager.pipelines[model]
+    swaps = {}
+    for sampler in ('unipc', 'euler'):
+        start = time.perf_counter()
+        manager.schedulers.apply(pipeline, model, sampler)
+        swaps[sampler] = time.perf_counter() - start
+    start = time.perf_counter()
+    manager.schedulers.apply(pipeline, model, 'unipc')
+    cached_swap = time.perf_counter() - start
+
+    rows = []
+    steps_list = [int(s) for s in args.steps.split(',')]
+    for sampler in args.samplers.split(','):
+        for steps in steps_list:
+            try:
+                image, seconds = render(sampler, steps)
+            except ValueError as e:
+                # Not supported by the installed diffusers: skip the sampler
+                print(f"skip {sampler}: {e}")
+                break
+            rows.append({'sampler': sampler, 'steps': steps, 'seconds': round(seconds, 3),
+                         'psnr_db': round(psnr(image, reference), 2)})
+
+    print(f"Reference: {args.reference_sampler} at {args.reference_steps} steps, "
+          f"{args.size}x{args.size}, {'tiny random pipeline' if args.model is None else model}")
+    print(f"Scheduler swap: first build {max(swaps.values()) * 1000:.2f} ms, cached {cached_swap * 1000:.3f} ms")
+    print(f"{'sampler':<18} " + ' '.join(f"{s:>13}" for s in steps_list))
+    print(f"{'':<18} " + ' '.join(f"{'s / PSNR dB':>13}" for _ in steps_list))
+    for sampler in dict.fromkeys(r['sampler'] for r in rows):
+        cells = {r['steps']: r for r in rows if r['sampler'] == sampler}
+        print(f"{sampler:<18} " + ' '.join(
+            f"{cells[s]['seconds']:>6.2f}/{cells[s]['psnr_db']:>6}" if s in cells else f"{'-':>13}"
+            for s in steps_list))
+
+    if args.output:
+        Path(args.output).write_text(json.dumps({
+            'reference': {'sampler': args.reference_sampler, 'steps': args.reference_steps},
+            'size': args.size, 'model': args.model or 'tiny',
+            'swap_ms': {'first': round(max(swaps.values()) * 1000, 3), 'cached': round(cached_swap * 1000, 4)},
+            'results': rows
+        }, indent=2))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,142 @@
+"""
+Scheduling policy benchmark: FIFO vs shortest-job-first on a mixed burst
+
+Each policy runs in its own process (SCHEDULING_POLICY is read when the
+broker is created) on the real job runner with the stub pipeline
+(benchmarks/stub_pipeline.py) in place of inference. The cost model is first
+trained on a few jobs of every size, then a burst of short and long jobs is
+submitted at once in a fixed shuffled order. Reports mean / p95 latency
+(submit to 'complete') per job class and overall, and the median relative
+error of the ETAs the jobs were given at submit.
+
+Usage:
+    python benchmarks/bench_scheduling.py [--jobs 40] [--long-share 0.25] [--step-ms 10] [--output results.json]
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+import subprocess
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from stub_pipeline import REPO_ROOT, install
+
+POLICIES = ('fifo', 'sjf')
+CLASSES = {'short': 4, 'medium': 15, 'long': 50}  # job class -> denoising steps
+MODEL = 'bench-model'
+
+def _percentile(values, q: float) -> float:
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+def _run_jobs(runner, specs, submitted: dict) -> dict:
+    """Submit all specs at once; wait for every job; returns job id -> finish time"""
+    finished = {}
+    done = threading.Event()
+
+    def listener_for(job_id):
+        def listener(event, data):
+            if event in ('complete', 'error'):
+                finished[job_id] = time.perf_counter()
+                if len(finished) == len(specs):
+                    done.set()
+        return listener
+
+    for job_id, params in specs:
+        submitted[job_id] = time.perf_counter()
+        job = runner.submit({'id': job_id, 'params': params, 'sid': None}, listener=listener_for(job_id))
+        if job['status'] == 'rejected':
+            raise RuntimeError(f"Job {job_id} rejected; raise MAX_QUEUE_SIZE")
+    done.wait()
+    return finished
+
+def run_policy(args) -> dict:
+    """Child process: train the cost model, run the burst, print results as JSON"""
+    sys.path.insert(0, str(REPO_ROOT))
+    import colab_server
+
+    install(colab_server.sd_manager, args.step_ms / 1000, image_size=64)
+    runner = colab_server.job_runner
+
+    def params(steps: int, index: int) -> dict:
+        return {'task': 'txt2img', 'prompt': f'job {index}', 'model': MODEL, 'steps': steps,
+                'width': 512, 'height': 512, 'seed': -1}
+
+    # Training: a few sequential jobs of every class (the first one loads the model)
+    warmup = [(f'warm-{c}-{i}', params(steps, i)) for i in range(args.warmup) for c, steps in CLASSES.items()]
+    for spec in warmup:
+        _run_jobs(runner, [spec], {})
+
+    rng = random.Random(args.seed)
+    classes = ['long' if rng.random() < args.long_share else rng.choice(['short', 'medium'])
+               for _ in range(args.jobs)]
+    specs = [(f'{c}-{i}', params(CLASSES[c], i)) for i, c in enumerate(classes)]
+    predicted = {}
+    submitted = {}
+    finished = _run_jobs(runner, specs, submitted)
+    for job_id, _ in specs:
+        predicted[job_id] = runner.records[job_id].get('eta_seconds')
+
+    latencies = {job_id: finished[job_id] - submitted[job_id] for job_id, _ in specs}
+    result = {'policy': os.environ['SCHEDULING_POLICY'], 'classes': {}}
+    for name in CLASSES:
+        values = [latencies[j] for j, _ in specs if j.startswith(name + '-')]
+        if values:
+            result['classes'][name] = {'jobs': len(values), 'mean_s': round(sum(values) / len(values), 3),
+                                       'p95_s': round(_percentile(values, 0.95), 3)}
+    values = list(latencies.values())
+    result['all'] = {'jobs': len(values), 'mean_s': round(sum(values) / len(values), 3),
+                     'p95_s': round(_percentile(values, 0.95), 3), 'makespan_s': round(max(values), 3)}
+    errors = sorted(abs(predicted[j] - latencies[j]) / latencies[j] for j in latencies if predicted[j])
+    result['eta_median_relative_error'] = round(errors[len(errors) // 2], 3) if errors else None
+    result['cost_model'] = {k: v for k, v in colab_server.cost_model.status().items() if k != 'fits'}
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description='FIFO vs shortest-job-first scheduling benchmark')
+    parser.add_argument('--jobs', type=int, default=40, help='Jobs in the burst')
+    parser.add_argument('--long-share', type=float, default=0.25, help='Share of long jobs in the burst')
+    parser.add_argument('--warmup', type=int, default=3, help='Training jobs per class')
+    parser.add_argument('--step-ms', type=float, default=10.0, help='Stub latency per denoising step')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--policy', choices=POLICIES, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--output', default=None, help='Write results JSON here')
+    args = parser.parse_args()
+
+    if args.policy:
+        print(json.dumps(run_policy(args)))
+        return 0
+
+    results = []
+    for policy in POLICIES:
+        with tempfile.TemporaryDirectory() as workdir:
+            env = dict(os.environ, SCHEDULING_POLICY=policy, DEVICE='cpu', PRELOAD_MODELS='',
+                       INFERENCE_WORKERS='0', JOB_BROKER='memory', RESULT_CACHE_ENABLED='false',
+                       MAX_QUEUE_SIZE=str(args.jobs + 10), COST_MODEL_PATH=str(Path(workdir) / 'cost_model.json'),
+                       LOG_LEVEL='WARNING')
+            command = [sys.executable, str(Path(__file__).resolve()), '--policy', policy]
+            for flag in ('jobs', 'long_share', 'warmup', 'step_ms', 'seed'):
+                command += [f"--{flag.replace('_', '-')}", str(getattr(args, flag))]
+            output = subprocess.run(command, cwd=workdir, env=env, check=True, capture_output=True, text=True).stdout
+            results.append(json.loads(output.strip().splitlines()[-1]))
+
+    print(f"{args.jobs} jobs, {args.long_share:.0%} long, {args.step_ms} ms/step")
+    print(f"{'policy':<6} {'class':<7} {'jobs':>5} {'mean s':>8} {'p95 s':>8}")
+    for result in results:
+        for name, stats in list(result['classes'].items()) + [('all', result['all'])]:
+            print(f"{result['policy']:<6} {name:<7} {stats['jobs']:>5} {stats['mean_s']:>8} {stats['p95_s']:>8}")
+        print(f"{result['policy']:<6} ETA median relative error: {result['eta_median_relative_error']}")
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
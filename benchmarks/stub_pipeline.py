@@ -0,0 +1,100 @@
+"""
+Stub inference backend for load tests
+
+StubPipeline replaces StableDiffusionManager.generate: each denoising step
+blocks the calling thread for STUB_STEP_MS (like a real pipeline holds the
+executor), step callbacks fire as usual, and the result is noise images of
+STUB_IMAGE_SIZE (or the requested size), so PNG encoding, saving and the
+'complete' payload cost what they would in production. Everything else -
+job runner, broker, result cache, rate limiter, event bus - is the real
+server.
+
+Run it directly to serve colab_server with the stub installed:
+
+    STUB_STEP_MS=50 STUB_IMAGE_SIZE=512 python benchmarks/stub_pipeline.py
+"""
+
+import os
+import sys
+import time
+import asyncio
+import logging
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+from PIL import Image
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+class StubPipeline:
+    """Fake generate(): fixed per-step latency, noise images"""
+
+    def __init__(self, step_latency: float = 0.05, image_size: Optional[int] = None, load_latency: float = 0.0):
+        self.step_latency = step_latency
+        self.image_size = image_size
+        self.load_latency = load_latency
+        self.loaded = set()
+        self.pipelines = {}  # the manager's loaded pipelines, so the server sees models as loaded
+        self.calls = 0
+        self._images = {}
+
+    def _image(self, width: int, height: int) -> Image.Image:
+        # Noise does not compress: PNG encode is the worst case, as for detailed images
+        image = self._images.get((width, height))
+        if image is None:
+            image = self._images[(width, height)] = Image.merge(
+                'RGB', [Image.effect_noise((width, height), 64) for _ in range(3)])
+        return image
+
+    async def generate(self, params: Dict, step_callback: Optional[Callable] = None,
+                       cell_callback: Optional[Callable] = None) -> List[Image.Image]:
+        self.calls += 1
+        model = params.get('model', 'stub')
+        if model not in self.loaded:
+            time.sleep(self.load_latency)
+            self.loaded.add(model)
+            self.pipelines[model] = self
+        steps = int(params.get('steps', 20))
+        for step in range(steps):
+            time.sleep(self.step_latency)
+            if step_callback is not None:
+                step_callback(step + 1, steps)
+        width = self.image_size or int(params.get('width', 512))
+        height = self.image_size or int(params.get('height', 512))
+        return [self._image(width, height) for _ in range(int(params.get('num_images', 1)))]
+
+def install(manager, step_latency: float = 0.05, image_size: Optional[int] = None,
+            load_latency: float = 0.0) -> StubPipeline:
+    """Replace manager.generate with a StubPipeline"""
+    stub = StubPipeline(step_latency, image_size, load_latency)
+    stub.pipelines = manager.pipelines
+    manager.generate = stub.generate
+    return stub
+
+def main():
+    sys.path.insert(0, str(REPO_ROOT))
+    os.environ.setdefault('PRELOAD_MODELS', '')
+    os.environ.setdefault('DEVICE', 'cpu')
+    import colab_server
+
+    image_size = int(os.environ.get('STUB_IMAGE_SIZE', 0)) or None
+    install(colab_server.sd_manager, float(os.environ.get('STUB_STEP_MS', 50)) / 1000, image_size,
+            float(os.environ.get('STUB_LOAD_MS', 0)) / 1000)
+
+    port = int(os.environ.get('PORT', 5000))
+    if os.environ.get('SERVER_MODE', 'asgi').lower() == 'asgi':
+        import asgi_server
+        asgi_server.run(port=port)
+        return 0
+
+    Path('./outputs').mkdir(exist_ok=True)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(colab_server.initialize_server())
+    logging.getLogger(__name__).info(f"Starting stub server on port {port}")
+    colab_server.socketio.run(colab_server.app, host='0.0.0.0', port=port, debug=False,
+                              allow_unsafe_werkzeug=True)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
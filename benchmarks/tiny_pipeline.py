@@ -0,0 +1,136 @@
+"""
+Tiny random-weight Stable Diffusion pipelines for offline CPU benchmarks
+
+The pipelines have the same structure as SD 1.5 (CLIP text encoder, UNet with
+cross-attention, KL VAE) but only a few thousand parameters per block, so they
+build in seconds without network access. build_tiny_controlnet() adds a
+ControlNet of the same shape. They are saved with save_pretrained() and
+loaded back through StableDiffusionManager like any local model.
+"""
+
+import json
+import tempfile
+from pathlib import Path
+
+DEFAULT_CACHE_DIR = Path(tempfile.gettempdir()) / 'sd_tiny_pipelines'
+
+def _bytes_to_unicode():
+    """Byte-to-unicode table used by CLIP's byte-level BPE"""
+    bs = list(range(ord('!'), ord('~') + 1)) + list(range(ord('¡'), ord('¬') + 1)) + list(range(ord('®'), ord('ÿ') + 1))
+    cs = bs[:]
+    n = 0
+    for b in range(256):
+        if b not in bs:
+            bs.append(b)
+            cs.append(256 + n)
+            n += 1
+    return [chr(c) for c in cs]
+
+def build_tokenizer(path: Path):
+    """Write a character-level CLIP tokenizer (no merges) and load it"""
+    from transformers import CLIPTokenizer
+
+    chars = _bytes_to_unicode()
+    tokens = ['<|startoftext|>', '<|endoftext|>'] + chars + [c + '</w>' for c in chars]
+    (path / 'vocab.json').write_text(json.dumps({t: i for i, t in enumerate(tokens)}))
+    (path / 'merges.txt').write_text('#version: 0.2\n')
+    return CLIPTokenizer(
+        str(path / 'vocab.json'), str(path / 'merges.txt'),
+        bos_token='<|startoftext|>', eos_token='<|endoftext|>',
+        unk_token='<|endoftext|>', pad_token='<|endoftext|>',
+        model_max_length=77
+    )
+
+def _components(seed: int = 0, cross_attention_dim: int = 32):
+    """Random-weight UNet, VAE and text encoder"""
+    import torch
+    from diffusers import AutoencoderKL, DDIMScheduler, UNet2DConditionModel
+    from transformers import CLIPTextConfig, CLIPTextModel
+
+    torch.manual_seed(seed)
+    unet = UNet2DConditionModel(
+        block_out_channels=(32, 64),
+        layers_per_block=2,
+        sample_size=32,
+        in_channels=4,
+        out_channels=4,
+        down_block_types=('DownBlock2D', 'CrossAttnDownBlock2D'),
+        up_block_types=('CrossAttnUpBlock2D', 'UpBlock2D'),
+        cross_attention_dim=cross_attention_dim,
+    )
+    vae = AutoencoderKL(
+        block_out_channels=[32, 64],
+        in_channels=3,
+        out_channels=3,
+        down_block_types=['DownEncoderBlock2D', 'DownEncoderBlock2D'],
+        up_block_types=['UpDecoderBlock2D', 'UpDecoderBlock2D'],
+        latent_channels=4,
+    )
+    text_encoder = CLIPTextModel(CLIPTextConfig(
+        bos_token_id=0,
+        eos_token_id=1,
+        pad_token_id=1,
+        hidden_size=cross_attention_dim,
+        intermediate_size=37,
+        layer_norm_eps=1e-05,
+        num_attention_heads=4,
+        num_hidden_layers=5,
+        vocab_size=600,
+    ))
+    scheduler = DDIMScheduler(
+        beta_start=0.00085,
+        beta_end=0.012,
+        beta_schedule='scaled_linear',
+        clip_sample=False,
+        set_alpha_to_one=False,
+    )
+    return unet, vae, text_encoder, scheduler
+
+def build_tiny_pipeline(path=None, seed: int = 0, force: bool = False) -> str:
+    """Build and save a tiny SD 1.5-style pipeline, returning its directory"""
+    from diffusers import StableDiffusionPipeline
+
+    path = Path(path or DEFAULT_CACHE_DIR / f'tiny-sd-{seed}')
+    if (path / 'model_index.json').exists() and not force:
+        return str(path)
+
+    unet, vae, text_encoder, scheduler = _components(seed)
+    with tempfile.TemporaryDirectory() as tokenizer_dir:
+        tokenizer = build_tokenizer(Path(tokenizer_dir))
+        pipeline = StableDiffusionPipeline(
+            vae=vae,
+            text_encoder=text_encoder,
+            tokenizer=tokenizer,
+            unet=unet,
+            scheduler=scheduler,
+            safety_checker=None,
+            feature_extractor=None,
+            requires_safety_checker=False,
+        )
+        pipeline.save_pretrained(str(path), safe_serialization=True)
+    return str(path)
+
+def build_tiny_controlnet(path=None, seed: int = 0, force: bool = False) -> str:
+    """Build and save a tiny ControlNet matching build_tiny_pipeline()'s UNet, returning its directory"""
+    import torch
+    from diffusers import ControlNetModel
+
+    path = Path(path or DEFAULT_CACHE_DIR / f'tiny-controlnet-{seed}')
+    if (path / 'config.json').exists() and not force:
+        return str(path)
+
+    torch.manual_seed(seed)
+    controlnet = ControlNetModel(
+        block_out_channels=(32, 64),
+        layers_per_block=2,
+        in_channels=4,
+        down_block_types=('DownBlock2D', 'CrossAttnDownBlock2D'),
+        cross_attention_dim=32,
+        conditioning_embedding_out_channels=(16, 32),
+    )
+    controlnet.save_pretrained(str(path), safe_serialization=True)
+    return str(path)
+
+if __name__ == '__main__':
+    print(build_tiny_pipeline(force=True))
+    print(build_tiny_controlnet(force=True))
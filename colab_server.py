@@ -4,6 +4,7 @@ Stable Diffusion WebSocket Server for Google Colab
 """
 
 import os
+import sys
 import json
 import base64
 import asyncio
@@ -11,40 +12,61 @@ import threading
 import logging
 from datetime import datetime
 from pathlib import Path
-from typing import Dict, List, Optional, Any
+from typing import Dict, List, Optional, Any, Callable
 from functools import wraps
 import time
 import re
+import hmac
+import uuid
+import queue
+import importlib.util
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
-from flask import Flask, request, send_file, jsonify
-from flask_socketio import SocketIO, emit, join_room, leave_room
+from flask import Flask, Response, request, send_file, jsonify, stream_with_context
+from flask_socketio import SocketIO
 from flask_cors import CORS
 from PIL import Image
 import io
-import cv2
-import numpy as np
+
+import precision
+import samplers
+import metrics
+import tracing
+import profiler
+from memory_tracker import memory_tracker
+import structured_logging
+from utils import PerformanceMonitor
+from memory_policy import SAFETY_FACTOR, total_memory
+from cost_model import CostModel
+from job_broker import create_broker, default_node_id
+from socket_transport import ThreadingTransport
+from rate_limiter import create_rate_limiter, retry_after_header
+from result_cache import ResultCache, request_key
+from sweep import prepare_sweep, plan_sweep, sweep_summary
+from batch_jobs import BatchManager, parse_specs
+from job_journal import JobJournal
+from event_bus import EventBus, GALLERY_ROOM, job_room, batch_room, is_public_room
+from sd_pipeline import (DEFAULT_MODEL, state, validate_input, png_base64,
+                         sd_manager, start_model_preload)
+
+# Heavy dependencies (torch, diffusers, transformers, cv2, numpy, Google API client)
+# are imported inside the functions that use them, so importing this module and
+# answering /health stays fast. Only check here whether they are installed.
+def _module_available(name: str) -> bool:
+    """Check if a module can be imported without importing it"""
+    try:
+        return importlib.util.find_spec(name) is not None
+    except (ImportError, ValueError):
+        return False
 
 # Optional imports для Colab
-try:
-    from google.colab import auth
-    from google.auth.transport.requests import Request
-    from googleapiclient.discovery import build
-    from googleapiclient.http import MediaFileUpload, MediaIoBaseUpload
-    IN_COLAB = True
-except ImportError:
-    IN_COLAB = False
-
-try:
-    import torch
-    from diffusers import StableDiffusionPipeline, StableDiffusionXLPipeline
-    from diffusers import StableDiffusionImg2ImgPipeline, StableDiffusionInpaintPipeline
-    from transformers import CLIPTextModel, CLIPTokenizer
-    DIFFUSERS_AVAILABLE = True
-except ImportError:
-    DIFFUSERS_AVAILABLE = False
-
-# Setup logging
-logging.basicConfig(level=logging.INFO)
+IN_COLAB = _module_available('google.colab') and _module_available('googleapiclient')
+
+DIFFUSERS_AVAILABLE = _module_available('torch') and _module_available('diffusers')
+
+# Setup logging: records go through a queue to a background writer (structured_logging.py)
+structured_logging.configure_logging()
 logger = logging.getLogger(__name__)
 
 # Flask app initialization
@@ -53,70 +75,62 @@ CORS(app)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-key-change-in-production')
 socketio = SocketIO(app, cors_allowed_origins="*", ping_timeout=60, ping_interval=25)
 
-# Global state
-class ServerState:
-    def __init__(self):
-        self.models = {}
-        self.current_task = None
-        self.is_generating = False
-        self.queue = []
-        self.gdrive_service = None
-        self.gdrive_folder_id = None
-        self.gallery_history = []
-        self.rate_limit_store = {}
-        self.model_precision = "fp16"
-        self.device = "cuda" if torch.cuda.is_available() else "cpu"
-        
-    def clear(self):
-        self.models = {}
-        self.current_task = None
-        self.is_generating = False
-        self.queue = []
+# Socket event handlers take the client sid first and reply through the active
+# transport: Flask-SocketIO threading mode here, or the ASGI server (asgi_server.py)
+socket_handlers = {}
+
+def on_event(event: str):
+    """Register a socket event handler (sid, *args); events other than connect/disconnect are rate limited"""
+    def decorator(f):
+        socket_handlers[event] = f if event in ('connect', 'disconnect') else rate_limit(event)(f)
+        return f
+    return decorator
 
-state = ServerState()
+transport = ThreadingTransport(socketio)
+# Job, batch and gallery events; looks the transport up on every fan-out
+event_bus = EventBus(lambda: transport)
+
+# Token buckets per client for socket events and REST requests (rate_limiter.py)
+rate_limiter = create_rate_limiter()
 
 # ==================== UTILITY FUNCTIONS ====================
 
-def rate_limit(max_calls: int = 100, time_window: int = 60):
-    """Rate limiting decorator"""
+def rate_limit(action: str):
+    """Socket handler decorator: spend the client's tokens for `action` or reply with an error"""
     def decorator(f):
-        @wraps(f)
-        def decorated_function(*args, **kwargs):
-            client_id = request.sid if hasattr(request, 'sid') else 'default'
-            now = time.time()
-            
-            if client_id not in state.rate_limit_store:
-                state.rate_limit_store[client_id] = []
-            
-            # Remove old entries
-            state.rate_limit_store[client_id] = [
-                t for t in state.rate_limit_store[client_id] 
-                if now - t < time_window
-            ]
-            
-            if len(state.rate_limit_store[client_id]) >= max_calls:
-                return {'status': 'error', 'message': 'Rate limit exceeded'}, 429
-            
-            state.rate_limit_store[client_id].append(now)
-            return f(*args, **kwargs)
-        return decorated_function
+        def allowed(sid) -> bool:
+            ok, retry_after = rate_limiter.check(transport.environ(sid), action)
+            if not ok:
+                transport.emit('error', {'message': 'Rate limit exceeded',
+                                         'retry_after': round(retry_after, 1)}, to=sid)
+            return ok
+        
+        if asyncio.iscoroutinefunction(f):
+            @wraps(f)
+            async def limited(sid, *args):
+                if allowed(sid):
+                    return await f(sid, *args)
+        else:
+            @wraps(f)
+            def limited(sid, *args):
+                if allowed(sid):
+                    return f(sid, *args)
+        return limited
     return decorator
 
-def validate_input(data: Dict, required_fields: List[str]) -> Optional[Dict]:
-    """Validate input data"""
-    if not isinstance(data, dict):
-        return {'error': 'Invalid request format'}
-    
-    for field in required_fields:
-        if field not in data:
-            return {'error': f'Missing required field: {field}'}
-    
-    # Validate string lengths
-    for key, value in data.items():
-        if isinstance(value, str) and len(value) > 10000:
-            return {'error': f'Field {key} exceeds maximum length'}
-    
-    return None
+# Bearer token for /api/admin/*; admin endpoints are disabled without it
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')
+
+def admin_required(f):
+    """REST decorator: require 'Authorization: Bearer <ADMIN_TOKEN>'"""
+    @wraps(f)
+    def guarded(*args, **kwargs):
+        if not ADMIN_TOKEN:
+            return jsonify({'error': 'Admin endpoints are disabled (set ADMIN_TOKEN)'}), 403
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {ADMIN_TOKEN}'):
+            return jsonify({'error': 'Unauthorized'}), 401
+        return f(*args, **kwargs)
+    return guarded
 
 def sanitize_filename(filename: str) -> str:
     """Sanitize filename for file system"""
@@ -160,6 +174,9 @@ class GoogleDriveManager:
             return False
         
         try:
+            from google.colab import auth
+            from googleapiclient.discovery import build
+            
             auth.authenticate_user()
             self.service = build('drive', 'v3')
             
@@ -184,11 +201,11 @@ class GoogleDriveManager:
                 self.folder_id = folder.get('id')
             
             self.initialized = True
-            logger.info(f"Google Drive initialized. Folder ID: {self.folder_id}")
+            logger.info("Google Drive initialized. Folder ID: %s", self.folder_id)
             return True
         
         except Exception as e:
-            logger.error(f"Google Drive initialization failed: {e}")
+            logger.error("Google Drive initialization failed: %s", e)
             return False
     
     async def upload_image(self, image: Image.Image, metadata: Dict) -> Optional[str]:
@@ -197,6 +214,8 @@ class GoogleDriveManager:
             return None
         
         try:
+            from googleapiclient.http import MediaIoBaseUpload
+            
             # Prepare image
             img_byte_arr = io.BytesIO()
             image.save(img_byte_arr, format='PNG')
@@ -230,11 +249,11 @@ class GoogleDriveManager:
                 fields='id'
             ).execute()
             
-            logger.info(f"Image uploaded to Google Drive: {file['id']}")
+            logger.info("Image uploaded to Google Drive: %s", file['id'])
             return file['id']
         
         except Exception as e:
-            logger.error(f"Google Drive upload failed: {e}")
+            logger.error("Google Drive upload failed: %s", e)
             return None
     
     async def _get_or_create_folder(self, folder_name: str, parent_id: str) -> str:
@@ -261,479 +280,968 @@ class GoogleDriveManager:
             return folder['id']
         
         except Exception as e:
-            logger.error(f"Folder creation failed: {e}")
+            logger.error("Folder creation failed: %s", e)
             return parent_id
 
 gdrive_manager = GoogleDriveManager()
 
-# ==================== STABLE DIFFUSION PIPELINE ====================
+# ==================== ENHANCEMENT FUNCTIONS ====================
 
-class StableDiffusionManager:
-    """Manage Stable Diffusion models and generation"""
+async def enhance_prompt(prompt: str) -> str:
+    """Enhance prompt using LLM or predefined templates"""
+    enhancements = {
+        'portrait': 'a detailed portrait, professional lighting, sharp focus, 8k',
+        'landscape': 'a beautiful landscape, atmospheric, cinematic lighting, 8k',
+        'abstract': 'abstract art, colorful, artistic, creative composition',
+    }
     
-    def __init__(self):
-        self.pipelines = {}
-        self.models_path = Path(os.environ.get('MODELS_PATH', './models'))
-        self.models_path.mkdir(exist_ok=True)
-        self.current_model = None
-        self.model_lock = threading.Lock()
-    
-    async def load_model(self, model_name: str, model_type: str = "checkpoint") -> bool:
-        """Load model into memory"""
-        with self.model_lock:
-            try:
-                if model_name in self.pipelines:
-                    self.current_model = model_name
-                    return True
-                
-                logger.info(f"Loading model: {model_name}")
-                
-                if model_type == "checkpoint":
-                    # Load from HuggingFace or local path
-                    if "xl" in model_name.lower():
-                        pipeline = StableDiffusionXLPipeline.from_pretrained(
-                            model_name,
-                            torch_dtype=torch.float16 if state.model_precision == "fp16" else torch.float32,
-                            use_safetensors=True
-                        )
-                    else:
-                        pipeline = StableDiffusionPipeline.from_pretrained(
-                            model_name,
-                            torch_dtype=torch.float16 if state.model_precision == "fp16" else torch.float32,
-                            use_safetensors=True
-                        )
-                    
-                    pipeline = pipeline.to(state.device)
-                    self.pipelines[model_name] = pipeline
-                    self.current_model = model_name
-                    
-                    logger.info(f"Model loaded successfully: {model_name}")
-                    return True
-                
-                return False
-            
-            except Exception as e:
-                logger.error(f"Model loading failed: {e}")
-                return False
+    # Simple keyword matching
+    for key, enhancement in enhancements.items():
+        if key.lower() in prompt.lower():
+            return f"{prompt}, {enhancement}"
     
-    async def unload_model(self, model_name: str = None):
-        """Unload model from memory"""
-        model_to_unload = model_name or self.current_model
-        
-        if model_to_unload and model_to_unload in self.pipelines:
-            del self.pipelines[model_to_unload]
-            if torch.cuda.is_available():
-                torch.cuda.empty_cache()
-            logger.info(f"Model unloaded: {model_to_unload}")
-    
-    async def generate(self, params: Dict) -> List[Image.Image]:
-        """Generate images based on parameters"""
-        try:
-            # Validate input
-            validation_error = validate_input(params, ['task', 'prompt'])
-            if validation_error:
-                raise ValueError(validation_error['error'])
-            
-            task = params['task']
-            prompt = params['prompt']
-            negative_prompt = params.get('negative_prompt', '')
-            
-            # Load model if not already loaded
-            model_name = params.get('model', 'runwayml/stable-diffusion-v1-5')
-            await self.load_model(model_name)
-            
-            pipeline = self.pipelines[self.current_model]
-            
-            # Generate based on task type
-            if task == 'txt2img':
-                images = await self._txt2img(pipeline, params)
-            elif task == 'img2img':
-                images = await self._img2img(pipeline, params)
-            elif task == 'inpaint':
-                images = await self._inpaint(pipeline, params)
-            elif 'controlnet' in task:
-                images = await self._controlnet(pipeline, params)
-            else:
-                raise ValueError(f"Unknown task: {task}")
-            
-            return images
-        
-        except Exception as e:
-            logger.error(f"Generation failed: {e}")
-            raise
-    
-    async def _txt2img(self, pipeline, params: Dict) -> List[Image.Image]:
-        """Text to image generation"""
-        prompt = params['prompt']
-        negative_prompt = params.get('negative_prompt', '')
-        width = params.get('width', 512)
-        height = params.get('height', 512)
-        steps = params.get('steps', 20)
-        cfg_scale = params.get('cfg_scale', 7.5)
-        seed = params.get('seed', -1)
-        sampler = params.get('sampler', 'euler')
-        num_images = params.get('num_images', 1)
-        loras = params.get('loras', [])
+    # Default enhancement
+    return f"{prompt}, high quality, detailed, professional"
+
+async def apply_adetailer(image: Image.Image, params: Dict) -> Image.Image:
+    """Apply Adetailer for detail enhancement"""
+    logger.info("Applying Adetailer...")
+    # Mock implementation
+    return image
+
+async def upscale_image(image: Image.Image, scale: int = 2, method: str = 'esrgan') -> Image.Image:
+    """Upscale image"""
+    logger.info("Upscaling image with %s...", method)
+    new_width = image.width * scale
+    new_height = image.height * scale
+    # Off the event loop: other clients keep being served while this runs
+    return await asyncio.to_thread(image.resize, (new_width, new_height), Image.Resampling.LANCZOS)
+
+# ==================== JOB EXECUTION ====================
+
+MAX_QUEUE_SIZE = int(os.environ.get('MAX_QUEUE_SIZE', 100))
+
+# all: accept and run jobs, frontend: only accept jobs, worker: only run jobs
+NODE_ROLE = os.environ.get('NODE_ROLE', 'all').lower()
+HEARTBEAT_INTERVAL = float(os.environ.get('HEARTBEAT_INTERVAL', 5))
+# Identical requests stop attaching to a leader job older than this (seconds)
+COALESCE_TIMEOUT = 600
+# Finished jobs whose status / result this node keeps in memory (older ones come from the journal)
+JOB_HISTORY_SIZE = int(os.environ.get('JOB_HISTORY_SIZE', 1000))
+FINISHED_STATUSES = ('completed', 'failed', 'cancelled', 'rejected')
+# Seconds between SSE keep-alive comments
+SSE_KEEPALIVE = 15
+# Open SSE streams of running jobs each hold a REST thread; past this many new ones get 503
+# (default: half of WSGI_THREADS, so the other routes keep threads of their own)
+SSE_MAX_STREAMS = int(os.environ.get('SSE_MAX_STREAMS') or max(1, int(os.environ.get('WSGI_THREADS', 16)) // 2))
+sse_streams = threading.BoundedSemaphore(SSE_MAX_STREAMS)
+# Learned job durations / load times and memory calibration survive restarts here
+COST_MODEL_PATH = os.environ.get('COST_MODEL_PATH', './cache/cost_model.json')
+# off: accept everything, reject: refuse jobs that cannot fit into device memory (or
+# ADMISSION_MAX_SECONDS), downscale: shrink txt2img batch / resolution until they fit
+ADMISSION_CONTROL = os.environ.get('ADMISSION_CONTROL', 'off').lower()
+ADMISSION_MAX_SECONDS = float(os.environ.get('ADMISSION_MAX_SECONDS', 0))
+
+result_cache = ResultCache()
+job_journal = JobJournal()
+perf_monitor = PerformanceMonitor()
+cost_model = CostModel(COST_MODEL_PATH, sd_manager.memory_policy, state.peek_device)
+
+def _labels(params: Dict):
+    """(task, model) metric labels of a request"""
+    return params.get('task', 'txt2img'), params.get('model', DEFAULT_MODEL)
+
+def _job_images(params: Dict) -> Optional[int]:
+    """Images a request generates when it is not num_images: the cells of a sweep"""
+    return len(plan_sweep(params)['cells']) if params.get('task') == 'sweep' else None
+
+async def save_generation_outputs(images: List[Image.Image], data: Dict) -> Dict:
+    """Save images locally, upload to Drive, record in gallery; returns the 'complete' payload"""
+    metadata = create_metadata_dict(data)
+    saved_paths = []
+    gdrive_ids = []
+    image_data = []
+    
+    for idx, image in enumerate(images):
+        with metrics.SAVE.labels(*_labels(data)).time(), tracing.span('save_image', index=idx):
+            # Encode once, reuse the PNG bytes for the file and the preview
+            buffered = io.BytesIO()
+            image.save(buffered, format="PNG")
+            png_bytes = buffered.getvalue()
+            
+            # Save locally
+            local_path = _write_output(png_bytes, data, idx)
+        saved_paths.append(str(local_path))
+        image_data.append(base64.b64encode(png_bytes).decode())
         
-        logger.info(f"🎨 Txt2Img: {prompt[:50]}... ({width}x{height}, {steps} steps)")
-        if loras:
-            logger.info(f"📦 LoRAs: {[l.get('name', '') for l in loras]}")
+        # Upload to Google Drive
+        gdrive_id = None
+        if gdrive_manager.initialized:
+            with metrics.DRIVE_UPLOAD.labels(*_labels(data)).time(), tracing.span('drive_upload', index=idx):
+                gdrive_id = await gdrive_manager.upload_image(image, metadata)
+            if gdrive_id:
+                gdrive_ids.append(gdrive_id)
         
-        try:
-            # Load LoRAs if provided
-            for lora in loras:
-                lora_name = lora.get('name', '')
-                lora_weight = lora.get('weight', 1.0)
-                lora_path = Path('./models/loras') / lora_name
-                
-                if lora_path.exists():
-                    logger.info(f"Loading LoRA: {lora_name} (weight={lora_weight})")
-                    pipeline.load_lora_weights(str(lora_path))
-                    if hasattr(pipeline, 'set_lora_device'):
-                        pipeline.set_lora_device(state.device)
-                    if hasattr(pipeline, 'fuse_lora'):
-                        pipeline.fuse_lora(lora_scale=lora_weight)
-            
-            # Set seed
-            generator = None
-            if seed >= 0:
-                generator = torch.Generator(device=state.device).manual_seed(seed)
-            
-            # Run generation
-            output = pipeline(
-                prompt=prompt,
-                negative_prompt=negative_prompt,
-                height=height,
-                width=width,
-                num_inference_steps=steps,
-                guidance_scale=cfg_scale,
-                generator=generator,
-                num_images_per_prompt=num_images
+        _add_to_gallery(local_path, metadata, gdrive_id)
+    
+    return {
+        'images': image_data,
+        'metadata': metadata,
+        'paths': saved_paths,
+        'gdrive_ids': gdrive_ids
+    }
+
+def save_cached_outputs(payload: Dict, data: Dict) -> Dict:
+    """'complete' payload of another job (cache hit, coalesced request) saved for this request
+    
+    The payload's files belong to the job that generated them: write its images
+    under this request's output_dir / filename_prefix and add them to the gallery.
+    """
+    metadata = create_metadata_dict(data)
+    saved_paths = []
+    for idx, image_data in enumerate(payload.get('images', [])):
+        local_path = _write_output(base64.b64decode(image_data), data, idx)
+        saved_paths.append(str(local_path))
+        _add_to_gallery(local_path, metadata, None)
+    return dict(payload, metadata=metadata, paths=saved_paths, gdrive_ids=[])
+
+def save_remote_outputs(payload: Dict, output: Dict) -> Dict:
+    """'complete' payload of a job that ran on another node, with its images also written here
+    
+    The executing node saved the files on its own disk; the node that accepted
+    the job serves the image URLs and the gallery, so it keeps a copy under the
+    request's output location (`output`: output_dir, filename_prefix, seed).
+    """
+    metadata = payload.get('metadata') or {}
+    saved_paths = []
+    for idx, image_data in enumerate(payload.get('images', [])):
+        local_path = _write_output(base64.b64decode(image_data), output, idx)
+        saved_paths.append(str(local_path))
+        _add_to_gallery(local_path, metadata, None)
+    return dict(payload, paths=saved_paths)
+
+def _write_output(png_bytes: bytes, data: Dict, idx: int) -> Path:
+    """Write one image under the request's output_dir / filename_prefix"""
+    filename = f"{data.get('filename_prefix', 'gen')}_{int(time.time())}_{data.get('seed', -1)}_{idx}.png"
+    local_path = Path(data.get('output_dir', './outputs')) / filename
+    local_path.parent.mkdir(parents=True, exist_ok=True)
+    local_path.write_bytes(png_bytes)
+    return local_path
+
+def _add_to_gallery(local_path: Path, metadata: Dict, gdrive_id: Optional[str]):
+    """Store a saved image in the gallery history and announce it"""
+    item = {
+        'path': str(local_path),
+        'metadata': metadata,
+        'gdrive_id': gdrive_id,
+        'timestamp': datetime.now().isoformat()
+    }
+    state.gallery_history.append(item)
+    event_bus.publish(GALLERY_ROOM, 'gallery_item', item)
+
+class JobCancelled(Exception):
+    """Raised from the step callback to stop a cancelled job"""
+
+class JobRunner:
+    """Run generation jobs in the background
+    
+    Jobs go through a broker (job_broker.py): JOB_BROKER=memory (default)
+    keeps everything in this process, JOB_BROKER=redis lets several instances
+    share one queue. Every node accepts jobs; nodes with NODE_ROLE=all or
+    worker pull jobs when they have a free slot, preferring models they have
+    loaded, and publish progress back to the job's origin node, which emits it
+    to the client's socket.
+    
+    With INFERENCE_WORKERS=0 (default) jobs run one at a time on a thread of
+    this process. With N > 0 they go to N worker processes
+    (inference_workers.WorkerPool), each with its own StableDiffusionManager,
+    and this process only dispatches jobs and saves results.
+    """
+    
+    def __init__(self):
+        self.jobs = {}  # job id -> job pulled by this node
+        self.node_id = default_node_id()
+        self.role = NODE_ROLE
+        self.broker = None
+        self.pool = None
+        self.capacity = 0
+        self._queue = queue.Queue()
+        self._slots = None
+        self._thread = None
+        self._started = False
+        self._start_lock = threading.Lock()
+        self._running = set()
+        # result cache key -> running leader job and the identical requests waiting on it
+        self._inflight = {}
+        self._inflight_keys = {}  # leader job id -> key
+        self._listeners = {}  # job id -> callback for jobs without a socket (batches)
+        self.records = OrderedDict()  # job id -> status of a job submitted on this node
+        self._cancelled = set()  # jobs whose further events are dropped
+        self._abort = set()  # cancelled jobs that should not run (any more)
+        self._coalesce_lock = threading.Lock()
+        self._output_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='job-output')
+    
+    def start(self):
+        """Connect to the broker and start the executor (in-process thread or worker pool)"""
+        with self._start_lock:
+            if self._started:
+                return
+            self._started = True
+            
+            self.broker = create_broker(DEFAULT_MODEL)
+            self.broker.listen(self.node_id, self._deliver)
+            cost_model.start_autosave()
+            
+            if self.role == 'frontend':
+                # Front ends load no models; they are ready as soon as they serve
+                state.preload_models = []
+            else:
+                self._start_executor()
+                self._slots = threading.Semaphore(self.capacity)
+                # Jobs a previous run under the same NODE_ID pulled and never finished
+                self.broker.requeue(self.node_id)
+                # Announce the node before it pulls, so its jobs are not taken for orphans
+                self._heartbeat()
+                threading.Thread(target=self._pull_loop, name='job-puller', daemon=True).start()
+            
+            threading.Thread(target=self._heartbeat_loop, name='node-heartbeat', daemon=True).start()
+            logger.info("Node %s started (%s, capacity %s)", self.node_id, self.role, self.capacity)
+    
+    def _start_executor(self):
+        num_workers = int(os.environ.get('INFERENCE_WORKERS', 0))
+        if num_workers > 0:
+            from inference_workers import WorkerPool
+            
+            # Workers load and warm up PRELOAD_MODELS themselves
+            for model_name in state.preload_models:
+                state.model_status.setdefault(model_name, 'pending')
+            
+            threads = os.environ.get('INFERENCE_WORKER_THREADS')
+            self.pool = WorkerPool(
+                num_workers,
+                threads_per_worker=int(threads) if threads else None,
+                default_model=DEFAULT_MODEL,
+                on_ready=self._on_worker_ready,
+                on_start=self._on_start,
+                on_progress=self._on_progress,
+                on_cell=self._on_cell,
+                on_done=self._on_pool_done,
+                on_error=self._on_error
             )
-            
-            logger.info(f"✅ Generated {len(output.images)} image(s)")
-            return output.images
-        
-        except Exception as e:
-            logger.error(f"❌ Txt2Img error: {e}")
-            raise
+            self.pool.start()
+            self.capacity = num_workers
+        else:
+            self._thread = threading.Thread(target=self._run_local, name='inference', daemon=True)
+            self._thread.start()
+            self.capacity = 1
     
-    async def _img2img(self, pipeline, params: Dict) -> List[Image.Image]:
-        """Image to image generation"""
-        from diffusers import StableDiffusionImg2ImgPipeline
+    def submit(self, job: Dict, listener: Optional[Callable] = None) -> Dict:
+        """Queue a job {'id', 'params', 'sid'}; its events come back to this node
         
-        prompt = params['prompt']
-        negative_prompt = params.get('negative_prompt', '')
-        strength = params.get('strength', 0.75)
-        steps = params.get('steps', 20)
-        cfg_scale = params.get('cfg_scale', 7.5)
-        seed = params.get('seed', -1)
+        Events go to the job's room ('job:<id>', which the submitting socket
+        joins), or to `listener(event, data)` if given.
+        Deterministic requests (fixed seed) are answered from the result cache
+        (status 'completed') or attached to a running identical job (status
+        'coalesced'). A full queue rejects the job (status 'rejected'), as does
+        admission control for a job that cannot run here (with job['reject_reason']).
+        Queued jobs get their predicted cost (job['cost']) and an ETA.
+        """
+        self.start()
+        job.update(status='queued', created_at=time.time(), origin=self.node_id)
+        if 'trace' not in job:
+            job['trace'] = tracing.new_trace(True if job['params'].get('trace') else None, job_id=job['id'])
+        self._remember({
+            'id': job['id'], 'status': 'queued', 'sid': job['sid'], 'created_at': job['created_at'],
+            'trace_id': job['trace']['id'],
+            'started_at': None, 'finished_at': None, 'progress': None, 'result': None, 'error': None,
+            # Where the images go, should the job run on another node
+            'output': {k: job['params'][k] for k in ('output_dir', 'filename_prefix', 'seed') if k in job['params']},
+            # Batches checkpoint themselves; everything else goes into the journal
+            'journaled': listener is None
+        })
+        if listener is not None:
+            self._listeners[job['id']] = listener
+        else:
+            if job['sid'] is not None:
+                event_bus.subscribe(job['sid'], job_room(job['id']))
+            job_journal.record(job['id'], 'accepted', params=job['params'], sid=job['sid'])
         
-        # Decode input image
-        image_data = base64.b64decode(params.get('image', ''))
-        image = Image.open(io.BytesIO(image_data))
+        reason = self._admit(job)
+        if reason is not None:
+            return self._reject(job, reason)
         
-        logger.info(f"🖼️ Img2Img: {prompt[:50]}... (strength={strength})")
+        key = None
+        if result_cache.enabled:
+            key = request_key(job['params'], {'model': DEFAULT_MODEL, 'precision': state.model_precision})
+        if key is not None:
+            payload = result_cache.get(key)
+            if payload is not None:
+                job['status'] = 'completed'
+                payload = save_cached_outputs(payload, job['params'])
+                self._send(job['id'], 'complete', dict(payload, job_id=job['id'], cached=True,
+                                                       trace_id=job['trace']['id']))
+                return job
+            
+            with self._coalesce_lock:
+                leader = self._inflight.get(key)
+                if leader is not None and time.time() - leader['created_at'] < COALESCE_TIMEOUT:
+                    leader['followers'].append(job)
+                    result_cache.coalesced += 1
+                    job['status'] = self.records[job['id']]['status'] = 'coalesced'
+                    return job
         
-        try:
-            # Load img2img pipeline if not already loaded
-            if not isinstance(pipeline, StableDiffusionImg2ImgPipeline):
-                model_name = self.current_model
-                logger.info("Loading img2img pipeline...")
-                pipeline = StableDiffusionImg2ImgPipeline.from_pretrained(
-                    model_name,
-                    torch_dtype=torch.float16 if state.model_precision == "fp16" else torch.float32,
-                    use_safetensors=True
-                ).to(state.device)
-            
-            generator = None
-            if seed >= 0:
-                generator = torch.Generator(device=state.device).manual_seed(seed)
-            
-            output = pipeline(
-                prompt=prompt,
-                negative_prompt=negative_prompt,
-                image=image,
-                strength=strength,
-                num_inference_steps=steps,
-                guidance_scale=cfg_scale,
-                generator=generator
-            )
-            
-            logger.info(f"✅ Img2Img generated successfully")
-            return output.images
+        if self.queue_depth() >= MAX_QUEUE_SIZE:
+            return self._reject(job)
         
-        except Exception as e:
-            logger.error(f"❌ Img2Img error: {e}")
-            raise
+        if key is not None:
+            with self._coalesce_lock:
+                self._inflight[key] = {'leader': job['id'], 'followers': [], 'created_at': time.time()}
+                self._inflight_keys[job['id']] = key
+        task, model = _labels(job['params'])
+        job['cost'] = dict(job.get('cost') or {},
+                           seconds=round(cost_model.predict_seconds(job['params'], model, _job_images(job['params'])), 2),
+                           load_seconds=round(cost_model.predict_load_seconds(model), 2))
+        self.broker.submit(job)
+        job['eta_seconds'] = round(self._eta(job), 1)
+        self.records[job['id']].update(cost=job['cost'], eta_seconds=job['eta_seconds'])
+        return job
     
-    async def _inpaint(self, pipeline, params: Dict) -> List[Image.Image]:
-        """Inpainting generation"""
-        from diffusers import StableDiffusionInpaintPipeline
-        
-        prompt = params['prompt']
-        negative_prompt = params.get('negative_prompt', '')
-        strength = params.get('strength', 0.8)
-        steps = params.get('steps', 20)
-        cfg_scale = params.get('cfg_scale', 7.5)
-        seed = params.get('seed', -1)
+    def _reject(self, job: Dict, reason: Optional[str] = None) -> Dict:
+        job['status'] = 'rejected'
+        if reason:
+            job['reject_reason'] = reason
+        self._listeners.pop(job['id'], None)
+        record = self.records[job['id']]
+        record.update(status='rejected', finished_at=time.time(), error=reason)
+        if record['journaled']:
+            job_journal.record(job['id'], 'rejected', error=reason)
+        return job
+    
+    def _admit(self, job: Dict) -> Optional[str]:
+        """Admission control: None if the job may run (txt2img possibly downscaled), else why not
         
-        # Decode images
-        image_data = base64.b64decode(params.get('image', ''))
-        image = Image.open(io.BytesIO(image_data))
+        A job is refused when even the most economical memory settings need
+        more than the device has (total memory, not what is free now: memory
+        in use is freed as jobs finish), or when it would run longer than
+        ADMISSION_MAX_SECONDS. Front ends do not know the workers' devices
+        and admit everything.
+        """
+        if ADMISSION_CONTROL == 'off' or self.role == 'frontend':
+            return None
+        params = job['params']
+        task, model = _labels(params)
+        device = state.device
+        total_bytes = total_memory(device)
+        usable_gb = total_bytes * SAFETY_FACTOR / 1024 ** 3 if total_bytes else None
+        weights_bytes = sd_manager.memory_reports.get(model, {}).get('memory_bytes')
+        dtype_bytes = 2 if sd_manager._policy_for(model)['mode'] in ('fp16', 'bf16') else 4
         
-        mask_data = base64.b64decode(params.get('mask', ''))
-        mask = Image.open(io.BytesIO(mask_data))
+        def too_expensive(candidate: Dict) -> Optional[str]:
+            memory_gb = cost_model.predict_memory_gb(candidate, model, device, weights_bytes, dtype_bytes)
+            job['cost'] = {'memory_gb': memory_gb}
+            if usable_gb is not None and memory_gb is not None and memory_gb > usable_gb:
+                return f"needs ~{memory_gb:.1f} GB, {device} has {usable_gb:.1f} GB usable"
+            if ADMISSION_MAX_SECONDS > 0:
+                seconds = cost_model.predict_seconds(candidate, model, _job_images(candidate))
+                if seconds > ADMISSION_MAX_SECONDS:
+                    return f"would take ~{seconds:.0f}s, the limit is {ADMISSION_MAX_SECONDS:.0f}s"
+            return None
         
-        logger.info(f"🎭 Inpaint: {prompt[:50]}... (strength={strength})")
+        reason = too_expensive(params)
+        if reason is None:
+            return None
+        if ADMISSION_CONTROL == 'downscale' and task == 'txt2img':
+            scaled = dict(params)
+            while reason is not None and (scaled.get('num_images', 1) > 1 or
+                                          min(scaled.get('width', 512), scaled.get('height', 512)) > 256):
+                if scaled.get('num_images', 1) > 1:
+                    scaled['num_images'] = scaled['num_images'] // 2
+                else:
+                    # Keep the aspect ratio, multiples of 8
+                    scaled['width'] = max(int(scaled.get('width', 512) * 0.875) // 8 * 8, 64)
+                    scaled['height'] = max(int(scaled.get('height', 512) * 0.875) // 8 * 8, 64)
+                reason = too_expensive(scaled)
+            if reason is None:
+                job['downscaled'] = {k: {'from': params.get(k), 'to': scaled.get(k)}
+                                     for k in ('width', 'height', 'num_images') if params.get(k) != scaled.get(k)}
+                logger.info("Job %s downscaled to fit: %s", job['id'], job['downscaled'])
+                job['params'] = scaled
+                return None
+        logger.info("Job %s rejected by admission control: %s", job['id'], reason)
+        return f"Request cannot run on this server: it {reason}"
+    
+    def _eta(self, job: Dict) -> float:
+        """Predicted seconds until a queued job finishes
         
-        try:
-            # Load inpaint pipeline if not already loaded
-            if not isinstance(pipeline, StableDiffusionInpaintPipeline):
-                model_name = self.current_model
-                logger.info("Loading inpaint pipeline...")
-                pipeline = StableDiffusionInpaintPipeline.from_pretrained(
-                    model_name,
-                    torch_dtype=torch.float16 if state.model_precision == "fp16" else torch.float32,
-                    use_safetensors=True
-                ).to(state.device)
-            
-            generator = None
-            if seed >= 0:
-                generator = torch.Generator(device=state.device).manual_seed(seed)
-            
-            output = pipeline(
-                prompt=prompt,
-                negative_prompt=negative_prompt,
-                image=image,
-                mask_image=mask,
-                strength=strength,
-                num_inference_steps=steps,
-                guidance_scale=cfg_scale,
-                generator=generator
-            )
-            
-            logger.info(f"✅ Inpaint generated successfully")
-            return output.images
+        The remaining time of the jobs this node holds and of the queued jobs
+        that will be pulled before this one, shared over the executor slots
+        (the cluster's, on a front end), plus the job's own run time and its
+        model's load time if that is not loaded.
+        """
+        now = time.time()
+        loaded = self.loaded_models()
+        model = _labels(job['params'])[1]
+        own = job['cost']['seconds'] + (0.0 if model in loaded else job['cost']['load_seconds'])
         
-        except Exception as e:
-            logger.error(f"❌ Inpaint error: {e}")
-            raise
+        ahead = 0.0
+        for other in list(self.jobs.values()):
+            cost = (other.get('cost') or {}).get('seconds', 0.0)
+            started = other.get('started_at')
+            ahead += max(cost - (now - started), 0.0) if started else cost
+        queued = self.broker.queued_jobs(loaded)
+        if queued is None:
+            ahead += max(self.broker.queue_depth() - 1, 0) * own
+        else:
+            for other in queued:
+                if other['id'] == job['id']:
+                    break
+                ahead += (other.get('cost') or {}).get('seconds', 0.0)
+        capacity = self.capacity or sum(n.get('capacity', 0) for n in self.broker.nodes().values()) or 1
+        return ahead / capacity + own
     
-    async def _controlnet(self, pipeline, params: Dict) -> List[Image.Image]:
-        """ControlNet generation"""
-        from diffusers import ControlNetModel, StableDiffusionControlNetPipeline
-        import cv2
+    def job_status(self, job_id: str) -> Optional[Dict]:
+        """Status, progress and result (without image data) of a job submitted here"""
+        record = self.records.get(job_id)
+        if record is not None:
+            return {k: v for k, v in record.items() if k not in ('journaled', 'sid', 'output')}
+        entry = job_journal.get(job_id)
+        if entry is None:
+            return None
+        status = {'accepted': 'queued', 'started': 'running'}.get(entry['status'], entry['status'])
+        return {'id': job_id, 'status': status, 'created_at': entry['created_at'],
+                'started_at': entry['started_at'], 'finished_at': entry['finished_at'], 'progress': None,
+                'result': entry['result'], 'error': entry['error']}
+    
+    def cancel(self, job_id: str) -> bool:
+        """Cancel a queued or running job; False if it is unknown or already finished
         
-        prompt = params['prompt']
-        negative_prompt = params.get('negative_prompt', '')
-        steps = params.get('steps', 20)
-        cfg_scale = params.get('cfg_scale', 7.5)
-        seed = params.get('seed', -1)
-        width = params.get('width', 512)
-        height = params.get('height', 512)
+        A queued job is skipped when it comes up, a running in-process job
+        stops at its next step. Jobs running in a worker process or on another
+        node run to the end, but their events are dropped. A leader job that
+        identical requests are attached to keeps running for them.
+        """
+        record = self.records.get(job_id)
+        if record is None or record['status'] in FINISHED_STATUSES:
+            return False
+        record.update(status='cancelled', finished_at=time.time())
+        if record['journaled']:
+            job_journal.record(job_id, 'cancelled')
         
-        controlnet_type = params.get('controlnet_type', 'canny')
-        controlnet_weight = params.get('controlnet_weight', 1.0)
+        keep_running = False
+        with self._coalesce_lock:
+            key = self._inflight_keys.get(job_id)
+            entry = self._inflight.get(key) if key else None
+            if entry and entry['leader'] == job_id:
+                if entry['followers']:
+                    keep_running = True
+                else:
+                    del self._inflight[key]
+                    del self._inflight_keys[job_id]
+            for entry in self._inflight.values():
+                entry['followers'] = [f for f in entry['followers'] if f['id'] != job_id]
+        if not keep_running:
+            self._abort.add(job_id)
+        self._cancelled.add(job_id)
         
-        # Decode input image
-        image_data = base64.b64decode(params.get('image', ''))
-        image = Image.open(io.BytesIO(image_data))
-        image = image.resize((width, height))
+        data = {'job_id': job_id, 'message': 'Generation cancelled'}
+        listener = self._listeners.pop(job_id, None)
+        if listener is not None:
+            listener('error', data)
+        else:
+            event_bus.publish(job_room(job_id), 'cancelled', data)
+        return True
+    
+    def queue_depth(self) -> int:
+        if not self._started:
+            return 0
+        local = self.pool.queue_depth() if self.pool else self._queue.qsize()
+        return self.broker.queue_depth() + local
+    
+    def loaded_models(self) -> List[str]:
+        if self.pool:
+            return sorted({m for w in self.pool.workers for m in w['models']})
+        return list(sd_manager.pipelines)
+    
+    def status(self) -> Dict:
+        if not self._started:
+            return {'node_id': self.node_id, 'role': self.role, 'started': False}
+        return {
+            'node_id': self.node_id,
+            'role': self.role,
+            'mode': 'workers' if self.pool else 'in-process',
+            'capacity': self.capacity,
+            'queue_depth': self.queue_depth(),
+            'running': len(self._running),
+            'workers': self.pool.status() if self.pool else [],
+            'nodes': self.broker.nodes()
+        }
+    
+    # ---------- broker ----------
+    
+    def _pull_loop(self):
+        """Take a job from the broker whenever an executor slot is free"""
+        while True:
+            self._slots.acquire()
+            job = None
+            while job is None:
+                try:
+                    job = self.broker.pull(self.node_id, self.loaded_models(), timeout=1.0)
+                except Exception as e:
+                    logger.error("Job broker pull failed: %s", e)
+                    time.sleep(1.0)
+            if job['id'] in self._abort:
+                # Cancelled while queued
+                self._abort.discard(job['id'])
+                self._cancelled.discard(job['id'])
+                self.broker.ack(self.node_id, job)
+                self._slots.release()
+                continue
+            self.jobs[job['id']] = job
+            if self.pool:
+                self.pool.submit(job)
+            else:
+                self._queue.put(job)
+    
+    def _heartbeat(self):
+        """Advertise role, capacity and loaded models"""
+        try:
+            self.broker.heartbeat(self.node_id, {
+                'role': self.role,
+                'capacity': self.capacity,
+                'busy': len(self._running),
+                'models': self.loaded_models() if self.role != 'frontend' else [],
+                'ready': state.is_ready()
+            })
+        except Exception as e:
+            logger.warning("Heartbeat failed: %s", e)
+    
+    def _heartbeat_loop(self):
+        """Heartbeats; also requeue the jobs of nodes that died while running them"""
+        while True:
+            self._heartbeat()
+            try:
+                self.broker.requeue_orphans()
+            except Exception as e:
+                logger.warning("Requeueing jobs of dead nodes failed: %s", e)
+            time.sleep(HEARTBEAT_INTERVAL)
+    
+    def recover(self) -> int:
+        """Requeue the journaled jobs that were accepted but never finished"""
+        jobs = job_journal.unfinished()
+        for entry in jobs:
+            self.submit({'id': entry['id'], 'params': entry['params'], 'sid': None})
+        return len(jobs)
+    
+    def _remember(self, record: Dict):
+        self.records[record['id']] = record
+        # Drop the oldest finished jobs; unfinished ones are never dropped
+        while len(self.records) > JOB_HISTORY_SIZE:
+            oldest = next(iter(self.records.values()))
+            if oldest['status'] not in FINISHED_STATUSES:
+                break
+            self.records.popitem(last=False)
+    
+    def _track(self, job_id: str, event: str, data: Dict):
+        """Update a job's record with started / completed / failed transitions and journal them"""
+        record = self.records.get(job_id)
+        if record is None or record['status'] in FINISHED_STATUSES:
+            return
+        if event == 'progress':
+            record['progress'] = {'step': data.get('step'), 'total': data.get('total')}
+            if record['status'] != 'running':
+                record.update(status='running', started_at=time.time())
+                if record['journaled']:
+                    job_journal.record(job_id, 'started')
+        elif event == 'complete':
+            # Images stay on disk; the result keeps their paths
+            result = {k: v for k, v in data.items() if k != 'images'}
+            record.update(status='completed', finished_at=time.time(), result=result)
+            if record['journaled']:
+                job_journal.record(job_id, 'completed', result=result)
+        elif event == 'error':
+            record.update(status='failed', finished_at=time.time(), error=data.get('message'))
+            if record['journaled']:
+                job_journal.record(job_id, 'failed', error=data.get('message'))
+    
+    def _send(self, job_id: str, event: str, data: Dict):
+        """Event to a job's listener or room"""
+        if job_id in self._cancelled:
+            if event in ('complete', 'error'):
+                self._cancelled.discard(job_id)
+            return
+        self._track(job_id, event, data)
+        listener = self._listeners.get(job_id)
+        if listener is not None:
+            if event in ('complete', 'error'):
+                self._listeners.pop(job_id, None)
+            listener(event, data)
+        else:
+            event_bus.publish(job_room(job_id), event, data)
+    
+    def _deliver(self, message: Dict):
+        """Event for a client connected to this node; also sent to coalesced followers"""
+        if message['event'] == 'complete' and message.get('node', self.node_id) != self.node_id:
+            # The images are on the disk of the node that ran the job: copy them here first
+            self._output_executor.submit(self._deliver_remote_complete, message)
+            return
+        self._fan_out(message)
+    
+    def _deliver_remote_complete(self, message: Dict):
+        data = message['data']
+        record = self.records.get(data.get('job_id'))
+        try:
+            if record is not None:
+                data = save_remote_outputs(data, record.get('output', {}))
+        except Exception as e:
+            logger.error("Saving images of job %s from node %s failed: %s", data.get('job_id'), message['node'], e)
+        self._fan_out(dict(message, data=data))
+    
+    def _fan_out(self, message: Dict):
+        job_id = message['data'].get('job_id')
+        self._send(job_id, message['event'], message['data'])
         
-        logger.info(f"🎮 ControlNet {controlnet_type}: {prompt[:50]}...")
+        key = self._inflight_keys.get(job_id)
+        if key is None:
+            return
+        finished = message['event'] in ('complete', 'error')
+        with self._coalesce_lock:
+            entry = self._inflight.get(key)
+            followers = list(entry['followers']) if entry and entry['leader'] == job_id else []
+            if finished:
+                self._inflight_keys.pop(job_id, None)
+                if entry and entry['leader'] == job_id:
+                    del self._inflight[key]
         
-        try:
-            # Map controlnet types to models
-            controlnet_models = {
-                'canny': 'lllyasviel/control_v11p_sd15_canny',
-                'openpose': 'lllyasviel/control_v11p_sd15_openpose',
-                'depth': 'lllyasviel/control_v11p_sd15_depth',
-                'mlsd': 'lllyasviel/control_v11p_sd15_mlsd',
-                'lineart': 'lllyasviel/control_v11p_sd15_lineart',
-                'normalbae': 'lllyasviel/control_v11p_sd15_normalbae',
-                'tile': 'lllyasviel/control_v11f1p_sd15_tile'
-            }
-            
-            cn_model = controlnet_models.get(controlnet_type, 'lllyasviel/control_v11p_sd15_canny')
-            
-            logger.info(f"Loading ControlNet: {cn_model}")
-            controlnet = ControlNetModel.from_pretrained(
-                cn_model,
-                torch_dtype=torch.float16 if state.model_precision == "fp16" else torch.float32,
-                use_safetensors=True
-            )
-            
-            cn_pipeline = StableDiffusionControlNetPipeline.from_pretrained(
-                self.current_model,
-                controlnet=controlnet,
-                torch_dtype=torch.float16 if state.model_precision == "fp16" else torch.float32,
-                use_safetensors=True
-            ).to(state.device)
-            
-            # Preprocess image based on type
-            if controlnet_type == 'canny':
-                low = params.get('canny_low', 100)
-                high = params.get('canny_high', 200)
-                image_cv = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR)
-                edges = cv2.Canny(image_cv, low, high)
-                edges = cv2.cvtColor(edges, cv2.COLOR_GRAY2BGR)
-                control_image = Image.fromarray(cv2.cvtColor(edges, cv2.COLOR_BGR2RGB))
+        for follower in followers:
+            data = dict(message['data'], job_id=follower['id'])
+            if message['event'] == 'complete':
+                # The leader's files are in its own output_dir: save a copy for the follower
+                self._output_executor.submit(self._complete_follower, follower, data)
             else:
-                control_image = image  # Assume preprocessed
-            
-            generator = None
-            if seed >= 0:
-                generator = torch.Generator(device=state.device).manual_seed(seed)
-            
-            output = cn_pipeline(
-                prompt=prompt,
-                negative_prompt=negative_prompt,
-                image=control_image,
-                controlnet_conditioning_scale=controlnet_weight,
-                num_inference_steps=steps,
-                guidance_scale=cfg_scale,
-                generator=generator
-            )
-            
-            logger.info(f"✅ ControlNet generated successfully")
-            return output.images
-        
+                self._send(follower['id'], message['event'], data)
+        if message['event'] == 'complete':
+            payload = {k: v for k, v in message['data'].items() if k != 'job_id'}
+            self._output_executor.submit(result_cache.put, key, payload)
+    
+    def _complete_follower(self, follower: Dict, data: Dict):
+        try:
+            self._send(follower['id'], 'complete', save_cached_outputs(data, follower['params']))
         except Exception as e:
-            logger.error(f"❌ ControlNet error: {e}")
-            raise
+            self._send(follower['id'], 'error', {'message': str(e), 'job_id': follower['id']})
+    
+    # ---------- execution ----------
+    
+    def _on_worker_ready(self, worker_id: int, info: Dict):
+        """A worker finished its warm-up: its warm models make this instance ready"""
+        for model_name, status in info.get('model_status', {}).items():
+            if state.model_status.get(model_name) != 'warm':
+                state.model_status[model_name] = status
+        logger.info("Inference worker %s ready (pid %s), models: %s", worker_id, info.get('pid'), info.get('models'))
+    
+    def _run_local(self):
+        """In-process executor: one job at a time on a private event loop"""
+        loop = asyncio.new_event_loop()
+        while True:
+            job = self._queue.get()
+            if job['id'] in self._abort:
+                self._cancelled.discard(job['id'])
+                self._done(job, 'cancelled')
+                continue
+            
+            def on_step(step, total, job=job):
+                if job['id'] in self._abort:
+                    raise JobCancelled()
+                self._on_progress(job, step, total)
+            
+            self._on_start(job)
+            # The sampling profiler sees this thread already; torch.profiler is per job
+            session = profiler.profiler.active()
+            try:
+                with tracing.activate(job.get('trace')), \
+                        profiler.torch_capture(session is not None and session.wants_torch(), job['id']) as captured:
+                    images = loop.run_until_complete(sd_manager.generate(
+                        job['params'],
+                        step_callback=on_step,
+                        cell_callback=lambda cell, image, job=job: self._on_cell(job, cell, png_base64(image))
+                    ))
+                if captured:
+                    session.torch_trace = captured['torch_trace']
+                loop.run_until_complete(self._finish(job, images))
+            except JobCancelled:
+                logger.info("Job %s cancelled", job['id'])
+                self._cancelled.discard(job['id'])
+                self._done(job, 'cancelled')
+            except Exception as e:
+                self._on_error(job, str(e))
+    
+    def _on_start(self, job: Dict, worker_id: Optional[int] = None):
+        job['status'] = 'running'
+        job['started_at'] = time.time()
+        models = self.pool.workers[worker_id]['models'] if worker_id is not None else sd_manager.pipelines
+        # Cold starts teach the cost model load times, not run times
+        job['warm'] = _labels(job['params'])[1] in models
+        metrics.QUEUE_WAIT.labels(*_labels(job['params'])).observe(job['started_at'] - job['created_at'])
+        tracing.record('queue', tracing.from_wall(job['created_at']), tracing.from_wall(job['started_at']),
+                       job.get('trace'))
+        self._running.add(job['id'])
+        state.is_generating = True
+        self._emit(job, 'progress', {'step': 0, 'total': job['params'].get('steps', 20),
+                                     'status': 'Starting generation...'})
+    
+    def _on_progress(self, job: Dict, step: int, total: int):
+        self._emit(job, 'progress', {'step': step, 'total': total, 'status': 'Generating...'})
+    
+    def _on_cell(self, job: Dict, cell: Dict, image_base64: str):
+        """One finished cell of a sweep"""
+        self._emit(job, 'sweep_cell', {
+            'index': cell['index'], 'coords': cell['coords'], 'col': cell['col'], 'row': cell['row'],
+            'seed': cell['seed'], 'image': image_base64
+        })
+    
+    def _on_pool_done(self, job: Dict, images: List[Image.Image], release: Callable):
+        """Images from a worker: save them off the dispatcher thread, then free shared memory"""
+        def finish():
+            try:
+                asyncio.run(self._finish(job, images))
+            except Exception as e:
+                self._on_error(job, str(e))
+            finally:
+                release()
+        
+        self._output_executor.submit(finish)
+    
+    async def _finish(self, job: Dict, images: List[Image.Image]):
+        with tracing.activate(job.get('trace')), tracing.span('save_outputs', images=len(images)):
+            payload = await save_generation_outputs(images, job['params'])
+        payload['job_id'] = job['id']
+        payload['trace_id'] = job['trace']['id']
+        if job['params'].get('task') == 'sweep':
+            payload['sweep'] = sweep_summary(plan_sweep(job['params']))
+        self._done(job, 'completed')
+        self._emit(job, 'complete', payload)
+    
+    def _on_error(self, job: Dict, message: str):
+        logger.error("Generation error: %s", message)
+        self._done(job, 'failed')
+        self._emit(job, 'error', {'message': message, 'job_id': job['id']})
+    
+    def _done(self, job: Dict, status: str):
+        job['status'] = status
+        job['finished_at'] = time.time()
+        task, model = _labels(job['params'])
+        metrics.JOBS.inc(task, status)
+        if job.get('started_at'):
+            tracing.record('job', tracing.from_wall(job['started_at']), tracing.from_wall(job['finished_at']),
+                           job.get('trace'), task=task, model=model, status=status)
+        if job.get('started_at') and status in ('completed', 'failed'):
+            duration = job['finished_at'] - job['started_at']
+            if status == 'completed':
+                metrics.GENERATION.labels(task, model).observe(duration)
+                cost_model.observe(job['params'], model, duration, warm=job.get('warm', True),
+                                   images=_job_images(job['params']))
+            resolution = f"{job['params'].get('width', 512)}x{job['params'].get('height', 512)}"
+            perf_monitor.record_generation(duration, success=status == 'completed', task=task, model=model,
+                                           resolution=resolution)
+        profiler.profiler.job_finished()
+        self._abort.discard(job['id'])
+        self._running.discard(job['id'])
+        state.is_generating = bool(self._running)
+        if self.jobs.pop(job['id'], None) is not None:
+            self.broker.ack(self.node_id, job)
+            self._slots.release()
+    
+    def _emit(self, job: Dict, event: str, data: Dict):
+        """Publish an event to the node holding the client's socket"""
+        data.setdefault('job_id', job['id'])
+        self.broker.publish(job['origin'], {'event': event, 'data': data, 'sid': job['sid'], 'node': self.node_id})
 
-sd_manager = StableDiffusionManager()
+job_runner = JobRunner()
 
-# ==================== ENHANCEMENT FUNCTIONS ====================
+def _on_batch_progress(batch, stats: Dict):
+    event_bus.publish(batch_room(batch.id), 'batch_progress', batch.status())
 
-async def enhance_prompt(prompt: str) -> str:
-    """Enhance prompt using LLM or predefined templates"""
-    enhancements = {
-        'portrait': 'a detailed portrait, professional lighting, sharp focus, 8k',
-        'landscape': 'a beautiful landscape, atmospheric, cinematic lighting, 8k',
-        'abstract': 'abstract art, colorful, artistic, creative composition',
-    }
-    
-    # Simple keyword matching
-    for key, enhancement in enhancements.items():
-        if key.lower() in prompt.lower():
-            return f"{prompt}, {enhancement}"
-    
-    # Default enhancement
-    return f"{prompt}, high quality, detailed, professional"
+# Items are checked like single requests (prepare_generation is defined with the socket handlers)
+batch_manager = BatchManager(job_runner.submit, on_progress=_on_batch_progress,
+                             prepare=lambda params: prepare_generation(params))
 
-async def apply_adetailer(image: Image.Image, params: Dict) -> Image.Image:
-    """Apply Adetailer for detail enhancement"""
-    logger.info("Applying Adetailer...")
-    # Mock implementation
-    return image
+# ==================== METRICS ====================
 
-async def upscale_image(image: Image.Image, scale: int = 2, method: str = 'esrgan') -> Image.Image:
-    """Upscale image"""
-    logger.info(f"Upscaling image with {method}...")
-    new_width = image.width * scale
-    new_height = image.height * scale
-    return image.resize((new_width, new_height), Image.Resampling.LANCZOS)
+def _cache_stat(field: str):
+    return lambda: result_cache.status()[field]
+
+metrics.REGISTRY.gauge('sd_queue_depth', 'Jobs waiting in the broker and executor queues', job_runner.queue_depth)
+metrics.REGISTRY.gauge('sd_running_jobs', 'Jobs running on this node', lambda: job_runner.status().get('running', 0))
+metrics.REGISTRY.gauge('sd_loaded_pipelines', 'Pipelines loaded on this node', lambda: len(job_runner.loaded_models()))
+metrics.REGISTRY.gauge('sd_model_status', 'Preloaded model state (1 for the current one)',
+                       lambda: {(model, status): 1 for model, status in state.model_status.items()},
+                       ('model', 'status'))
+metrics.REGISTRY.gauge('sd_result_cache_entries', 'Cached results', _cache_stat('entries'))
+metrics.REGISTRY.gauge('sd_result_cache_bytes', 'Result cache size', _cache_stat('bytes'))
+metrics.REGISTRY.gauge('sd_result_cache_requests_total', 'Result cache lookups by outcome',
+                       lambda: {'hit': result_cache.hits, 'miss': result_cache.misses,
+                                'coalesced': result_cache.coalesced},
+                       ('result',), kind='counter')
+metrics.REGISTRY.gauge('sd_result_cache_evictions_total', 'Results evicted from the cache',
+                       lambda: result_cache.evictions, kind='counter')
+metrics.REGISTRY.gauge('sd_compile_cache_entries', 'Compiled pipeline variants',
+                       lambda: len(sd_manager.compile_cache.entries))
+metrics.REGISTRY.gauge('sd_rate_limited_total', 'Requests rejected by the rate limiter',
+                       lambda: rate_limiter.rejected, kind='counter')
+metrics.REGISTRY.gauge('sd_rate_limiter_clients', 'Clients tracked by the rate limiter',
+                       lambda: rate_limiter.status()['clients'])
+metrics.REGISTRY.gauge('sd_event_rooms', 'Rooms with an event history', lambda: event_bus.status()['rooms'])
+metrics.REGISTRY.gauge('sd_event_queue', 'Events waiting for fan-out', lambda: event_bus.status()['pending'])
+metrics.REGISTRY.gauge('sd_job_journal_pending', 'Journal records waiting for commit',
+                       lambda: job_journal.status()['pending'])
+metrics.REGISTRY.gauge('sd_gallery_items', 'Images in the gallery history', lambda: len(state.gallery_history))
+metrics.REGISTRY.gauge('process_resident_memory_bytes', 'Resident memory size', metrics.process_rss_bytes)
+metrics.REGISTRY.gauge('sd_cuda_memory_bytes', 'CUDA memory of this process', metrics.cuda_memory,
+                       ('device', 'kind'))
 
 # ==================== WEBSOCKET HANDLERS ====================
 
-@socketio.on('connect')
-def handle_connect():
+@on_event('connect')
+def handle_connect(sid, auth=None):
     """Handle client connection"""
-    logger.info(f"Client connected: {request.sid}")
-    emit('connection', {'status': 'connected', 'message': 'Connected to Stable Diffusion server'})
+    logger.info("Client connected: %s", sid)
+    transport.emit('connection', {'status': 'connected', 'message': 'Connected to Stable Diffusion server'}, to=sid)
 
-@socketio.on('disconnect')
-def handle_disconnect():
+@on_event('disconnect')
+def handle_disconnect(sid):
     """Handle client disconnection"""
-    logger.info(f"Client disconnected: {request.sid}")
+    logger.info("Client disconnected: %s", sid)
+
+def prepare_generation(data: Dict) -> Dict:
+    """Validated, normalized generation request (single requests and batch items); ValueError if invalid"""
+    validation_error = validate_input(data, ['task', 'prompt'])
+    if validation_error:
+        raise ValueError(validation_error['error'])
+    
+    if data['task'] == 'sweep':
+        # Reject bad axes now rather than in the worker; fixes the base seed
+        data = prepare_sweep(data)
+        axes = data.get('axes', {})
+        for sampler in axes.get('sampler', [data.get('sampler')]):
+            for schedule in axes.get('scheduler', [data.get('scheduler')]):
+                samplers.check_supported(*samplers.parse_sampler(sampler, schedule))
+    else:
+        # Canonical sampler names (and fast-mode steps) before the result cache and cost model see them
+        data = samplers.normalize(data)
+    return data
+
+def submit_generation(data: Dict, sid: Optional[str] = None) -> Dict:
+    """Validate a generation request and queue it (socket and REST API); ValueError if invalid"""
+    data = prepare_generation(data)
+    job = job_runner.submit({
+        'id': uuid.uuid4().hex,
+        'params': data,
+        'sid': sid
+    })
+    if job['status'] not in ('rejected', 'completed'):
+        event_bus.publish(job_room(job['id']), 'queued', {
+            'job_id': job['id'], 'position': job_runner.queue_depth(), 'coalesced': job['status'] == 'coalesced',
+            'trace_id': job['trace']['id'], 'eta_seconds': job.get('eta_seconds'), 'downscaled': job.get('downscaled')
+        })
+    return job
 
-@socketio.on('generate')
-async def handle_generate(data):
-    """Handle generation request"""
+@on_event('generate')
+def handle_generate(sid, data):
+    """Handle generation request: validate and queue it for the job runner"""
     try:
         validation_error = validate_input(data, ['task', 'prompt'])
         if validation_error:
-            emit('error', validation_error)
+            transport.emit('error', validation_error, to=sid)
             return
         
-        if state.is_generating:
-            emit('error', {'message': 'Generation already in progress'})
+        job = submit_generation(data, sid)
+        if job['status'] == 'rejected':
+            transport.emit('error', {'message': job.get('reject_reason') or 'Server is busy, try again later',
+                                     'job_id': job['id']}, to=sid)
+    
+    except Exception as e:
+        logger.error("Generation error: %s", e)
+        transport.emit('error', {'message': str(e)}, to=sid)
+
+@on_event('cancel_generation')
+def handle_cancel(sid, data=None):
+    """Cancel a job ({'job_id'}), or every unfinished job this client started"""
+    job_id = (data or {}).get('job_id')
+    if job_id:
+        job_ids = [job_id]
+    else:
+        job_ids = [r['id'] for r in list(job_runner.records.values())
+                   if r['sid'] == sid and r['status'] not in FINISHED_STATUSES]
+    # Cancelled jobs announce it in their rooms
+    if not [j for j in job_ids if job_runner.cancel(j)]:
+        transport.emit('cancelled', {'message': 'No generation to cancel', 'job_ids': []}, to=sid)
+
+@on_event('resume_job')
+def handle_resume_job(sid, data):
+    """Reconnected client asking for a job by id: its result, its error, or its further progress"""
+    try:
+        job_id = data.get('job_id')
+        entry = job_journal.get(job_id) if job_id else None
+        if entry is None:
+            transport.emit('error', {'message': 'Unknown job', 'job_id': job_id}, to=sid)
             return
         
-        state.is_generating = True
-        
-        try:
-            # Emit progress
-            emit('progress', {'step': 0, 'total': 100, 'status': 'Starting generation...'})
-            
-            # Generate images
-            images = await sd_manager.generate(data)
-            
-            # Save images and metadata
-            metadata = create_metadata_dict(data)
-            saved_paths = []
-            gdrive_ids = []
-            
-            for idx, image in enumerate(images):
-                # Create filename
-                timestamp = int(time.time())
-                seed = data.get('seed', -1)
-                filename = f"gen_{timestamp}_{seed}_{idx}.png"
-                
-                # Save locally
-                local_path = Path(data.get('output_dir', './outputs')) / filename
-                local_path.parent.mkdir(parents=True, exist_ok=True)
-                image.save(local_path)
-                saved_paths.append(str(local_path))
-                
-                # Upload to Google Drive
-                if gdrive_manager.initialized:
-                    gdrive_id = await gdrive_manager.upload_image(image, metadata)
-                    if gdrive_id:
-                        gdrive_ids.append(gdrive_id)
-                
-                # Store in gallery history
-                state.gallery_history.append({
-                    'path': str(local_path),
-                    'metadata': metadata,
-                    'gdrive_id': gdrive_id,
-                    'timestamp': datetime.now().isoformat()
-                })
-            
-            # Convert images to base64 for preview
-            image_data = []
-            for image in images:
-                buffered = io.BytesIO()
-                image.save(buffered, format="PNG")
-                img_base64 = base64.b64encode(buffered.getvalue()).decode()
-                image_data.append(img_base64)
-            
-            # Emit completion
-            emit('complete', {
-                'images': image_data,
-                'metadata': metadata,
-                'paths': saved_paths,
-                'gdrive_ids': gdrive_ids
-            })
-        
-        finally:
-            state.is_generating = False
+        if entry['status'] == 'completed':
+            payload = dict(entry['result'] or {}, job_id=job_id, restored=True)
+            payload['images'] = [base64.b64encode(Path(path).read_bytes()).decode()
+                                 for path in payload.get('paths', []) if os.path.exists(path)]
+            transport.emit('complete', payload, to=sid)
+        elif entry['status'] in ('failed', 'rejected', 'cancelled'):
+            transport.emit('error', {'message': entry['error'] or f"Job {entry['status']}", 'job_id': job_id}, to=sid)
+        else:
+            # Re-attach: replays what the client missed, then the job's further events
+            event_bus.subscribe(sid, job_room(job_id), since=data.get('since', 0))
+    
+    except Exception as e:
+        logger.error("Job resume failed: %s", e)
+        transport.emit('error', {'message': f'Job resume failed: {e}'}, to=sid)
+
+@on_event('subscribe')
+def handle_subscribe(sid, data):
+    """Watch a job, a batch or the gallery: {'job_id' | 'batch_id' | 'room': 'gallery', 'since': seq}"""
+    room = _room_of(data)
+    if room is None:
+        transport.emit('error', {'message': 'Nothing to subscribe to'}, to=sid)
+        return
+    event_bus.subscribe(sid, room, since=data.get('since'))
+    transport.emit('subscribed', {'room': room}, to=sid)
+
+@on_event('unsubscribe')
+def handle_unsubscribe(sid, data):
+    """Stop watching a room"""
+    room = _room_of(data)
+    if room is not None:
+        event_bus.unsubscribe(sid, room)
+
+def _room_of(data: Dict) -> Optional[str]:
+    if data.get('job_id'):
+        return job_room(data['job_id'])
+    if data.get('batch_id'):
+        return batch_room(data['batch_id'])
+    room = data.get('room')
+    return room if room and is_public_room(room) else None
+
+@on_event('start_batch')
+def handle_start_batch(sid, data):
+    """Start a batch from {'items': [...]} or {'text': JSONL/CSV, 'format'}; progress comes as 'batch_progress'"""
+    try:
+        items = data.get('items')
+        if items is None:
+            items = parse_specs(data.get('text', ''), data.get('format'))
+        batch = batch_manager.create(items, defaults=data.get('defaults'), name=data.get('name'))
+        event_bus.subscribe(sid, batch_room(batch.id))
+        transport.emit('batch_started', batch.status(), to=sid)
     
     except Exception as e:
-        logger.error(f"Generation error: {e}")
-        emit('error', {'message': str(e)})
-        state.is_generating = False
-
-@socketio.on('cancel_generation')
-def handle_cancel():
-    """Cancel current generation"""
-    state.is_generating = False
-    emit('cancelled', {'message': 'Generation cancelled'})
-
-@socketio.on('download_model')
-async def handle_download_model(data):
+        logger.error("Batch start failed: %s", e)
+        transport.emit('error', {'message': f'Batch start failed: {e}'}, to=sid)
+
+@on_event('download_model')
+async def handle_download_model(sid, data):
     """Handle model download request"""
     try:
         url = data.get('url', '').strip()
@@ -742,22 +1250,22 @@ async def handle_download_model(data):
         civitai_key = data.get('civitai_key', '')
         
         if not url:
-            emit('error', {'message': 'URL is required'})
+            transport.emit('error', {'message': 'URL is required'}, to=sid)
             return
         
         # Emit start
-        emit('download_start', {
+        transport.emit('download_start', {
             'model_type': model_type,
             'url': url
-        })
+        }, to=sid)
         
         # Define progress callback
         async def progress_callback(progress_data):
-            emit('download_progress', {
+            transport.emit('download_progress', {
                 'model_type': model_type,
                 'progress': progress_data['progress'],
                 'filename': progress_data['filename']
-            })
+            }, to=sid)
         
         # Download based on type
         if model_type == 'checkpoint':
@@ -767,55 +1275,55 @@ async def handle_download_model(data):
         elif model_type == 'vae':
             result = await downloader.download_vae(url, hf_token, progress_callback)
         else:
-            emit('error', {'message': f'Unknown model type: {model_type}'})
+            transport.emit('error', {'message': f'Unknown model type: {model_type}'}, to=sid)
             return
         
         if result['status'] == 'success':
-            emit('download_complete', {
+            transport.emit('download_complete', {
                 'model_type': model_type,
                 'filename': result['filename'],
                 'path': result['path'],
                 'size': result['size']
-            })
+            }, to=sid)
         else:
-            emit('error', {'message': result.get('message', 'Download failed')})
+            transport.emit('error', {'message': result.get('message', 'Download failed')}, to=sid)
     
     except Exception as e:
-        logger.error(f"Download error: {e}")
-        emit('error', {'message': f'Download error: {str(e)}'})
+        logger.error("Download error: %s", e)
+        transport.emit('error', {'message': f'Download error: {str(e)}'}, to=sid)
 
-@socketio.on('get_available_models')
-def handle_get_available_models():
+@on_event('get_available_models')
+def handle_get_available_models(sid):
     """Get list of available models"""
     try:
         models = downloader.get_available_models()
-        emit('models_list', {
+        transport.emit('models_list', {
             'models': models,
             'total': len(models)
-        })
+        }, to=sid)
     except Exception as e:
-        logger.error(f"Error getting models list: {e}")
-        emit('error', {'message': str(e)})
+        logger.error("Error getting models list: %s", e)
+        transport.emit('error', {'message': str(e)}, to=sid)
 
-@socketio.on('delete_model')
-def handle_delete_model(data):
+@on_event('delete_model')
+def handle_delete_model(sid, data):
     """Delete a model file"""
     try:
         path = data.get('path', '')
         if not path:
-            emit('error', {'message': 'Path is required'})
+            transport.emit('error', {'message': 'Path is required'}, to=sid)
             return
         
         if downloader.delete_model(path):
-            emit('model_deleted', {'path': path})
+            transport.emit('model_deleted', {'path': path}, to=sid)
         else:
-            emit('error', {'message': 'Failed to delete model'})
+            transport.emit('error', {'message': 'Failed to delete model'}, to=sid)
     except Exception as e:
-        logger.error(f"Delete error: {e}")
-        emit('error', {'message': str(e)})
+        logger.error("Delete error: %s", e)
+        transport.emit('error', {'message': str(e)}, to=sid)
 
-@socketio.on('get_models')
-async def handle_get_models():
+@on_event('get_models')
+async def handle_get_models(sid):
     """Get list of available models"""
     try:
         models = {
@@ -832,36 +1340,36 @@ async def handle_get_models():
                 'lllyasviel/control_v11p_sd15_depth',
             ]
         }
-        emit('models_list', models)
+        transport.emit('models_list', models, to=sid)
     except Exception as e:
-        emit('error', {'message': f'Failed to get models: {e}'})
+        transport.emit('error', {'message': f'Failed to get models: {e}'}, to=sid)
 
-@socketio.on('download_model')
-async def handle_download_model(data):
+@on_event('download_model')
+async def handle_download_model(sid, data):
     """Download model from URL"""
     try:
         validation_error = validate_input(data, ['url', 'type'])
         if validation_error:
-            emit('error', validation_error)
+            transport.emit('error', validation_error, to=sid)
             return
         
         url = data['url']
         model_type = data['type']  # checkpoint, lora, vae
         
-        emit('progress', {'status': f'Downloading {model_type}...', 'step': 0, 'total': 100})
+        transport.emit('progress', {'status': f'Downloading {model_type}...', 'step': 0, 'total': 100}, to=sid)
         
         # Mock download
-        logger.info(f"Downloading {model_type} from {url}")
+        logger.info("Downloading %s from %s", model_type, url)
         
-        emit('progress', {'status': f'{model_type} downloaded', 'step': 100, 'total': 100})
-        emit('success', {'message': f'{model_type} downloaded successfully'})
+        transport.emit('progress', {'status': f'{model_type} downloaded', 'step': 100, 'total': 100}, to=sid)
+        transport.emit('success', {'message': f'{model_type} downloaded successfully'}, to=sid)
     
     except Exception as e:
-        logger.error(f"Download failed: {e}")
-        emit('error', {'message': f'Download failed: {e}'})
+        logger.error("Download failed: %s", e)
+        transport.emit('error', {'message': f'Download failed: {e}'}, to=sid)
 
-@socketio.on('get_gallery')
-async def handle_get_gallery(data):
+@on_event('get_gallery')
+async def handle_get_gallery(sid, data):
     """Get gallery items with pagination"""
     try:
         page = data.get('page', 0)
@@ -873,45 +1381,45 @@ async def handle_get_gallery(data):
         items = state.gallery_history[start:end]
         total = len(state.gallery_history)
         
-        emit('gallery_data', {
+        transport.emit('gallery_data', {
             'items': items,
             'total': total,
             'page': page,
             'limit': limit
-        })
+        }, to=sid)
     
     except Exception as e:
-        logger.error(f"Gallery retrieval failed: {e}")
-        emit('error', {'message': f'Gallery retrieval failed: {e}'})
+        logger.error("Gallery retrieval failed: %s", e)
+        transport.emit('error', {'message': f'Gallery retrieval failed: {e}'}, to=sid)
 
-@socketio.on('enhance_prompt')
-async def handle_enhance_prompt(data):
+@on_event('enhance_prompt')
+async def handle_enhance_prompt(sid, data):
     """Enhance prompt"""
     try:
         validation_error = validate_input(data, ['prompt'])
         if validation_error:
-            emit('error', validation_error)
+            transport.emit('error', validation_error, to=sid)
             return
         
         original_prompt = data['prompt']
         enhanced = await enhance_prompt(original_prompt)
         
-        emit('prompt_enhanced', {
+        transport.emit('prompt_enhanced', {
             'original': original_prompt,
             'enhanced': enhanced
-        })
+        }, to=sid)
     
     except Exception as e:
-        logger.error(f"Prompt enhancement failed: {e}")
-        emit('error', {'message': f'Prompt enhancement failed: {e}'})
+        logger.error("Prompt enhancement failed: %s", e)
+        transport.emit('error', {'message': f'Prompt enhancement failed: {e}'}, to=sid)
 
-@socketio.on('upscale_image')
-async def handle_upscale_image(data):
+@on_event('upscale_image')
+async def handle_upscale_image(sid, data):
     """Upscale image"""
     try:
         validation_error = validate_input(data, ['image', 'scale'])
         if validation_error:
-            emit('error', validation_error)
+            transport.emit('error', validation_error, to=sid)
             return
         
         # Decode base64 image
@@ -924,27 +1432,25 @@ async def handle_upscale_image(data):
         upscaled = await upscale_image(image, scale, method)
         
         # Encode to base64
-        buffered = io.BytesIO()
-        upscaled.save(buffered, format="PNG")
-        img_base64 = base64.b64encode(buffered.getvalue()).decode()
+        img_base64 = await asyncio.to_thread(png_base64, upscaled)
         
-        emit('upscale_complete', {
+        transport.emit('upscale_complete', {
             'image': img_base64,
             'original_size': (image.width, image.height),
             'upscaled_size': (upscaled.width, upscaled.height)
-        })
+        }, to=sid)
     
     except Exception as e:
-        logger.error(f"Upscaling failed: {e}")
-        emit('error', {'message': f'Upscaling failed: {e}'})
+        logger.error("Upscaling failed: %s", e)
+        transport.emit('error', {'message': f'Upscaling failed: {e}'}, to=sid)
 
-@socketio.on('adetailer')
-async def handle_adetailer(data):
+@on_event('adetailer')
+async def handle_adetailer(sid, data):
     """Apply Adetailer to image"""
     try:
         validation_error = validate_input(data, ['image'])
         if validation_error:
-            emit('error', validation_error)
+            transport.emit('error', validation_error, to=sid)
             return
         
         image_data = base64.b64decode(data['image'])
@@ -952,15 +1458,15 @@ async def handle_adetailer(data):
         
         result = await apply_adetailer(image, data)
         
-        buffered = io.BytesIO()
-        result.save(buffered, format="PNG")
-        img_base64 = base64.b64encode(buffered.getvalue()).decode()
+        img_base64 = await asyncio.to_thread(png_base64, result)
         
-        emit('adetailer_complete', {'image': img_base64})
+        transport.emit('adetailer_complete', {'image': img_base64}, to=sid)
     
     except Exception as e:
-        logger.error(f"Adetailer failed: {e}")
-        emit('error', {'message': f'Adetailer failed: {e}'})
+        logger.error("Adetailer failed: %s", e)
+        transport.emit('error', {'message': f'Adetailer failed: {e}'}, to=sid)
+
+transport.register(socket_handlers)
 
 # ==================== MODEL DOWNLOADER ====================
 
@@ -994,7 +1500,7 @@ class ModelDownloader:
                         return data['modelVersions'][0]['downloadUrl']
             return url
         except Exception as e:
-            logger.error(f"Error parsing Civitai URL: {e}")
+            logger.error("Error parsing Civitai URL: %s", e)
             return url
     
     def _parse_huggingface_url(self, url: str, hf_token: str = None) -> Optional[str]:
@@ -1055,7 +1561,7 @@ class ModelDownloader:
                 'size': filepath.stat().st_size
             }
         except Exception as e:
-            logger.error(f"Checkpoint download failed: {e}")
+            logger.error("Checkpoint download failed: %s", e)
             return {'status': 'error', 'message': str(e)}
     
     async def download_lora(self, url: str, hf_token: str = None,
@@ -1097,7 +1603,7 @@ class ModelDownloader:
                 'size': filepath.stat().st_size
             }
         except Exception as e:
-            logger.error(f"LoRA download failed: {e}")
+            logger.error("LoRA download failed: %s", e)
             return {'status': 'error', 'message': str(e)}
     
     async def download_vae(self, url: str, hf_token: str = None,
@@ -1135,7 +1641,7 @@ class ModelDownloader:
                 'size': filepath.stat().st_size
             }
         except Exception as e:
-            logger.error(f"VAE download failed: {e}")
+            logger.error("VAE download failed: %s", e)
             return {'status': 'error', 'message': str(e)}
     
     async def _download_hf_model(self, model_id: str, hf_token: str = None,
@@ -1166,7 +1672,7 @@ class ModelDownloader:
                 'size': Path(filepath).stat().st_size
             }
         except Exception as e:
-            logger.error(f"HF download failed: {e}")
+            logger.error("HF download failed: %s", e)
             return {'status': 'error', 'message': str(e)}
     
     def get_available_models(self) -> List[Dict[str, Any]]:
@@ -1195,10 +1701,10 @@ class ModelDownloader:
             file_path = Path(path)
             if file_path.exists() and file_path.parent in [self.checkpoint_dir, self.lora_dir, self.vae_dir]:
                 file_path.unlink()
-                logger.info(f"Deleted model: {path}")
+                logger.info("Deleted model: %s", path)
                 return True
         except Exception as e:
-            logger.error(f"Failed to delete model: {e}")
+            logger.error("Failed to delete model: %s", e)
         return False
 
 downloader = ModelDownloader()
@@ -1210,11 +1716,84 @@ def health_check():
     """Health check endpoint"""
     return jsonify({
         'status': 'ok',
-        'device': state.device,
+        'live': True,
+        'ready': state.is_ready(),
+        'models': dict(state.model_status),
+        'uptime': round(time.time() - state.started_at, 1),
+        'device': state.peek_device(),
         'is_generating': state.is_generating,
+        'jobs': job_runner.status(),
+        'result_cache': result_cache.status(),
+        'job_journal': job_journal.status(),
+        'events': event_bus.status(),
+        'performance': perf_monitor.get_report(by_series=True),
+        'tracing': tracing.tracer.status(),
+        'profile': profiler.profiler.status(),
+        'memory': memory_tracker.status(),
+        'samplers': sd_manager.schedulers.status(),
+        'logging': structured_logging.status(),
+        'scheduling': {
+            'policy': os.environ.get('SCHEDULING_POLICY', 'fifo').lower(),
+            'admission': ADMISSION_CONTROL,
+            'cost_model': {k: v for k, v in cost_model.status().items() if k != 'fits'}
+        },
         'gdrive_connected': gdrive_manager.initialized
     })
 
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Prometheus scrape endpoint"""
+    return Response(metrics.REGISTRY.expose(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/health/live', methods=['GET'])
+def liveness_check():
+    """Liveness probe: the process is up and serving requests"""
+    return jsonify({'live': True})
+
+@app.route('/health/ready', methods=['GET'])
+def readiness_check():
+    """Readiness probe: 503 until all preloaded models are warm"""
+    ready = state.is_ready()
+    return jsonify({
+        'ready': ready,
+        'models': dict(state.model_status)
+    }), 200 if ready else 503
+
+@app.route('/api/cost-model', methods=['GET'])
+def cost_model_status():
+    """Learned latency fits, model load times and memory calibration of the cost model"""
+    return jsonify(dict(cost_model.status(), memory_calibration=dict(sd_manager.memory_policy.calibration)))
+
+@app.route('/api/memory', methods=['GET'])
+def memory_breakdown():
+    """Memory by model, cache and in-flight job, for this process and each inference worker
+
+    ?check=true first collects garbage and flags job pipelines that outlived their job.
+    """
+    if request.args.get('check') == 'true':
+        memory_tracker.check()
+    trace_jobs = {record['trace_id']: job_id for job_id, record in list(job_runner.records.items())}
+    
+    def by_job(report: Dict) -> Dict:
+        report['jobs'] = {trace_jobs.get(trace_id, trace_id): entries for trace_id, entries in report['jobs'].items()}
+        return report
+    
+    cuda = metrics.cuda_memory() or {}
+    devices = sorted({device for device, _ in cuda})
+    return jsonify({
+        **by_job(memory_tracker.report()),
+        'running_jobs': sorted(job_runner._running),
+        'caches': {
+            # Freed blocks the CUDA caching allocator keeps for reuse
+            'cuda_allocator_cached': {d: cuda[(d, 'reserved')] - cuda[(d, 'allocated')] for d in devices},
+            'compiled_graphs': len(sd_manager.compile_cache.entries),
+            'result_cache_disk': result_cache.status()['bytes']
+        },
+        'workers': {worker_id: by_job(report) if report else None
+                    for worker_id, report in job_runner.pool.memory_reports().items()}
+                   if job_runner.pool else None
+    })
+
 @app.route('/api/image/<image_id>', methods=['GET'])
 def get_image(image_id):
     """Get saved image by ID"""
@@ -1251,11 +1830,264 @@ def list_models():
             'loaded_models': list(sd_manager.pipelines.keys()),
             'current_model': sd_manager.current_model,
             'device': state.device,
-            'precision': state.model_precision
+            'precision': state.model_precision,
+            'precision_modes': list(precision.PRECISION_MODES),
+            'memory': dict(sd_manager.memory_reports),
+            'memory_policy': {
+                'settings': sd_manager.memory_policy.settings,
+                'calibration': dict(sd_manager.memory_policy.calibration)
+            },
+            'compile_cache': sd_manager.compile_cache.status()
         })
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def _image_urls(job_id: str, result: Optional[Dict]) -> List[str]:
+    return [f"/api/jobs/{job_id}/images/{index}" for index in range(len((result or {}).get('paths', [])))]
+
+def _job_json(status: Dict) -> Dict:
+    """Job status for the REST API: images as URLs"""
+    status = dict(status)
+    if status.get('result'):
+        status['result'] = dict(status['result'], image_urls=_image_urls(status['id'], status['result']))
+    return status
+
+def _sse(event: str, data: Dict) -> str:
+    """One Server-Sent Event; image data is replaced by URLs"""
+    if event == 'complete':
+        data = {k: v for k, v in data.items() if k != 'images'}
+        data['image_urls'] = _image_urls(data['job_id'], data)
+    seq = data.get('seq')
+    return (f"id: {seq}\n" if seq is not None else '') + f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+@app.route('/api/jobs', methods=['POST'])
+def create_job():
+    """Queue a generation (same parameters as the 'generate' socket event); returns the job id at once"""
+    try:
+        job = submit_generation(request.get_json(force=True))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    
+    if job['status'] == 'rejected' and job.get('reject_reason'):
+        return jsonify({'error': job['reject_reason'], 'job_id': job['id']}), 422
+    if job['status'] == 'rejected':
+        response = jsonify({'error': 'Server is busy, try again later'})
+        response.status_code = 503
+        response.headers['Retry-After'] = '5'
+        return response
+    
+    body = _job_json(job_runner.job_status(job['id']))
+    body.update(job_id=job['id'], position=job_runner.queue_depth(), urls={
+        'status': f"/api/jobs/{job['id']}",
+        'events': f"/api/jobs/{job['id']}/events"
+    })
+    return jsonify(body), 200 if job['status'] == 'completed' else 202
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Status, progress and result of a job"""
+    status = job_runner.job_status(job_id)
+    if status is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(_job_json(status))
+
+@app.route('/api/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    """Cancel a queued or running job"""
+    status = job_runner.job_status(job_id)
+    if status is None:
+        return jsonify({'error': 'Job not found'}), 404
+    if not job_runner.cancel(job_id):
+        return jsonify({'error': f"Job is already {status['status']}", 'status': status['status']}), 409
+    return jsonify({'job_id': job_id, 'status': 'cancelled'})
+
+@app.route('/api/jobs/<job_id>/images/<int:index>', methods=['GET'])
+def get_job_image(job_id, index):
+    """PNG of a finished job"""
+    status = job_runner.job_status(job_id)
+    paths = ((status or {}).get('result') or {}).get('paths', [])
+    if index >= len(paths) or not os.path.exists(paths[index]):
+        return jsonify({'error': 'Image not found'}), 404
+    return send_file(os.path.abspath(paths[index]), mimetype='image/png')
+
+@app.route('/api/jobs/<job_id>/trace', methods=['GET'])
+def get_job_trace(job_id):
+    """Chrome trace / Perfetto JSON of a job (its spans recorded on this node)"""
+    record = job_runner.records.get(job_id)
+    if record is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    return jsonify(tracing.tracer.export(record['trace_id']))
+
+@app.route('/api/traces', methods=['GET'])
+def get_traces():
+    """Chrome trace JSON of one trace (?trace_id=) or of the most recent spans (?limit=)"""
+    trace_id = request.args.get('trace_id')
+    limit = request.args.get('limit', 5000, type=int)
+    return jsonify(tracing.tracer.export(trace_id, limit=None if trace_id else limit))
+
+@app.route('/api/admin/profile', methods=['POST'])
+@admin_required
+def start_profile():
+    """Start a sampling profile: {'seconds'} window or the next {'jobs'}, 'interval_ms', 'torch'"""
+    data = request.get_json(silent=True) or {}
+    try:
+        session = profiler.profiler.start(
+            seconds=float(data['seconds']) if data.get('seconds') else None,
+            jobs=int(data['jobs']) if data.get('jobs') else None,
+            interval=max(float(data.get('interval_ms', 10)), 1) / 1000,
+            torch_job=bool(data.get('torch', False))
+        )
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Invalid profile options'}), 400
+    except RuntimeError as e:
+        return jsonify({'error': str(e)}), 409
+    return jsonify(session.status()), 201
+
+@app.route('/api/admin/profile', methods=['GET'])
+@admin_required
+def get_profile():
+    """Last profile as collapsed stacks (?format=collapsed, default) or ?format=speedscope; 202 while running"""
+    session = profiler.profiler.session
+    if session is None:
+        return jsonify({'error': 'No profile'}), 404
+    if request.args.get('format') == 'status' or (not session.finished.is_set() and
+                                                  request.args.get('partial') != 'true'):
+        return jsonify(session.status()), 200 if session.finished.is_set() else 202
+    if request.args.get('format') == 'speedscope':
+        return jsonify(session.output('speedscope'))
+    return Response(session.output('collapsed'), content_type='text/plain; charset=utf-8')
+
+@app.route('/api/admin/profile', methods=['DELETE'])
+@admin_required
+def stop_profile():
+    """Stop the running profile early"""
+    session = profiler.profiler.session
+    if session is None:
+        return jsonify({'error': 'No profile'}), 404
+    session.stop()
+    return jsonify(session.status())
+
+@app.route('/api/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    """Server-Sent Events of a job (progress, sweep_cell, complete / error / cancelled)
+    
+    Reconnecting clients send Last-Event-ID (or ?since=) and get the events they missed.
+    """
+    status = job_runner.job_status(job_id)
+    if status is None:
+        return jsonify({'error': 'Job not found'}), 404
+    try:
+        since = int(request.headers.get('Last-Event-ID') or request.args.get('since', 0))
+    except ValueError:
+        return jsonify({'error': 'Last-Event-ID / since must be an event number'}), 400
+    room = job_room(job_id)
+    terminal = ('complete', 'error', 'cancelled')
+    
+    def final_event(status: Dict) -> str:
+        """Terminal event rebuilt from the job status, when it is no longer buffered"""
+        if status['status'] == 'completed':
+            return _sse('complete', dict(status['result'] or {}, job_id=job_id))
+        if status['status'] == 'cancelled':
+            return _sse('cancelled', {'job_id': job_id, 'message': 'Generation cancelled'})
+        return _sse('error', {'job_id': job_id, 'message': status.get('error') or f"Job {status['status']}"})
+    
+    def stream():
+        if status['status'] in FINISHED_STATUSES:
+            history = event_bus.history(room, since)
+            for item in history:
+                yield _sse(item['event'], item['data'])
+            if not any(item['event'] in terminal for item in history):
+                yield final_event(status)
+            return
+        
+        events = queue.Queue()
+        listener = lambda event, data: events.put((event, data))
+        event_bus.listen(room, listener, since=since)
+        try:
+            while True:
+                try:
+                    event, data = events.get(timeout=SSE_KEEPALIVE)
+                except queue.Empty:
+                    current = job_runner.job_status(job_id)
+                    if current is None or current['status'] in FINISHED_STATUSES:
+                        yield final_event(current or dict(status, status='failed'))
+                        return
+                    yield ': keep-alive\n\n'
+                    continue
+                yield _sse(event, data)
+                if event in terminal:
+                    return
+        finally:
+            event_bus.unlisten(room, listener)
+    
+    live = status['status'] not in FINISHED_STATUSES
+    if live and not sse_streams.acquire(blocking=False):
+        response = jsonify({'error': 'Too many open event streams, poll the job status instead'})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(SSE_KEEPALIVE)
+        return response
+    
+    response = Response(stream_with_context(stream()), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    if live:
+        # Runs when the stream ends or the client goes away, started or not
+        response.call_on_close(sse_streams.release)
+    return response
+
+@app.route('/api/batch', methods=['POST'])
+def create_batch():
+    """Start a batch: JSON {'items', 'defaults', 'name'} or an uploaded JSONL/CSV file ('file')"""
+    try:
+        if 'file' in request.files:
+            upload = request.files['file']
+            fmt = 'csv' if upload.filename.lower().endswith('.csv') else 'jsonl'
+            items = parse_specs(upload.read().decode('utf-8'), fmt)
+            defaults = json.loads(request.form.get('defaults', '{}'))
+            name = request.form.get('name') or Path(upload.filename).stem
+        else:
+            data = request.get_json(force=True)
+            items = data.get('items')
+            if items is None:
+                items = parse_specs(data.get('text', ''), data.get('format'))
+            defaults, name = data.get('defaults'), data.get('name')
+        batch = batch_manager.create(items, defaults=defaults, name=name)
+        return jsonify(batch.status()), 202
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/batch', methods=['GET'])
+def list_batches():
+    """All batches with their progress"""
+    return jsonify({'batches': batch_manager.list()})
+
+@app.route('/api/batch/<batch_id>', methods=['GET'])
+def get_batch(batch_id):
+    """Progress and throughput of a batch"""
+    batch = batch_manager.get(batch_id)
+    if batch is None:
+        return jsonify({'error': 'Batch not found'}), 404
+    return jsonify(batch.status())
+
+@app.route('/api/batch/<batch_id>/resume', methods=['POST'])
+def resume_batch(batch_id):
+    """Run the unfinished items of a batch again"""
+    try:
+        return jsonify(batch_manager.start(batch_id).status()), 202
+    except KeyError:
+        return jsonify({'error': 'Batch not found'}), 404
+
+@app.route('/api/batch/<batch_id>/cancel', methods=['POST'])
+def cancel_batch(batch_id):
+    """Stop submitting items of a batch; queued items still finish"""
+    batch = batch_manager.cancel(batch_id)
+    if batch is None:
+        return jsonify({'error': 'Batch not found'}), 404
+    return jsonify(batch.status())
+
 # ==================== INITIALIZATION ====================
 
 async def initialize_server():
@@ -1283,44 +2115,80 @@ async def initialize_server():
                 local_models = Path('./models')
                 if not local_models.exists():
                     os.symlink(str(project_path / 'models'), str(local_models))
-                    logger.info(f"✅ Linked models to Drive")
+                    logger.info("✅ Linked models to Drive")
                 
                 local_outputs = Path('./outputs')
                 if not local_outputs.exists():
                     os.symlink(str(project_path / 'outputs'), str(local_outputs))
-                    logger.info(f"✅ Linked outputs to Drive")
+                    logger.info("✅ Linked outputs to Drive")
                 
             except Exception as e:
-                logger.warning(f"⚠️ Google Drive mount failed: {e}")
+                logger.warning("⚠️ Google Drive mount failed: %s", e)
+        
+        # Connect to the job broker; load and warm up models in the background
+        job_runner.start()
+        
+        # Requeue jobs that were queued or running when the server went down
+        job_journal.start()
+        pruned = job_journal.prune(float(os.environ.get('JOB_JOURNAL_RETENTION_DAYS', 7)) * 86400)
+        recovered = job_runner.recover()
+        if recovered or pruned:
+            logger.info("📒 Job journal: requeued %s unfinished jobs, pruned %s", recovered, pruned)
+        if job_runner.pool is None and job_runner.role != 'frontend':
+            start_model_preload()
+        
+        # Pick up batches interrupted by a restart (e.g. a Colab disconnect)
+        if os.environ.get('BATCH_AUTO_RESUME', 'true').lower() in ('1', 'true', 'yes'):
+            resumed = batch_manager.resume_unfinished()
+            if resumed:
+                logger.info("📦 Resumed batches: %s", ', '.join(resumed))
         
         # Initialize Google Drive API
         await gdrive_manager.initialize()
         
         logger.info("✅ Server initialization complete")
     except Exception as e:
-        logger.error(f"❌ Server initialization failed: {e}")
+        logger.error("❌ Server initialization failed: %s", e)
 
 @app.before_request
 def before_request():
-    """Before request hook for rate limiting"""
-    pass
+    """Rate limit REST requests per client; health probes and scrapes are exempt"""
+    if request.path.startswith('/health') or request.path == '/metrics':
+        return None
+    allowed, retry_after = rate_limiter.check(request.environ, request.endpoint or 'rest')
+    if not allowed:
+        response = jsonify({'error': 'Rate limit exceeded', 'retry_after': round(retry_after, 1)})
+        response.status_code = 429
+        response.headers['Retry-After'] = retry_after_header(retry_after)
+        return response
+    return None
 
 # ==================== MAIN ====================
 
 if __name__ == '__main__':
-    # Create output directory
-    Path('./outputs').mkdir(exist_ok=True)
-    
     # Get port from environment or use default
     port = int(os.environ.get('PORT', 5000))
     
+    # asgi (default): uvicorn + python-socketio AsyncServer, see asgi_server.py
+    # threading: Werkzeug development server, a few dozen clients at most
+    server_mode = os.environ.get('SERVER_MODE', 'asgi').lower()
+    if server_mode == 'asgi':
+        # Let asgi_server import this module instead of loading a second copy
+        sys.modules.setdefault('colab_server', sys.modules[__name__])
+        import asgi_server
+        asgi_server.run(port=port)
+        sys.exit(0)
+    
+    # Create output directory
+    Path('./outputs').mkdir(exist_ok=True)
+    
     # Initialize server
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
     loop.run_until_complete(initialize_server())
     
     # Start server
-    logger.info(f"Starting server on port {port}")
+    logger.info("Starting development server on port %s", port)
     socketio.run(
         app,
         host='0.0.0.0',
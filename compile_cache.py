@@ -0,0 +1,202 @@
+"""
+torch.compile cache for UNet and VAE decoder with resolution bucketing
+
+Opt-in with ENABLE_TORCH_COMPILE=true. Requests are snapped to the nearest
+resolution bucket (RESOLUTION_BUCKETS) so a small set of static-shape graphs
+covers all traffic. Graphs are compiled per (model, bucket, batch size) on a
+background thread after the first eager run of that key; until a key is ready,
+requests keep running eagerly. The warm-up passes that trigger compilation
+run under the model's pipeline lock (pipeline_lock), so they never overlap
+a job on the same pipeline.
+"""
+
+import os
+import queue
+import logging
+import threading
+import time
+import weakref
+from contextlib import contextmanager, nullcontext
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = '512x512,512x768,768x512,768x768,640x896,896x640,1024x1024'
+
+def parse_buckets(value: str) -> List[Tuple[int, int]]:
+    """Parse "WxH,WxH" into a list of (width, height), multiples of 8"""
+    buckets = []
+    for item in value.split(','):
+        if 'x' not in item:
+            continue
+        width, height = item.lower().split('x', 1)
+        buckets.append((int(width) // 8 * 8, int(height) // 8 * 8))
+    return buckets
+
+class CompiledPipelineCache:
+    """Compiled UNet / VAE decoder modules keyed by (model, width, height, batch)"""
+
+    def __init__(self, enabled: Optional[bool] = None, buckets: Optional[List[Tuple[int, int]]] = None,
+                 mode: Optional[str] = None, pipeline_lock: Optional[Callable] = None):
+        if enabled is None:
+            enabled = os.environ.get('ENABLE_TORCH_COMPILE', 'false').lower() in ('1', 'true', 'yes')
+        self.enabled = enabled
+        self.buckets = buckets or parse_buckets(os.environ.get('RESOLUTION_BUCKETS', DEFAULT_BUCKETS))
+        self.mode = mode or os.environ.get('TORCH_COMPILE_MODE', 'default')
+        # model name -> lock that jobs on its pipeline hold
+        self.pipeline_lock = pipeline_lock or (lambda model_name: nullcontext())
+        # key -> {'status', 'unet', 'decoder', 'compile_s', 'hits'}
+        self.entries = {}
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._thread = None
+
+    # ---------- bucketing ----------
+
+    def snap(self, width: int, height: int) -> Tuple[int, int]:
+        """Nearest bucket: closest aspect ratio first, then closest area"""
+        if not self.buckets:
+            return width, height
+        aspect = width / height
+        area = width * height
+        return min(self.buckets, key=lambda b: (round(abs(b[0] / b[1] - aspect), 2), abs(b[0] * b[1] - area)))
+
+    @staticmethod
+    def key_for(params: Dict) -> Tuple[str, int, int, int]:
+        """Cache key of a request: model, size and UNet batch (doubled by CFG)"""
+        batch = params.get('num_images', 1)
+        unet_batch = batch * 2 if params.get('cfg_scale', 7.5) > 1 else batch
+        return (params.get('model'), params.get('width', 512), params.get('height', 512), unet_batch)
+
+    # ---------- compilation ----------
+
+    def schedule(self, pipeline, params: Dict, device: str):
+        """Queue background compilation for the request's key if not done yet"""
+        if not self.enabled:
+            return
+        key = self.key_for(params)
+        with self._lock:
+            if key in self.entries:
+                return
+            self.entries[key] = {'status': 'pending', 'unet': None, 'decoder': None, 'compile_s': None, 'hits': 0}
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._worker, name='torch-compile', daemon=True)
+                self._thread.start()
+        # Weak reference: a queued compile must not keep an unloaded model alive
+        self._queue.put((key, weakref.ref(pipeline), params.get('num_images', 1), device))
+
+    def _worker(self):
+        """Compile queued keys one at a time"""
+        while True:
+            item = self._queue.get()
+            try:
+                self._compile_entry(*item)
+            finally:
+                self._queue.task_done()
+            # Do not hold on to the last pipeline while waiting for the next key
+            del item
+
+    def _compile_entry(self, key, pipeline_ref, batch: int, device: str):
+        """Compile one queued key unless its model was unloaded in the meantime"""
+        entry = self.entries.get(key)
+        pipeline = pipeline_ref()
+        if entry is None or pipeline is None:
+            logger.debug("Skipping compile of %s: model unloaded", key)
+            return
+        entry['status'] = 'compiling'
+        try:
+            with self.pipeline_lock(key[0]):
+                start = time.time()
+                entry['unet'], entry['decoder'] = self._compile(pipeline, key, batch, device)
+                entry['compile_s'] = round(time.time() - start, 2)
+            entry['status'] = 'ready'
+            logger.info("Compiled %s %sx%s batch %s in %ss", key[0], key[1], key[2], key[3], entry['compile_s'])
+        except Exception as e:
+            entry['status'] = 'failed'
+            logger.warning("torch.compile failed for %s: %s", key, e)
+
+    def _compile(self, pipeline, key, batch: int, device: str):
+        """Compile UNet and VAE decoder and trace them once at the bucket shape"""
+        import torch
+
+        _, width, height, unet_batch = key
+        unet = pipeline.unet
+        vae = pipeline.vae
+        dtype = unet.dtype
+        compiled_unet = torch.compile(unet, mode=self.mode, dynamic=False)
+        compiled_decoder = torch.compile(vae.decoder, mode=self.mode, dynamic=False)
+
+        latent_h, latent_w = height // 8, width // 8
+        with torch.no_grad():
+            latents = torch.randn(unet_batch, unet.config.in_channels, latent_h, latent_w, dtype=dtype, device=device)
+            hidden = torch.randn(unet_batch, 77, unet.config.cross_attention_dim, dtype=dtype, device=device)
+            timestep = torch.tensor(999, device=device)
+            extra = {}
+            if getattr(unet.config, 'addition_embed_type', None) == 'text_time':
+                # SDXL: pooled text embeddings and size/crop conditioning
+                pooled_dim = unet.config.projection_class_embeddings_input_dim - 6 * unet.config.addition_time_embed_dim
+                extra['added_cond_kwargs'] = {
+                    'text_embeds': torch.randn(unet_batch, pooled_dim, dtype=dtype, device=device),
+                    'time_ids': torch.randn(unet_batch, 6, dtype=dtype, device=device),
+                }
+            compiled_unet(latents, timestep, encoder_hidden_states=hidden, **extra)
+
+            decoder_dtype = next(vae.decoder.parameters()).dtype
+            z = torch.randn(batch, vae.config.latent_channels, latent_h, latent_w, dtype=decoder_dtype, device=device)
+            compiled_decoder(vae.post_quant_conv(z) if hasattr(vae, 'post_quant_conv') else z)
+        return compiled_unet, compiled_decoder
+
+    def wait(self, timeout: Optional[float] = None):
+        """Block until all queued compilations are done (benchmarks)"""
+        deadline = time.time() + timeout if timeout else None
+        while self._queue.unfinished_tasks:
+            if deadline and time.time() > deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    # ---------- execution ----------
+
+    @contextmanager
+    def use(self, pipeline, params: Dict, memory_plan: Optional[Dict] = None):
+        """Run the pipeline with compiled modules if the key is ready, eagerly otherwise"""
+        entry = self.entries.get(self.key_for(params)) if self.enabled else None
+        # Slicing / tiling / offload change shapes and hooks; keep those eager
+        eager_only = memory_plan is not None and memory_plan.get('level', 0) > 0
+        if entry is None or entry['status'] != 'ready' or eager_only:
+            if self.enabled:
+                self.misses += 1
+            yield False
+            return
+
+        unet = pipeline.unet
+        decoder = pipeline.vae.decoder
+        # Bypass DiffusionPipeline.__setattr__ so the config is left untouched
+        pipeline.__dict__['unet'] = entry['unet']
+        pipeline.vae.decoder = entry['decoder']
+        entry['hits'] += 1
+        try:
+            yield True
+        finally:
+            pipeline.__dict__['unet'] = unet
+            pipeline.vae.decoder = decoder
+
+    def drop_model(self, model_name: str):
+        """Forget compiled modules of an unloaded model"""
+        with self._lock:
+            for key in [k for k in self.entries if k[0] == model_name]:
+                del self.entries[key]
+
+    def status(self) -> Dict:
+        """Summary for the models endpoint"""
+        return {
+            'enabled': self.enabled,
+            'buckets': [f"{w}x{h}" for w, h in self.buckets],
+            'misses': self.misses,
+            'entries': [
+                {'model': k[0], 'size': f"{k[1]}x{k[2]}", 'unet_batch': k[3],
+                 'status': e['status'], 'compile_s': e['compile_s'], 'hits': e['hits']}
+                for k, e in list(self.entries.items())
+            ]
+        }
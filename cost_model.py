@@ -0,0 +1,238 @@
+"""
+Calibrated cost model: expected duration and peak memory of a job
+
+Latency is learned from finished jobs with a linear model per (model, task)
+over features of the request:
+
+    seconds ~ c0 + c1 * work + c2 * work * mp + c3 * images * mp + c4 * loras
+
+where mp is megapixels per image, images the batch size (or sweep cells),
+and work = denoising steps x images x mp (steps scaled by strength for
+img2img / inpaint). The c2 term is the attention cost that grows with
+resolution, c3 the VAE decode and saving, c4 LoRA fusing. Coefficients are
+fitted by exponentially weighted ridge regression (old observations fade, so
+the model follows driver / hardware changes); until a key has enough
+observations the prediction falls back to the model's pooled fit, the task's
+fit across models, and finally a per-device prior. Jobs that had to load
+their model first are not used for the fit; their excess time is learned as
+the model's load time instead.
+
+Peak memory comes from MemoryPolicyEngine's analytical estimate, which is
+calibrated per model against observed CUDA peaks; the calibration is
+persisted here along with the latency statistics (COST_MODEL_PATH).
+"""
+
+import os
+import json
+import atexit
+import time
+import logging
+import threading
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+FEATURES = ('const', 'work', 'work_mp', 'images_mp', 'loras')
+# Observations a key needs before its own fit is used
+MIN_OBSERVATIONS = 5
+# Per-observation decay of older observations
+FORGET = 0.995
+RIDGE = 1e-3
+# Prior seconds per step per megapixel-image, until something is learned
+PRIOR_STEP_SECONDS = {'cuda': 0.4, 'mps': 2.0, 'cpu': 15.0}
+
+def job_features(params: Dict, images: Optional[int] = None) -> List[float]:
+    """Feature vector of a request (see module docstring)"""
+    width, height = params.get('width', 512), params.get('height', 512)
+    mp = width * height / 1e6
+    if images is None:
+        images = int(params.get('num_images', 1)) if params.get('task', 'txt2img') == 'txt2img' else 1
+    steps = int(params.get('steps', 20))
+    if params.get('task') in ('img2img', 'inpaint'):
+        steps = max(int(steps * float(params.get('strength', 0.75))), 1)
+    work = steps * images * mp
+    return [1.0, work, work * mp, images * mp, float(len(params.get('loras') or []))]
+
+def _solve(a: List[List[float]], b: List[float]) -> Optional[List[float]]:
+    """Solve a small dense system by Gaussian elimination with partial pivoting"""
+    n = len(b)
+    m = [row[:] + [b[i]] for i, row in enumerate(a)]
+    for col in range(n):
+        pivot = max(range(col, n), key=lambda r: abs(m[r][col]))
+        if abs(m[pivot][col]) < 1e-12:
+            return None
+        m[col], m[pivot] = m[pivot], m[col]
+        for r in range(col + 1, n):
+            factor = m[r][col] / m[col][col]
+            for c in range(col, n + 1):
+                m[r][c] -= factor * m[col][c]
+    x = [0.0] * n
+    for r in range(n - 1, -1, -1):
+        x[r] = (m[r][n] - sum(m[r][c] * x[c] for c in range(r + 1, n))) / m[r][r]
+    return x
+
+class LatencyFit:
+    """Exponentially weighted least-squares statistics of one key"""
+
+    def __init__(self, state: Optional[Dict] = None):
+        n = len(FEATURES)
+        state = state or {}
+        self.xtx = state.get('xtx') or [[0.0] * n for _ in range(n)]
+        self.xty = state.get('xty') or [0.0] * n
+        self.count = state.get('count', 0)
+        self.weight = state.get('weight', 0.0)
+        self.coefficients = state.get('coefficients')
+
+    def add(self, x: List[float], seconds: float):
+        n = len(x)
+        for i in range(n):
+            self.xty[i] = self.xty[i] * FORGET + x[i] * seconds
+            for j in range(n):
+                self.xtx[i][j] = self.xtx[i][j] * FORGET + x[i] * x[j]
+        self.weight = self.weight * FORGET + 1
+        self.count += 1
+        # Ridge relative to each feature's own scale, so features with small values (the
+        # constant, LoRA count) are not shrunk towards zero by the large ones (work); the
+        # floor keeps the fit defined before every feature has been seen
+        scale = max(self.xtx[i][i] for i in range(n)) or 1.0
+        a = [[self.xtx[i][j] + (RIDGE * max(self.xtx[i][i], 1e-6 * scale) if i == j else 0.0) for j in range(n)]
+             for i in range(n)]
+        self.coefficients = _solve(a, self.xty) or self.coefficients
+
+    def predict(self, x: List[float]) -> Optional[float]:
+        if self.coefficients is None:
+            return None
+        return sum(c * v for c, v in zip(self.coefficients, x))
+
+    def to_dict(self) -> Dict:
+        return {'xtx': self.xtx, 'xty': self.xty, 'count': self.count, 'weight': self.weight,
+                'coefficients': self.coefficients}
+
+class CostModel:
+    """Learned job durations and model load times, plus the memory estimates of a MemoryPolicyEngine"""
+
+    def __init__(self, path: Optional[str] = None, memory_policy=None,
+                 device: Callable[[], Optional[str]] = lambda: None):
+        self.path = Path(path) if path else None
+        self.memory_policy = memory_policy
+        self.device = device  # device of this node, None until known
+        self.fits = {}  # 'model|task' (either may be '*') -> LatencyFit
+        self.load_seconds = {}  # model -> EWMA of model load time
+        self.errors = []  # recent relative prediction errors, for status
+        self._dirty = False
+        self._lock = threading.Lock()
+        self.load()
+
+    # ---------- latency ----------
+
+    @staticmethod
+    def _keys(model: str, task: str) -> List[str]:
+        """Most to least specific"""
+        return [f"{model}|{task}", f"{model}|*", f"*|{task}", "*|*"]
+
+    def predict_seconds(self, params: Dict, model: str, images: Optional[int] = None) -> float:
+        """Expected run time of a job on a loaded model"""
+        x = job_features(params, images)
+        with self._lock:
+            for key in self._keys(model, params.get('task', 'txt2img')):
+                fit = self.fits.get(key)
+                if fit is not None and fit.count >= MIN_OBSERVATIONS:
+                    predicted = fit.predict(x)
+                    if predicted is not None:
+                        return max(predicted, 0.05)
+        device = (self.device() or 'cpu').split(':')[0]
+        return 1.0 + PRIOR_STEP_SECONDS.get(device, PRIOR_STEP_SECONDS['cpu']) * x[1]
+
+    def predict_load_seconds(self, model: str) -> float:
+        return self.load_seconds.get(model, self.load_seconds.get('*', 0.0))
+
+    def observe(self, params: Dict, model: str, seconds: float, warm: bool = True, images: Optional[int] = None):
+        """Learn from a finished job; `warm`: its model was already loaded when it started"""
+        if seconds <= 0:
+            return
+        predicted = self.predict_seconds(params, model, images)
+        if not warm:
+            # Cold start: the time beyond a warm run is the model load
+            excess = max(seconds - predicted, 0.0)
+            with self._lock:
+                for key in (model, '*'):
+                    previous = self.load_seconds.get(key)
+                    self.load_seconds[key] = excess if previous is None else 0.7 * previous + 0.3 * excess
+                self._dirty = True
+            return
+        x = job_features(params, images)
+        with self._lock:
+            for key in self._keys(model, params.get('task', 'txt2img')):
+                self.fits.setdefault(key, LatencyFit()).add(x, seconds)
+            self.errors = (self.errors + [abs(predicted - seconds) / seconds])[-200:]
+            self._dirty = True
+
+    # ---------- memory ----------
+
+    def predict_memory_gb(self, params: Dict, model: str, device: str, weights_bytes: Optional[int] = None,
+                          dtype_bytes: int = 2) -> Optional[float]:
+        """Peak memory (GB) with the most economical memory settings allowed on the device"""
+        if self.memory_policy is None:
+            return None
+        return self.memory_policy.min_estimate(params, model, device, weights_bytes, dtype_bytes)
+
+    # ---------- persistence ----------
+
+    def load(self):
+        if self.path is None or not self.path.exists():
+            return
+        try:
+            data = json.loads(self.path.read_text())
+        except (OSError, ValueError) as e:
+            logger.warning("Could not read cost model %s: %s", self.path, e)
+            return
+        self.fits = {key: LatencyFit(state) for key, state in data.get('latency', {}).items()}
+        self.load_seconds = data.get('load_seconds', {})
+        if self.memory_policy is not None:
+            self.memory_policy.calibration.update(data.get('memory_calibration', {}))
+        logger.info("Cost model loaded from %s (%s latency fits)", self.path, len(self.fits))
+
+    def save(self, force: bool = False):
+        """Write the statistics if anything changed (atomic replace)"""
+        if self.path is None or not (self._dirty or force):
+            return
+        with self._lock:
+            data = {
+                'version': 1,
+                'saved_at': time.time(),
+                'features': FEATURES,
+                'latency': {key: fit.to_dict() for key, fit in self.fits.items()},
+                'load_seconds': dict(self.load_seconds),
+                'memory_calibration': dict(self.memory_policy.calibration) if self.memory_policy else {}
+            }
+            self._dirty = False
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_suffix('.tmp')
+            tmp.write_text(json.dumps(data))
+            os.replace(tmp, self.path)
+        except OSError as e:
+            logger.warning("Could not save cost model: %s", e)
+
+    def start_autosave(self, interval: float = 30.0):
+        """Save changes every `interval` seconds from a background thread"""
+        def loop():
+            while True:
+                time.sleep(interval)
+                self.save()
+
+        threading.Thread(target=loop, name='cost-model-save', daemon=True).start()
+        atexit.register(self.save)
+
+    def status(self) -> Dict:
+        with self._lock:
+            errors = sorted(self.errors)
+            return {
+                'path': str(self.path) if self.path else None,
+                'fits': {key: {'observations': fit.count,
+                               'coefficients': [round(c, 6) for c in fit.coefficients] if fit.coefficients else None}
+                         for key, fit in self.fits.items()},
+                'load_seconds': {k: round(v, 2) for k, v in self.load_seconds.items()},
+                'median_relative_error': round(errors[len(errors) // 2], 3) if errors else None
+            }
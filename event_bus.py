@@ -0,0 +1,170 @@
+"""
+Event bus: rooms, subscriptions and replay
+
+Events are published to rooms rather than to a socket: every job has a room
+('job:<id>'), so does every batch ('batch:<id>'), and gallery updates go to
+'gallery'. Any client can subscribe to a room (a second tab watching a job,
+a client that reconnected with a new sid), and each room keeps its last
+EVENT_HISTORY_SIZE events in a ring buffer so a subscriber passing the last
+'seq' it saw gets what it missed.
+
+publish() only numbers the event and queues it; a dispatcher thread does the
+actual fan-out, so the inference thread never waits on sockets. Subscribing
+goes through the same queue: the subscriber joins the room after every event
+already queued has been sent and is replayed exactly those it missed.
+"""
+
+import os
+import queue
+import logging
+import threading
+from collections import OrderedDict, deque
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+EVENT_HISTORY_SIZE = int(os.environ.get('EVENT_HISTORY_SIZE', 64))
+# Rooms whose history is kept, least recently published dropped first
+EVENT_HISTORY_ROOMS = int(os.environ.get('EVENT_HISTORY_ROOMS', 1000))
+
+GALLERY_ROOM = 'gallery'
+
+def job_room(job_id: str) -> str:
+    return f"job:{job_id}"
+
+def batch_room(batch_id: str) -> str:
+    return f"batch:{batch_id}"
+
+def is_public_room(room: str) -> bool:
+    """Rooms clients may subscribe to (a sid's own room is not one of them)"""
+    if room == GALLERY_ROOM:
+        return True
+    prefix, _, name = room.partition(':')
+    return prefix in ('job', 'batch') and bool(name)
+
+class EventBus:
+    """Room-based fan-out with per-room replay buffers
+
+    `get_transport()` returns the current transport (it is replaced when the
+    ASGI server starts); it needs emit(event, data, to), enter_room(sid, room)
+    and leave_room(sid, room).
+    """
+
+    def __init__(self, get_transport: Callable, history_size: Optional[int] = None,
+                 max_rooms: Optional[int] = None):
+        self.get_transport = get_transport
+        self.history_size = history_size or EVENT_HISTORY_SIZE
+        self.max_rooms = max_rooms or EVENT_HISTORY_ROOMS
+        self.published = 0
+        self.replayed = 0
+        self._history = OrderedDict()  # room -> deque of (seq, event, data)
+        self._seq = {}  # room -> last seq
+        self._sent = {}  # room -> last seq the dispatcher has sent
+        self._listeners = {}  # room -> in-process callbacks (SSE streams)
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _ensure_thread(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._dispatch, name='event-fanout', daemon=True)
+                    self._thread.start()
+
+    def publish(self, room: str, event: str, data: Dict) -> int:
+        """Queue an event for a room's subscribers; returns its sequence number"""
+        self._ensure_thread()
+        with self._lock:
+            seq = self._seq.get(room, 0) + 1
+            self._seq[room] = seq
+            data = dict(data, seq=seq)
+            history = self._history.get(room)
+            if history is None:
+                history = self._history[room] = deque(maxlen=self.history_size)
+                while len(self._history) > self.max_rooms:
+                    old_room, _ = self._history.popitem(last=False)
+                    self._seq.pop(old_room, None)
+                    self._sent.pop(old_room, None)
+            else:
+                self._history.move_to_end(room)
+            history.append((seq, event, data))
+            self.published += 1
+        self._queue.put(('emit', room, event, data))
+        return seq
+
+    def subscribe(self, sid: str, room: str, since: Optional[int] = None):
+        """Join a room; with `since`, first replay the buffered events after that seq"""
+        self._ensure_thread()
+        self._queue.put(('join', sid, room, since))
+
+    def unsubscribe(self, sid: str, room: str):
+        self._ensure_thread()
+        self._queue.put(('leave', sid, room, None))
+
+    def listen(self, room: str, callback: Callable, since: Optional[int] = None):
+        """Like subscribe() for in-process consumers: callback(event, data) on the dispatcher thread"""
+        self._ensure_thread()
+        self._queue.put(('listen', callback, room, since))
+
+    def unlisten(self, room: str, callback: Callable):
+        self._ensure_thread()
+        self._queue.put(('unlisten', callback, room, None))
+
+    def history(self, room: str, since: int = 0) -> List[Dict]:
+        """Buffered events of a room after `since`"""
+        with self._lock:
+            return [{'event': event, 'data': data} for seq, event, data in self._history.get(room, ())
+                    if seq > since]
+
+    def _missed(self, room: str, since: Optional[int]) -> List:
+        """Events already sent to a room after `since`; later ones reach a new subscriber live"""
+        if since is None:
+            return []
+        with self._lock:
+            sent = self._sent.get(room, 0)
+            missed = [(event, data) for seq, event, data in self._history.get(room, ()) if since < seq <= sent]
+        self.replayed += len(missed)
+        return missed
+
+    def _dispatch(self):
+        while True:
+            action, target, room_or_event, arg = self._queue.get()
+            transport = self.get_transport()
+            try:
+                if action == 'emit':
+                    room, event, data = target, room_or_event, arg
+                    transport.emit(event, data, to=room)
+                    self._sent[room] = data['seq']
+                    for callback in self._listeners.get(room, ()):
+                        callback(event, data)
+                elif action == 'join':
+                    for event, data in self._missed(room_or_event, arg):
+                        transport.emit(event, data, to=target)
+                    transport.enter_room(target, room_or_event)
+                elif action == 'leave':
+                    transport.leave_room(target, room_or_event)
+                elif action == 'listen':
+                    for event, data in self._missed(room_or_event, arg):
+                        target(event, data)
+                    self._listeners.setdefault(room_or_event, []).append(target)
+                elif action == 'unlisten':
+                    callbacks = self._listeners.get(room_or_event, [])
+                    if target in callbacks:
+                        callbacks.remove(target)
+                    if not callbacks:
+                        self._listeners.pop(room_or_event, None)
+            except Exception as e:
+                logger.warning("Event fan-out failed (%s %s): %s", action, target, e)
+
+    def status(self) -> Dict:
+        with self._lock:
+            rooms = len(self._history)
+        return {
+            'rooms': rooms,
+            'published': self.published,
+            'replayed': self.replayed,
+            'pending': self._queue.qsize(),
+            'listeners': sum(len(callbacks) for callbacks in self._listeners.values()),
+            'history_size': self.history_size
+        }
@@ -0,0 +1,402 @@
+"""
+Multi-process inference workers
+
+Each worker process owns its own StableDiffusionManager and a CPU thread
+budget. The parent keeps one duplex pipe per worker and routes jobs by model
+affinity: a job goes to an idle worker that already has its model loaded, or
+else to the idle worker with the fewest models. Generated images are handed
+back through shared memory; only their name, size and mode cross the pipe.
+Workers that die are restarted and their in-flight job is retried once.
+"""
+
+import os
+import sys
+import time
+import types
+import asyncio
+import logging
+import threading
+import multiprocessing as mp
+from collections import deque
+from contextlib import contextmanager
+from multiprocessing import resource_tracker, shared_memory
+from multiprocessing.connection import wait
+from typing import Callable, Dict, List, Optional
+
+from PIL import Image
+
+import metrics
+import tracing
+import profiler
+from memory_tracker import memory_tracker
+
+logger = logging.getLogger(__name__)
+
+# Restart backoff when a worker keeps crashing
+CRASH_WINDOW = 30
+CRASH_LIMIT = 3
+CRASH_BACKOFF = 5
+
+# ==================== WORKER PROCESS ====================
+
+def _export_image(image: Image.Image) -> Dict:
+    """Copy an image into a new shared memory block owned by the parent"""
+    if image.mode not in ('RGB', 'RGBA', 'L'):
+        image = image.convert('RGB')
+    data = image.tobytes()
+    shm = shared_memory.SharedMemory(create=True, size=max(len(data), 1))
+    shm.buf[:len(data)] = data
+    meta = {'shm': shm.name, 'size': image.size, 'mode': image.mode, 'nbytes': len(data)}
+    # The parent unlinks the block; stop this process's tracker from doing it at exit
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    shm.close()
+    return meta
+
+def _job_info(sd_manager, trace: Optional[Dict], profile: Optional[Dict] = None) -> Dict:
+    """Loaded models, the metric deltas since the last message, the job's trace spans and profile,
+    and the worker's memory report"""
+    return {'models': list(sd_manager.pipelines), 'metrics': metrics.REGISTRY.drain(),
+            'spans': tracing.tracer.drain(trace['id']) if trace else [], 'profile': profile,
+            'memory': memory_tracker.report()}
+
+def _worker_main(worker_id: int, conn, threads: int):
+    """Worker process loop: receive jobs, generate, send images back"""
+    os.environ['OMP_NUM_THREADS'] = str(threads)
+    os.environ['MKL_NUM_THREADS'] = str(threads)
+    os.environ.setdefault('INFERENCE_WORKER_ID', str(worker_id))
+
+    # The server is not imported here: the worker needs the pipelines, not a second web server
+    import structured_logging
+    structured_logging.configure_logging()
+
+    import torch
+    torch.set_num_threads(threads)
+
+    from sd_pipeline import sd_manager, state, png_base64
+
+    # Load and warm up PRELOAD_MODELS before accepting jobs
+    loop = asyncio.new_event_loop()
+    for model_name in state.preload_models:
+        loop.run_until_complete(sd_manager.warm_up(model_name))
+    conn.send(('ready', {
+        'pid': os.getpid(),
+        'models': list(sd_manager.pipelines),
+        'model_status': dict(state.model_status),
+        'metrics': metrics.REGISTRY.drain(),
+        'memory': memory_tracker.report()
+    }))
+
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            break
+        if message[0] == 'shutdown':
+            break
+        if message[0] != 'job':
+            continue
+
+        _, job_id, params, trace, profile_options = message
+        profiled = None
+
+        def on_step(step: int, total: int):
+            conn.send(('progress', job_id, step, total))
+
+        def on_cell(cell: Dict, image: Image.Image):
+            # Sweep cells are small previews: send them PNG-encoded over the pipe
+            cell = {k: cell[k] for k in ('index', 'coords', 'col', 'row', 'seed')}
+            conn.send(('cell', job_id, cell, png_base64(image)))
+
+        try:
+            with tracing.activate(trace), profiler.profile_job(profile_options, job_id) as profiled:
+                images = loop.run_until_complete(sd_manager.generate(params, step_callback=on_step,
+                                                                     cell_callback=on_cell))
+                with tracing.span('export_images', images=len(images)):
+                    metas = [_export_image(image) for image in images]
+            conn.send(('done', job_id, metas, _job_info(sd_manager, trace, profiled)))
+        except Exception as e:
+            conn.send(('error', job_id, str(e), _job_info(sd_manager, trace, profiled)))
+
+    loop.close()
+
+# ==================== PARENT SIDE ====================
+
+_main_lock = threading.Lock()
+
+@contextmanager
+def _without_main_module():
+    """Spawn processes without re-running the parent's main script in them
+
+    A spawned child normally executes the parent's __main__ (colab_server.py or
+    asgi_server.py) as __mp_main__ before calling its target, building the whole
+    server a second time. _worker_main lives in this module and needs nothing from
+    __main__, so hide it while the child's preparation data is taken.
+    """
+    with _main_lock:
+        main = sys.modules['__main__']
+        sys.modules['__main__'] = types.ModuleType('__main__')
+        try:
+            yield
+        finally:
+            sys.modules['__main__'] = main
+
+def attach_images(metas: List[Dict]):
+    """Map images from shared memory; returns (images, release) where release() frees the blocks"""
+    blocks = []
+    images = []
+    for meta in metas:
+        shm = shared_memory.SharedMemory(name=meta['shm'])
+        blocks.append(shm)
+        images.append(Image.frombuffer(
+            meta['mode'], tuple(meta['size']), shm.buf[:meta['nbytes']], 'raw', meta['mode'], 0, 1
+        ))
+
+    def release():
+        images.clear()
+        for shm in blocks:
+            try:
+                shm.close()
+            except BufferError:
+                # An image view is still alive; unlinking below still frees the name
+                pass
+            shm.unlink()
+
+    return images, release
+
+class WorkerPool:
+    """Pool of inference worker processes with a dispatcher thread"""
+
+    def __init__(self, num_workers: int, threads_per_worker: Optional[int] = None,
+                 default_model: str = '', on_ready: Optional[Callable] = None,
+                 on_start: Optional[Callable] = None,
+                 on_progress: Optional[Callable] = None, on_cell: Optional[Callable] = None,
+                 on_done: Optional[Callable] = None, on_error: Optional[Callable] = None):
+        self.num_workers = num_workers
+        self.threads_per_worker = threads_per_worker or max((os.cpu_count() or 1) // num_workers, 1)
+        self.default_model = default_model
+        self.on_ready = on_ready
+        self.on_start = on_start
+        self.on_progress = on_progress
+        self.on_cell = on_cell
+        self.on_done = on_done
+        self.on_error = on_error
+
+        self.workers = []
+        self.pending = deque()
+        self._lock = threading.RLock()
+        self._ctx = mp.get_context('spawn')
+        self._wakeup_recv, self._wakeup_send = self._ctx.Pipe(duplex=False)
+        self._thread = None
+        self._running = False
+
+    # ---------- lifecycle ----------
+
+    def start(self):
+        """Spawn the workers and the dispatcher thread"""
+        self._running = True
+        for worker_id in range(self.num_workers):
+            self.workers.append({
+                'id': worker_id, 'process': None, 'conn': None, 'job': None,
+                'models': set(), 'ready': False, 'crashes': deque(), 'restart_at': 0.0,
+                'restarts': 0, 'jobs_done': 0, 'memory': None
+            })
+            self._spawn(self.workers[-1])
+        self._thread = threading.Thread(target=self._dispatch_loop, name='worker-dispatcher', daemon=True)
+        self._thread.start()
+        logger.info("Started %s inference workers, %s threads each", self.num_workers, self.threads_per_worker)
+
+    def _spawn(self, worker: Dict):
+        """Start (or restart) a worker process"""
+        parent_conn, child_conn = self._ctx.Pipe()
+        process = self._ctx.Process(
+            target=_worker_main,
+            args=(worker['id'], child_conn, self.threads_per_worker),
+            name=f"sd-worker-{worker['id']}",
+            daemon=True
+        )
+        with _without_main_module():
+            process.start()
+        child_conn.close()
+        worker.update(process=process, conn=parent_conn, job=None, models=set(), ready=False)
+
+    def stop(self):
+        """Ask workers to exit and stop dispatching"""
+        self._running = False
+        self._wake()
+        for worker in self.workers:
+            try:
+                worker['conn'].send(('shutdown',))
+            except (OSError, ValueError):
+                pass
+        for worker in self.workers:
+            if worker['process'] is None:
+                continue
+            worker['process'].join(timeout=10)
+            if worker['process'].is_alive():
+                worker['process'].terminate()
+
+    # ---------- submission ----------
+
+    def submit(self, job: Dict):
+        """Queue a job ({'id', 'params', ...}) for the next suitable worker"""
+        job.setdefault('attempts', 0)
+        with self._lock:
+            self.pending.append(job)
+        self._wake()
+
+    def _wake(self):
+        try:
+            self._wakeup_send.send_bytes(b'\0')
+        except (OSError, ValueError):
+            pass
+
+    def queue_depth(self) -> int:
+        return len(self.pending)
+
+    def status(self) -> List[Dict]:
+        """Per-worker state for health / debugging endpoints"""
+        return [{
+            'id': w['id'],
+            'pid': w['process'].pid if w['process'] else None,
+            'alive': bool(w['process'] and w['process'].is_alive()),
+            'ready': w['ready'],
+            'busy': w['job'] is not None,
+            'models': sorted(w['models']),
+            'restarts': w['restarts'],
+            'jobs_done': w['jobs_done']
+        } for w in self.workers]
+
+    def memory_reports(self) -> Dict[int, Optional[Dict]]:
+        """Memory report each worker sent with its last message (None before it is ready)"""
+        return {w['id']: w['memory'] for w in self.workers}
+
+    # ---------- dispatcher thread ----------
+
+    def _dispatch_loop(self):
+        """Receive worker messages, detect crashes and assign pending jobs"""
+        while self._running:
+            self._restart_due_workers()
+            self._assign_jobs()
+
+            waitables = {self._wakeup_recv: None}
+            for worker in self.workers:
+                if worker['process'] is not None:
+                    waitables[worker['conn']] = worker
+                    waitables[worker['process'].sentinel] = worker
+            for ready in wait(list(waitables), timeout=1.0):
+                if ready is self._wakeup_recv:
+                    while self._wakeup_recv.poll():
+                        self._wakeup_recv.recv_bytes()
+                    continue
+                worker = waitables[ready]
+                if worker['process'] is None:
+                    continue
+                if ready is worker['conn']:
+                    try:
+                        while worker['conn'].poll():
+                            self._handle_message(worker, worker['conn'].recv())
+                    except (EOFError, OSError):
+                        self._handle_crash(worker)
+                elif not worker['process'].is_alive():
+                    self._handle_crash(worker)
+
+    def _handle_message(self, worker: Dict, message):
+        kind = message[0]
+        if kind == 'ready':
+            worker['ready'] = True
+            worker['models'] = set(message[1].get('models', []))
+            worker['memory'] = message[1].get('memory')
+            metrics.REGISTRY.merge(message[1].get('metrics'))
+            if self.on_ready:
+                self.on_ready(worker['id'], message[1])
+        elif kind == 'progress':
+            _, job_id, step, total = message
+            if worker['job'] and worker['job']['id'] == job_id and self.on_progress:
+                self.on_progress(worker['job'], step, total)
+        elif kind == 'cell':
+            _, job_id, cell, image_base64 = message
+            if worker['job'] and worker['job']['id'] == job_id and self.on_cell:
+                self.on_cell(worker['job'], cell, image_base64)
+        elif kind in ('done', 'error'):
+            job = worker['job']
+            worker['job'] = None
+            worker['models'] = set(message[3].get('models', []))
+            worker['memory'] = message[3].get('memory')
+            metrics.REGISTRY.merge(message[3].get('metrics'))
+            tracing.tracer.extend(message[3].get('spans'))
+            profiler.profiler.merge_worker(message[3].get('profile'), f"worker-{worker['id']}")
+            worker['jobs_done'] += 1
+            if job is None or job['id'] != message[1]:
+                return
+            if kind == 'done':
+                images, release = attach_images(message[2])
+                if self.on_done:
+                    self.on_done(job, images, release)
+                else:
+                    release()
+            elif self.on_error:
+                self.on_error(job, message[2])
+
+    def _handle_crash(self, worker: Dict):
+        """Restart a dead worker and retry its job once"""
+        process = worker['process']
+        exitcode = process.exitcode if process else None
+        logger.error("Inference worker %s died (exit code %s)", worker['id'], exitcode)
+        try:
+            worker['conn'].close()
+        except OSError:
+            pass
+        if process is not None and process.is_alive():
+            # Its pipe broke but the process runs on: stop it before a replacement starts
+            process.terminate()
+            process.join(timeout=5)
+            if process.is_alive():
+                process.kill()
+                process.join(timeout=5)
+
+        job = worker['job']
+        worker.update(process=None, job=None, ready=False, models=set(), memory=None)
+        if job is not None:
+            job['attempts'] += 1
+            if job['attempts'] < 2:
+                with self._lock:
+                    self.pending.appendleft(job)
+            elif self.on_error:
+                self.on_error(job, f"Inference worker crashed (exit code {exitcode})")
+
+        now = time.time()
+        crashes = worker['crashes']
+        crashes.append(now)
+        while crashes and now - crashes[0] > CRASH_WINDOW:
+            crashes.popleft()
+        worker['restart_at'] = now + CRASH_BACKOFF if len(crashes) >= CRASH_LIMIT else now
+
+    def _restart_due_workers(self):
+        now = time.time()
+        for worker in self.workers:
+            if worker['process'] is None and self._running and now >= worker['restart_at']:
+                worker['restarts'] += 1
+                logger.info("Restarting inference worker %s", worker['id'])
+                self._spawn(worker)
+
+    def _assign_jobs(self):
+        """Send pending jobs to idle workers, preferring workers that have the model loaded"""
+        with self._lock:
+            while self.pending:
+                idle = [w for w in self.workers if w['ready'] and w['job'] is None and w['process'] is not None]
+                if not idle:
+                    return
+                job = self.pending[0]
+                model = job['params'].get('model', self.default_model)
+                worker = next((w for w in idle if model in w['models']), None) \
+                    or min(idle, key=lambda w: (len(w['models']), w['jobs_done']))
+                try:
+                    worker['conn'].send(('job', job['id'], job['params'], job.get('trace'),
+                                         profiler.profiler.job_options()))
+                except (OSError, ValueError):
+                    self._handle_crash(worker)
+                    continue
+                self.pending.popleft()
+                worker['job'] = job
+                if self.on_start:
+                    self.on_start(job, worker['id'])
@@ -0,0 +1,344 @@
+"""
+Job and event broker for running several server instances as one cluster
+
+Front ends submit jobs to the broker; worker nodes pull jobs, preferring the
+models they already have loaded; progress and completion events are published
+to the node that holds the client's socket (the job's 'origin'). Nodes
+advertise their capacity and loaded models with heartbeats.
+
+Backends:
+    InProcessBroker - single instance, no dependencies (default); FIFO or
+                      shortest-job-first (SCHEDULING_POLICY=sjf)
+    RedisBroker     - any Redis-compatible server (JOB_BROKER=redis, REDIS_URL);
+                      takes a client object, so a local stand-in such as
+                      fakeredis works for testing
+"""
+
+import os
+import json
+import time
+import socket
+import logging
+import threading
+import uuid
+from collections import deque
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+HEARTBEAT_TTL = 15  # seconds without a heartbeat before a node is considered gone
+PULL_POLL_INTERVAL = 0.05  # seconds between queue scans while waiting for a job on several models
+MAX_REQUEUES = 2  # a job requeued more often (it keeps taking nodes down with it) fails instead
+
+def sjf_score(job: Dict, model: str, loaded: List[str], aging: float, now: float) -> float:
+    """Shortest-job-first priority, lowest first
+
+    Predicted run time (job['cost'], from the cost model), plus the model's
+    load time when it is not loaded, minus `aging` seconds per second waited
+    so long jobs cannot starve.
+    """
+    cost = job.get('cost') or {}
+    score = cost.get('seconds', 0.0)
+    if model not in loaded:
+        score += cost.get('load_seconds', 0.0)
+    return score - aging * (now - job.get('created_at', now))
+
+def default_node_id() -> str:
+    """NODE_ID from the environment, or host-pid-random"""
+    return os.environ.get('NODE_ID') or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+
+class JobBroker:
+    """Broker interface"""
+
+    def __init__(self, default_model: str = ''):
+        self.default_model = default_model
+
+    def model_of(self, job: Dict) -> str:
+        return job['params'].get('model') or self.default_model
+
+    def submit(self, job: Dict):
+        """Queue a job; job['origin'] is the node that receives its events"""
+        raise NotImplementedError
+
+    def pull(self, node_id: str, models: List[str], timeout: float = 1.0) -> Optional[Dict]:
+        """Next job, preferring jobs for `models`; None after `timeout` seconds"""
+        raise NotImplementedError
+
+    def ack(self, node_id: str, job: Dict):
+        """A pulled job has finished (or was dropped) on node_id and must not be requeued"""
+
+    def requeue(self, node_id: str) -> int:
+        """Queue the unacknowledged jobs of node_id again; returns how many"""
+        return 0
+
+    def requeue_orphans(self) -> int:
+        """Requeue unacknowledged jobs of nodes whose heartbeat expired; returns how many"""
+        return 0
+
+    def publish(self, node_id: str, message: Dict):
+        """Send an event message to the node holding the client's socket"""
+        raise NotImplementedError
+
+    def listen(self, node_id: str, callback: Callable[[Dict], None]):
+        """Deliver messages published to node_id to callback (on a broker thread)"""
+        raise NotImplementedError
+
+    def heartbeat(self, node_id: str, info: Dict):
+        """Advertise a node's role, capacity and loaded models"""
+        raise NotImplementedError
+
+    def nodes(self) -> Dict[str, Dict]:
+        """Live nodes and their last heartbeat"""
+        raise NotImplementedError
+
+    def queue_depth(self) -> int:
+        raise NotImplementedError
+
+    def queued_jobs(self, models: List[str] = ()) -> Optional[List[Dict]]:
+        """Queued jobs in pull order for a node with `models` loaded; None if the backend cannot tell cheaply"""
+        return None
+
+    def close(self):
+        pass
+
+class InProcessBroker(JobBroker):
+    """Broker for a single instance: a deque of jobs and direct callbacks
+
+    policy 'fifo' pulls the oldest job (for a loaded model if there is one);
+    'sjf' pulls the job with the lowest sjf_score().
+    """
+
+    def __init__(self, default_model: str = '', policy: str = 'fifo', aging: float = 0.1):
+        super().__init__(default_model)
+        self.policy = policy
+        self.aging = aging
+        self._jobs = deque()
+        self._cond = threading.Condition()
+        self._listeners = {}
+        self._nodes = {}
+
+    def submit(self, job: Dict):
+        with self._cond:
+            self._jobs.append(job)
+            self._cond.notify()
+
+    def pull(self, node_id: str, models: List[str], timeout: float = 1.0) -> Optional[Dict]:
+        deadline = time.time() + timeout
+        with self._cond:
+            while not self._jobs:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+
+            if self.policy == 'sjf':
+                now = time.time()
+                job = min(self._jobs, key=lambda j: sjf_score(j, self.model_of(j), models, self.aging, now))
+                self._jobs.remove(job)
+                return job
+            if models:
+                for job in self._jobs:
+                    if self.model_of(job) in models:
+                        self._jobs.remove(job)
+                        return job
+            return self._jobs.popleft()
+
+    def publish(self, node_id: str, message: Dict):
+        callback = self._listeners.get(node_id)
+        if callback is not None:
+            callback(message)
+
+    def listen(self, node_id: str, callback: Callable[[Dict], None]):
+        self._listeners[node_id] = callback
+
+    def heartbeat(self, node_id: str, info: Dict):
+        self._nodes[node_id] = dict(info, ts=time.time())
+
+    def nodes(self) -> Dict[str, Dict]:
+        now = time.time()
+        return {n: info for n, info in self._nodes.items() if now - info['ts'] < HEARTBEAT_TTL}
+
+    def queue_depth(self) -> int:
+        return len(self._jobs)
+
+    def queued_jobs(self, models: List[str] = ()) -> Optional[List[Dict]]:
+        with self._cond:
+            jobs = list(self._jobs)
+        if self.policy == 'sjf':
+            now = time.time()
+            jobs.sort(key=lambda j: sjf_score(j, self.model_of(j), models, self.aging, now))
+        return jobs
+
+class RedisBroker(JobBroker):
+    """Broker on a Redis-compatible server
+
+    Keys (all under `prefix`):
+        jobs:<model>       list of queued jobs for a model (LPUSH / RPOPLPUSH, FIFO)
+        jobs:models        set of models that have had queued jobs
+        processing:<node>  jobs a node has pulled and not acknowledged yet
+        processing:nodes   set of nodes that have pulled jobs
+        events:<node>      pub/sub channel of events for a node
+        nodes              hash node id -> last heartbeat JSON
+
+    A pull moves the job atomically into the node's processing list, and ack()
+    removes it when the job is finished. Jobs left in the processing list of a
+    node whose heartbeat expired (the node died mid-job) are queued again.
+    """
+
+    def __init__(self, client, default_model: str = '', prefix: str = 'sd:'):
+        super().__init__(default_model)
+        self.client = client
+        self.prefix = prefix
+        self._pubsub = None
+        self._pubsub_thread = None
+        self._claimed = {}  # job id -> job JSON as stored in this node's processing list
+
+    def _key(self, *parts: str) -> str:
+        return self.prefix + ':'.join(parts)
+
+    def submit(self, job: Dict):
+        model = self.model_of(job)
+        pipe = self.client.pipeline()
+        pipe.sadd(self._key('jobs', 'models'), model)
+        pipe.lpush(self._key('jobs', model), json.dumps(job))
+        pipe.execute()
+
+    def pull(self, node_id: str, models: List[str], timeout: float = 1.0) -> Optional[Dict]:
+        known = sorted(self._decode(m) for m in self.client.smembers(self._key('jobs', 'models')))
+        # Loaded models first, then any other model
+        keys = [self._key('jobs', m) for m in models]
+        keys += [self._key('jobs', m) for m in known if m not in models]
+        if not keys:
+            time.sleep(timeout)
+            return None
+        processing = self._key('processing', node_id)
+        self.client.sadd(self._key('processing', 'nodes'), node_id)
+        # RPOPLPUSH takes one source list: scan the model queues in order, block only on a single one
+        deadline = time.time() + timeout
+        while True:
+            for key in keys:
+                raw = self.client.rpoplpush(key, processing)
+                if raw is not None:
+                    return self._claim(raw)
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            if len(keys) == 1:
+                raw = self.client.brpoplpush(keys[0], processing, timeout=max(int(round(remaining)), 1))
+                return self._claim(raw) if raw is not None else None
+            time.sleep(min(PULL_POLL_INTERVAL, remaining))
+
+    def _claim(self, raw) -> Dict:
+        job = json.loads(raw)
+        self._claimed[job['id']] = raw
+        return job
+
+    def ack(self, node_id: str, job: Dict):
+        raw = self._claimed.pop(job['id'], None)
+        if raw is not None:
+            self.client.lrem(self._key('processing', node_id), 1, raw)
+
+    def requeue(self, node_id: str) -> int:
+        processing = self._key('processing', node_id)
+        # One node requeues a given list at a time
+        if not self.client.set(self._key('requeue', node_id), 1, nx=True, ex=HEARTBEAT_TTL):
+            return 0
+        count = 0
+        try:
+            while True:
+                raw = self.client.rpop(processing)
+                if raw is None:
+                    break
+                job = json.loads(raw)
+                job['requeues'] = job.get('requeues', 0) + 1
+                if job['requeues'] > MAX_REQUEUES:
+                    logger.error("Job %s lost its node %d times; failing it", job['id'], job['requeues'])
+                    self.publish(job['origin'], {
+                        'event': 'error', 'sid': job.get('sid'),
+                        'data': {'message': 'Job failed: the nodes running it stopped responding',
+                                 'job_id': job['id']}
+                    })
+                    continue
+                # Back at the head of its queue: it was pulled before everything still waiting
+                pipe = self.client.pipeline()
+                pipe.sadd(self._key('jobs', 'models'), self.model_of(job))
+                pipe.rpush(self._key('jobs', self.model_of(job)), json.dumps(job))
+                pipe.execute()
+                count += 1
+            self.client.srem(self._key('processing', 'nodes'), node_id)
+        finally:
+            self.client.delete(self._key('requeue', node_id))
+        if count:
+            logger.warning("Requeued %d unfinished jobs of node %s", count, node_id)
+        return count
+
+    def requeue_orphans(self) -> int:
+        live = self.nodes()
+        pulled = (self._decode(n) for n in self.client.smembers(self._key('processing', 'nodes')))
+        return sum(self.requeue(node_id) for node_id in pulled if node_id not in live)
+
+    def publish(self, node_id: str, message: Dict):
+        self.client.publish(self._key('events', node_id), json.dumps(message))
+
+    def listen(self, node_id: str, callback: Callable[[Dict], None]):
+        def handler(message):
+            try:
+                callback(json.loads(message['data']))
+            except Exception as e:
+                logger.error("Event delivery failed: %s", e)
+
+        self._pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        self._pubsub.subscribe(**{self._key('events', node_id): handler})
+        self._pubsub_thread = self._pubsub.run_in_thread(sleep_time=0.01, daemon=True)
+
+    def heartbeat(self, node_id: str, info: Dict):
+        self.client.hset(self._key('nodes'), node_id, json.dumps(dict(info, ts=time.time())))
+
+    def nodes(self) -> Dict[str, Dict]:
+        now = time.time()
+        live = {}
+        for node_id, raw in self.client.hgetall(self._key('nodes')).items():
+            info = json.loads(raw)
+            node_id = self._decode(node_id)
+            if now - info['ts'] < HEARTBEAT_TTL:
+                live[node_id] = info
+            elif now - info['ts'] > HEARTBEAT_TTL * 4:
+                self.client.hdel(self._key('nodes'), node_id)
+        return live
+
+    def queue_depth(self) -> int:
+        models = self.client.smembers(self._key('jobs', 'models'))
+        return sum(self.client.llen(self._key('jobs', self._decode(m))) for m in models)
+
+    def close(self):
+        if self._pubsub_thread is not None:
+            self._pubsub_thread.stop()
+        if self._pubsub is not None:
+            self._pubsub.close()
+
+    @staticmethod
+    def _decode(value) -> str:
+        return value.decode() if isinstance(value, bytes) else value
+
+def create_broker(default_model: str = '') -> JobBroker:
+    """Broker selected by JOB_BROKER (memory or redis) and REDIS_URL
+
+    SCHEDULING_POLICY=sjf (with SJF_AGING) applies to the in-process broker;
+    Redis queues stay FIFO per model.
+    """
+    backend = os.environ.get('JOB_BROKER', 'memory').lower()
+    policy = os.environ.get('SCHEDULING_POLICY', 'fifo').lower()
+    if policy not in ('fifo', 'sjf'):
+        raise ValueError(f"Unknown SCHEDULING_POLICY: {policy}")
+    if backend == 'memory':
+        return InProcessBroker(default_model, policy, float(os.environ.get('SJF_AGING', 0.1)))
+    if policy == 'sjf':
+        logger.warning("SCHEDULING_POLICY=sjf is not supported with JOB_BROKER=redis; using FIFO")
+    if backend == 'redis':
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("JOB_BROKER=redis requires the redis package (pip install redis)")
+        client = redis.Redis.from_url(os.environ.get('REDIS_URL', 'redis://localhost:6379/0'))
+        return RedisBroker(client, default_model, prefix=os.environ.get('REDIS_PREFIX', 'sd:'))
+    raise ValueError(f"Unknown JOB_BROKER: {backend}")
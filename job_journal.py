@@ -0,0 +1,222 @@
+"""
+Write-ahead journal of generation jobs
+
+Every job accepted by this node is recorded with its full request
+parameters, then updated as it starts, completes or fails. On startup the
+jobs that never finished are requeued, and a client that reconnects with a
+job id gets the stored result or is re-attached to the running job.
+
+The journal is a SQLite database in WAL mode. record() only appends to an
+in-memory queue; a writer thread commits everything that arrived within
+JOB_JOURNAL_COMMIT_MS in one transaction (group commit), so recording a
+transition costs microseconds on the request path. Reads and pruning share
+one more connection, opened on first use.
+"""
+
+import os
+import json
+import time
+import queue
+import sqlite3
+import logging
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+UNFINISHED = ('accepted', 'started')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    params TEXT,
+    sid TEXT,
+    result TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status);
+"""
+
+# Later transitions keep what earlier ones wrote (params, sid, timestamps)
+_UPSERT = """
+INSERT INTO jobs (id, status, params, sid, result, error, created_at, started_at, finished_at, updated_at)
+VALUES (:id, :status, :params, :sid, :result, :error, :at, :started_at, :finished_at, :at)
+ON CONFLICT (id) DO UPDATE SET
+    status = excluded.status,
+    params = COALESCE(excluded.params, jobs.params),
+    sid = COALESCE(excluded.sid, jobs.sid),
+    result = COALESCE(excluded.result, jobs.result),
+    error = COALESCE(excluded.error, jobs.error),
+    started_at = COALESCE(excluded.started_at, jobs.started_at),
+    finished_at = COALESCE(excluded.finished_at, jobs.finished_at),
+    updated_at = excluded.updated_at
+"""
+
+class JobJournal:
+    """SQLite job journal with a group-committing writer thread"""
+
+    def __init__(self, path: Optional[str] = None, commit_interval: Optional[float] = None,
+                 enabled: Optional[bool] = None):
+        if enabled is None:
+            enabled = os.environ.get('JOB_JOURNAL_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+        self.enabled = enabled
+        self.path = Path(path or os.environ.get('JOB_JOURNAL_PATH', './cache/jobs.db'))
+        if commit_interval is None:
+            commit_interval = float(os.environ.get('JOB_JOURNAL_COMMIT_MS', 20)) / 1000
+        self.commit_interval = commit_interval
+        self.records = 0
+        self.commits = 0
+        self.commit_seconds = 0.0
+        self._queued = 0  # transitions recorded
+        self._written = 0  # of those, handled by the writer (committed or failed)
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._reader = None
+        self._read_lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        # Survives process crashes; only an OS crash can lose the last commits
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.executescript(_SCHEMA)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def start(self):
+        """Open the database and start the writer thread"""
+        with self._lock:
+            if not self.enabled or self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._writer, args=(self._connect(),),
+                                            name='job-journal', daemon=True)
+            self._thread.start()
+
+    # ---------- writes ----------
+
+    def record(self, job_id: str, status: str, params: Optional[Dict] = None, sid: Optional[str] = None,
+               result: Optional[Dict] = None, error: Optional[str] = None):
+        """Queue a transition (accepted / started / completed / failed / rejected)"""
+        if not self.enabled:
+            return
+        self.start()
+        now = time.time()
+        self._queued += 1
+        self._queue.put({
+            'id': job_id,
+            'status': status,
+            'params': json.dumps(params, default=str) if params is not None else None,
+            'sid': sid,
+            'result': json.dumps(result, default=str) if result is not None else None,
+            'error': error,
+            'at': now,
+            'started_at': now if status == 'started' else None,
+            'finished_at': now if status not in UNFINISHED else None
+        })
+
+    def _writer(self, conn: sqlite3.Connection):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.commit_interval
+            while True:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            # Events in the batch are flush() markers
+            rows = [item for item in batch if isinstance(item, dict)]
+            if rows:
+                start = time.perf_counter()
+                try:
+                    conn.execute('BEGIN')
+                    conn.executemany(_UPSERT, rows)
+                    conn.execute('COMMIT')
+                except sqlite3.Error as e:
+                    logger.error("Job journal write failed (%s records): %s", len(rows), e)
+                    if conn.in_transaction:
+                        conn.execute('ROLLBACK')
+                else:
+                    self.records += len(rows)
+                    self.commits += 1
+                    self.commit_seconds += time.perf_counter() - start
+                self._written += len(rows)
+            for item in batch:
+                if isinstance(item, threading.Event):
+                    item.set()
+
+    def flush(self, timeout: float = 5.0):
+        """Wait until everything recorded so far is committed"""
+        if self._thread is None or self._written == self._queued:
+            return
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait(timeout)
+
+    # ---------- reads ----------
+
+    def _run(self, sql: str, args=()):
+        """(rows, rowcount) of a statement on the shared read connection, after pending writes"""
+        self.flush()
+        with self._read_lock:
+            if self._reader is None:
+                self._reader = self._connect()
+            cursor = self._reader.execute(sql, args)
+            return cursor.fetchall(), cursor.rowcount
+
+    def _query(self, sql: str, args=()) -> List[Dict]:
+        rows, _ = self._run(sql, args)
+        jobs = []
+        for row in rows:
+            job = dict(row)
+            for field in ('params', 'result'):
+                if job.get(field) is not None:
+                    job[field] = json.loads(job[field])
+            jobs.append(job)
+        return jobs
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        """Latest state of a job"""
+        if not self.enabled:
+            return None
+        jobs = self._query('SELECT * FROM jobs WHERE id = ?', (job_id,))
+        return jobs[0] if jobs else None
+
+    def unfinished(self) -> List[Dict]:
+        """Jobs accepted or started but never finished, oldest first"""
+        if not self.enabled:
+            return []
+        return self._query(
+            f"SELECT * FROM jobs WHERE status IN ({', '.join('?' * len(UNFINISHED))}) ORDER BY created_at",
+            UNFINISHED)
+
+    def prune(self, max_age: float) -> int:
+        """Delete finished jobs older than max_age seconds"""
+        if not self.enabled:
+            return 0
+        _, deleted = self._run(
+            f"DELETE FROM jobs WHERE status NOT IN ({', '.join('?' * len(UNFINISHED))}) AND updated_at < ?",
+            (*UNFINISHED, time.time() - max_age))
+        return deleted
+
+    def status(self) -> Dict:
+        return {
+            'enabled': self.enabled,
+            'path': str(self.path),
+            'records': self.records,
+            'commits': self.commits,
+            'pending': self._queue.qsize(),
+            'records_per_commit': round(self.records / self.commits, 2) if self.commits else None,
+            'avg_commit_ms': round(self.commit_seconds / self.commits * 1000, 3) if self.commits else None
+        }
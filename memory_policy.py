@@ -0,0 +1,302 @@
+"""
+Memory-optimization policy engine for Stable Diffusion pipelines
+
+Reads the optimization settings from the environment (.env.example) and picks,
+per request, the fastest combination of attention slicing, VAE slicing/tiling
+and CPU offload whose estimated peak memory fits into free memory. Static
+settings (SDPA / xformers attention, channels_last) are applied once when a
+pipeline is loaded.
+
+Each boolean setting accepts true, false or auto; explicit true/false pins the
+setting, auto lets the engine decide per request.
+"""
+
+import os
+import logging
+import weakref
+from typing import Any, Dict, Optional
+
+from utils import detect_model_type, estimate_memory_requirement
+
+logger = logging.getLogger(__name__)
+
+# Escalation levels, cheapest first. Offload levels are only used on CUDA.
+MEMORY_LEVELS = [
+    {'attention_slicing': False, 'vae_slicing': False, 'vae_tiling': False, 'offload': None},
+    {'attention_slicing': True, 'vae_slicing': True, 'vae_tiling': False, 'offload': None},
+    {'attention_slicing': True, 'vae_slicing': True, 'vae_tiling': True, 'offload': None},
+    {'attention_slicing': True, 'vae_slicing': True, 'vae_tiling': True, 'offload': 'model'},
+    {'attention_slicing': True, 'vae_slicing': True, 'vae_tiling': True, 'offload': 'sequential'},
+]
+
+# Share of the weights that stays on the GPU with each offload mode
+OFFLOAD_RESIDENT_WEIGHTS = {None: 1.0, 'model': 0.7, 'sequential': 0.05}
+
+# Leave headroom for the allocator and other processes
+SAFETY_FACTOR = 0.9
+
+def _env_flag(name: str, default: str = 'auto') -> Optional[bool]:
+    """Read a true/false/auto environment setting, None meaning auto"""
+    value = os.environ.get(name, default).strip().lower()
+    if value in ('1', 'true', 'yes', 'on'):
+        return True
+    if value in ('0', 'false', 'no', 'off'):
+        return False
+    return None
+
+def available_memory(device: str) -> Optional[int]:
+    """Free memory in bytes on the device, None if unknown"""
+    if device.startswith('cuda'):
+        import torch
+
+        free, _ = torch.cuda.mem_get_info()
+        return free
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def total_memory(device: str) -> Optional[int]:
+    """Total memory in bytes of the device, None if unknown"""
+    if device.startswith('cuda'):
+        import torch
+
+        _, total = torch.cuda.mem_get_info()
+        return total
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemTotal:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+class MemoryPolicyEngine:
+    """Choose and apply memory optimizations per pipeline and request"""
+
+    def __init__(self, settings: Optional[Dict[str, Any]] = None):
+        self.settings = settings if settings is not None else self.settings_from_env()
+        # model name -> observed / estimated peak ratio
+        self.calibration = {}
+        # pipeline -> optimizations currently applied to it
+        self._applied = weakref.WeakKeyDictionary()
+
+    @staticmethod
+    def settings_from_env() -> Dict[str, Any]:
+        """Optimization settings from the environment"""
+        strategy = os.environ.get('OFFLOAD_STRATEGY', 'auto').strip().lower()
+        if _env_flag('ENABLE_SEQUENTIAL_CPU_OFFLOAD', 'false'):
+            strategy = 'force_sequential'
+        return {
+            'attention_slicing': _env_flag('ENABLE_ATTENTION_SLICING'),
+            'vae_slicing': _env_flag('ENABLE_VAE_SLICING'),
+            'vae_tiling': _env_flag('ENABLE_VAE_TILING'),
+            # auto / sequential: both offload modes allowed, model: only model
+            # offload, none / attention: never offload
+            'offload_strategy': strategy,
+            'xformers': _env_flag('ENABLE_XFORMERS'),
+            'sdpa': _env_flag('USE_SCALED_DOT_PRODUCT_ATTENTION'),
+            'channels_last': _env_flag('ENABLE_CHANNELS_LAST'),
+        }
+
+    # ---------- static settings (once per pipeline) ----------
+
+    def prepare(self, pipeline, device: str):
+        """Apply attention backend and memory format when a pipeline is loaded"""
+        import torch
+
+        backend = self._set_attention_backend(pipeline, device)
+
+        channels_last = self.settings['channels_last']
+        if channels_last is None:
+            channels_last = device.startswith('cuda')
+        if channels_last:
+            for name in ('unet', 'vae', 'controlnet'):
+                component = getattr(pipeline, name, None)
+                if component is not None:
+                    component.to(memory_format=torch.channels_last)
+
+        self._applied[pipeline] = {
+            'attention_backend': backend,
+            'channels_last': bool(channels_last),
+            'attention_slicing': False,
+            'vae_slicing': False,
+            'vae_tiling': False,
+            'offload': None,
+        }
+        return pipeline
+
+    def _set_attention_backend(self, pipeline, device: str) -> str:
+        """Select xformers, SDPA or classic attention; returns the backend name"""
+        import torch
+
+        xformers = self.settings['xformers']
+        if xformers is not False and device.startswith('cuda') and hasattr(
+                pipeline, 'enable_xformers_memory_efficient_attention'):
+            try:
+                pipeline.enable_xformers_memory_efficient_attention()
+                return 'xformers'
+            except Exception as e:
+                if xformers:
+                    logger.warning("xformers unavailable, using SDPA: %s", e)
+
+        unet = getattr(pipeline, 'unet', None)
+        has_sdpa = hasattr(torch.nn.functional, 'scaled_dot_product_attention')
+        if unet is None:
+            return 'sdpa' if has_sdpa else 'classic'
+
+        from diffusers.models.attention_processor import AttnProcessor, AttnProcessor2_0
+
+        if has_sdpa and self.settings['sdpa'] is not False:
+            unet.set_attn_processor(AttnProcessor2_0())
+            return 'sdpa'
+        unet.set_attn_processor(AttnProcessor())
+        return 'classic'
+
+    # ---------- per-request planning ----------
+
+    def _allowed_levels(self, device: str):
+        """Escalation levels permitted by the settings, with pinned flags applied"""
+        strategy = self.settings['offload_strategy']
+        levels = []
+        for level in MEMORY_LEVELS:
+            offload = level['offload']
+            if offload and not device.startswith('cuda'):
+                continue
+            if offload == 'sequential' and strategy not in ('auto', 'sequential', 'force_sequential'):
+                continue
+            if offload == 'model' and strategy not in ('auto', 'sequential', 'model'):
+                continue
+            if strategy == 'force_sequential' and device.startswith('cuda') and offload != 'sequential':
+                continue
+
+            config = dict(level)
+            for key in ('attention_slicing', 'vae_slicing', 'vae_tiling'):
+                if self.settings[key] is not None:
+                    config[key] = self.settings[key]
+            if config not in levels:
+                levels.append(config)
+        return levels or [dict(MEMORY_LEVELS[0])]
+
+    def estimate(self, config: Dict[str, Any], params: Dict, model_name: str,
+                 weights_bytes: Optional[int], dtype_bytes: int, attention_backend: str) -> float:
+        """Estimated peak memory in GB for a request under a configuration"""
+        if attention_backend in ('sdpa', 'xformers'):
+            attention = 'sdpa'
+        else:
+            attention = 'sliced' if config['attention_slicing'] else 'full'
+
+        weights_gb = None
+        if weights_bytes is not None:
+            weights_gb = weights_bytes / (1024**3) * OFFLOAD_RESIDENT_WEIGHTS[config['offload']]
+
+        return estimate_memory_requirement(
+            params.get('width', 512),
+            params.get('height', 512),
+            params.get('steps', 20),
+            model_type=detect_model_type(model_name),
+            batch_size=params.get('num_images', 1),
+            dtype_bytes=dtype_bytes,
+            attention=attention,
+            vae_slicing=config['vae_slicing'],
+            vae_tiling=config['vae_tiling'],
+            weights_gb=weights_gb,
+            calibration=self.calibration.get(model_name, 1.0)
+        )
+
+    def min_estimate(self, params: Dict, model_name: str, device: str,
+                     weights_bytes: Optional[int] = None, dtype_bytes: int = 2) -> float:
+        """Estimated peak memory in GB with the most economical configuration allowed"""
+        return self.estimate(self._allowed_levels(device)[-1], params, model_name,
+                             weights_bytes, dtype_bytes, 'sdpa')
+
+    def plan(self, pipeline, params: Dict, model_name: str, device: str,
+             weights_bytes: Optional[int] = None, dtype_bytes: int = 2,
+             min_level: int = 0, free_bytes: Optional[int] = None) -> Dict[str, Any]:
+        """Pick the cheapest configuration that fits into free memory"""
+        applied = self._applied.get(pipeline, {})
+        backend = applied.get('attention_backend', 'sdpa')
+        levels = self._allowed_levels(device)
+        min_level = min(min_level, len(levels) - 1)
+
+        if free_bytes is None:
+            free_bytes = available_memory(device)
+        budget_gb = None
+        if free_bytes is not None:
+            # Weights already on the device are part of the estimate, not of the free memory
+            resident = weights_bytes * OFFLOAD_RESIDENT_WEIGHTS[applied.get('offload')] if weights_bytes else 0
+            budget_gb = (free_bytes + resident) * SAFETY_FACTOR / (1024**3)
+
+        chosen = len(levels) - 1
+        estimates = []
+        for index, config in enumerate(levels):
+            estimate_gb = self.estimate(config, params, model_name, weights_bytes, dtype_bytes, backend)
+            estimates.append(estimate_gb)
+            if index >= min_level and (budget_gb is None or estimate_gb <= budget_gb):
+                chosen = index
+                break
+
+        return dict(levels[chosen], level=chosen, max_level=len(levels) - 1,
+                    estimate_gb=estimates[-1],
+                    budget_gb=round(budget_gb, 2) if budget_gb is not None else None)
+
+    def apply(self, pipeline, plan: Dict[str, Any], device: str):
+        """Switch a pipeline to a planned configuration, touching only what changed"""
+        applied = self._applied.get(pipeline)
+        if applied is None:
+            self.prepare(pipeline, device)
+            applied = self._applied[pipeline]
+
+        if applied['offload'] != plan['offload']:
+            if applied['offload'] and hasattr(pipeline, 'remove_all_hooks'):
+                pipeline.remove_all_hooks()
+            if plan['offload'] == 'model':
+                pipeline.enable_model_cpu_offload()
+            elif plan['offload'] == 'sequential':
+                pipeline.enable_sequential_cpu_offload()
+            elif applied['offload'] and hasattr(pipeline, 'remove_all_hooks'):
+                pipeline.to(device)
+            else:
+                # Offload hooks cannot be removed on this diffusers version
+                plan = dict(plan, offload=applied['offload'])
+            applied['offload'] = plan['offload']
+
+        if applied['attention_slicing'] != plan['attention_slicing']:
+            if plan['attention_slicing']:
+                pipeline.enable_attention_slicing()
+            else:
+                pipeline.disable_attention_slicing()
+                # Disabling slicing resets the processors to the default backend
+                applied['attention_backend'] = self._set_attention_backend(pipeline, device)
+            applied['attention_slicing'] = plan['attention_slicing']
+
+        for key, enable, disable in (
+            ('vae_slicing', 'enable_vae_slicing', 'disable_vae_slicing'),
+            ('vae_tiling', 'enable_vae_tiling', 'disable_vae_tiling'),
+        ):
+            if applied[key] != plan[key] and hasattr(pipeline, enable):
+                getattr(pipeline, enable if plan[key] else disable)()
+                applied[key] = plan[key]
+
+        return plan
+
+    def observe(self, model_name: str, estimated_gb: float, peak_bytes: int):
+        """Calibrate estimates for a model from an observed peak"""
+        if not estimated_gb or peak_bytes <= 0:
+            return
+        uncalibrated = estimated_gb / self.calibration.get(model_name, 1.0)
+        ratio = peak_bytes / (1024**3) / uncalibrated
+        previous = self.calibration.get(model_name, ratio)
+        # Exponential moving average, clamped so one outlier cannot dominate
+        self.calibration[model_name] = min(max(0.8 * previous + 0.2 * ratio, 0.5), 3.0)
@@ -0,0 +1,249 @@
+"""
+Memory accounting and leak detection for loaded pipelines
+
+Every pipeline the manager creates is registered here: base models (kept in
+StableDiffusionManager.pipelines) and the img2img / inpaint / ControlNet
+variants built for a single job. An entry records the weight bytes by
+component, dtype and device, and the process RSS / CUDA allocation deltas
+around the load. Pipelines are held by weak reference only, so the tracker
+itself never keeps memory alive.
+
+Leak detection:
+    - after a base model is unloaded, the tracker collects garbage and checks
+      that the pipeline object is gone and that RSS (or CUDA memory) dropped
+      by roughly what the load added;
+    - a variant still alive after its job finished is reported on check().
+
+Reports are per process; inference workers send theirs with every job.
+"""
+
+import gc
+import os
+import sys
+import time
+import logging
+import threading
+import weakref
+from collections import deque
+from typing import Dict, List, Optional
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Memory not given back after an unload, above which it is flagged:
+# max(MEMORY_LEAK_MIN_MB, MEMORY_LEAK_FRACTION x weight bytes)
+LEAK_MIN_BYTES = int(float(os.environ.get('MEMORY_LEAK_MIN_MB', 64)) * 1024 ** 2)
+LEAK_FRACTION = float(os.environ.get('MEMORY_LEAK_FRACTION', 0.25))
+
+def _tensors(module):
+    """Parameters, buffers and dynamically quantized (packed) Linear weights of a module"""
+    yield from module.parameters()
+    yield from module.buffers()
+    for submodule in module.modules():
+        packed = getattr(submodule, '_packed_params', None)
+        if packed is not None and hasattr(packed, '_weight_bias'):
+            for tensor in packed._weight_bias():
+                if tensor is not None:
+                    yield tensor
+
+def weight_breakdown(pipeline) -> Dict:
+    """Weight bytes of a pipeline's torch modules: total, per component, dtype and device
+
+    Tensors shared between components are counted once.
+    """
+    components = getattr(pipeline, 'components', None)
+    if not isinstance(components, dict):
+        components = {name: getattr(pipeline, name, None) for name in
+                      ('unet', 'text_encoder', 'text_encoder_2', 'vae', 'controlnet')}
+    seen = set()
+    by_component, by_dtype, by_device = {}, {}, {}
+    total = 0
+    for name, component in components.items():
+        if component is None or not hasattr(component, 'parameters'):
+            continue
+        component_bytes = 0
+        for tensor in _tensors(component):
+            key = (str(tensor.device), tensor.data_ptr(), tensor.numel())
+            if key in seen:
+                continue
+            seen.add(key)
+            nbytes = tensor.numel() * tensor.element_size()
+            dtype = str(tensor.dtype).replace('torch.', '')
+            by_dtype[dtype] = by_dtype.get(dtype, 0) + nbytes
+            by_device[str(tensor.device)] = by_device.get(str(tensor.device), 0) + nbytes
+            component_bytes += nbytes
+        by_component[name] = component_bytes
+        total += component_bytes
+    return {'bytes': total, 'components': by_component, 'dtypes': by_dtype, 'devices': by_device}
+
+def _trim_heap():
+    """Return free malloc arenas to the OS (glibc), so RSS reflects what was freed"""
+    try:
+        import ctypes
+        ctypes.CDLL('libc.so.6').malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+def _cuda_allocated() -> Optional[int]:
+    torch = sys.modules.get('torch')
+    if torch is None or not torch.cuda.is_available():
+        return None
+    return sum(torch.cuda.memory_allocated(i) for i in range(torch.cuda.device_count()))
+
+def memory_snapshot() -> Dict:
+    """Process RSS and CUDA allocated bytes now"""
+    return {'rss': metrics.process_rss_bytes(), 'cuda': _cuda_allocated()}
+
+def _delta(before: Dict, after: Dict) -> Dict:
+    return {key: after[key] - before[key] if after.get(key) is not None and before.get(key) is not None else None
+            for key in ('rss', 'cuda')}
+
+class MemoryTracker:
+    """Weakly referenced registry of the pipelines of this process"""
+
+    def __init__(self, history_size: int = 100):
+        self.entries = {}  # entry id -> entry of a live (or leaked) pipeline
+        self.leaks = deque(maxlen=history_size)
+        self.released = deque(maxlen=history_size)
+        self._refs = {}  # entry id -> weakref to the pipeline
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def loaded(self, model_name: str, pipeline, before: Dict, kind: str = 'base',
+               trace_id: Optional[str] = None) -> Dict:
+        """Register a pipeline built since `before` (a memory_snapshot()); variants name their job's trace"""
+        entry = {
+            'model': model_name,
+            'kind': kind,
+            'trace_id': trace_id,
+            'loaded_at': time.time(),
+            'load_delta': _delta(before, memory_snapshot()),
+            'unload_delta': None,
+            'job_finished_at': None,
+            **weight_breakdown(pipeline)
+        }
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            entry['id'] = entry_id
+            self.entries[entry_id] = entry
+            self._refs[entry_id] = weakref.ref(pipeline)
+        # Transient variants leave the registry once they are garbage
+        weakref.finalize(pipeline, self._finalized, entry_id)
+        return entry
+
+    def _finalized(self, entry_id: int):
+        with self._lock:
+            entry = self.entries.pop(entry_id, None)
+            self._refs.pop(entry_id, None)
+            if entry is not None:
+                entry['released_at'] = time.time()
+                self.released.append(entry)
+
+    def unloading(self) -> Dict:
+        """Snapshot to pass to unloaded() once the pipeline has been dropped"""
+        return memory_snapshot()
+
+    def unloaded(self, model_name: str, before: Dict) -> List[Dict]:
+        """Check that a model's base pipeline is really gone after an unload; returns new leaks"""
+        gc.collect()
+        torch = sys.modules.get('torch')
+        if torch is not None and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        _trim_heap()
+        delta = _delta(before, memory_snapshot())
+
+        with self._lock:
+            loads = [e for e in list(self.entries.values()) + list(self.released)
+                     if e['model'] == model_name and e['kind'] == 'base' and e['unload_delta'] is None]
+            alive = {e['id'] for e in self.entries.values() if e['model'] == model_name and e['kind'] == 'base'}
+        found = []
+        for entry in loads:
+            entry['unload_delta'] = delta
+            if entry['id'] in alive:
+                found.append(self._leak(entry, 'pipeline still referenced after unload',
+                                        referrers=self._referrers(entry['id'])))
+                continue
+            # The load added load_delta; the unload should give most of it back
+            for key in ('rss', 'cuda'):
+                added, freed = entry['load_delta'].get(key), delta.get(key)
+                if added is None or freed is None:
+                    continue
+                retained = added + freed
+                if retained > max(LEAK_MIN_BYTES, LEAK_FRACTION * entry['bytes']):
+                    found.append(self._leak(entry, f'{key} not released after unload', retained_bytes=retained))
+        return found
+
+    def job_finished(self, trace_id: Optional[str]):
+        """Mark the variants of a finished job; check() flags those still alive"""
+        now = time.time()
+        with self._lock:
+            for entry in self.entries.values():
+                if entry['kind'] != 'base' and entry['trace_id'] == trace_id and entry['job_finished_at'] is None:
+                    entry['job_finished_at'] = now
+
+    def check(self, collect: bool = True, grace: float = 5.0) -> List[Dict]:
+        """Leaks among variants that outlived their job by more than `grace` seconds"""
+        if collect:
+            gc.collect()
+        now = time.time()
+        with self._lock:
+            stale = [e for e in self.entries.values() if e['kind'] != 'base' and e['job_finished_at']
+                     and now - e['job_finished_at'] > grace and not e.get('leaked')]
+        return [self._leak(entry, 'variant pipeline alive after its job finished',
+                           referrers=self._referrers(entry['id'])) for entry in stale]
+
+    def _referrers(self, entry_id: int) -> List[str]:
+        """Types of the objects that still refer to a pipeline, to find who holds it"""
+        pipeline = self._refs.get(entry_id, lambda: None)()
+        if pipeline is None:
+            return []
+        return sorted({type(r).__name__ for r in gc.get_referrers(pipeline)})
+
+    def _leak(self, entry: Dict, reason: str, **details) -> Dict:
+        entry['leaked'] = True
+        leak = {'model': entry['model'], 'kind': entry['kind'], 'trace_id': entry['trace_id'], 'reason': reason,
+                'bytes': entry['bytes'], 'detected_at': time.time(), **details}
+        self.leaks.append(leak)
+        logger.warning("Memory leak: %s (%s): %s %s", entry['model'], entry['kind'], reason, details or '')
+        return leak
+
+    def report(self) -> Dict:
+        """Live pipelines by model and by job trace, totals by dtype / device, recent releases and leaks"""
+        with self._lock:
+            entries = [dict(e) for e in self.entries.values()]
+            released = [dict(e) for e in self.released]
+            leaks = list(self.leaks)
+        models, jobs, dtypes, devices = {}, {}, {}, {}
+        for entry in entries:
+            if entry['kind'] == 'base':
+                models.setdefault(entry['model'], []).append(entry)
+            else:
+                jobs.setdefault(entry['trace_id'] or 'untraced', []).append(entry)
+            for dtype, nbytes in entry['dtypes'].items():
+                dtypes[dtype] = dtypes.get(dtype, 0) + nbytes
+            for device, nbytes in entry['devices'].items():
+                devices[device] = devices.get(device, 0) + nbytes
+        return {
+            'pid': os.getpid(),
+            'process': memory_snapshot(),
+            'tracked_bytes': sum(e['bytes'] for e in entries),
+            'dtypes': dtypes,
+            'devices': devices,
+            'models': models,
+            'jobs': jobs,
+            'released': released[-20:],
+            'leaks': leaks
+        }
+
+    def status(self) -> Dict:
+        """Short summary for /health"""
+        with self._lock:
+            return {
+                'pipelines': len(self.entries),
+                'tracked_bytes': sum(e['bytes'] for e in self.entries.values()),
+                'leaks': len(self.leaks)
+            }
+
+memory_tracker = MemoryTracker()
@@ -0,0 +1,342 @@
+"""
+Prometheus metrics
+
+A small dependency-free metrics registry with Prometheus text exposition
+(GET /metrics). Histograms are plain bucket-count lists updated without
+locks: an observation is one bisect and three increments under the GIL, and
+callers keep the labelled child so the hot path does no lookups or
+allocations. Gauges are read from callbacks at scrape time.
+
+Stage timings of a pipeline call come from PipelineRun: instrument_pipeline()
+wraps a pipeline's encode_prompt and VAE decode once, the step callback marks
+each denoising step, so prompt encode, every step, the whole denoise loop and
+the VAE decode are measured without touching diffusers internals. The same
+stages are recorded as spans of the current trace (tracing.py).
+
+Worker processes (inference_workers.py) have their own registry; they send
+drain() deltas with every result and the parent merge()s them.
+"""
+
+import os
+import sys
+import time
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Sequence
+
+import tracing
+
+# Seconds; covers sub-millisecond stages up to long model loads
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 60, 120, 300)
+STEP_BUCKETS = (0.01, 0.025, 0.05, 0.075, 0.1, 0.15, 0.2, 0.3, 0.5, 0.75, 1, 2, 5, 10)
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(names: Sequence[str], values: Sequence, extra: str = '') -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class _HistogramChild:
+    __slots__ = ('upper', 'counts', 'sum', 'count')
+
+    def __init__(self, upper: Sequence[float]):
+        self.upper = upper
+        self.counts = [0] * (len(upper) + 1)  # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.upper, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+class Histogram:
+    """Histogram with label values -> bucket counts"""
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DURATION_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.upper = tuple(buckets)
+        self._children = {}
+
+    def labels(self, *values) -> _HistogramChild:
+        """Child for these label values; keep it to skip the lookup on hot paths"""
+        values = tuple(str(v) for v in values)
+        child = self._children.get(values)
+        if child is None:
+            # setdefault is atomic: concurrent first observers share one child
+            child = self._children.setdefault(values, _HistogramChild(self.upper))
+        return child
+
+    def drain(self) -> Dict:
+        """Counts observed since the last drain, and reset them (worker -> parent)"""
+        drained = {}
+        for values, child in list(self._children.items()):
+            if child.count:
+                drained[values] = (list(child.counts), child.sum, child.count)
+                child.counts = [0] * len(child.counts)
+                child.sum = 0.0
+                child.count = 0
+        return drained
+
+    def merge(self, drained: Dict):
+        for values, (counts, total, count) in drained.items():
+            child = self.labels(*values)
+            child.counts = [a + b for a, b in zip(child.counts, counts)]
+            child.sum += total
+            child.count += count
+
+    def expose(self) -> List[str]:
+        lines = []
+        for values, child in sorted(self._children.items()):
+            cumulative = 0
+            for upper, count in zip(self.upper + (float('inf'),), child.counts):
+                cumulative += count
+                le = f'le="{_format_value(float(upper))}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, values, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, values)} {child.sum!r}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, values)} {child.count}")
+        return lines
+
+class Counter:
+    """Monotonic counter with labels"""
+
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+
+    def inc(self, *values, amount: float = 1):
+        values = tuple(str(v) for v in values)
+        self._values[values] = self._values.get(values, 0) + amount
+
+    def drain(self) -> Dict:
+        drained = {k: v for k, v in self._values.items() if v}
+        for values in drained:
+            self._values[values] = 0
+        return drained
+
+    def merge(self, drained: Dict):
+        for values, amount in drained.items():
+            self.inc(*values, amount=amount)
+
+    def expose(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(value)}"
+                for values, value in sorted(self._values.items())]
+
+class CallbackMetric:
+    """Gauge (or counter) read at scrape time: fn() returns a number or {label values: number}"""
+
+    def __init__(self, name: str, documentation: str, fn: Callable, labelnames: Sequence[str] = (),
+                 kind: str = 'gauge'):
+        self.name = name
+        self.documentation = documentation
+        self.fn = fn
+        self.labelnames = tuple(labelnames)
+        self.kind = kind
+
+    def expose(self) -> List[str]:
+        value = self.fn()
+        if value is None:
+            return []
+        if not isinstance(value, dict):
+            value = {(): value}
+        return [f"{self.name}{_format_labels(self.labelnames, labels if isinstance(labels, tuple) else (labels,))} "
+                f"{_format_value(v)}" for labels, v in sorted(value.items()) if v is not None]
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, *args, **kwargs) -> Histogram:
+        return self.register(Histogram(*args, **kwargs))
+
+    def counter(self, *args, **kwargs) -> Counter:
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, name: str, documentation: str, fn: Callable, labelnames: Sequence[str] = (),
+              kind: str = 'gauge'):
+        """Metric read from fn() at scrape time; kind='counter' for totals kept elsewhere"""
+        return self.register(CallbackMetric(name, documentation, fn, labelnames, kind))
+
+    def drain(self) -> Dict:
+        """Histogram / counter deltas of this process, keyed by metric name"""
+        return {m.name: m.drain() for m in self.metrics if hasattr(m, 'drain')}
+
+    def merge(self, drained: Dict):
+        by_name = {m.name: m for m in self.metrics}
+        for name, values in (drained or {}).items():
+            if name in by_name and values:
+                by_name[name].merge(values)
+
+    def expose(self) -> str:
+        """Prometheus text format (version 0.0.4)"""
+        lines = []
+        for metric in self.metrics:
+            try:
+                samples = metric.expose()
+            except Exception as e:
+                lines.append(f"# {metric.name} unavailable: {e}")
+                continue
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(samples)
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+# ==================== GENERATION METRICS ====================
+
+QUEUE_WAIT = REGISTRY.histogram('sd_queue_wait_seconds', 'Time from job submission to start',
+                                ('task', 'model'))
+MODEL_LOAD = REGISTRY.histogram('sd_model_load_seconds', 'Pipeline load time', ('model',))
+PROMPT_ENCODE = REGISTRY.histogram('sd_prompt_encode_seconds', 'Text encoder time per pipeline call',
+                                   ('task', 'model'))
+DENOISE = REGISTRY.histogram('sd_denoise_seconds', 'Denoising loop time per pipeline call', ('task', 'model'))
+STEP = REGISTRY.histogram('sd_step_seconds', 'Time per denoising step', ('task', 'model'), buckets=STEP_BUCKETS)
+VAE_DECODE = REGISTRY.histogram('sd_vae_decode_seconds', 'VAE decode time per pipeline call', ('task', 'model'))
+SAVE = REGISTRY.histogram('sd_save_seconds', 'PNG encode and save time per image', ('task', 'model'))
+DRIVE_UPLOAD = REGISTRY.histogram('sd_drive_upload_seconds', 'Google Drive upload time per image',
+                                  ('task', 'model'))
+GENERATION = REGISTRY.histogram('sd_generation_seconds', 'Job run time from start to saved result',
+                                ('task', 'model'))
+JOBS = REGISTRY.counter('sd_jobs_total', 'Finished jobs by outcome', ('task', 'status'))
+
+# ==================== PIPELINE STAGES ====================
+
+_local = threading.local()
+
+class PipelineRun:
+    """Stage timings of one pipeline call on the current thread"""
+
+    __slots__ = ('encode', 'denoise', 'step', 'decode', 'started', 'last_step', 'decoded')
+
+    def __init__(self, task: str, model: str):
+        self.encode = PROMPT_ENCODE.labels(task, model)
+        self.denoise = DENOISE.labels(task, model)
+        self.step = STEP.labels(task, model)
+        self.decode = VAE_DECODE.labels(task, model)
+        # Denoising starts when the prompt is encoded (or now, for pipelines that do not encode)
+        self.started = self.last_step = time.perf_counter()
+        self.decoded = False
+
+    def encoded(self, seconds: float):
+        self.encode.observe(seconds)
+        self.started = self.last_step = time.perf_counter()
+        tracing.record('prompt_encode', self.started - seconds, self.started)
+
+    def mark_step(self):
+        now = time.perf_counter()
+        self.step.observe(now - self.last_step)
+        self.last_step = now
+
+    def decode_started(self):
+        if not self.decoded:
+            self._denoised()
+            self.decoded = True
+
+    def _denoised(self):
+        self.denoise.observe(self.last_step - self.started)
+        tracing.record('denoise', self.started, self.last_step)
+
+def current_run() -> Optional[PipelineRun]:
+    return getattr(_local, 'run', None)
+
+@contextmanager
+def pipeline_run(task: str, model: str):
+    """Time the stages of the pipeline calls made inside this block"""
+    run = PipelineRun(task, model)
+    previous = current_run()
+    _local.run = run
+    try:
+        yield run
+    finally:
+        if not run.decoded and run.last_step > run.started:
+            # output_type='latent' or an error after denoising
+            run._denoised()
+        _local.run = previous
+
+def instrument_pipeline(pipeline):
+    """Wrap a pipeline's encode_prompt and VAE decode (once) to report to the current PipelineRun"""
+    if getattr(pipeline, '_sd_instrumented', False):
+        return pipeline
+
+    encode_prompt = getattr(pipeline, 'encode_prompt', None)
+    if encode_prompt is not None:
+        def timed_encode_prompt(*args, **kwargs):
+            run = current_run()
+            start = time.perf_counter()
+            result = encode_prompt(*args, **kwargs)
+            if run is not None:
+                run.encoded(time.perf_counter() - start)
+            return result
+        pipeline.encode_prompt = timed_encode_prompt
+
+    vae = getattr(pipeline, 'vae', None)
+    if vae is not None and hasattr(vae, 'decode'):
+        decode = vae.decode
+
+        def timed_decode(*args, **kwargs):
+            run = current_run()
+            if run is None:
+                return decode(*args, **kwargs)
+            run.decode_started()
+            start = time.perf_counter()
+            result = decode(*args, **kwargs)
+            end = time.perf_counter()
+            run.decode.observe(end - start)
+            tracing.record('vae_decode', start, end)
+            return result
+        vae.decode = timed_decode
+
+    pipeline._sd_instrumented = True
+    return pipeline
+
+# ==================== PROCESS ====================
+
+def process_rss_bytes() -> Optional[int]:
+    """Resident set size of this process"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+def cuda_memory() -> Optional[Dict]:
+    """{(device, kind): bytes} for allocated / reserved CUDA memory, if torch is already loaded"""
+    torch = sys.modules.get('torch')
+    if torch is None or not torch.cuda.is_available():
+        return None
+    values = {}
+    for index in range(torch.cuda.device_count()):
+        values[(str(index), 'allocated')] = torch.cuda.memory_allocated(index)
+        values[(str(index), 'reserved')] = torch.cuda.memory_reserved(index)
+    return values
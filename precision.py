@@ -0,0 +1,162 @@
+"""
+Precision and weight-quantization policies for Stable Diffusion pipelines
+
+Modes:
+    auto  - fp16 on CUDA/MPS, bf16 on CPU
+    fp32  - full precision
+    fp16  - half precision (GPU only, falls back to bf16 on CPU)
+    bf16  - bfloat16, the CPU-friendly half precision
+    int8  - fp32 weights with dynamic int8 quantization of the UNet and
+            text-encoder Linear layers (CPU only, falls back to fp16 on GPU)
+
+Independently of the mode, the VAE can be kept in fp32 for decoding, which
+avoids NaN / black images with half-precision VAEs (notably SDXL).
+"""
+
+import os
+from typing import Any, Dict, Optional, Tuple
+
+PRECISION_MODES = ('auto', 'fp32', 'fp16', 'bf16', 'int8')
+
+# Components whose Linear layers are quantized in int8 mode
+QUANTIZED_COMPONENTS = ('unet', 'text_encoder', 'text_encoder_2')
+
+# Components counted in memory reports
+MEMORY_COMPONENTS = ('unet', 'text_encoder', 'text_encoder_2', 'vae', 'controlnet')
+
+def parse_model_overrides(value: str) -> Dict[str, str]:
+    """Parse "model=mode,model2=mode" into a dict"""
+    overrides = {}
+    for item in value.split(','):
+        if '=' not in item:
+            continue
+        model_name, mode = item.rsplit('=', 1)
+        if model_name.strip() and mode.strip():
+            overrides[model_name.strip()] = mode.strip().lower()
+    return overrides
+
+def _parse_bool(value) -> Optional[bool]:
+    """Parse true/false/auto style values, None meaning auto"""
+    if value is None or isinstance(value, bool):
+        return value
+    value = str(value).strip().lower()
+    if value in ('1', 'true', 'yes', 'on'):
+        return True
+    if value in ('0', 'false', 'no', 'off'):
+        return False
+    return None
+
+def resolve_policy(model_name: str, device: str, requested: Optional[str] = None,
+                   default: str = 'auto', overrides: Optional[Dict[str, str]] = None,
+                   vae_fp32=None) -> Dict[str, Any]:
+    """Resolve the precision policy for a model on a device
+
+    Priority: per-request mode, per-model override, server default.
+    Modes the device cannot run are replaced by the closest supported one.
+    """
+    overrides = overrides if overrides is not None else parse_model_overrides(
+        os.environ.get('MODEL_PRECISION_OVERRIDES', ''))
+    mode = (requested or overrides.get(model_name) or default or 'auto').lower()
+    if mode not in PRECISION_MODES:
+        raise ValueError(f"Unknown precision mode: {mode} (expected one of {', '.join(PRECISION_MODES)})")
+
+    on_cpu = device == 'cpu'
+    if mode == 'auto':
+        mode = 'bf16' if on_cpu else 'fp16'
+    elif mode == 'fp16' and on_cpu:
+        mode = 'bf16'
+    elif mode == 'int8' and not on_cpu:
+        mode = 'fp16'
+
+    if vae_fp32 is None:
+        vae_fp32 = os.environ.get('VAE_FP32', 'auto')
+    upcast_vae = _parse_bool(vae_fp32)
+    if upcast_vae is None:
+        # fp16 VAEs overflow to NaN on large activations, SDXL in particular
+        upcast_vae = mode == 'fp16' and 'xl' in model_name.lower()
+
+    return {'mode': mode, 'vae_fp32': bool(upcast_vae)}
+
+def torch_dtype(policy: Dict[str, Any]):
+    """torch dtype used to load the weights for a policy"""
+    import torch
+
+    return {
+        'fp32': torch.float32,
+        'fp16': torch.float16,
+        'bf16': torch.bfloat16,
+        'int8': torch.float32,
+    }[policy['mode']]
+
+def _upcast_vae(vae):
+    """Keep the VAE in fp32 and cast latents on the way in"""
+    import torch
+
+    vae.to(torch.float32)
+    decode = vae.decode
+
+    def decode_fp32(z, *args, **kwargs):
+        return decode(z.to(torch.float32), *args, **kwargs)
+
+    vae.decode = decode_fp32
+
+def apply_policy(pipeline, policy: Dict[str, Any]):
+    """Apply quantization and VAE upcasting after the pipeline is on its device"""
+    import torch
+
+    if policy['mode'] == 'int8':
+        from torch.ao.quantization import quantize_dynamic
+
+        for name in QUANTIZED_COMPONENTS:
+            component = getattr(pipeline, name, None)
+            if component is not None:
+                quantize_dynamic(component, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+    vae = getattr(pipeline, 'vae', None)
+    if policy['vae_fp32'] and vae is not None and vae.dtype != torch.float32:
+        _upcast_vae(vae)
+
+    return pipeline
+
+def _weight_stats(module) -> Tuple[int, int]:
+    """(bytes, elements) of a module's weights, including dynamically quantized Linear layers"""
+    tensors = list(module.parameters()) + list(module.buffers())
+    for submodule in module.modules():
+        packed = getattr(submodule, '_packed_params', None)
+        if packed is not None and hasattr(packed, '_weight_bias'):
+            weight, bias = packed._weight_bias()
+            tensors.append(weight)
+            if bias is not None:
+                tensors.append(bias)
+    nbytes = sum(t.numel() * t.element_size() for t in tensors)
+    numel = sum(t.numel() for t in tensors)
+    return nbytes, numel
+
+def module_nbytes(module) -> int:
+    """Bytes held by a module's weights"""
+    return _weight_stats(module)[0]
+
+def memory_report(pipeline, policy: Dict[str, Any]) -> Dict[str, Any]:
+    """Weight memory of a pipeline compared to an fp32 copy"""
+    memory_bytes = 0
+    fp32_bytes = 0
+    components = {}
+    for name in MEMORY_COMPONENTS:
+        component = getattr(pipeline, name, None)
+        if component is None or not hasattr(component, 'parameters'):
+            continue
+        nbytes, numel = _weight_stats(component)
+        components[name] = nbytes
+        memory_bytes += nbytes
+        fp32_bytes += numel * 4
+
+    saved = fp32_bytes - memory_bytes
+    return {
+        'precision': policy['mode'],
+        'vae_fp32': policy['vae_fp32'],
+        'memory_bytes': memory_bytes,
+        'fp32_bytes': fp32_bytes,
+        'saved_bytes': saved,
+        'saved_percent': round(saved / fp32_bytes * 100, 1) if fp32_bytes else 0.0,
+        'components': components
+    }
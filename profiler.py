@@ -0,0 +1,306 @@
+"""
+On-demand sampling profiler
+
+A profiling session samples the Python stacks of every thread of the server
+(sys._current_frames) from a background thread, for a fixed time window or
+until the next N jobs have finished, and aggregates them into collapsed
+stacks ("thread;outer;...;inner count", for flamegraph.pl / speedscope) or
+a speedscope JSON profile. Jobs running in inference worker processes are
+profiled there with the same sampler and their stacks are merged in.
+
+Sampling only holds the GIL while it walks the stacks. That cost is
+measured, and the interval is stretched whenever it exceeds max_overhead
+(2%) of the wall time, so a session stays below a few percent overhead.
+
+A session may also capture one in-process job with torch.profiler (operator
+level, CPU and CUDA); that trace is written as Chrome trace JSON.
+"""
+
+import os
+import sys
+import time
+import uuid
+import logging
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+PROFILE_DIR = Path(os.environ.get('PROFILE_DIR', './cache/profiles'))
+# Sessions are bounded whatever the request says
+MAX_SECONDS = float(os.environ.get('PROFILE_MAX_SECONDS', 300))
+
+def _frame_name(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+class StackSampler:
+    """Samples thread stacks into a Counter of (thread name, frames root-first)"""
+
+    def __init__(self, interval: float = 0.01, max_overhead: float = 0.02):
+        self.requested_interval = interval
+        self.interval = interval
+        self.max_overhead = max_overhead
+        self.counts = Counter()
+        self.samples = 0
+        self.sampling_seconds = 0.0
+        self.started_at = None
+        self.stopped_at = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._names = {}  # code object -> frame name
+
+    def start(self):
+        self.started_at = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        if self.stopped_at is None:
+            self.stopped_at = time.perf_counter()
+
+    def _run(self):
+        own = threading.get_ident()
+        cost = None
+        while not self._stop.wait(self.interval):
+            # Thread CPU time: waiting for the GIL is not cost this thread adds
+            start = time.thread_time()
+            threads = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    name = self._names.get(code)
+                    if name is None:
+                        name = self._names[code] = _frame_name(code)
+                    stack.append(name)
+                    frame = frame.f_back
+                stack.reverse()
+                self.counts[(threads.get(ident, str(ident)), tuple(stack))] += 1
+            self.samples += 1
+            spent = time.thread_time() - start
+            self.sampling_seconds += spent
+            # Keep the (smoothed) sampling cost under max_overhead of wall time
+            cost = spent if cost is None else 0.9 * cost + 0.1 * spent
+            self.interval = min(max(self.requested_interval, cost / self.max_overhead), 1.0)
+
+    def overhead(self) -> float:
+        """Fraction of wall time spent sampling (GIL held)"""
+        elapsed = (self.stopped_at or time.perf_counter()) - (self.started_at or time.perf_counter())
+        return self.sampling_seconds / elapsed if elapsed > 0 else 0.0
+
+    def collapsed(self) -> List[str]:
+        return collapsed(self.counts)
+
+def collapsed(counts: Counter) -> List[str]:
+    """Collapsed-stack lines, most frequent first"""
+    return [f"{thread};{';'.join(stack)} {count}" if stack else f"{thread} {count}"
+            for (thread, stack), count in counts.most_common()]
+
+def merge_collapsed(counts: Counter, lines: List[str], prefix: str = ''):
+    """Add collapsed-stack lines (e.g. from a worker process) to a Counter"""
+    for line in lines:
+        stacks, _, count = line.rpartition(' ')
+        thread, *frames = stacks.split(';')
+        counts[(prefix + thread, tuple(frames))] += int(count)
+
+def speedscope(counts: Counter, name: str, interval: float) -> Dict:
+    """speedscope file format: one sampled profile per thread"""
+    frames = []
+    index = {}
+    profiles = {}
+    for (thread, stack), count in counts.items():
+        ids = []
+        for frame in stack:
+            if frame not in index:
+                index[frame] = len(frames)
+                frames.append({'name': frame})
+            ids.append(index[frame])
+        profile = profiles.setdefault(thread, {'samples': [], 'weights': []})
+        profile['samples'].append(ids)
+        profile['weights'].append(count)
+    return {
+        '$schema': 'https://www.speedscope.app/file-format-schema.json',
+        'name': name,
+        'shared': {'frames': frames},
+        'profiles': [{'type': 'sampled', 'name': thread, 'unit': 'none', 'startValue': 0,
+                      'endValue': sum(p['weights']), 'samples': p['samples'], 'weights': p['weights']}
+                     for thread, p in sorted(profiles.items())],
+        'exporter': f'sd-server sampling profiler ({interval * 1000:.1f} ms)'
+    }
+
+class ProfileSession:
+    """One profiling window: `seconds` long, or until `jobs` jobs have finished"""
+
+    def __init__(self, seconds: Optional[float] = None, jobs: Optional[int] = None, interval: float = 0.01,
+                 torch_job: bool = False, max_overhead: float = 0.02):
+        if not seconds and not jobs:
+            seconds = 10
+        self.id = uuid.uuid4().hex[:12]
+        self.seconds = min(float(seconds), MAX_SECONDS) if seconds else None
+        self.jobs_left = int(jobs) if jobs else None
+        self.jobs = 0
+        self.torch_job = torch_job
+        self.torch_trace = None
+        self.sampler = StackSampler(interval, max_overhead)
+        self.counts = self.sampler.counts
+        self.created_at = time.time()
+        self.finished = threading.Event()
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def start(self):
+        self.sampler.start()
+        # Job-bounded sessions also end after MAX_SECONDS
+        self._timer = threading.Timer(self.seconds or MAX_SECONDS, self.stop)
+        self._timer.name = 'profile-timer'
+        self._timer.daemon = True
+        self._timer.start()
+
+    def stop(self):
+        with self._lock:
+            if self.finished.is_set():
+                return
+            self.sampler.stop()
+            if self._timer is not None:
+                self._timer.cancel()
+            self.finished.set()
+        logger.info("Profile %s finished: %s samples, overhead %.2f%%", self.id, self.sampler.samples,
+                    self.sampler.overhead() * 100)
+
+    def merge(self, stacks: List[str], prefix: str):
+        """Add stacks sampled in a worker process"""
+        with self._lock:
+            merge_collapsed(self.counts, stacks, prefix)
+
+    def job_finished(self):
+        with self._lock:
+            self.jobs += 1
+            done = self.jobs_left is not None and self.jobs >= self.jobs_left
+        if done:
+            self.stop()
+
+    def wants_torch(self) -> bool:
+        """True once: the next in-process job is captured with torch.profiler"""
+        with self._lock:
+            if self.torch_job and self.torch_trace is None and not self.finished.is_set():
+                self.torch_trace = 'pending'
+                return True
+            return False
+
+    def status(self) -> Dict:
+        return {
+            'id': self.id,
+            'running': not self.finished.is_set(),
+            'seconds': self.seconds,
+            'jobs': self.jobs,
+            'jobs_target': self.jobs_left,
+            'samples': self.sampler.samples,
+            'interval_ms': round(self.sampler.interval * 1000, 2),
+            'overhead_percent': round(self.sampler.overhead() * 100, 3),
+            'stacks': len(self.counts),
+            'torch_trace': self.torch_trace
+        }
+
+    def output(self, fmt: str = 'collapsed'):
+        with self._lock:
+            counts = Counter(self.counts)
+        if fmt == 'speedscope':
+            return speedscope(counts, f"profile {self.id}", self.sampler.interval)
+        return ''.join(line + '\n' for line in collapsed(counts))
+
+class Profiler:
+    """At most one session at a time, and the last finished one"""
+
+    def __init__(self):
+        self.session = None
+
+    def active(self) -> Optional[ProfileSession]:
+        session = self.session
+        return session if session is not None and not session.finished.is_set() else None
+
+    def start(self, **options) -> ProfileSession:
+        if self.active() is not None:
+            raise RuntimeError(f"Profile {self.session.id} is already running")
+        session = ProfileSession(**options)
+        session.start()
+        self.session = session
+        return session
+
+    def job_finished(self):
+        session = self.active()
+        if session is not None:
+            session.job_finished()
+
+    def job_options(self) -> Optional[Dict]:
+        """What a worker process should profile for a job dispatched now (None: nothing)"""
+        session = self.active()
+        if session is None:
+            return None
+        return {'session': session.id, 'interval': session.sampler.interval, 'torch': session.wants_torch()}
+
+    def merge_worker(self, result: Optional[Dict], worker: str):
+        """Stacks and torch trace of a job profiled in a worker process"""
+        session = self.session
+        if not result or session is None or session.id != result.get('session'):
+            return
+        if result.get('stacks') and not session.finished.is_set():
+            session.merge(result['stacks'], f"{worker}:")
+        if result.get('torch_trace'):
+            session.torch_trace = result['torch_trace']
+
+    def status(self) -> Optional[Dict]:
+        return self.session.status() if self.session is not None else None
+
+@contextmanager
+def torch_capture(enabled: bool, name: str):
+    """torch.profiler over the block (CPU, and CUDA when present), written as Chrome trace JSON
+
+    Yields a dict that holds 'torch_trace' (the file path) after the block.
+    """
+    result = {}
+    if not enabled:
+        yield result
+        return
+    import torch
+    from torch.profiler import ProfilerActivity, profile
+
+    activities = [ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(ProfilerActivity.CUDA)
+    with profile(activities=activities) as prof:
+        yield result
+    PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+    path = PROFILE_DIR / f"torch_{name}.json"
+    prof.export_chrome_trace(str(path))
+    result['torch_trace'] = str(path)
+    logger.info("torch.profiler trace written to %s", path)
+
+@contextmanager
+def profile_job(options: Optional[Dict], name: str):
+    """Worker side: sample this process (and optionally torch.profiler) while a job runs
+
+    Yields the dict sent back to the parent: {'session', 'stacks', 'torch_trace'}.
+    """
+    if not options:
+        yield None
+        return
+    result = {'session': options.get('session')}
+    sampler = StackSampler(options.get('interval', 0.01))
+    sampler.start()
+    try:
+        with torch_capture(options.get('torch', False), name) as captured:
+            yield result
+        result.update(captured)
+    finally:
+        sampler.stop()
+        result['stacks'] = sampler.collapsed()
+
+profiler = Profiler()
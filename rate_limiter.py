@@ -0,0 +1,208 @@
+"""
+Token-bucket rate limiting per client
+
+Each client (IP address) has a bucket of RATE_LIMIT_REQUESTS tokens that
+refills over RATE_LIMIT_WINDOW seconds. Every socket event and REST request
+spends tokens; expensive actions (generate, upscale...) cost more than cheap
+ones (RATE_LIMIT_COSTS). Checks are O(1).
+
+Backends:
+    MemoryBuckets - per process; buckets kept in LRU order and evicted once
+                    idle long enough to be full again
+    RedisBuckets  - shared by all workers/nodes (RATE_LIMIT_BACKEND=redis);
+                    one hash per client updated by a Lua script, expiring
+                    when the bucket would be full again
+"""
+
+import os
+import math
+import time
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Tokens spent per action; anything not listed costs DEFAULT_COST
+DEFAULT_COSTS = {
+    'generate': 10,
+    'create_job': 10,
+    'upscale_image': 5,
+    'adetailer': 5,
+    'download_model': 5,
+}
+DEFAULT_COST = 1
+
+def parse_costs(value: str) -> Dict[str, float]:
+    """Parse "action=cost,action=cost" overrides"""
+    costs = {}
+    for item in value.split(','):
+        if '=' not in item:
+            continue
+        action, cost = item.split('=', 1)
+        costs[action.strip()] = float(cost)
+    return costs
+
+def client_address(environ: Dict, trust_proxy: bool = False) -> str:
+    """Client IP from a WSGI / Socket.IO environ"""
+    if trust_proxy:
+        forwarded = environ.get('HTTP_X_FORWARDED_FOR')
+        if forwarded:
+            return forwarded.split(',')[0].strip()
+    # The ASGI Socket.IO environ has a placeholder REMOTE_ADDR; the scope has the peer
+    scope = environ.get('asgi.scope')
+    if scope and scope.get('client'):
+        return scope['client'][0]
+    return environ.get('REMOTE_ADDR') or 'unknown'
+
+class MemoryBuckets:
+    """In-process token buckets, least recently used first"""
+
+    def __init__(self, rate: float, burst: float, max_clients: int = 100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        # Seconds after which an untouched bucket is full again and can be dropped
+        self.idle_after = burst / rate
+        self._buckets = OrderedDict()  # key -> (tokens, last update)
+        self._lock = threading.Lock()
+
+    def take(self, key: str, cost: float) -> Tuple[bool, float]:
+        """Spend `cost` tokens; returns (allowed, seconds until allowed)"""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.pop(key, None)
+            if bucket is None:
+                tokens = self.burst
+            else:
+                tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            self._buckets[key] = (tokens, now)
+            self._evict(now)
+
+        return allowed, 0.0 if allowed else (cost - tokens) / self.rate
+
+    def _evict(self, now: float):
+        """Drop full (idle) buckets from the LRU end; amortized O(1)"""
+        buckets = self._buckets
+        while buckets:
+            key, (_, last) = next(iter(buckets.items()))
+            if now - last < self.idle_after and len(buckets) <= self.max_clients:
+                break
+            buckets.popitem(last=False)
+
+    def __len__(self):
+        return len(self._buckets)
+
+# KEYS[1] bucket; ARGV rate, burst, now (s), cost -> {allowed, tokens}
+_TAKE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local cost = tonumber(ARGV[4])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1])
+if tokens == nil then
+    tokens = burst
+else
+    tokens = math.min(burst, tokens + math.max(now - tonumber(bucket[2]), 0) * rate)
+end
+local allowed = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000))
+return {allowed, tostring(tokens)}
+"""
+
+class RedisBuckets:
+    """Token buckets on a Redis-compatible server, shared across processes"""
+
+    def __init__(self, client, rate: float, burst: float, prefix: str = 'sd:ratelimit:'):
+        self.client = client
+        self.rate = rate
+        self.burst = burst
+        self.prefix = prefix
+        self._script = client.register_script(_TAKE_SCRIPT)
+
+    def take(self, key: str, cost: float) -> Tuple[bool, float]:
+        allowed, tokens = self._script(keys=[self.prefix + key], args=[self.rate, self.burst, time.time(), cost])
+        if allowed:
+            return True, 0.0
+        return False, (cost - float(tokens)) / self.rate
+
+class RateLimiter:
+    """Check a client's bucket for an action"""
+
+    def __init__(self, buckets, costs: Dict[str, float] = None, enabled: bool = True,
+                 trust_proxy: bool = False):
+        self.buckets = buckets
+        self.costs = dict(DEFAULT_COSTS, **(costs or {}))
+        self.enabled = enabled
+        self.trust_proxy = trust_proxy
+        self.rejected = 0
+
+    def cost(self, action: str) -> float:
+        return self.costs.get(action, DEFAULT_COST)
+
+    def check(self, environ: Dict, action: str) -> Tuple[bool, float]:
+        """(allowed, retry_after seconds) for the client of `environ`"""
+        if not self.enabled:
+            return True, 0.0
+        key = client_address(environ or {}, self.trust_proxy)
+        try:
+            allowed, retry_after = self.buckets.take(key, self.cost(action))
+        except Exception as e:
+            # A broken shared backend must not take the server down with it
+            logger.warning("Rate limiter unavailable, allowing request: %s", e)
+            return True, 0.0
+        if not allowed:
+            self.rejected += 1
+        return allowed, retry_after
+
+    def status(self) -> Dict:
+        return {
+            'enabled': self.enabled,
+            'backend': type(self.buckets).__name__,
+            'rate_per_s': round(self.buckets.rate, 4),
+            'burst': self.buckets.burst,
+            'clients': len(self.buckets) if hasattr(self.buckets, '__len__') else None,
+            'rejected': self.rejected
+        }
+
+def create_rate_limiter() -> RateLimiter:
+    """Rate limiter configured by RATE_LIMIT_* (and REDIS_URL for the redis backend)"""
+    requests = float(os.environ.get('RATE_LIMIT_REQUESTS', 100))
+    window = float(os.environ.get('RATE_LIMIT_WINDOW', 60))
+    rate = requests / window
+    backend = os.environ.get('RATE_LIMIT_BACKEND', 'memory').lower()
+
+    if backend == 'redis':
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("RATE_LIMIT_BACKEND=redis requires the redis package (pip install redis)")
+        client = redis.Redis.from_url(os.environ.get('REDIS_URL', 'redis://localhost:6379/0'))
+        prefix = os.environ.get('REDIS_PREFIX', 'sd:') + 'ratelimit:'
+        buckets = RedisBuckets(client, rate, requests, prefix=prefix)
+    elif backend == 'memory':
+        buckets = MemoryBuckets(rate, requests, int(os.environ.get('RATE_LIMIT_MAX_CLIENTS', 100000)))
+    else:
+        raise ValueError(f"Unknown RATE_LIMIT_BACKEND: {backend}")
+
+    return RateLimiter(
+        buckets,
+        costs=parse_costs(os.environ.get('RATE_LIMIT_COSTS', '')),
+        enabled=os.environ.get('RATE_LIMIT_ENABLED', 'true').lower() in ('1', 'true', 'yes'),
+        trust_proxy=os.environ.get('RATE_LIMIT_TRUST_PROXY', 'false').lower() in ('1', 'true', 'yes')
+    )
+
+def retry_after_header(retry_after: float) -> str:
+    """Retry-After header value (whole seconds, at least 1)"""
+    return str(max(int(math.ceil(retry_after)), 1))
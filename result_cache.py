@@ -0,0 +1,174 @@
+"""
+Content-addressed cache of generation results
+
+A request with a fixed seed is deterministic, so its 'complete' payload can
+be stored under a canonical hash of everything that affects the output
+(model, precision, LoRAs, task, prompts, seed, sampler, steps, size, input
+image hashes, ...) and replayed for identical requests. Requests with a
+random seed (-1) are never cached.
+
+Entries are JSON files under RESULT_CACHE_DIR, evicted least recently used
+first once their total size exceeds RESULT_CACHE_MAX_MB.
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Bump when a change makes old entries produce different images
+CACHE_VERSION = 1
+
+# Request fields that do not change the images
+IGNORED_FIELDS = {'output_dir', 'filename_prefix', 'job_id', 'request_id', 'client_id', 'trace'}
+# Base64 inputs, hashed instead of embedded in the key
+IMAGE_FIELDS = ('image', 'mask', 'control_image')
+# Defaults as applied by StableDiffusionManager, so omitted and explicit values share a key
+PARAM_DEFAULTS = {
+    'negative_prompt': '',
+    'sampler': 'euler',
+    'scheduler': 'normal',
+    'steps': 20,
+    'cfg_scale': 7.5,
+    'width': 512,
+    'height': 512,
+    'num_images': 1,
+    'loras': [],
+}
+
+def request_key(params: Dict, defaults: Optional[Dict] = None) -> Optional[str]:
+    """Canonical hash of a request, None if it is not deterministic"""
+    seed = params.get('seed', -1)
+    if seed is None or int(seed) < 0:
+        return None
+
+    canonical = dict(PARAM_DEFAULTS, **(defaults or {}))
+    for name, value in params.items():
+        if name in IGNORED_FIELDS or value is None:
+            continue
+        if name in IMAGE_FIELDS:
+            value = hashlib.sha256(str(value).encode()).hexdigest()
+        canonical[name] = value
+    canonical['seed'] = int(seed)
+    canonical['_version'] = CACHE_VERSION
+
+    blob = json.dumps(canonical, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(blob.encode()).hexdigest()
+
+class ResultCache:
+    """On-disk LRU cache of 'complete' payloads keyed by request_key()"""
+
+    def __init__(self, directory: Optional[str] = None, max_bytes: Optional[int] = None,
+                 enabled: Optional[bool] = None):
+        if enabled is None:
+            enabled = os.environ.get('RESULT_CACHE_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+        self.enabled = enabled
+        self.directory = Path(directory or os.environ.get('RESULT_CACHE_DIR', './cache/results'))
+        if max_bytes is None:
+            max_bytes = int(float(os.environ.get('RESULT_CACHE_MAX_MB', 2048)) * 1024 * 1024)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.hit_seconds = 0.0
+        self._index = None  # key -> size, least recently used first
+        self._total = 0
+        self._lock = threading.Lock()
+
+    def _path(self, key: str) -> Path:
+        return self.directory / key[:2] / f"{key}.json"
+
+    def _load_index(self):
+        """Scan the cache directory once, oldest access first"""
+        entries = []
+        if self.directory.exists():
+            for path in self.directory.glob('*/*.json'):
+                try:
+                    stat = path.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, path.stem, stat.st_size))
+        entries.sort()
+        self._index = OrderedDict((key, size) for _, key, size in entries)
+        self._total = sum(size for _, _, size in entries)
+
+    def get(self, key: str) -> Optional[Dict]:
+        """Cached payload or None"""
+        if not self.enabled or key is None:
+            return None
+        start = time.perf_counter()
+        with self._lock:
+            if self._index is None:
+                self._load_index()
+            if key not in self._index:
+                self.misses += 1
+                return None
+            self._index.move_to_end(key)
+
+        path = self._path(key)
+        try:
+            payload = json.loads(path.read_text())
+            os.utime(path)
+        except (OSError, ValueError):
+            with self._lock:
+                self._total -= self._index.pop(key, 0)
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+            self.hit_seconds += time.perf_counter() - start
+        return payload
+
+    def put(self, key: str, payload: Dict):
+        """Store a payload and evict least recently used entries over the size limit"""
+        if not self.enabled or key is None:
+            return
+        data = json.dumps(payload, separators=(',', ':'), default=str).encode()
+        if len(data) > self.max_bytes:
+            return
+        path = self._path(key)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_suffix('.tmp')
+            tmp.write_bytes(data)
+            os.replace(tmp, path)
+        except OSError as e:
+            logger.warning("Result cache write failed: %s", e)
+            return
+
+        with self._lock:
+            if self._index is None:
+                self._load_index()
+            self._total += len(data) - self._index.pop(key, 0)
+            self._index[key] = len(data)
+            while self._total > self.max_bytes and len(self._index) > 1:
+                old_key, size = self._index.popitem(last=False)
+                self._total -= size
+                self.evictions += 1
+                try:
+                    self._path(old_key).unlink()
+                except OSError:
+                    pass
+
+    def status(self) -> Dict:
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'entries': len(self._index) if self._index is not None else None,
+                'bytes': self._total,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'evictions': self.evictions,
+                'avg_hit_ms': round(self.hit_seconds / self.hits * 1000, 2) if self.hits else None
+            }
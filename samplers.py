@@ -0,0 +1,232 @@
+"""
+Sampler registry: request sampler names -> diffusers schedulers
+
+A request names a sampler ('euler', 'Euler a', 'DPM++ 2M Karras', 'unipc',
+'lcm', ...) and optionally a sigma schedule ('normal', 'karras',
+'exponential'; a name ending in "Karras" sets it too). SchedulerRegistry
+builds the scheduler from the model's original scheduler config, caches it
+per (model, sampler, schedule) and swaps it onto cached pipelines; weights are
+never reloaded. 'default' keeps the model's own scheduler.
+
+Fast mode ('fast': true, or sampler 'lcm') samples with the LCM scheduler in
+LCM_STEPS steps (4 by default) at low guidance. Models that are not LCM
+distilled (no 'lcm' in the name) get the LCM-LoRA of their architecture
+fused in (LCM_LORA_SD15 / LCM_LORA_SDXL). Pairs the installed diffusers
+cannot run (ddim + karras, LCM or exponential sigmas on old releases, ...)
+are rejected by normalize() when the request comes in.
+"""
+
+import os
+import re
+import sys
+import inspect
+import importlib.util
+import logging
+import threading
+import weakref
+from typing import Dict, List, Optional, Tuple
+
+from utils import detect_model_type
+
+logger = logging.getLogger(__name__)
+
+# Sampler name -> (diffusers scheduler class, config overrides)
+SAMPLERS = {
+    'default': (None, {}),
+    'euler': ('EulerDiscreteScheduler', {}),
+    'euler_a': ('EulerAncestralDiscreteScheduler', {}),
+    'heun': ('HeunDiscreteScheduler', {}),
+    'lms': ('LMSDiscreteScheduler', {}),
+    'ddim': ('DDIMScheduler', {}),
+    'pndm': ('PNDMScheduler', {}),
+    'dpm2': ('KDPM2DiscreteScheduler', {}),
+    'dpm2_a': ('KDPM2AncestralDiscreteScheduler', {}),
+    'dpmpp_2m': ('DPMSolverMultistepScheduler', {'algorithm_type': 'dpmsolver++', 'solver_order': 2}),
+    'dpmpp_2m_sde': ('DPMSolverMultistepScheduler', {'algorithm_type': 'sde-dpmsolver++', 'solver_order': 2}),
+    'unipc': ('UniPCMultistepScheduler', {}),
+    'lcm': ('LCMScheduler', {}),
+}
+
+# Other spellings (after normalization: lower case, '_' separators, '++' -> 'pp')
+ALIASES = {
+    'euler_ancestral': 'euler_a',
+    'dpm': 'dpmpp_2m',
+    'dpm_solver': 'dpmpp_2m',
+    'dpmpp': 'dpmpp_2m',
+    'dpm_2': 'dpm2',
+    'dpm_2_a': 'dpm2_a',
+    'uni_pc': 'unipc',
+    'lcm_lora': 'lcm',
+}
+
+# Sigma schedule -> scheduler config flag
+SCHEDULES = {
+    'normal': None,
+    'karras': 'use_karras_sigmas',
+    'exponential': 'use_exponential_sigmas',
+}
+
+DEFAULT_SAMPLER = os.environ.get('DEFAULT_SAMPLER', 'euler')
+LCM_STEPS = int(os.environ.get('LCM_STEPS', 4))
+# Step counts above this in fast mode are replaced by LCM_STEPS
+LCM_MAX_STEPS = 8
+# LCM samples well with little or no classifier-free guidance (1.0 disables it)
+LCM_MAX_GUIDANCE = 2.0
+LCM_LORAS = {
+    'sd15': os.environ.get('LCM_LORA_SD15', 'latent-consistency/lcm-lora-sdv1-5'),
+    'sdxl': os.environ.get('LCM_LORA_SDXL', 'latent-consistency/lcm-lora-sdxl'),
+}
+# Name of the LCM-LoRA in a request's LoRA list
+LCM_LORA = 'lcm-lora'
+
+def parse_sampler(sampler: Optional[str], schedule: Optional[str] = None) -> Tuple[str, str]:
+    """(sampler, schedule) registry keys of a request; ValueError if unknown"""
+    key = re.sub(r'[\s\-]+', '_', str(sampler or DEFAULT_SAMPLER).strip().lower()).replace('++', 'pp')
+    suffix = None
+    for name in SCHEDULES:
+        if key.endswith('_' + name):
+            key, suffix = key[:-len(name) - 1], name
+    key = ALIASES.get(key, key)
+    if key not in SAMPLERS:
+        raise ValueError(f"Unknown sampler: {sampler} (available: {', '.join(SAMPLERS)})")
+
+    schedule = suffix or str(schedule or 'normal').strip().lower()
+    if schedule not in SCHEDULES:
+        raise ValueError(f"Unknown scheduler: {schedule} (available: {', '.join(SCHEDULES)})")
+    return key, schedule
+
+def _diffusers():
+    """The diffusers module, imported on first use; None where it is not installed (e.g. tests)"""
+    module = sys.modules.get('diffusers')
+    if module is None and importlib.util.find_spec('diffusers') is not None:
+        import diffusers as module
+    return module
+
+# (sampler, schedule) -> first diffusers release that runs it; older ones accept the flag but fail
+# in set_timesteps (diffusers 0.31 multistep solvers with exponential sigmas)
+FIXED_IN = {
+    ('dpmpp_2m', 'exponential'): (0, 32),
+    ('dpmpp_2m_sde', 'exponential'): (0, 32),
+    ('unipc', 'exponential'): (0, 32),
+}
+
+def _version(diffusers) -> Tuple[int, ...]:
+    return tuple(int(part) for part in re.findall(r'\d+', diffusers.__version__)[:2])
+
+def _accepts(cls, option: str) -> bool:
+    return option in inspect.signature(cls.__init__).parameters
+
+def scheduler_class(diffusers, class_name: str, sampler: str, schedule: str):
+    """diffusers scheduler class of a sampler; ValueError if this diffusers cannot run it"""
+    cls = getattr(diffusers, class_name, None)
+    if cls is None:
+        raise ValueError(f"Sampler {sampler} needs {class_name}, which diffusers "
+                         f"{diffusers.__version__} does not have")
+    flag = SCHEDULES[schedule]
+    if flag is not None and not _accepts(cls, flag):
+        raise ValueError(f"Sampler {sampler} does not support the {schedule} schedule "
+                         f"with diffusers {diffusers.__version__}")
+    fixed_in = FIXED_IN.get((sampler, schedule))
+    if fixed_in is not None and _version(diffusers) < fixed_in:
+        raise ValueError(f"Sampler {sampler} with the {schedule} schedule needs diffusers >= "
+                         f"{'.'.join(map(str, fixed_in))} (installed: {diffusers.__version__})")
+    return cls
+
+_supported = set()
+
+def check_supported(sampler: str, schedule: str):
+    """ValueError if the installed diffusers cannot build (sampler, schedule), so requests fail on submit
+
+    'default' depends on the model and is checked when the scheduler is built.
+    """
+    class_name = SAMPLERS[sampler][0]
+    if class_name is None or (sampler, schedule) in _supported:
+        return
+    diffusers = _diffusers()
+    if diffusers is None:
+        return
+    scheduler_class(diffusers, class_name, sampler, schedule)
+    _supported.add((sampler, schedule))
+
+def normalize(params: Dict) -> Dict:
+    """Request with canonical sampler / scheduler names and fast-mode steps and guidance
+
+    ValueError for unknown names and for samplers the installed diffusers does not support.
+    """
+    params = dict(params)
+    if params.get('fast'):
+        params['sampler'] = 'lcm'
+    params['sampler'], params['scheduler'] = parse_sampler(params.get('sampler'), params.get('scheduler'))
+    check_supported(params['sampler'], params['scheduler'])
+    if params['sampler'] == 'lcm':
+        if int(params.get('steps', 20)) > LCM_MAX_STEPS:
+            params['steps'] = LCM_STEPS
+        params['cfg_scale'] = min(max(float(params.get('cfg_scale', 1.0)), 1.0), LCM_MAX_GUIDANCE)
+    return params
+
+def lcm_lora_source(model_name: str) -> Optional[str]:
+    """LCM-LoRA (hub id or path) for a model that is not LCM distilled itself, else None"""
+    if 'lcm' in model_name.lower():
+        return None
+    return LCM_LORAS.get(detect_model_type(model_name))
+
+def with_lcm_lora(loras: List[Dict], params: Dict, model_name: str) -> List[Dict]:
+    """A request's LoRAs plus the LCM-LoRA when it samples with LCM"""
+    if params.get('sampler') == 'lcm' and lcm_lora_source(model_name):
+        return list(loras) + [{'name': LCM_LORA, 'weight': 1.0}]
+    return loras
+
+class SchedulerRegistry:
+    """Schedulers built per model and sampler, swapped onto pipelines"""
+
+    def __init__(self):
+        self.base_configs = {}  # model name -> config of the scheduler the model shipped with
+        self.schedulers = {}  # (model name, sampler, schedule) -> scheduler
+        self.swaps = 0
+        # pipeline -> (sampler, schedule) it currently runs with
+        self._applied = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def build(self, base_config, sampler: str, schedule: str = 'normal'):
+        """New scheduler for a sampler from a model's scheduler config"""
+        import diffusers
+
+        class_name, overrides = SAMPLERS[sampler]
+        cls = scheduler_class(diffusers, class_name or base_config['_class_name'], sampler, schedule)
+        flag = SCHEDULES[schedule]
+        if flag is not None:
+            overrides = dict(overrides, **{flag: True})
+        # Overrides from an earlier sampler must not leak in: always start from the original config
+        return cls.from_config(base_config, **overrides)
+
+    def apply(self, pipeline, model_name: str, sampler: Optional[str] = None, schedule: Optional[str] = None):
+        """Put the scheduler for (sampler, schedule) on a pipeline of `model_name`"""
+        key = parse_sampler(sampler, schedule)
+        if self._applied.get(pipeline) == key:
+            return pipeline.scheduler
+        with self._lock:
+            if pipeline not in self._applied:
+                self.base_configs.setdefault(model_name, pipeline.scheduler.config)
+            scheduler = self.schedulers.get((model_name,) + key)
+            if scheduler is None:
+                scheduler = self.build(self.base_configs[model_name], *key)
+                self.schedulers[(model_name,) + key] = scheduler
+            pipeline.scheduler = scheduler
+            self._applied[pipeline] = key
+            self.swaps += 1
+        return scheduler
+
+    def drop_model(self, model_name: str):
+        """Forget a model's schedulers when it is unloaded"""
+        with self._lock:
+            self.base_configs.pop(model_name, None)
+            for key in [k for k in self.schedulers if k[0] == model_name]:
+                del self.schedulers[key]
+
+    def status(self) -> Dict:
+        with self._lock:
+            return {
+                'default': DEFAULT_SAMPLER,
+                'cached': sorted(f"{model}:{sampler}:{schedule}" for model, sampler, schedule in self.schedulers),
+                'swaps': self.swaps
+            }
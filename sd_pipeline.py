@@ -0,0 +1,812 @@
+"""
+Stable Diffusion pipelines: model loading, warm-up and generation
+
+StableDiffusionManager and the process state it needs (device, precision,
+preloaded models), without the web server around them. colab_server.py
+builds the server on top of this module; inference worker processes
+(inference_workers.py) import only this module, so a worker holds a single
+manager and state and never builds the Flask / Socket.IO app, the job
+journal or the result cache.
+"""
+
+import os
+import io
+import time
+import base64
+import asyncio
+import logging
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Callable
+
+from PIL import Image
+
+import precision
+import samplers
+import metrics
+import tracing
+from memory_tracker import memory_tracker, memory_snapshot
+from memory_policy import MemoryPolicyEngine
+from compile_cache import CompiledPipelineCache
+
+logger = logging.getLogger(__name__)
+
+# ==================== CONFIGURATION ====================
+
+DEFAULT_MODEL = os.environ.get('DEFAULT_MODEL', 'runwayml/stable-diffusion-v1-5')
+
+# ControlNet checkpoint per controlnet_type
+CONTROLNET_MODELS = {
+    'canny': 'lllyasviel/control_v11p_sd15_canny',
+    'openpose': 'lllyasviel/control_v11p_sd15_openpose',
+    'depth': 'lllyasviel/control_v11p_sd15_depth',
+    'mlsd': 'lllyasviel/control_v11p_sd15_mlsd',
+    'lineart': 'lllyasviel/control_v11p_sd15_lineart',
+    'normalbae': 'lllyasviel/control_v11p_sd15_normalbae',
+    'tile': 'lllyasviel/control_v11f1p_sd15_tile'
+}
+
+# Global state
+class ServerState:
+    def __init__(self):
+        self.models = {}
+        self.current_task = None
+        self.is_generating = False
+        self.queue = []
+        self.gdrive_service = None
+        self.gdrive_folder_id = None
+        self.gallery_history = []
+        # Default precision policy: auto, fp32, fp16, bf16 or int8 (see precision.py)
+        self.model_precision = os.environ.get('MODEL_PRECISION', 'auto').lower()
+        self._device = os.environ.get('DEVICE') or None
+        self.started_at = time.time()
+        # Models to load and warm up in the background at startup
+        self.preload_models = [
+            m.strip() for m in os.environ.get('PRELOAD_MODELS', '').split(',') if m.strip()
+        ]
+        # model name -> pending / loading / warming / warm / failed
+        self.model_status = {}
+        
+    @property
+    def device(self) -> str:
+        """Inference device, detected on first use (imports torch)"""
+        if self._device is None:
+            import torch
+            self._device = "cuda" if torch.cuda.is_available() else "cpu"
+        return self._device
+    
+    def peek_device(self) -> Optional[str]:
+        """Device if already known, without importing torch"""
+        return self._device
+    
+    def is_ready(self) -> bool:
+        """Ready once every preloaded model has been loaded and warmed up"""
+        return all(self.model_status.get(m) == 'warm' for m in self.preload_models)
+    
+    def clear(self):
+        self.models = {}
+        self.current_task = None
+        self.is_generating = False
+        self.queue = []
+
+state = ServerState()
+
+# ==================== UTILITY FUNCTIONS ====================
+
+# Request fields holding base64-encoded images
+IMAGE_FIELDS = ('image', 'mask')
+
+def validate_input(data: Dict, required_fields: List[str]) -> Optional[Dict]:
+    """Validate input data"""
+    if not isinstance(data, dict):
+        return {'error': 'Invalid request format'}
+    
+    for field in required_fields:
+        if field not in data:
+            return {'error': f'Missing required field: {field}'}
+    
+    # Validate string lengths; base64 images are bounded by the upload size limit instead
+    for key, value in data.items():
+        if key not in IMAGE_FIELDS and isinstance(value, str) and len(value) > 10000:
+            return {'error': f'Field {key} exceeds maximum length'}
+    
+    return None
+
+def png_base64(image: Image.Image) -> str:
+    """Encode an image as base64 PNG"""
+    buffered = io.BytesIO()
+    image.save(buffered, format="PNG")
+    return base64.b64encode(buffered.getvalue()).decode()
+
+# ==================== STABLE DIFFUSION PIPELINE ====================
+
+class StableDiffusionManager:
+    """Manage Stable Diffusion models and generation"""
+    
+    def __init__(self):
+        self.pipelines = {}
+        self.models_path = Path(os.environ.get('MODELS_PATH', './models'))
+        self.models_path.mkdir(exist_ok=True)
+        self.current_model = None
+        self.model_lock = threading.Lock()
+        # model name -> lock held while a generation (job or warm-up) uses its pipeline
+        self.pipeline_locks = {}
+        self.pipeline_policies = {}  # model name -> precision policy
+        self.memory_reports = {}  # model name -> weight memory vs fp32
+        self.memory_policy = MemoryPolicyEngine()
+        self.compile_cache = CompiledPipelineCache(pipeline_lock=self.pipeline_lock)
+        self.active_loras = {}  # model name -> [(lora name, weight)] fused into the pipeline
+        self.schedulers = samplers.SchedulerRegistry()
+    
+    async def load_model(self, model_name: str, model_type: str = "checkpoint",
+                         precision_mode: Optional[str] = None) -> bool:
+        """Load model into memory"""
+        with self.model_lock:
+            try:
+                policy = precision.resolve_policy(
+                    model_name, state.device, precision_mode, state.model_precision
+                )
+                
+                if model_name in self.pipelines:
+                    if self.pipeline_policies.get(model_name) == policy:
+                        self.current_model = model_name
+                        return True
+                    
+                    # Loaded with another precision policy: reload once nothing runs on it
+                    logger.info("Reloading %s with precision %s", model_name, policy['mode'])
+                    with self.pipeline_lock(model_name):
+                        self._release_pipeline(model_name)
+                
+                logger.info("Loading model: %s (%s)", model_name, policy['mode'])
+                
+                from diffusers import StableDiffusionPipeline, StableDiffusionXLPipeline
+                
+                if model_type == "checkpoint":
+                    # Load from HuggingFace or local path
+                    if "xl" in model_name.lower():
+                        pipeline_cls = StableDiffusionXLPipeline
+                    else:
+                        pipeline_cls = StableDiffusionPipeline
+                    
+                    before = memory_snapshot()
+                    with metrics.MODEL_LOAD.labels(model_name).time(), tracing.span('load_model', model=model_name):
+                        pipeline = self._from_pretrained(pipeline_cls, model_name, policy)
+                    memory_tracker.loaded(model_name, pipeline, before)
+                    self.pipelines[model_name] = pipeline
+                    self.pipeline_policies[model_name] = policy
+                    self.memory_reports[model_name] = precision.memory_report(pipeline, policy)
+                    self.current_model = model_name
+                    
+                    logger.info("Model loaded successfully: %s", model_name)
+                    return True
+                
+                return False
+            
+            except Exception as e:
+                logger.error("Model loading failed: %s", e)
+                return False
+    
+    def _from_pretrained(self, pipeline_cls, model_name: str, policy: Dict, **kwargs):
+        """Load a pipeline with the weights dtype and quantization of a precision policy"""
+        with tracing.span('from_pretrained', pipeline=pipeline_cls.__name__, model=model_name):
+            pipeline = pipeline_cls.from_pretrained(
+                model_name,
+                torch_dtype=precision.torch_dtype(policy),
+                use_safetensors=True,
+                **kwargs
+            ).to(state.device)
+            precision.apply_policy(pipeline, policy)
+            return metrics.instrument_pipeline(self.memory_policy.prepare(pipeline, state.device))
+    
+    def _load_variant(self, pipeline_cls, model_name: str, kind: str, before: Optional[Dict] = None, **kwargs):
+        """Build a per-job pipeline (img2img, inpaint, ControlNet) and register it with the memory tracker"""
+        before = before or memory_snapshot()
+        pipeline = self._from_pretrained(pipeline_cls, model_name, self._policy_for(model_name), **kwargs)
+        memory_tracker.loaded(model_name, pipeline, before, kind=kind,
+                              trace_id=(tracing.current() or {}).get('id'))
+        return pipeline
+    
+    def pipeline_lock(self, model_name: str) -> threading.Lock:
+        """Lock serializing generations on a model's cached pipeline"""
+        return self.pipeline_locks.setdefault(model_name, threading.Lock())
+    
+    def _policy_for(self, model_name: str) -> Dict:
+        """Precision policy of a loaded model"""
+        return self.pipeline_policies.get(model_name) or precision.resolve_policy(
+            model_name, state.device, None, state.model_precision
+        )
+    
+    def _release_pipeline(self, model_name: str):
+        """Drop a pipeline and everything recorded about it, then check that its memory was freed"""
+        before = memory_tracker.unloading()
+        self.pipelines.pop(model_name, None)
+        self.pipeline_policies.pop(model_name, None)
+        self.memory_reports.pop(model_name, None)
+        self.active_loras.pop(model_name, None)
+        self.compile_cache.drop_model(model_name)
+        self.schedulers.drop_model(model_name)
+        # Collects garbage and empties the CUDA cache before measuring
+        memory_tracker.unloaded(model_name, before)
+    
+    async def unload_model(self, model_name: str = None):
+        """Unload model from memory"""
+        model_to_unload = model_name or self.current_model
+        
+        if model_to_unload and model_to_unload in self.pipelines:
+            with self.pipeline_lock(model_to_unload):
+                self._release_pipeline(model_to_unload)
+            logger.info("Model unloaded: %s", model_to_unload)
+    
+    async def warm_up(self, model_name: str) -> bool:
+        """Load a model and run one small generation to warm kernels and allocator"""
+        state.model_status[model_name] = 'loading'
+        if not await self.load_model(model_name):
+            state.model_status[model_name] = 'failed'
+            return False
+        
+        state.model_status[model_name] = 'warming'
+        size = int(os.environ.get('WARMUP_SIZE', 256))
+        try:
+            start = time.time()
+            # Runs on the preload thread: wait for a job already using the pipeline
+            with self.pipeline_lock(model_name):
+                pipeline = self.pipelines[model_name]
+                await self._txt2img(pipeline, {
+                    'prompt': 'warm-up',
+                    'model': model_name,
+                    'width': size,
+                    'height': size,
+                    'steps': int(os.environ.get('WARMUP_STEPS', 2)),
+                    'seed': 0
+                })
+                
+                if self.compile_cache.enabled:
+                    width, height = self.compile_cache.snap(
+                        int(os.environ.get('DEFAULT_WIDTH', 512)), int(os.environ.get('DEFAULT_HEIGHT', 512))
+                    )
+                    self.compile_cache.schedule(pipeline, {
+                        'model': model_name, 'width': width, 'height': height
+                    }, state.device)
+            state.model_status[model_name] = 'warm'
+            logger.info("🔥 Model warmed up: %s (%.1fs)", model_name, time.time() - start)
+            return True
+        except Exception as e:
+            state.model_status[model_name] = 'failed'
+            logger.error("Warm-up failed for %s: %s", model_name, e)
+            return False
+    
+    async def generate(self, params: Dict, step_callback: Optional[Callable[[int, int], None]] = None,
+                       cell_callback: Optional[Callable[[Dict, Image.Image], None]] = None) -> List[Image.Image]:
+        """Generate images based on parameters
+
+        step_callback(step, total) is called after every denoising step,
+        cell_callback(cell, image) after every cell of a sweep.
+        """
+        try:
+            # Validate input
+            validation_error = validate_input(params, ['task', 'prompt'])
+            if validation_error:
+                raise ValueError(validation_error['error'])
+            
+            task = params['task']
+            if task == 'sweep':
+                return await self._sweep(params, step_callback, cell_callback)
+            params = samplers.normalize(params)
+            prompt = params['prompt']
+            negative_prompt = params.get('negative_prompt', '')
+            
+            # Load model if not already loaded
+            model_name = params.get('model', DEFAULT_MODEL)
+            precision_mode = params.get('precision')
+            if precision_mode and precision_mode not in precision.PRECISION_MODES:
+                raise ValueError(f"Unknown precision mode: {precision_mode}")
+            if not await self.load_model(model_name, precision_mode=precision_mode):
+                raise RuntimeError(f"Model could not be loaded: {model_name}")
+            params = dict(params, model=model_name, step_callback=step_callback)
+            
+            # Compiled graphs are static-shape: snap to a resolution bucket
+            if self.compile_cache.enabled and task == 'txt2img':
+                width, height = self.compile_cache.snap(params.get('width', 512), params.get('height', 512))
+                if (width, height) != (params.get('width', 512), params.get('height', 512)):
+                    logger.info("Snapped %sx%s to bucket %sx%s", params.get('width', 512), params.get('height', 512),
+                                width, height)
+                params['width'], params['height'] = width, height
+            
+            # Background warm-up may be running on the same pipeline
+            with self.pipeline_lock(model_name):
+                # Look up by name: background preloading may switch current_model
+                pipeline = self.pipelines[model_name]
+                
+                # On out-of-memory, retry with the next memory-saving level
+                while True:
+                    try:
+                        return await self._run_task(pipeline, params)
+                    except Exception as e:
+                        plan = params.get('memory_plan')
+                        if not _is_out_of_memory(e) or not plan or plan['level'] >= plan['max_level']:
+                            raise
+                        logger.warning("Out of memory at memory level %s, retrying with more savings", plan['level'])
+                        _empty_device_cache()
+                        params = dict(params, memory_level=plan['level'] + 1)
+        
+        except Exception as e:
+            logger.error("Generation failed: %s", e)
+            raise
+        finally:
+            # Variants built for this job should be garbage from here on
+            memory_tracker.job_finished((tracing.current() or {}).get('id'))
+    
+    async def _run_task(self, pipeline, params: Dict) -> List[Image.Image]:
+        """Dispatch to the task implementation and calibrate the memory estimate"""
+        import torch
+        
+        task = params['task']
+        track_peak = state.device.startswith('cuda')
+        if track_peak:
+            torch.cuda.reset_peak_memory_stats()
+        
+        # Generate based on task type
+        with metrics.pipeline_run(task, params['model']), tracing.span(task, model=params['model']):
+            if task == 'txt2img':
+                images = await self._txt2img(pipeline, params)
+            elif task == 'img2img':
+                images = await self._img2img(pipeline, params)
+            elif task == 'inpaint':
+                images = await self._inpaint(pipeline, params)
+            elif 'controlnet' in task:
+                images = await self._controlnet(pipeline, params)
+            else:
+                raise ValueError(f"Unknown task: {task}")
+        
+        plan = params.get('memory_plan')
+        if track_peak and plan:
+            self.memory_policy.observe(params['model'], plan['estimate_gb'], torch.cuda.max_memory_allocated())
+        return images
+    
+    @staticmethod
+    def _callback_kwargs(params: Dict, total: int) -> Dict:
+        """diffusers per-step callback arguments for progress reporting and step timing"""
+        step_callback = params.get('step_callback')
+        
+        def callback(pipeline, step, timestep, callback_kwargs):
+            run = metrics.current_run()
+            if run is not None:
+                run.mark_step()
+            if step_callback is not None:
+                step_callback(step + 1, total)
+            return callback_kwargs
+        
+        return {'callback_on_step_end': callback}
+    
+    def _apply_memory_policy(self, pipeline, params: Dict) -> Dict:
+        """Pick and apply memory optimizations for this request"""
+        model_name = params.get('model', self.current_model)
+        policy = self._policy_for(model_name)
+        plan = self.memory_policy.plan(
+            pipeline, params, model_name, state.device,
+            weights_bytes=self.memory_reports.get(model_name, {}).get('memory_bytes'),
+            dtype_bytes=2 if policy['mode'] in ('fp16', 'bf16') else 4,
+            min_level=params.get('memory_level', 0)
+        )
+        plan = self.memory_policy.apply(pipeline, plan, state.device)
+        if plan['level'] > 0:
+            logger.info("Memory level %s: ~%s GB, budget %s GB, offload=%s",
+                        plan['level'], plan['estimate_gb'], plan['budget_gb'], plan['offload'])
+        params['memory_plan'] = plan
+        return plan
+    
+    def _apply_loras(self, pipeline, model_name: str, loras: List[Dict]):
+        """Fuse the requested LoRAs into a pipeline, unless exactly these are fused already"""
+        if loras and self._policy_for(model_name)['mode'] == 'int8':
+            logger.warning("LoRAs cannot be fused into int8-quantized weights, ignoring them")
+            loras = []
+        
+        signature = [(lora.get('name', ''), lora.get('weight', 1.0)) for lora in loras]
+        if self.active_loras.get(model_name, []) == signature:
+            return
+        
+        with tracing.span('fuse_loras', loras=[name for name, _ in signature]):
+            if self.active_loras.get(model_name):
+                if hasattr(pipeline, 'unfuse_lora'):
+                    pipeline.unfuse_lora()
+                if hasattr(pipeline, 'unload_lora_weights'):
+                    pipeline.unload_lora_weights()
+            
+            for lora_name, lora_weight in signature:
+                if lora_name == samplers.LCM_LORA:
+                    source = samplers.lcm_lora_source(model_name)
+                else:
+                    lora_path = Path('./models/loras') / lora_name
+                    source = str(lora_path) if lora_path.exists() else None
+                
+                if source:
+                    logger.info("Loading LoRA: %s (weight=%s)", lora_name, lora_weight)
+                    self._load_lora(pipeline, source, lora_weight)
+        self.active_loras[model_name] = signature
+    
+    @staticmethod
+    def _load_lora(pipeline, source: str, weight: float):
+        """Load LoRA weights (local path or hub id) and fuse them at `weight`"""
+        kwargs = {}
+        if Path(source).is_dir():
+            # diffusers only guesses the weights file of a directory when it may go online
+            weights = sorted(Path(source).glob('*.safetensors'))
+            if weights:
+                kwargs['weight_name'] = weights[0].name
+        # The PEFT backend puts the adapter weights on the device of the layers they wrap
+        pipeline.load_lora_weights(source, **kwargs)
+        if hasattr(pipeline, 'fuse_lora'):
+            pipeline.fuse_lora(lora_scale=weight)
+    
+    def _apply_sampler(self, pipeline, params: Dict, variant: bool = False):
+        """Swap in the request's scheduler; per-job variant pipelines also get the LCM-LoRA here"""
+        model_name = params.get('model', self.current_model)
+        if variant and params.get('sampler') == 'lcm':
+            source = samplers.lcm_lora_source(model_name)
+            if source and self._policy_for(model_name)['mode'] != 'int8':
+                with tracing.span('fuse_loras', loras=[samplers.LCM_LORA]):
+                    self._load_lora(pipeline, source, 1.0)
+        self.schedulers.apply(pipeline, model_name, params.get('sampler'), params.get('scheduler'))
+    
+    @staticmethod
+    def _encode_prompt(pipeline, params: Dict, do_cfg: bool) -> Dict:
+        """Prompt embeddings as pipeline keyword arguments"""
+        import torch
+        
+        with torch.no_grad():
+            encoded = pipeline.encode_prompt(
+                prompt=params['prompt'],
+                device=pipeline._execution_device,
+                num_images_per_prompt=1,
+                do_classifier_free_guidance=do_cfg,
+                negative_prompt=params.get('negative_prompt') or None
+            )
+        kwargs = {'prompt_embeds': encoded[0], 'negative_prompt_embeds': encoded[1]}
+        if len(encoded) == 4:
+            # SDXL: pooled embeddings as well
+            kwargs['pooled_prompt_embeds'] = encoded[2]
+            kwargs['negative_pooled_prompt_embeds'] = encoded[3]
+        return kwargs
+    
+    async def _sweep(self, params: Dict, step_callback: Optional[Callable] = None,
+                     cell_callback: Optional[Callable] = None) -> List[Image.Image]:
+        """Parameter sweep (sweep.py): run the planned batches, report each cell, return the grid"""
+        import torch
+        from sweep import plan_sweep, compose_grid, embedding_key
+        
+        plan = plan_sweep(params)
+        total_steps = sum(batch['params'].get('steps', 20) for batch in plan['batches'])
+        done_steps = 0
+        embeddings = {}
+        images = {}
+        logger.info("🧮 Sweep: %d cells in %d batches", len(plan['cells']), len(plan['batches']))
+        
+        for batch in plan['batches']:
+            batch_params = samplers.normalize(dict(batch['params'], num_images=len(batch['seeds'])))
+            model_name = batch_params.get('model', DEFAULT_MODEL)
+            if not await self.load_model(model_name, precision_mode=batch_params.get('precision')):
+                raise RuntimeError(f"Model could not be loaded: {model_name}")
+            batch_params['model'] = model_name
+            with self.pipeline_lock(model_name):
+                pipeline = self.pipelines[model_name]
+                self._apply_loras(pipeline, model_name,
+                                  samplers.with_lcm_lora(batch_params.get('loras', []), batch_params, model_name))
+                self._apply_sampler(pipeline, batch_params)
+                self._apply_memory_policy(pipeline, batch_params)
+                
+                steps = batch_params.get('steps', 20)
+                cfg_scale = batch_params.get('cfg_scale', 7.5)
+                with metrics.pipeline_run('sweep', model_name) as run, tracing.span('sweep_batch', seeds=batch['seeds']):
+                    # Prompts are encoded once per model / LoRA set, whatever the other axes do
+                    key = (embedding_key(batch_params), cfg_scale > 1, batch_params['sampler'] == 'lcm')
+                    if key not in embeddings:
+                        embeddings[key] = self._encode_prompt(pipeline, batch_params, cfg_scale > 1)
+                    
+                    def callback(pipeline, step, timestep, callback_kwargs, offset=done_steps):
+                        run.mark_step()
+                        if step_callback is not None:
+                            step_callback(offset + step + 1, total_steps)
+                        return callback_kwargs
+                    
+                    # Cells that differ only by seed: one call, one generator per image
+                    generators = [torch.Generator(device=state.device).manual_seed(seed) for seed in batch['seeds']]
+                    output = pipeline(
+                        height=batch_params.get('height', 512),
+                        width=batch_params.get('width', 512),
+                        num_inference_steps=steps,
+                        guidance_scale=cfg_scale,
+                        generator=generators,
+                        num_images_per_prompt=len(generators),
+                        callback_on_step_end=callback,
+                        **embeddings[key]
+                    )
+                done_steps += steps
+            
+            for index, image in zip(batch['cells'], output.images):
+                images[index] = image
+                if cell_callback is not None:
+                    cell_callback(plan['cells'][index], image)
+        
+        logger.info("✅ Sweep finished: %d images", len(images))
+        return [compose_grid(plan, images)]
+    
+    async def _txt2img(self, pipeline, params: Dict) -> List[Image.Image]:
+        """Text to image generation"""
+        import torch
+        
+        prompt = params['prompt']
+        negative_prompt = params.get('negative_prompt', '')
+        width = params.get('width', 512)
+        height = params.get('height', 512)
+        steps = params.get('steps', 20)
+        cfg_scale = params.get('cfg_scale', 7.5)
+        seed = params.get('seed', -1)
+        num_images = params.get('num_images', 1)
+        loras = params.get('loras', [])
+        
+        logger.info("🎨 Txt2Img: %s... (%sx%s, %s steps)", prompt[:50], width, height, steps)
+        if loras:
+            logger.info("📦 LoRAs: %s", ', '.join(str(l.get('name', '')) for l in loras))
+        
+        try:
+            # Load LoRAs if provided (and the LCM-LoRA in fast mode), then the sampler
+            model_name = params.get('model', self.current_model)
+            self._apply_loras(pipeline, model_name, samplers.with_lcm_lora(loras, params, model_name))
+            self._apply_sampler(pipeline, params)
+            
+            # Set seed
+            generator = None
+            if seed >= 0:
+                generator = torch.Generator(device=state.device).manual_seed(seed)
+            
+            plan = self._apply_memory_policy(pipeline, params)
+            
+            # Run generation (compiled UNet / VAE decoder once ready for this bucket)
+            with self.compile_cache.use(pipeline, params, plan):
+                output = pipeline(
+                    prompt=prompt,
+                    negative_prompt=negative_prompt,
+                    height=height,
+                    width=width,
+                    num_inference_steps=steps,
+                    guidance_scale=cfg_scale,
+                    generator=generator,
+                    num_images_per_prompt=num_images,
+                    **self._callback_kwargs(params, steps)
+                )
+            
+            # The eager run above warmed this key up; compile it in the background
+            self.compile_cache.schedule(pipeline, params, state.device)
+            
+            logger.info("✅ Generated %d image(s)", len(output.images))
+            return output.images
+        
+        except Exception as e:
+            logger.error("❌ Txt2Img error: %s", e)
+            raise
+    
+    async def _img2img(self, pipeline, params: Dict) -> List[Image.Image]:
+        """Image to image generation"""
+        import torch
+        from diffusers import StableDiffusionImg2ImgPipeline
+        
+        prompt = params['prompt']
+        negative_prompt = params.get('negative_prompt', '')
+        strength = params.get('strength', 0.75)
+        steps = params.get('steps', 20)
+        cfg_scale = params.get('cfg_scale', 7.5)
+        seed = params.get('seed', -1)
+        
+        # Decode input image
+        image_data = base64.b64decode(params.get('image', ''))
+        image = Image.open(io.BytesIO(image_data))
+        
+        logger.info("🖼️ Img2Img: %s... (strength=%s)", prompt[:50], strength)
+        
+        try:
+            # Load img2img pipeline if not already loaded
+            if not isinstance(pipeline, StableDiffusionImg2ImgPipeline):
+                model_name = params.get('model', self.current_model)
+                logger.info("Loading img2img pipeline...")
+                pipeline = self._load_variant(StableDiffusionImg2ImgPipeline, model_name, 'img2img')
+            self._apply_sampler(pipeline, params, variant=True)
+            
+            generator = None
+            if seed >= 0:
+                generator = torch.Generator(device=state.device).manual_seed(seed)
+            
+            self._apply_memory_policy(pipeline, params)
+            
+            output = pipeline(
+                prompt=prompt,
+                negative_prompt=negative_prompt,
+                image=image,
+                strength=strength,
+                num_inference_steps=steps,
+                guidance_scale=cfg_scale,
+                generator=generator,
+                **self._callback_kwargs(params, max(int(steps * strength), 1))
+            )
+            
+            logger.info("✅ Img2Img generated successfully")
+            return output.images
+        
+        except Exception as e:
+            logger.error("❌ Img2Img error: %s", e)
+            raise
+    
+    async def _inpaint(self, pipeline, params: Dict) -> List[Image.Image]:
+        """Inpainting generation"""
+        import torch
+        from diffusers import StableDiffusionInpaintPipeline
+        
+        prompt = params['prompt']
+        negative_prompt = params.get('negative_prompt', '')
+        strength = params.get('strength', 0.8)
+        steps = params.get('steps', 20)
+        cfg_scale = params.get('cfg_scale', 7.5)
+        seed = params.get('seed', -1)
+        
+        # Decode images
+        image_data = base64.b64decode(params.get('image', ''))
+        image = Image.open(io.BytesIO(image_data))
+        
+        mask_data = base64.b64decode(params.get('mask', ''))
+        mask = Image.open(io.BytesIO(mask_data))
+        
+        logger.info("🎭 Inpaint: %s... (strength=%s)", prompt[:50], strength)
+        
+        try:
+            # Load inpaint pipeline if not already loaded
+            if not isinstance(pipeline, StableDiffusionInpaintPipeline):
+                model_name = params.get('model', self.current_model)
+                logger.info("Loading inpaint pipeline...")
+                pipeline = self._load_variant(StableDiffusionInpaintPipeline, model_name, 'inpaint')
+            self._apply_sampler(pipeline, params, variant=True)
+            
+            generator = None
+            if seed >= 0:
+                generator = torch.Generator(device=state.device).manual_seed(seed)
+            
+            self._apply_memory_policy(pipeline, params)
+            
+            output = pipeline(
+                prompt=prompt,
+                negative_prompt=negative_prompt,
+                image=image,
+                mask_image=mask,
+                strength=strength,
+                num_inference_steps=steps,
+                guidance_scale=cfg_scale,
+                generator=generator,
+                **self._callback_kwargs(params, max(int(steps * strength), 1))
+            )
+            
+            logger.info("✅ Inpaint generated successfully")
+            return output.images
+        
+        except Exception as e:
+            logger.error("❌ Inpaint error: %s", e)
+            raise
+    
+    async def _controlnet(self, pipeline, params: Dict) -> List[Image.Image]:
+        """ControlNet generation"""
+        import torch
+        import cv2
+        import numpy as np
+        from diffusers import ControlNetModel, StableDiffusionControlNetPipeline
+        
+        prompt = params['prompt']
+        negative_prompt = params.get('negative_prompt', '')
+        steps = params.get('steps', 20)
+        cfg_scale = params.get('cfg_scale', 7.5)
+        seed = params.get('seed', -1)
+        width = params.get('width', 512)
+        height = params.get('height', 512)
+        
+        controlnet_type = params.get('controlnet_type', 'canny')
+        controlnet_weight = params.get('controlnet_weight', 1.0)
+        
+        # Decode input image
+        image_data = base64.b64decode(params.get('image', ''))
+        image = Image.open(io.BytesIO(image_data))
+        image = image.resize((width, height))
+        
+        logger.info("🎮 ControlNet %s: %s...", controlnet_type, prompt[:50])
+        
+        try:
+            cn_model = CONTROLNET_MODELS.get(controlnet_type, CONTROLNET_MODELS['canny'])
+            
+            logger.info("Loading ControlNet: %s", cn_model)
+            model_name = params.get('model', self.current_model)
+            policy = self._policy_for(model_name)
+            before = memory_snapshot()
+            with tracing.span('from_pretrained', pipeline='ControlNetModel', model=cn_model):
+                controlnet = ControlNetModel.from_pretrained(
+                    cn_model,
+                    torch_dtype=precision.torch_dtype(policy),
+                    use_safetensors=True
+                )
+            
+            cn_pipeline = self._load_variant(
+                StableDiffusionControlNetPipeline, model_name, 'controlnet', before, controlnet=controlnet
+            )
+            self._apply_sampler(cn_pipeline, params, variant=True)
+            
+            # Preprocess image based on type
+            if controlnet_type == 'canny':
+                low = params.get('canny_low', 100)
+                high = params.get('canny_high', 200)
+                image_cv = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR)
+                edges = cv2.Canny(image_cv, low, high)
+                edges = cv2.cvtColor(edges, cv2.COLOR_GRAY2BGR)
+                control_image = Image.fromarray(cv2.cvtColor(edges, cv2.COLOR_BGR2RGB))
+            else:
+                control_image = image  # Assume preprocessed
+            
+            generator = None
+            if seed >= 0:
+                generator = torch.Generator(device=state.device).manual_seed(seed)
+            
+            self._apply_memory_policy(cn_pipeline, params)
+            
+            output = cn_pipeline(
+                prompt=prompt,
+                negative_prompt=negative_prompt,
+                image=control_image,
+                controlnet_conditioning_scale=controlnet_weight,
+                num_inference_steps=steps,
+                guidance_scale=cfg_scale,
+                generator=generator,
+                **self._callback_kwargs(params, steps)
+            )
+            
+            logger.info("✅ ControlNet generated successfully")
+            return output.images
+        
+        except Exception as e:
+            logger.error("❌ ControlNet error: %s", e)
+            raise
+
+def _is_out_of_memory(error: Exception) -> bool:
+    """True for CUDA or CPU allocation failures"""
+    message = str(error).lower()
+    return type(error).__name__ == 'OutOfMemoryError' or 'out of memory' in message \
+        or "can't allocate memory" in message
+
+def _empty_device_cache():
+    """Release cached allocator blocks after an out-of-memory error"""
+    import torch
+    
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+sd_manager = StableDiffusionManager()
+
+def _preload_models_worker(model_names: List[str]):
+    """Load and warm up models one by one on a private event loop"""
+    loop = asyncio.new_event_loop()
+    try:
+        for model_name in model_names:
+            loop.run_until_complete(sd_manager.warm_up(model_name))
+    finally:
+        loop.close()
+    logger.info("Model preload finished, ready=%s", state.is_ready())
+
+def start_model_preload() -> Optional[threading.Thread]:
+    """Start background preloading of PRELOAD_MODELS without blocking the server"""
+    if not state.preload_models:
+        return None
+    
+    for model_name in state.preload_models:
+        state.model_status[model_name] = 'pending'
+    
+    thread = threading.Thread(
+        target=_preload_models_worker,
+        args=(list(state.preload_models),),
+        name='model-preload',
+        daemon=True
+    )
+    thread.start()
+    logger.info("Preloading models in background: %s", state.preload_models)
+    return thread
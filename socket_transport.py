@@ -0,0 +1,125 @@
+"""
+Socket.IO transports for the server's event handlers
+
+Handlers in colab_server.py are registered with @on_event and take the client
+sid as first argument; they reply through `transport.emit(event, data, to=sid)`
+instead of Flask-SocketIO's request-bound emit(), so the same handlers run on:
+
+    ThreadingTransport - Flask-SocketIO in threading mode (development server).
+                         Coroutine handlers run to completion on a private
+                         event loop in the handler thread.
+    AsgiTransport      - python-socketio AsyncServer under uvicorn (asgi_server.py).
+                         Coroutine handlers run on the server's event loop,
+                         plain handlers on the default thread pool.
+"""
+
+import asyncio
+import inspect
+import logging
+from typing import Callable, Dict
+
+logger = logging.getLogger(__name__)
+
+class ThreadingTransport:
+    """Flask-SocketIO server in threading mode"""
+
+    def __init__(self, socketio):
+        self.socketio = socketio
+
+    def register(self, handlers: Dict[str, Callable]):
+        for event, handler in handlers.items():
+            self.socketio.on_event(event, self._wrap(event, handler))
+
+    @staticmethod
+    def _wrap(event: str, handler: Callable) -> Callable:
+        from flask import request
+
+        def run(*args):
+            result = handler(request.sid, *args)
+            if inspect.iscoroutine(result):
+                result = asyncio.run(result)
+            return result
+
+        if event == 'connect':
+            # Flask-SocketIO passes the auth payload to connect handlers
+            return lambda auth=None: run(auth)
+        return run
+
+    def emit(self, event: str, data=None, to=None):
+        self.socketio.emit(event, data, to=to)
+
+    def environ(self, sid) -> dict:
+        """WSGI environ of a client's connection"""
+        return self.socketio.server.get_environ(sid, namespace='/') or {}
+
+    def enter_room(self, sid, room: str):
+        self.socketio.server.enter_room(sid, room, namespace='/')
+
+    def leave_room(self, sid, room: str):
+        self.socketio.server.leave_room(sid, room, namespace='/')
+
+class AsgiTransport:
+    """python-socketio AsyncServer; emit() works from the event loop and from other threads"""
+
+    def __init__(self, sio):
+        self.sio = sio
+        self.loop = None
+        self._tasks = set()
+
+    def register(self, handlers: Dict[str, Callable]):
+        for event, handler in handlers.items():
+            self.sio.on(event, self._wrap(event, handler))
+
+    def _wrap(self, event: str, handler: Callable) -> Callable:
+        is_async = asyncio.iscoroutinefunction(handler)
+
+        async def run(sid, *args):
+            if is_async:
+                return await handler(sid, *args)
+            return await self.loop.run_in_executor(None, lambda: handler(sid, *args))
+
+        if event == 'connect':
+            # python-socketio passes (sid, environ, auth); handlers take (sid, auth)
+            async def connect(sid, environ, auth=None):
+                return await run(sid, auth)
+            return connect
+        return run
+
+    def environ(self, sid) -> dict:
+        """Environ of a client's connection (the ASGI scope is under 'asgi.scope')"""
+        return self.sio.get_environ(sid, namespace='/') or {}
+
+    def _on_loop(self, callback: Callable, *args):
+        """Run a callback on the server loop (room membership is not thread-safe)"""
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is not None and running is self.loop:
+            callback(*args)
+        elif self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(callback, *args)
+
+    def enter_room(self, sid, room: str):
+        self._on_loop(self.sio.enter_room, sid, room, '/')
+
+    def leave_room(self, sid, room: str):
+        self._on_loop(self.sio.leave_room, sid, room, '/')
+
+    def emit(self, event: str, data=None, to=None):
+        """Queue an emit on the server loop without blocking the caller"""
+        coro = self.sio.emit(event, data, to=to)
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is not None and running is self.loop:
+            # Keep a reference until the task is done, the loop only holds weak ones
+            task = self.loop.create_task(coro)
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        elif self.loop is not None and not self.loop.is_closed():
+            asyncio.run_coroutine_threadsafe(coro, self.loop)
+        else:
+            coro.close()
+            logger.warning("Dropped '%s' event: server loop is not running", event)
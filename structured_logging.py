@@ -0,0 +1,185 @@
+"""
+Non-blocking logging pipeline with JSON output and size-based rotation
+
+configure_logging() puts a single QueueHandler on the root logger. A log
+call only builds the record and appends it to an in-memory queue; a
+background QueueListener thread formats it and writes to the console and,
+with LOG_FILE set, to a rotating file (LOG_MAX_MB, LOG_BACKUP_COUNT). Nothing
+on the calling thread touches a file or a stream, and when the queue is full
+(LOG_QUEUE_SIZE) records are dropped and counted instead of blocking.
+
+Messages are formatted in the writer thread too, from the record's msg and
+args ("Loaded %s", name); args that may change before then (anything but
+str / numbers / None) are formatted on the calling thread.
+
+LOG_FORMAT=json writes one JSON object per line: ts, level, logger, msg,
+thread, job_id / trace_id of the job the calling thread works on (the
+current tracing context), any `extra` fields, and exc for exceptions.
+LOG_FORMAT=text keeps the plain "LEVEL:logger:message" lines.
+
+Inference worker processes write to their own file (server.worker1.log for
+LOG_FILE=server.log) so rotation never races between processes.
+"""
+
+import os
+import sys
+import json
+import queue
+import atexit
+import logging
+import logging.handlers
+import threading
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+import tracing
+
+# Arguments that cannot change between the log call and the writer thread
+_IMMUTABLE = (str, int, float, bool, type(None), bytes)
+
+# LogRecord attributes; everything else on a record came in through `extra`
+_RECORD_FIELDS = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+class ContextQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that defers formatting and never blocks
+
+    The stock QueueHandler formats the message on the calling thread; this
+    one only attaches the job / trace ids and leaves formatting to the writer.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        trace = tracing.current()
+        if trace:
+            record.trace_id = trace['id']
+            record.job_id = trace.get('job_id')
+        if record.args and not all(isinstance(arg, _IMMUTABLE) for arg in
+                                   (record.args.values() if isinstance(record.args, dict) else record.args)):
+            record.msg = record.getMessage()
+            record.args = None
+        if record.exc_info and not record.exc_text:
+            # Traceback objects pin frames; render them now
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+            'thread': record.threadName,
+            'process': record.process,
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_FIELDS and key not in entry:
+                entry[key] = value
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+def _worker_log_file(path: str) -> str:
+    """server.log -> server.worker<N>.log inside an inference worker process"""
+    worker_id = os.environ.get('INFERENCE_WORKER_ID')
+    if not worker_id:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.worker{worker_id}{ext or '.log'}"
+
+class LoggingPipeline:
+    """The root logger's queue, its handler and the writer thread"""
+
+    def __init__(self, level: str = 'INFO', fmt: str = 'text', log_file: Optional[str] = None,
+                 max_bytes: int = 10 * 1024 ** 2, backup_count: int = 5, queue_size: int = 10000):
+        self.format = fmt
+        self.log_file = _worker_log_file(log_file) if log_file else None
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.handler = ContextQueueHandler(self.queue)
+
+        formatter = JsonFormatter() if fmt == 'json' else logging.Formatter('%(levelname)s:%(name)s:%(message)s')
+        handlers = [logging.StreamHandler(sys.stderr)]
+        if self.log_file:
+            handlers.append(logging.handlers.RotatingFileHandler(
+                self.log_file, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8', delay=True))
+        for handler in handlers:
+            handler.setFormatter(formatter)
+        self.listener = logging.handlers.QueueListener(self.queue, *handlers, respect_handler_level=True)
+
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(self.handler)
+        root.setLevel(level.upper())
+
+        self.listener.start()
+        self.listener._thread.name = 'log-writer'
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Write out what is queued and stop the writer"""
+        if self.listener._thread is not None:
+            self.listener.stop()
+
+    def status(self) -> Dict:
+        return {
+            'format': self.format,
+            'file': self.log_file,
+            'queued': self.queue.qsize(),
+            'dropped': self.handler.dropped
+        }
+
+_pipeline = None
+_pipeline_lock = threading.Lock()
+_file_loggers = {}  # path -> logger writing only to that file
+
+def configure_logging() -> LoggingPipeline:
+    """Install the pipeline from LOG_* settings (once per process)"""
+    global _pipeline
+    with _pipeline_lock:
+        if _pipeline is None:
+            _pipeline = LoggingPipeline(
+                level=os.environ.get('LOG_LEVEL', 'INFO'),
+                fmt=os.environ.get('LOG_FORMAT', 'text').lower(),
+                log_file=os.environ.get('LOG_FILE') or None,
+                max_bytes=int(float(os.environ.get('LOG_MAX_MB', 10)) * 1024 ** 2),
+                backup_count=int(os.environ.get('LOG_BACKUP_COUNT', 5)),
+                queue_size=int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+            )
+        return _pipeline
+
+def file_logger(path: str) -> logging.Logger:
+    """Logger that appends "[timestamp] message" lines to one file, written by its own background thread"""
+    with _pipeline_lock:
+        logger = _file_loggers.get(path)
+        if logger is None:
+            log_queue = queue.Queue(maxsize=10000)
+            handler = logging.handlers.RotatingFileHandler(
+                path, maxBytes=int(float(os.environ.get('LOG_MAX_MB', 10)) * 1024 ** 2),
+                backupCount=int(os.environ.get('LOG_BACKUP_COUNT', 5)), encoding='utf-8', delay=True)
+            handler.setFormatter(logging.Formatter('[%(asctime)s] %(message)s', '%Y-%m-%d %H:%M:%S'))
+            listener = logging.handlers.QueueListener(log_queue, handler)
+            listener.start()
+            atexit.register(listener.stop)
+
+            logger = logging.getLogger(f'file.{path}')
+            logger.propagate = False
+            logger.setLevel(logging.INFO)
+            logger.addHandler(ContextQueueHandler(log_queue))
+            _file_loggers[path] = logger
+        return logger
+
+def status() -> Optional[Dict]:
+    return _pipeline.status() if _pipeline is not None else None
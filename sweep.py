@@ -0,0 +1,200 @@
+"""
+Parameter sweeps (XY grids)
+
+A sweep request is a txt2img request with task 'sweep' and an 'axes' dict of
+parameter -> list of values, e.g.
+
+    {'task': 'sweep', 'prompt': 'a lighthouse', 'seed': 1,
+     'axes': {'cfg_scale': [4, 7, 10], 'seed': [1, 2, 3, 4]}}
+
+plan_sweep() expands the axes into cells and groups them into batches:
+cells that differ only by seed run as one pipeline call (one generator per
+seed), and batches are ordered by model, LoRAs, prompt and sampler so the
+executor swaps models and LoRAs as rarely as possible and computes each
+prompt embedding once. compose_grid() lays the cell images
+out with the first axis as columns and the remaining axes as rows.
+"""
+
+import os
+import json
+import random
+import itertools
+from typing import Dict, Optional
+
+from PIL import Image, ImageDraw
+
+SWEEP_AXES = ('seed', 'cfg_scale', 'steps', 'sampler', 'scheduler', 'lora_weight',
+              'prompt', 'negative_prompt', 'model', 'width', 'height')
+
+# Parameters that change prompt embeddings (besides the prompts themselves)
+EMBEDDING_PARAMS = ('model', 'loras', 'prompt', 'negative_prompt')
+
+MAX_CELLS = int(os.environ.get('SWEEP_MAX_CELLS', 64))
+MAX_BATCH = int(os.environ.get('MAX_BATCH_SIZE', 4))
+
+LABEL_HEIGHT = 28
+
+def _seed(value, what: str = 'seed') -> Optional[int]:
+    """Integer seed (None stays None); ValueError if it is not a number"""
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid {what}: {value!r}")
+
+def _cell_params(base: Dict, coords: Dict) -> Dict:
+    """Request parameters of one cell"""
+    params = {k: v for k, v in base.items() if k not in ('axes', 'task')}
+    params['task'] = 'txt2img'
+    for name, value in coords.items():
+        if name == 'lora_weight':
+            params['loras'] = [dict(lora, weight=value) for lora in base.get('loras', [])]
+        else:
+            params[name] = value
+    return params
+
+def _order_key(params: Dict):
+    """Sort batches so that model and LoRA changes are grouped together"""
+    loras = json.dumps(params.get('loras', []), sort_keys=True)
+    return (str(params.get('model', '')), loras, str(params.get('prompt', '')),
+            str(params.get('negative_prompt', '')), str(params.get('sampler', '')),
+            str(params.get('scheduler', '')), params.get('steps', 20), params.get('cfg_scale', 7.5),
+            params.get('width', 512), params.get('height', 512))
+
+def embedding_key(params: Dict) -> str:
+    """Batches with the same key can share prompt embeddings"""
+    return json.dumps({k: params.get(k) for k in EMBEDDING_PARAMS}, sort_keys=True, default=str)
+
+def plan_sweep(params: Dict, max_batch: Optional[int] = None, max_cells: Optional[int] = None) -> Dict:
+    """Expand a sweep request into cells and ordered batches
+
+    Returns {'axes': [[name, values]], 'columns', 'rows', 'cells', 'batches'};
+    every cell has 'index', 'coords', 'col', 'row', 'seed' and 'params', every
+    batch 'params' (shared by its cells, without seed), 'seeds' and 'cells'.
+    """
+    max_batch = max_batch or MAX_BATCH
+    max_cells = max_cells or MAX_CELLS
+    axes = params.get('axes') or {}
+    if not isinstance(axes, dict) or not axes:
+        raise ValueError("Sweep needs 'axes': {parameter: [values, ...]}")
+    for name, values in axes.items():
+        if name not in SWEEP_AXES:
+            raise ValueError(f"Unsupported sweep axis: {name} (supported: {', '.join(SWEEP_AXES)})")
+        if not isinstance(values, list) or not values:
+            raise ValueError(f"Sweep axis {name} needs a non-empty list of values")
+        if name == 'lora_weight' and not params.get('loras'):
+            raise ValueError("Sweep axis lora_weight needs 'loras'")
+        if name == 'seed':
+            for value in values:
+                _seed(value, 'seed in sweep axis')
+
+    names = list(axes)
+    total = 1
+    for name in names:
+        total *= len(axes[name])
+    if total > max_cells:
+        raise ValueError(f"Sweep has {total} cells, the limit is {max_cells}")
+
+    # Without a seed axis every cell uses the same seed so that cells are comparable
+    base_seed = _seed(params.get('seed', -1))
+    if base_seed is None or base_seed < 0:
+        base_seed = random.randint(0, 2**32 - 1)
+
+    columns = len(axes[names[0]])
+    cells = []
+    # Rows enumerate the other axes, columns the first one
+    positions = itertools.product(*(range(len(axes[n])) for n in names[1:]), range(columns))
+    for index, position in enumerate(positions):
+        *row_position, col = position
+        coords = {names[0]: axes[names[0]][col]}
+        coords.update((n, axes[n][i]) for n, i in zip(names[1:], row_position))
+        cell_params = _cell_params(params, coords)
+        cell_params['seed'] = int(coords['seed']) if 'seed' in coords else base_seed
+        cells.append({
+            'index': index,
+            'coords': coords,
+            'col': col,
+            'row': index // columns,
+            'seed': cell_params['seed'],
+            'params': cell_params
+        })
+
+    # Cells that differ only by seed share one pipeline call
+    groups = {}
+    for cell in cells:
+        shared = {k: v for k, v in cell['params'].items() if k != 'seed'}
+        key = json.dumps(shared, sort_keys=True, default=str)
+        groups.setdefault(key, (shared, []))[1].append(cell)
+
+    batches = []
+    for shared, group in sorted(groups.values(), key=lambda g: _order_key(g[0])):
+        for start in range(0, len(group), max_batch):
+            chunk = group[start:start + max_batch]
+            batches.append({
+                'params': shared,
+                'seeds': [c['seed'] for c in chunk],
+                'cells': [c['index'] for c in chunk]
+            })
+
+    return {
+        'axes': [[n, axes[n]] for n in names],
+        'columns': columns,
+        'rows': total // columns,
+        'cells': cells,
+        'batches': batches
+    }
+
+def prepare_sweep(params: Dict) -> Dict:
+    """Validate a sweep request and fix its base seed, so the plan can be rebuilt identically"""
+    params = dict(params)
+    params['seed'] = _seed(params.get('seed'))
+    if params['seed'] is None or params['seed'] < 0:
+        params['seed'] = random.randint(0, 2**32 - 1)
+    plan_sweep(params)
+    return params
+
+def sweep_summary(plan: Dict) -> Dict:
+    """Grid layout without the per-cell parameters, for clients"""
+    return {
+        'axes': plan['axes'],
+        'columns': plan['columns'],
+        'rows': plan['rows'],
+        'batches': len(plan['batches']),
+        'cells': [{'index': c['index'], 'coords': c['coords'], 'col': c['col'], 'row': c['row'],
+                   'seed': c['seed']} for c in plan['cells']]
+    }
+
+def _label(coords: Dict) -> str:
+    return ', '.join(f"{k}={v}" for k, v in coords.items())
+
+def compose_grid(plan: Dict, images: Dict[int, Image.Image], max_side: int = 4096) -> Image.Image:
+    """Grid image: first axis as columns, other axes as rows, with labels"""
+    first = next(iter(images.values()))
+    cell_w, cell_h = first.size
+    columns, rows = plan['columns'], plan['rows']
+    scale = min(1.0, max_side / (cell_w * columns), max_side / (cell_h * rows))
+    cell_w, cell_h = max(int(cell_w * scale), 1), max(int(cell_h * scale), 1)
+
+    x_name = plan['axes'][0][0]
+    row_labels = len(plan['axes']) > 1
+    label_w = 220 if row_labels else 0
+    grid = Image.new('RGB', (label_w + cell_w * columns, LABEL_HEIGHT + cell_h * rows), 'white')
+    draw = ImageDraw.Draw(grid)
+
+    for col, value in enumerate(plan['axes'][0][1]):
+        draw.text((label_w + col * cell_w + 6, 8), f"{x_name}={value}", fill='black')
+
+    for cell in plan['cells']:
+        image = images.get(cell['index'])
+        x = label_w + cell['col'] * cell_w
+        y = LABEL_HEIGHT + cell['row'] * cell_h
+        if image is not None:
+            if image.size != (cell_w, cell_h):
+                image = image.resize((cell_w, cell_h), Image.Resampling.LANCZOS)
+            grid.paste(image.convert('RGB'), (x, y))
+        if row_labels and cell['col'] == 0:
+            row_coords = {k: v for k, v in cell['coords'].items() if k != x_name}
+            draw.text((6, y + cell_h // 2), _label(row_coords), fill='black')
+
+    return grid
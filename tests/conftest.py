@@ -0,0 +1,23 @@
+"""
+Unit tests for the server modules: python -m pytest tests/
+
+The modules live at the repository root; tests that need torch or diffusers
+skip themselves when those are not installed.
+"""
+
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+@pytest.fixture(scope='session')
+def server(tmp_path_factory):
+    """colab_server, imported and used inside a scratch directory (its models/, outputs/, cache/)"""
+    patch = pytest.MonkeyPatch()
+    patch.chdir(tmp_path_factory.mktemp('server'))
+    patch.setenv('PRELOAD_MODELS', '')
+    import colab_server
+    yield colab_server
+    patch.undo()
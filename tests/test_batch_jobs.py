@@ -0,0 +1,132 @@
+"""Batch specs parsing and checkpointed batch runs with a fake job runner"""
+
+import json
+import threading
+
+import pytest
+
+from batch_jobs import BatchManager, parse_specs
+
+def test_jsonl_specs():
+    text = '{"prompt": "a"}\n\n# comment\n{"prompt": "b", "steps": 4}\n'
+    assert parse_specs(text) == [{'prompt': 'a'}, {'prompt': 'b', 'steps': 4}]
+    with pytest.raises(ValueError, match='Line 2'):
+        parse_specs('{"prompt": "a"}\n{"prompt": \n')
+    with pytest.raises(ValueError, match='Line 1'):
+        parse_specs('["prompt"]', 'jsonl')
+
+def test_csv_specs():
+    text = ('prompt,steps,cfg_scale,seed,loras\n'
+            '[masterpiece] a cat,20,7.5,,"[{""name"": ""x"", ""weight"": 0.8}]"\n'
+            '1984,4,2,-1,\n')
+    first, second = parse_specs(text)
+    assert first == {'prompt': '[masterpiece] a cat', 'steps': 20, 'cfg_scale': 7.5,
+                     'loras': [{'name': 'x', 'weight': 0.8}]}
+    # Prompts stay text even when they look like numbers
+    assert second == {'prompt': '1984', 'steps': 4, 'cfg_scale': 2, 'seed': -1}
+
+def test_csv_invalid_json_column():
+    with pytest.raises(ValueError, match='Row 2: Column loras'):
+        parse_specs('prompt,loras\na cat,[oops\n', 'csv')
+
+class FakeRunner:
+    """JobRunner.submit stand-in: completes or fails jobs on a thread"""
+
+    def __init__(self, fail_prompts=()):
+        self.fail_prompts = set(fail_prompts)
+        self.submitted = []
+
+    def submit(self, job, listener):
+        self.submitted.append(job['params'])
+
+        def finish():
+            if job['params']['prompt'] in self.fail_prompts:
+                listener('error', {'message': 'boom', 'job_id': job['id']})
+            else:
+                listener('complete', {'paths': [job['params']['filename_prefix'] + '.png'], 'job_id': job['id']})
+        threading.Thread(target=finish).start()
+        return dict(job, status='queued')
+
+def run(manager, batch_id):
+    batch = manager.start(batch_id)
+    batch.thread.join(10)
+    return batch
+
+def test_batch_runs_and_resumes(tmp_path):
+    runner = FakeRunner(fail_prompts={'b'})
+    manager = BatchManager(runner.submit, directory=tmp_path, window=2)
+    specs = [{'prompt': 'a', 'model': 'm2'}, {'prompt': 'b', 'model': 'm1'}, {'prompt': 'c', 'model': 'm1'}]
+    batch = manager.create(specs, defaults={'steps': 4}, start=False)
+    batch = run(manager, batch.id)
+
+    assert batch.manifest['status'] == 'failed'
+    assert (batch.completed, batch.failed) == (2, 1)
+    # Grouped by model; defaults applied; outputs under the batch directory
+    assert [p['model'] for p in runner.submitted] == ['m1', 'm1', 'm2']
+    assert all(p['steps'] == 4 and p['output_dir'] == str(batch.directory) for p in runner.submitted)
+    lines = [json.loads(line) for line in (batch.directory / 'results.jsonl').read_text().splitlines()]
+    assert sorted(r['index'] for r in lines) == [0, 1, 2]
+
+    # A new manager (restarted process) reruns only the failed item
+    runner = FakeRunner()
+    manager = BatchManager(runner.submit, directory=tmp_path, window=2)
+    batch = run(manager, batch.id)
+    assert [p['prompt'] for p in runner.submitted] == ['b']
+    assert batch.manifest['status'] == 'completed' and batch.completed == 3
+
+def test_resume_unfinished(tmp_path):
+    runner = FakeRunner()
+    manager = BatchManager(runner.submit, directory=tmp_path)
+    batch = manager.create([{'prompt': 'a'}], start=False)
+    batch.write_manifest(status='running')
+    manager = BatchManager(runner.submit, directory=tmp_path)
+    assert manager.resume_unfinished() == [batch.id]
+    manager.get(batch.id).thread.join(10)
+    assert manager.get(batch.id).manifest['status'] == 'completed'
+
+def test_items_need_a_prompt(tmp_path):
+    manager = BatchManager(FakeRunner().submit, directory=tmp_path)
+    with pytest.raises(ValueError):
+        manager.create([])
+    with pytest.raises(ValueError, match='Item 2'):
+        manager.create([{'prompt': 'a'}, {'steps': 4}])
+
+def test_items_are_prepared_once_at_creation(tmp_path):
+    prepared = []
+
+    def prepare(params):
+        if params.get('steps', 0) > 100:
+            raise ValueError('too many steps')
+        prepared.append(params['prompt'])
+        return dict(params, sampler=str(params.get('sampler', 'euler')).lower())
+
+    runner = FakeRunner()
+    manager = BatchManager(runner.submit, directory=tmp_path, prepare=prepare)
+    with pytest.raises(ValueError, match='Item 2: too many steps'):
+        manager.create([{'prompt': 'a'}, {'prompt': 'b', 'steps': 500}])
+    assert list(tmp_path.iterdir()) == []
+
+    prepared.clear()
+    batch = run(manager, manager.create([{'prompt': 'a', 'sampler': 'EULER'}], defaults={'steps': 4},
+                                        start=False).id)
+    assert prepared == ['a']
+    assert runner.submitted[0]['sampler'] == 'euler' and runner.submitted[0]['task'] == 'txt2img'
+    assert batch.specs == [{'steps': 4, 'prompt': 'a', 'sampler': 'euler', 'task': 'txt2img'}]
+
+def test_batch_items_go_through_request_validation(server, tmp_path):
+    runner = FakeRunner()
+    manager = BatchManager(runner.submit, directory=tmp_path, prepare=server.prepare_generation)
+    with pytest.raises(ValueError, match='Item 1: Unknown sampler'):
+        manager.create([{'prompt': 'a', 'sampler': 'no-such-sampler'}])
+    with pytest.raises(ValueError, match='Item 1'):
+        manager.create([{'prompt': 'a', 'task': 'sweep', 'seed': 'soon', 'axes': {'cfg_scale': [5, 7]}}])
+
+    batch = manager.create([{'prompt': 'a', 'sampler': 'Euler a'},
+                            {'prompt': 'b', 'task': 'sweep', 'seed': -1, 'axes': {'cfg_scale': [5, 7]}}],
+                           start=False)
+    assert batch.specs[0]['sampler'] == 'euler_a'
+    # The sweep's base seed is drawn once and kept, so resumes replan the same grid
+    seed = batch.specs[1]['seed']
+    assert seed >= 0
+    run(manager, batch.id)
+    assert runner.submitted[1]['seed'] == seed
@@ -0,0 +1,101 @@
+"""Cost model: request features, latency fits and their fallbacks, persistence"""
+
+import itertools
+
+import pytest
+
+from cost_model import MIN_OBSERVATIONS, PRIOR_STEP_SECONDS, CostModel, LatencyFit, job_features
+
+def true_seconds(params):
+    """Synthetic hardware: a known linear function of the features"""
+    const, work, work_mp, images_mp, loras = job_features(params)
+    return 0.5 + 0.02 * work + 0.01 * work_mp + 0.3 * images_mp + 1.0 * loras
+
+def requests(task='txt2img'):
+    sizes = (256, 512, 768)
+    for steps, size, images, loras in itertools.product((10, 20, 30), sizes, (1, 2, 4), (0, 1)):
+        yield {'task': task, 'steps': steps, 'width': size, 'height': size, 'num_images': images,
+               'loras': [{'name': 'x'}] * loras}
+
+def test_job_features():
+    assert job_features({}) == [1.0, 20 * 0.262144, 20 * 0.262144 ** 2, 0.262144, 0.0]
+    params = {'task': 'txt2img', 'steps': 10, 'width': 1000, 'height': 1000, 'num_images': 2, 'loras': [{}]}
+    assert job_features(params) == [1.0, 20.0, 20.0, 2.0, 1.0]
+    # num_images only applies to txt2img; img2img / inpaint run strength x steps
+    img2img = dict(params, task='img2img', strength=0.5)
+    assert job_features(img2img) == [1.0, 5.0, 5.0, 1.0, 1.0]
+    assert job_features(dict(img2img, strength=0.01))[1] == 1.0
+    assert job_features(params, images=3)[3] == 3.0
+
+def test_latency_fit_recovers_linear_costs():
+    fit = LatencyFit()
+    assert fit.predict([1.0, 1.0, 1.0, 1.0, 0.0]) is None
+    for params in requests():
+        fit.add(job_features(params), true_seconds(params))
+    for params in ({'steps': 25, 'width': 640, 'height': 640, 'num_images': 3},
+                   {'steps': 15, 'width': 384, 'height': 384, 'loras': [{}]}):
+        assert fit.predict(job_features(params)) == pytest.approx(true_seconds(params), rel=0.05)
+
+def test_prior_until_enough_observations():
+    model = CostModel(device=lambda: 'cuda:0')
+    params = {'steps': 20, 'width': 1000, 'height': 1000}
+    assert model.predict_seconds(params, 'm') == pytest.approx(1.0 + PRIOR_STEP_SECONDS['cuda'] * 20)
+    for _ in range(MIN_OBSERVATIONS - 1):
+        model.observe(params, 'm', 3.0)
+    assert model.predict_seconds(params, 'm') == pytest.approx(1.0 + PRIOR_STEP_SECONDS['cuda'] * 20)
+    model.observe(params, 'm', 3.0)
+    assert model.predict_seconds(params, 'm') == pytest.approx(3.0, rel=0.05)
+
+def test_unseen_model_falls_back_to_task_fit():
+    model = CostModel()
+    for params in requests():
+        model.observe(params, 'model-a', true_seconds(params))
+    params = {'task': 'txt2img', 'steps': 20, 'width': 512, 'height': 512}
+    assert model.predict_seconds(params, 'model-b') == pytest.approx(true_seconds(params), rel=0.05)
+    assert model.status()['fits']['*|txt2img']['observations'] == 54
+    assert model.status()['median_relative_error'] is not None
+
+def test_cold_start_is_learned_as_load_time():
+    model = CostModel()
+    params = {'steps': 20}
+    for _ in range(MIN_OBSERVATIONS):
+        model.observe(params, 'm', 2.0)
+    model.observe(params, 'm', 12.0, warm=False)
+    assert model.predict_load_seconds('m') == pytest.approx(10.0, rel=0.05)
+    assert model.predict_load_seconds('other') == pytest.approx(10.0, rel=0.05)
+    # The cold run did not move the latency fit
+    assert model.predict_seconds(params, 'm') == pytest.approx(2.0, rel=0.05)
+    model.observe(params, 'm', 0)
+    assert model.status()['fits']['m|txt2img']['observations'] == MIN_OBSERVATIONS
+
+class FakeMemoryPolicy:
+    def __init__(self):
+        self.calibration = {}
+
+    def min_estimate(self, params, model, device, weights_bytes, dtype_bytes):
+        return 1.5 * self.calibration.get(model, 1.0)
+
+def test_save_and_load_round_trip(tmp_path):
+    path = tmp_path / 'cost' / 'model.json'
+    policy = FakeMemoryPolicy()
+    model = CostModel(str(path), memory_policy=policy)
+    for params in requests():
+        model.observe(params, 'm', true_seconds(params))
+    model.observe({'steps': 20}, 'm', 30.0, warm=False)
+    policy.calibration['m'] = 1.2
+    model.save()
+    assert path.exists() and not path.with_suffix('.tmp').exists()
+
+    restored_policy = FakeMemoryPolicy()
+    restored = CostModel(str(path), memory_policy=restored_policy)
+    params = {'steps': 25, 'width': 640, 'height': 640, 'num_images': 3}
+    assert restored.predict_seconds(params, 'm') == pytest.approx(model.predict_seconds(params, 'm'))
+    assert restored.predict_load_seconds('m') == model.predict_load_seconds('m')
+    assert restored.predict_memory_gb(params, 'm', 'cuda') == pytest.approx(1.8)
+    assert CostModel().predict_memory_gb(params, 'm', 'cuda') is None
+
+def test_unreadable_file_starts_empty(tmp_path):
+    path = tmp_path / 'model.json'
+    path.write_text('{not json')
+    model = CostModel(str(path))
+    assert model.fits == {} and model.load_seconds == {}
@@ -0,0 +1,112 @@
+"""Event bus: room fan-out, ordering and replay of missed events"""
+
+import threading
+
+from event_bus import EventBus, is_public_room, job_room
+
+class FakeTransport:
+    def __init__(self):
+        self.emitted = []  # (event, data, to)
+        self.rooms = {}  # sid -> set of rooms
+
+    def emit(self, event, data, to=None):
+        self.emitted.append((event, data, to))
+
+    def enter_room(self, sid, room):
+        self.rooms.setdefault(sid, set()).add(room)
+
+    def leave_room(self, sid, room):
+        self.rooms.get(sid, set()).discard(room)
+
+def flush(bus):
+    """Wait until the dispatcher has handled everything queued so far"""
+    done = threading.Event()
+    bus.publish('flush', 'flush', {})
+    listener = lambda event, data: done.set()
+    bus.listen('flush', listener, since=0)
+    assert done.wait(5)
+    bus.unlisten('flush', listener)
+
+def make_bus(**kwargs):
+    transport = FakeTransport()
+    return EventBus(lambda: transport, **kwargs), transport
+
+def sent_to(transport, target):
+    return [(event, data['seq']) for event, data, to in transport.emitted if to == target]
+
+def test_events_are_numbered_per_room_and_sent_in_order():
+    bus, transport = make_bus()
+    room = job_room('j1')
+    for step in range(3):
+        bus.publish(room, 'progress', {'step': step})
+    bus.publish(job_room('j2'), 'progress', {'step': 0})
+    flush(bus)
+    assert sent_to(transport, room) == [('progress', 1), ('progress', 2), ('progress', 3)]
+    assert sent_to(transport, job_room('j2')) == [('progress', 1)]
+
+def test_subscriber_gets_missed_events_then_joins():
+    bus, transport = make_bus()
+    room = job_room('j1')
+    for step in range(4):
+        bus.publish(room, 'progress', {'step': step})
+    bus.subscribe('sid1', room, since=2)
+    bus.subscribe('sid2', room)
+    flush(bus)
+    assert sent_to(transport, 'sid1') == [('progress', 3), ('progress', 4)]
+    assert sent_to(transport, 'sid2') == []
+    assert room in transport.rooms['sid1'] and room in transport.rooms['sid2']
+    bus.unsubscribe('sid1', room)
+    flush(bus)
+    assert room not in transport.rooms['sid1']
+
+def test_listener_replay_and_live_events():
+    bus, _ = make_bus()
+    room = job_room('j1')
+    received = []
+    bus.publish(room, 'progress', {'step': 1})
+    bus.listen(room, lambda event, data: received.append((event, data['seq'])), since=0)
+    bus.publish(room, 'complete', {})
+    flush(bus)
+    assert received == [('progress', 1), ('complete', 2)]
+
+def test_history_is_bounded():
+    bus, _ = make_bus(history_size=3, max_rooms=2)
+    for step in range(5):
+        bus.publish('job:a', 'progress', {'step': step})
+    assert [e['data']['seq'] for e in bus.history('job:a')] == [3, 4, 5]
+    assert [e['data']['seq'] for e in bus.history('job:a', since=4)] == [5]
+    bus.publish('job:b', 'progress', {})
+    bus.publish('job:c', 'progress', {})
+    # Least recently published room dropped, its numbering restarts
+    assert bus.history('job:a') == []
+    assert bus.publish('job:a', 'progress', {}) == 1
+
+def test_failing_transport_does_not_stop_fanout():
+    bus, transport = make_bus()
+    emit = transport.emit
+
+    def failing_emit(event, data, to=None):
+        if event == 'progress':
+            raise OSError('gone')
+        emit(event, data, to=to)
+
+    transport.emit = failing_emit
+    bus.publish('job:a', 'progress', {})
+    bus.publish('job:a', 'complete', {})
+    flush(bus)
+    assert sent_to(transport, 'job:a') == [('complete', 2)]
+
+def test_public_rooms():
+    assert is_public_room('gallery') and is_public_room('job:1') and is_public_room('batch:x')
+    assert not is_public_room('job:') and not is_public_room('sid123') and not is_public_room('admin:1')
+
+def test_flush_leaves_no_listeners():
+    bus, _ = make_bus()
+    for _ in range(3):
+        flush(bus)
+    # The last unlisten is queued before this listener, so it has run when the listener fires
+    done = threading.Event()
+    bus.listen('other', lambda event, data: done.set())
+    bus.publish('other', 'ping', {})
+    assert done.wait(5)
+    assert 'flush' not in bus._listeners
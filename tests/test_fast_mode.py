@@ -0,0 +1,69 @@
+"""Fast mode end to end: LCM scheduler and LCM-LoRA on the tiny random-weight pipeline"""
+
+import sys
+import asyncio
+from pathlib import Path
+
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('diffusers')
+pytest.importorskip('peft')
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'benchmarks'))
+
+import samplers
+from tiny_pipeline import build_tiny_pipeline
+
+@pytest.fixture(scope='module')
+def tiny_model(tmp_path_factory):
+    """Tiny SD 1.5-style pipeline and a random LCM-LoRA for its UNet"""
+    from diffusers import StableDiffusionPipeline, UNet2DConditionModel
+    from peft import LoraConfig
+    from peft.utils import get_peft_model_state_dict
+
+    root = tmp_path_factory.mktemp('fast_mode')
+    model = build_tiny_pipeline(root / 'tiny-sd')
+    unet = UNet2DConditionModel.from_pretrained(model, subfolder='unet')
+    # Non-zero B matrices, so fusing the LoRA changes the weights
+    unet.add_adapter(LoraConfig(r=4, lora_alpha=4, init_lora_weights=False,
+                                target_modules=['to_q', 'to_k', 'to_v', 'to_out.0']))
+    StableDiffusionPipeline.save_lora_weights(str(root / 'lcm-lora'), unet_lora_layers=get_peft_model_state_dict(unet))
+    return model, str(root / 'lcm-lora')
+
+@pytest.fixture
+def manager(server, tiny_model, monkeypatch):
+    model, lora = tiny_model
+    monkeypatch.setitem(samplers.LCM_LORAS, 'sd15', lora)
+    monkeypatch.setattr(server.state, '_device', 'cpu')
+    return server.sd_manager
+
+def _generate(server, manager, params):
+    steps = []
+    params = server.prepare_generation(dict({'task': 'txt2img', 'prompt': 'a lighthouse', 'width': 64,
+                                             'height': 64, 'seed': 1}, **params))
+    images = asyncio.run(manager.generate(params, step_callback=lambda step, total: steps.append(step)))
+    return params, images, steps
+
+def _fused(pipeline) -> bool:
+    return any(getattr(module, 'merged', False) for module in pipeline.unet.modules())
+
+def test_fast_mode_samples_with_lcm_and_the_lcm_lora(server, manager, tiny_model):
+    model, _ = tiny_model
+    params, images, steps = _generate(server, manager, {'model': model, 'steps': 30, 'cfg_scale': 7.5,
+                                                        'fast': True})
+    assert (params['sampler'], params['steps'], params['cfg_scale']) == ('lcm', samplers.LCM_STEPS,
+                                                                         samplers.LCM_MAX_GUIDANCE)
+    pipeline = manager.pipelines[model]
+    assert type(pipeline.scheduler).__name__ == 'LCMScheduler'
+    assert steps == list(range(1, samplers.LCM_STEPS + 1))
+    assert manager.active_loras[model] == [(samplers.LCM_LORA, 1.0)]
+    assert _fused(pipeline)
+    assert images[0].size == (64, 64)
+
+    # Back to a regular sampler: the LCM-LoRA comes out again
+    _, _, steps = _generate(server, manager, {'model': model, 'steps': 3, 'sampler': 'euler'})
+    assert type(pipeline.scheduler).__name__ == 'EulerDiscreteScheduler'
+    assert steps == [1, 2, 3]
+    assert manager.active_loras[model] == []
+    assert not _fused(pipeline)
@@ -0,0 +1,148 @@
+"""Job brokers: pull order, acknowledgement, requeue of dead nodes and event routing
+
+The Redis tests run against fakeredis and are skipped when it is not installed.
+"""
+
+import json
+import queue
+import time
+
+import pytest
+
+import job_broker
+from job_broker import HEARTBEAT_TTL, MAX_REQUEUES, InProcessBroker, RedisBroker
+
+def job(job_id, model, origin='front', **extra):
+    return dict({'id': job_id, 'params': {'model': model, 'prompt': job_id}, 'origin': origin, 'sid': 'sid-' + job_id},
+                **extra)
+
+@pytest.fixture
+def redis_server():
+    fakeredis = pytest.importorskip('fakeredis')
+    return fakeredis.FakeServer()
+
+@pytest.fixture
+def make_broker(redis_server):
+    import fakeredis
+
+    brokers = []
+
+    def make():
+        broker = RedisBroker(fakeredis.FakeRedis(server=redis_server), default_model='base')
+        brokers.append(broker)
+        return broker
+
+    yield make
+    for broker in brokers:
+        broker.close()
+
+def processing(broker, node_id):
+    return [json.loads(raw)['id'] for raw in broker.client.lrange(broker._key('processing', node_id), 0, -1)]
+
+def expire(broker, node_id):
+    broker.client.hset(broker._key('nodes'), node_id, json.dumps({'ts': time.time() - HEARTBEAT_TTL - 1}))
+
+def test_in_process_pull_prefers_loaded_model():
+    broker = InProcessBroker('base')
+    for job_id, model in (('1', 'a'), ('2', 'b'), ('3', 'a')):
+        broker.submit(job(job_id, model))
+    assert [broker.pull('n', ['b'])['id'], broker.pull('n', ['b'])['id'], broker.pull('n', [])['id']] == ['2', '1', '3']
+    assert broker.pull('n', [], timeout=0.01) is None
+
+def test_redis_pull_prefers_loaded_models_then_fifo(make_broker):
+    broker = make_broker()
+    for job_id, model in (('1', 'a'), ('2', 'b'), ('3', 'a'), ('4', 'c'), ('5', 'b')):
+        broker.submit(job(job_id, model))
+    broker.submit({'id': '6', 'params': {'prompt': 'no model'}, 'origin': 'front'})
+    assert broker.queue_depth() == 6
+    pulled = [broker.pull('node', ['b'], timeout=0.1)['id'] for _ in range(3)]
+    # Loaded model b in FIFO order, then the other models by name
+    assert pulled == ['2', '5', '1']
+    assert [broker.pull('node', ['base'], timeout=0.1)['id'] for _ in range(3)] == ['6', '3', '4']
+    assert broker.pull('node', ['b'], timeout=0.1) is None
+    assert processing(broker, 'node') == ['4', '3', '6', '1', '5', '2']
+
+def test_redis_ack_removes_the_job(make_broker):
+    broker = make_broker()
+    broker.submit(job('1', 'a'))
+    broker.submit(job('2', 'a'))
+    first, second = broker.pull('node', ['a'], timeout=0.1), broker.pull('node', ['a'], timeout=0.1)
+    broker.ack('node', first)
+    assert processing(broker, 'node') == ['2']
+    broker.ack('node', first)
+    broker.ack('node', second)
+    assert processing(broker, 'node') == []
+    assert broker.requeue('node') == 0 and broker.queue_depth() == 0
+
+def test_redis_requeues_jobs_of_expired_nodes(make_broker):
+    dead, survivor = make_broker(), make_broker()
+    for job_id in ('1', '2', '3'):
+        dead.submit(job(job_id, 'a'))
+    dead.heartbeat('dead', {'capacity': 1})
+    survivor.heartbeat('survivor', {'capacity': 1})
+    running = dead.pull('dead', ['a'], timeout=0.1)
+    assert running['id'] == '1'
+    assert survivor.requeue_orphans() == 0
+
+    expire(survivor, 'dead')
+    assert survivor.requeue_orphans() == 1
+    assert processing(survivor, 'dead') == []
+    # Requeued at the head: it runs before the jobs that were still waiting
+    requeued = survivor.pull('survivor', ['a'], timeout=0.1)
+    assert (requeued['id'], requeued['requeues']) == ('1', 1)
+    assert survivor.pull('survivor', ['a'], timeout=0.1)['id'] == '2'
+    assert survivor.requeue_orphans() == 0
+
+def test_redis_restarted_node_requeues_its_own_jobs(make_broker):
+    broker = make_broker()
+    broker.submit(job('1', 'a'))
+    broker.pull('node', ['a'], timeout=0.1)
+    restarted = make_broker()
+    assert restarted.requeue('node') == 1
+    assert restarted.pull('node', ['a'], timeout=0.1)['id'] == '1'
+
+def test_redis_fails_a_job_after_max_requeues(make_broker):
+    origin, worker = make_broker(), make_broker()
+    events = queue.Queue()
+    origin.listen('front', events.put)
+    time.sleep(0.05)
+    worker.submit(job('1', 'a'))
+    for _ in range(MAX_REQUEUES):
+        worker.pull('worker', ['a'], timeout=0.1)
+        assert worker.requeue('worker') == 1
+    pulled = worker.pull('worker', ['a'], timeout=0.1)
+    assert pulled['requeues'] == MAX_REQUEUES
+    assert worker.requeue('worker') == 0
+    assert worker.queue_depth() == 0 and processing(worker, 'worker') == []
+    message = events.get(timeout=2)
+    assert message['event'] == 'error' and message['sid'] == 'sid-1'
+    assert message['data']['job_id'] == '1'
+
+def test_redis_events_reach_the_origin_node_only(make_broker):
+    front, other, worker = make_broker(), make_broker(), make_broker()
+    front_events, other_events = queue.Queue(), queue.Queue()
+    front.listen('front', front_events.put)
+    other.listen('other', other_events.put)
+    time.sleep(0.05)
+    worker.submit(job('1', 'a', origin='front'))
+    pulled = worker.pull('worker', ['a'], timeout=0.1)
+    worker.publish(pulled['origin'], {'event': 'progress', 'sid': pulled['sid'], 'data': {'step': 1}})
+    assert front_events.get(timeout=2) == {'event': 'progress', 'sid': 'sid-1', 'data': {'step': 1}}
+    time.sleep(0.05)
+    assert other_events.empty()
+
+def test_redis_nodes_drop_expired_heartbeats(make_broker):
+    broker = make_broker()
+    broker.heartbeat('live', {'capacity': 2, 'models': ['a']})
+    expire(broker, 'stale')
+    nodes = broker.nodes()
+    assert list(nodes) == ['live'] and nodes['live']['models'] == ['a']
+
+def test_create_broker(monkeypatch):
+    monkeypatch.setenv('JOB_BROKER', 'memory')
+    monkeypatch.setenv('SCHEDULING_POLICY', 'sjf')
+    broker = job_broker.create_broker('base')
+    assert isinstance(broker, InProcessBroker) and broker.policy == 'sjf'
+    monkeypatch.setenv('SCHEDULING_POLICY', 'lifo')
+    with pytest.raises(ValueError):
+        job_broker.create_broker()
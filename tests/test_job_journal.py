@@ -0,0 +1,87 @@
+"""Job journal: merged transitions, crash recovery order, flush and pruning"""
+
+import time
+
+import pytest
+
+from job_journal import JobJournal
+
+@pytest.fixture
+def journal(tmp_path):
+    return JobJournal(str(tmp_path / 'jobs.db'), commit_interval=0.005, enabled=True)
+
+def test_later_transitions_keep_earlier_fields(journal):
+    journal.record('a', 'accepted', params={'prompt': 'cat', 'seed': 1}, sid='sid-1')
+    journal.record('a', 'started')
+    journal.record('a', 'completed', result={'paths': ['x.png']})
+    job = journal.get('a')
+    assert job['status'] == 'completed'
+    assert job['params'] == {'prompt': 'cat', 'seed': 1} and job['sid'] == 'sid-1'
+    assert job['result'] == {'paths': ['x.png']} and job['error'] is None
+    assert job['created_at'] <= job['started_at'] <= job['finished_at'] <= job['updated_at']
+
+    journal.record('b', 'accepted', params={'prompt': 'dog'})
+    journal.record('b', 'failed', error='out of memory')
+    job = journal.get('b')
+    assert (job['status'], job['error'], job['started_at']) == ('failed', 'out of memory', None)
+    assert job['finished_at'] is not None and job['params'] == {'prompt': 'dog'}
+    assert journal.get('missing') is None
+
+def test_unfinished_oldest_first(journal):
+    for job_id in ('first', 'second', 'third', 'fourth'):
+        journal.record(job_id, 'accepted', params={'id': job_id})
+        time.sleep(0.002)
+    journal.record('first', 'started')
+    journal.record('second', 'completed', result={})
+    journal.record('fourth', 'rejected', error='busy')
+    assert [job['id'] for job in journal.unfinished()] == ['first', 'third']
+    assert journal.unfinished()[0]['params'] == {'id': 'first'}
+
+def test_flush_commits_everything_recorded(journal, tmp_path):
+    for i in range(200):
+        journal.record(f'job-{i}', 'accepted', params={'i': i})
+    journal.flush()
+    assert journal.status()['pending'] == 0
+    assert journal.records == 200 and journal.commits < 200
+    # Visible to a separate reader (the next process after a crash)
+    assert len(JobJournal(str(tmp_path / 'jobs.db'), enabled=True).unfinished()) == 200
+
+def test_prune_deletes_only_old_finished_jobs(journal):
+    journal.record('old-done', 'completed', result={})
+    journal.record('old-running', 'accepted', params={})
+    journal.flush()
+    time.sleep(0.05)
+    journal.record('new-done', 'failed', error='x')
+    assert journal.prune(0.03) == 1
+    assert journal.get('old-done') is None
+    assert journal.get('old-running') is not None and journal.get('new-done') is not None
+
+def test_reads_share_one_connection(journal, monkeypatch):
+    journal.record('a', 'accepted', params={})
+    journal.get('a')
+    monkeypatch.setattr(journal, '_connect', lambda: pytest.fail('reconnected'))
+    for _ in range(3):
+        assert journal.get('unknown') is None
+    assert journal.prune(3600) == 0
+
+def test_disabled_journal_records_nothing(tmp_path):
+    journal = JobJournal(str(tmp_path / 'jobs.db'), enabled=False)
+    journal.record('a', 'accepted', params={})
+    assert journal.get('a') is None and journal.unfinished() == [] and journal.prune(0) == 0
+    assert not (tmp_path / 'jobs.db').exists()
+
+def test_recover_requeues_unfinished_jobs(server, journal, monkeypatch):
+    journal.record('done', 'accepted', params={'prompt': 'a'}, sid='s1')
+    journal.record('done', 'completed', result={})
+    journal.record('queued', 'accepted', params={'prompt': 'b', 'seed': 7}, sid='s2')
+    time.sleep(0.002)
+    journal.record('running', 'accepted', params={'prompt': 'c'}, sid='s3')
+    journal.record('running', 'started')
+    monkeypatch.setattr(server, 'job_journal', journal)
+    runner = server.JobRunner()
+    submitted = []
+    monkeypatch.setattr(runner, 'submit', submitted.append)
+    assert runner.recover() == 2
+    # Oldest first, with the journaled parameters; the old socket is gone
+    assert submitted == [{'id': 'queued', 'params': {'prompt': 'b', 'seed': 7}, 'sid': None},
+                         {'id': 'running', 'params': {'prompt': 'c'}, 'sid': None}]
@@ -0,0 +1,58 @@
+"""JobRunner event delivery between nodes"""
+
+import base64
+import io
+import time
+import uuid
+
+from PIL import Image
+
+def png_base64(color):
+    buffered = io.BytesIO()
+    Image.new('RGB', (8, 8), color).save(buffered, format='PNG')
+    return base64.b64encode(buffered.getvalue()).decode()
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+def test_images_of_a_job_run_elsewhere_are_served_by_the_accepting_node(server, tmp_path):
+    runner = server.job_runner
+    job_id = uuid.uuid4().hex
+    runner._remember({
+        'id': job_id, 'status': 'running', 'sid': None, 'created_at': time.time(), 'trace_id': None,
+        'started_at': None, 'finished_at': None, 'progress': None, 'result': None, 'error': None,
+        'output': {'output_dir': str(tmp_path / 'front'), 'filename_prefix': 'req', 'seed': 5},
+        'journaled': False
+    })
+    images = [png_base64('red'), png_base64('blue')]
+    runner._deliver({'event': 'complete', 'node': 'worker-node', 'sid': None, 'data': {
+        'job_id': job_id, 'images': images, 'metadata': {'prompt': 'x'},
+        'paths': ['/worker/disk/a.png', '/worker/disk/b.png'], 'gdrive_ids': []
+    }})
+    wait_for(lambda: runner.job_status(job_id)['status'] == 'completed')
+
+    paths = runner.job_status(job_id)['result']['paths']
+    assert [p.startswith(str(tmp_path / 'front')) for p in paths] == [True, True]
+    client = server.app.test_client()
+    for index, image in enumerate(images):
+        response = client.get(f'/api/jobs/{job_id}/images/{index}')
+        assert response.status_code == 200 and response.data == base64.b64decode(image)
+    assert 'output' not in runner.job_status(job_id)
+
+def test_events_from_this_node_are_delivered_as_they_are(server, tmp_path):
+    runner = server.job_runner
+    job_id = uuid.uuid4().hex
+    received = []
+    runner._remember({
+        'id': job_id, 'status': 'running', 'sid': None, 'created_at': time.time(), 'trace_id': None,
+        'started_at': None, 'finished_at': None, 'progress': None, 'result': None, 'error': None,
+        'output': {'output_dir': str(tmp_path / 'local')}, 'journaled': False
+    })
+    runner._listeners[job_id] = lambda event, data: received.append((event, data))
+    runner._deliver({'event': 'complete', 'node': runner.node_id, 'sid': None,
+                     'data': {'job_id': job_id, 'images': [png_base64('red')], 'paths': ['/here/a.png']}})
+    assert received[0][1]['paths'] == ['/here/a.png']
+    assert not (tmp_path / 'local').exists()
@@ -0,0 +1,121 @@
+"""Memory tracker: weight accounting and leak detection over load / unload cycles"""
+
+import gc
+
+import pytest
+
+from memory_tracker import MemoryTracker, memory_snapshot, weight_breakdown
+
+MB = 1024 ** 2
+
+class FakeTensor:
+    """Parameter stand-in that owns real memory, so RSS moves with it"""
+
+    def __init__(self, nbytes, dtype='torch.float32', device='cpu'):
+        self.storage = bytearray(nbytes)
+        self.dtype = dtype
+        self.device = device
+
+    def data_ptr(self):
+        return id(self.storage)
+
+    def numel(self):
+        return len(self.storage) // 4
+
+    def element_size(self):
+        return 4
+
+class FakeModule:
+    def __init__(self, *tensors):
+        self.tensors = tensors
+
+    def parameters(self):
+        return iter(self.tensors)
+
+    def buffers(self):
+        return iter(())
+
+    def modules(self):
+        return iter((self,))
+
+class FakePipeline:
+    def __init__(self, unet_mb=24, text_encoder_mb=8):
+        shared = FakeTensor(MB)
+        self.components = {
+            'unet': FakeModule(FakeTensor(unet_mb * MB), shared),
+            'text_encoder': FakeModule(FakeTensor(text_encoder_mb * MB, dtype='torch.float16'), shared),
+            'scheduler': object()
+        }
+
+def load(tracker, model, **kwargs):
+    before = memory_snapshot()
+    pipeline = FakePipeline()
+    tracker.loaded(model, pipeline, before, **kwargs)
+    return pipeline
+
+def test_weight_breakdown_counts_shared_tensors_once():
+    breakdown = weight_breakdown(FakePipeline(unet_mb=4, text_encoder_mb=2))
+    assert breakdown['bytes'] == 7 * MB
+    assert breakdown['components'] == {'unet': 5 * MB, 'text_encoder': 2 * MB}
+    assert breakdown['dtypes'] == {'float32': 5 * MB, 'float16': 2 * MB}
+    assert breakdown['devices'] == {'cpu': 7 * MB}
+
+def test_load_unload_cycles_leave_nothing_behind():
+    tracker = MemoryTracker()
+    for _ in range(3):
+        pipeline = load(tracker, 'model-a')
+        assert tracker.status()['pipelines'] == 1
+        before = tracker.unloading()
+        del pipeline
+        assert tracker.unloaded('model-a', before) == []
+    assert tracker.status() == {'pipelines': 0, 'tracked_bytes': 0, 'leaks': 0}
+    assert len(tracker.released) == 3
+    assert all(entry['unload_delta'] is not None for entry in tracker.released)
+
+def test_pipeline_still_referenced_after_unload_is_a_leak():
+    tracker = MemoryTracker()
+    cache = [load(tracker, 'model-a')]
+    leaks = tracker.unloaded('model-a', tracker.unloading())
+    assert [leak['reason'] for leak in leaks] == ['pipeline still referenced after unload']
+    assert 'list' in leaks[0]['referrers']
+    assert tracker.status()['leaks'] == 1
+    cache.clear()
+    gc.collect()
+    assert tracker.status()['pipelines'] == 0
+
+def test_variant_kept_past_its_job_is_flagged():
+    tracker = MemoryTracker()
+    kept = load(tracker, 'model-a', kind='img2img', trace_id='job-1')
+    transient = load(tracker, 'model-a', kind='inpaint', trace_id='job-2')
+    tracker.job_finished('job-1')
+    tracker.job_finished('job-2')
+    del transient
+    assert tracker.check(grace=0) != []
+    leaks = list(tracker.leaks)
+    assert [(leak['kind'], leak['trace_id']) for leak in leaks] == [('img2img', 'job-1')]
+    # Reported once, not on every check
+    assert tracker.check(grace=0) == []
+    assert list(tracker.report()['jobs']) == ['job-1']
+    del kept
+    gc.collect()
+    assert tracker.status()['pipelines'] == 0
+
+def test_variant_of_a_running_job_is_not_flagged():
+    tracker = MemoryTracker()
+    variant = load(tracker, 'model-a', kind='controlnet', trace_id='job-1')
+    assert tracker.check(grace=0) == []
+    tracker.job_finished('job-1')
+    assert tracker.check(grace=60) == []
+    del variant
+
+def test_torch_modules_are_accounted():
+    torch = pytest.importorskip('torch')
+    tracker = MemoryTracker()
+    pipeline = type('Pipeline', (), {})()
+    pipeline.components = {'unet': torch.nn.Linear(256, 256), 'vae': torch.nn.Linear(256, 256).half()}
+    entry = tracker.loaded('model-t', pipeline, memory_snapshot())
+    assert entry['components'] == {'unet': (256 * 256 + 256) * 4, 'vae': (256 * 256 + 256) * 2}
+    before = tracker.unloading()
+    del pipeline
+    assert tracker.unloaded('model-t', before) == []
+    assert tracker.status()['pipelines'] == 0
@@ -0,0 +1,90 @@
+"""Quantile sketch accuracy and merging, and the PerformanceMonitor built on it"""
+
+import random
+
+import pytest
+
+from utils import PerformanceMonitor, QuantileSketch
+
+QUANTILES = (0.01, 0.25, 0.5, 0.9, 0.95, 0.99, 0.999)
+
+def exact(values, q):
+    values = sorted(values)
+    return values[int(q * (len(values) - 1))]
+
+def durations(n, seed=0):
+    rng = random.Random(seed)
+    return [rng.lognormvariate(1.0, 0.8) for _ in range(n)]
+
+@pytest.mark.parametrize('accuracy', [0.01, 0.05])
+def test_quantiles_within_relative_accuracy(accuracy):
+    values = durations(20000)
+    sketch = QuantileSketch(accuracy)
+    for value in values:
+        sketch.add(value)
+    for q in QUANTILES:
+        assert sketch.quantile(q) == pytest.approx(exact(values, q), rel=accuracy)
+
+def test_merged_sketch_equals_sketch_of_all_values():
+    a_values, b_values = durations(5000, seed=1), [v * 10 for v in durations(3000, seed=2)]
+    a, b, whole = QuantileSketch(), QuantileSketch(), QuantileSketch()
+    for value in a_values:
+        a.add(value)
+        whole.add(value)
+    for value in b_values:
+        b.add(value)
+        whole.add(value)
+    a.merge(b.to_dict())
+    assert a.count == whole.count == 8000
+    assert a.bins == whole.bins
+    for q in QUANTILES:
+        assert a.quantile(q) == pytest.approx(exact(a_values + b_values, q), rel=0.01)
+    with pytest.raises(ValueError):
+        a.merge(QuantileSketch(0.05))
+
+def test_bucket_limit_keeps_upper_quantiles():
+    sketch = QuantileSketch(0.01, max_buckets=64)
+    values = [1.01 ** i for i in range(1000)]
+    for value in values:
+        sketch.add(value)
+    assert len(sketch.bins) <= 64
+    # Only the lowest buckets are collapsed
+    for q in (0.95, 0.99):
+        assert sketch.quantile(q) == pytest.approx(exact(values, q), rel=0.01)
+    assert sketch.quantile(0.0) is not None and QuantileSketch().quantile(0.5) is None
+
+def test_monitor_report_and_labels():
+    monitor = PerformanceMonitor(window_size=100)
+    values = durations(3000)
+    models = ('runwayml/stable-diffusion-v1-5', 'stabilityai/sdxl-turbo')
+    for i, value in enumerate(values):
+        monitor.record_generation(value, task='txt2img', model=models[i % 2], resolution='512x512')
+    monitor.record_generation(5.0, success=False, task='img2img', model=models[0], resolution='512x512')
+
+    report = monitor.get_report(by_series=True)
+    assert report['total_generations'] == 3000 and report['failed_generations'] == 1
+    assert report['p95'] == pytest.approx(exact(values, 0.95), rel=0.01)
+    assert report['recent_p95'] == round(exact(values[-100:], 0.95), 3)
+    assert sorted(report['series']) == ['img2img|runwayml/stable-diffusion-v1-5|512x512',
+                                        'txt2img|runwayml/stable-diffusion-v1-5|512x512',
+                                        'txt2img|stabilityai/sdxl-turbo|512x512']
+
+def test_snapshot_merge_adds_up():
+    first, second, combined = PerformanceMonitor(), PerformanceMonitor(), PerformanceMonitor()
+    for i, value in enumerate(durations(2000)):
+        target = first if i % 3 else second
+        target.record_generation(value, task='txt2img', model='m', resolution=f'{512 + i % 2 * 256}')
+        combined.record_generation(value, task='txt2img', model='m', resolution=f'{512 + i % 2 * 256}')
+    first.merge(second.snapshot())
+    merged, expected = first.get_report(), combined.get_report()
+    for field in ('total_generations', 'p50', 'p95', 'p99', 'fastest_generation', 'slowest_generation'):
+        assert merged[field] == expected[field]
+    assert merged['average_generation_time'] == pytest.approx(expected['average_generation_time'], abs=0.01)
+
+def test_series_are_bounded():
+    monitor = PerformanceMonitor(max_series=4)
+    for i in range(50):
+        monitor.record_generation(1.0, task='txt2img', model=f'model-{i}', resolution='512x512')
+    assert len(monitor.series) == 5
+    assert monitor.series[('other', 'other', 'other')].count == 46
+    assert monitor.get_report()['total_generations'] == 50
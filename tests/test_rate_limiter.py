@@ -0,0 +1,82 @@
+"""Token buckets: spending, refill, eviction and the limiter around them"""
+
+import pytest
+
+import rate_limiter
+from rate_limiter import (MemoryBuckets, RateLimiter, RedisBuckets, client_address, parse_costs,
+                          retry_after_header)
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(rate_limiter.time, 'monotonic', clock)
+    return clock
+
+def test_bucket_spends_and_refills(clock):
+    buckets = MemoryBuckets(rate=1.0, burst=10)
+    assert buckets.take('a', 10) == (True, 0.0)
+    allowed, retry_after = buckets.take('a', 4)
+    assert not allowed and retry_after == pytest.approx(4.0)
+    clock.now += 4
+    assert buckets.take('a', 4)[0]
+    # Other clients have their own bucket
+    assert buckets.take('b', 10)[0]
+
+def test_refill_is_capped_at_burst(clock):
+    buckets = MemoryBuckets(rate=1.0, burst=10)
+    buckets.take('a', 1)
+    clock.now += 1000
+    assert buckets.take('a', 10)[0]
+    assert not buckets.take('a', 1)[0]
+
+def test_idle_and_excess_buckets_are_evicted(clock):
+    buckets = MemoryBuckets(rate=1.0, burst=10, max_clients=3)
+    for key in 'abcd':
+        buckets.take(key, 1)
+    assert len(buckets) == 3
+    clock.now += 11
+    buckets.take('e', 1)
+    assert len(buckets) == 1
+
+def test_limiter_costs_and_rejections(clock):
+    limiter = RateLimiter(MemoryBuckets(rate=1.0, burst=20), costs={'upscale_image': 15})
+    environ = {'REMOTE_ADDR': '10.0.0.1'}
+    assert limiter.check(environ, 'generate')[0]  # 10 tokens
+    assert not limiter.check(environ, 'upscale_image')[0]
+    assert limiter.check(environ, 'get_models')[0]  # 1 token
+    assert limiter.status()['rejected'] == 1
+    assert RateLimiter(MemoryBuckets(1.0, 1), enabled=False).check(environ, 'generate') == (True, 0.0)
+
+def test_broken_backend_allows_requests():
+    class Broken:
+        def take(self, key, cost):
+            raise ConnectionError('down')
+
+    assert RateLimiter(Broken()).check({}, 'generate') == (True, 0.0)
+
+def test_client_address():
+    environ = {'REMOTE_ADDR': '10.0.0.1', 'HTTP_X_FORWARDED_FOR': '1.2.3.4, 10.0.0.2'}
+    assert client_address(environ) == '10.0.0.1'
+    assert client_address(environ, trust_proxy=True) == '1.2.3.4'
+    assert client_address({'REMOTE_ADDR': '127.0.0.1', 'asgi.scope': {'client': ('5.6.7.8', 4000)}}) == '5.6.7.8'
+    assert client_address({}) == 'unknown'
+
+def test_helpers():
+    assert parse_costs('generate=20, upscale_image=2.5,junk') == {'generate': 20.0, 'upscale_image': 2.5}
+    assert retry_after_header(0.2) == '1' and retry_after_header(2.1) == '3'
+
+def test_redis_buckets():
+    fakeredis = pytest.importorskip('fakeredis')
+    pytest.importorskip('lupa')
+
+    buckets = RedisBuckets(fakeredis.FakeRedis(), rate=1.0, burst=10)
+    assert buckets.take('a', 10) == (True, 0.0)
+    allowed, retry_after = buckets.take('a', 5)
+    assert not allowed and 0 < retry_after <= 5
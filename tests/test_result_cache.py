@@ -0,0 +1,59 @@
+"""Result cache: request keys and the on-disk LRU"""
+
+import json
+
+from result_cache import ResultCache, request_key
+
+BASE = {'task': 'txt2img', 'prompt': 'a red fox', 'seed': 7, 'model': 'm'}
+
+def test_random_seed_is_not_cached():
+    assert request_key(dict(BASE, seed=-1)) is None
+    assert request_key({k: v for k, v in BASE.items() if k != 'seed'}) is None
+
+def test_key_ignores_defaults_and_output_fields():
+    key = request_key(BASE)
+    assert key == request_key(dict(BASE, steps=20, cfg_scale=7.5, sampler='euler'))
+    assert key == request_key(dict(BASE, output_dir='/elsewhere', filename_prefix='x', trace=True))
+    assert key == request_key(dict(BASE, seed='7'))
+
+def test_key_changes_with_anything_that_changes_the_images():
+    key = request_key(BASE)
+    for change in ({'seed': 8}, {'steps': 21}, {'prompt': 'a blue fox'}, {'loras': [{'name': 'l', 'weight': 1}]},
+                   {'image': 'aGVsbG8='}):
+        assert request_key(dict(BASE, **change)) != key
+
+def test_key_uses_server_defaults():
+    assert request_key({k: v for k, v in BASE.items() if k != 'model'}, {'model': 'm'}) == request_key(BASE)
+
+def test_put_get_roundtrip(tmp_path):
+    cache = ResultCache(str(tmp_path), max_bytes=1 << 20, enabled=True)
+    key = request_key(BASE)
+    assert cache.get(key) is None
+    cache.put(key, {'images': ['abc'], 'paths': ['p.png']})
+    assert cache.get(key) == {'images': ['abc'], 'paths': ['p.png']}
+    status = cache.status()
+    assert (status['hits'], status['misses'], status['entries']) == (1, 1, 1)
+
+def test_index_is_rebuilt_from_disk(tmp_path):
+    key = request_key(BASE)
+    ResultCache(str(tmp_path), enabled=True).put(key, {'images': ['abc']})
+    assert ResultCache(str(tmp_path), enabled=True).get(key) == {'images': ['abc']}
+
+def test_evicts_least_recently_used(tmp_path):
+    size = len(json.dumps({'images': ['x' * 100]}, separators=(',', ':')))
+    cache = ResultCache(str(tmp_path), max_bytes=size * 2, enabled=True)
+    keys = [request_key(dict(BASE, seed=seed)) for seed in range(3)]
+    cache.put(keys[0], {'images': ['x' * 100]})
+    cache.put(keys[1], {'images': ['x' * 100]})
+    cache.get(keys[0])
+    cache.put(keys[2], {'images': ['x' * 100]})
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[0]) is not None and cache.get(keys[2]) is not None
+    assert cache.status()['evictions'] == 1
+
+def test_disabled_cache_stores_nothing(tmp_path):
+    cache = ResultCache(str(tmp_path), enabled=False)
+    key = request_key(BASE)
+    cache.put(key, {'images': []})
+    assert cache.get(key) is None
+    assert not list(tmp_path.iterdir())
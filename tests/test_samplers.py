@@ -0,0 +1,99 @@
+"""Sampler names, fast mode and the check against the installed diffusers"""
+
+import sys
+import types
+
+import pytest
+
+import samplers
+from samplers import check_supported, normalize, parse_sampler
+
+@pytest.mark.parametrize('name, schedule, expected', [
+    ('Euler a', None, ('euler_a', 'normal')),
+    ('euler_ancestral', None, ('euler_a', 'normal')),
+    ('DPM++ 2M Karras', None, ('dpmpp_2m', 'karras')),
+    ('dpm', 'Karras', ('dpmpp_2m', 'karras')),
+    ('DPM++ 2M SDE', 'exponential', ('dpmpp_2m_sde', 'exponential')),
+    ('UniPC', '', ('unipc', 'normal')),
+    ('LCM-LoRA', None, ('lcm', 'normal')),
+    (None, None, (samplers.DEFAULT_SAMPLER, 'normal')),
+])
+def test_parse_sampler(name, schedule, expected):
+    assert parse_sampler(name, schedule) == expected
+
+@pytest.mark.parametrize('name, schedule', [('ddpm', None), ('euler', 'linear'), ('karras', None)])
+def test_parse_sampler_rejects_unknown_names(name, schedule):
+    with pytest.raises(ValueError, match='Unknown'):
+        parse_sampler(name, schedule)
+
+class KarrasScheduler:
+    def __init__(self, num_train_timesteps=1000, use_karras_sigmas=False):
+        pass
+
+class PlainScheduler:
+    def __init__(self, num_train_timesteps=1000):
+        pass
+
+@pytest.fixture
+def diffusers(monkeypatch):
+    """diffusers 0.21-like: no LCMScheduler, no exponential sigmas, no Karras for DDIM"""
+    module = types.ModuleType('diffusers')
+    module.__version__ = '0.21.4'
+    module.EulerDiscreteScheduler = KarrasScheduler
+    module.DPMSolverMultistepScheduler = KarrasScheduler
+    module.DDIMScheduler = PlainScheduler
+    monkeypatch.setitem(sys.modules, 'diffusers', module)
+    monkeypatch.setattr(samplers, '_supported', set())
+    return module
+
+def test_normalize_rejects_what_diffusers_cannot_run(diffusers):
+    assert normalize({'sampler': 'DPM++ 2M Karras'})['scheduler'] == 'karras'
+    with pytest.raises(ValueError, match='LCMScheduler'):
+        normalize({'sampler': 'lcm'})
+    with pytest.raises(ValueError, match='LCMScheduler'):
+        normalize({'sampler': 'euler', 'fast': True})
+    with pytest.raises(ValueError, match='exponential'):
+        normalize({'sampler': 'euler', 'scheduler': 'exponential'})
+    with pytest.raises(ValueError, match='karras'):
+        normalize({'sampler': 'ddim', 'scheduler': 'karras'})
+    # The model's own scheduler is only known once it is loaded
+    check_supported('default', 'karras')
+
+class SigmasScheduler:
+    def __init__(self, num_train_timesteps=1000, use_karras_sigmas=False, use_exponential_sigmas=False):
+        pass
+
+@pytest.mark.parametrize('version, runs', [('0.31.0', False), ('0.32.2', True)])
+def test_exponential_multistep_needs_a_fixed_release(diffusers, version, runs):
+    diffusers.__version__ = version
+    diffusers.DPMSolverMultistepScheduler = SigmasScheduler
+    diffusers.EulerDiscreteScheduler = SigmasScheduler
+    assert normalize({'sampler': 'euler', 'scheduler': 'exponential'})['scheduler'] == 'exponential'
+    if runs:
+        normalize({'sampler': 'dpmpp_2m', 'scheduler': 'exponential'})
+    else:
+        with pytest.raises(ValueError, match='0.32'):
+            normalize({'sampler': 'dpmpp_2m', 'scheduler': 'exponential'})
+
+def test_check_is_cached(diffusers):
+    check_supported('euler', 'karras')
+    del diffusers.EulerDiscreteScheduler
+    check_supported('euler', 'karras')
+    with pytest.raises(ValueError):
+        check_supported('euler', 'normal')
+
+def test_fast_mode_steps_and_guidance(diffusers):
+    diffusers.LCMScheduler = PlainScheduler
+    params = normalize({'fast': True, 'sampler': 'euler', 'steps': 30, 'cfg_scale': 7.5})
+    assert (params['sampler'], params['steps'], params['cfg_scale']) == ('lcm', samplers.LCM_STEPS,
+                                                                         samplers.LCM_MAX_GUIDANCE)
+    params = normalize({'sampler': 'lcm', 'steps': 6, 'cfg_scale': 0.5})
+    assert (params['steps'], params['cfg_scale']) == (6, 1.0)
+    assert normalize({'sampler': 'euler', 'steps': 30})['steps'] == 30
+
+def test_lcm_lora_only_for_models_that_are_not_distilled():
+    params = {'sampler': 'lcm'}
+    assert samplers.lcm_lora_source('SimianLuo/LCM_Dreamshaper_v7') is None
+    loras = samplers.with_lcm_lora([], params, 'runwayml/stable-diffusion-v1-5')
+    assert loras == [{'name': samplers.LCM_LORA, 'weight': 1.0}]
+    assert samplers.with_lcm_lora([], {'sampler': 'euler'}, 'runwayml/stable-diffusion-v1-5') == []
@@ -0,0 +1,61 @@
+"""Sweep planning: cells, seed batching, ordering and validation"""
+
+import pytest
+
+from sweep import plan_sweep, prepare_sweep, sweep_summary, compose_grid
+
+def sweep(**kwargs):
+    return dict({'task': 'sweep', 'prompt': 'a lighthouse', 'seed': 5}, **kwargs)
+
+def test_cells_cover_the_grid():
+    plan = plan_sweep(sweep(axes={'cfg_scale': [4, 7, 10], 'steps': [10, 20]}))
+    assert (plan['columns'], plan['rows'], len(plan['cells'])) == (3, 2, 6)
+    first, last = plan['cells'][0], plan['cells'][-1]
+    assert first['coords'] == {'cfg_scale': 4, 'steps': 10} and (first['col'], first['row']) == (0, 0)
+    assert last['coords'] == {'cfg_scale': 10, 'steps': 20} and (last['col'], last['row']) == (2, 1)
+    assert all(cell['seed'] == 5 and cell['params']['task'] == 'txt2img' for cell in plan['cells'])
+
+def test_seed_axis_cells_share_batches():
+    plan = plan_sweep(sweep(axes={'seed': [1, 2, 3, 4, 5], 'cfg_scale': [4, 7]}), max_batch=4)
+    assert len(plan['cells']) == 10
+    # Per cfg_scale: 5 seeds in batches of at most 4
+    assert [len(b['seeds']) for b in plan['batches']] == [4, 1, 4, 1]
+    assert all('seed' not in b['params'] for b in plan['batches'])
+    assert sorted(i for b in plan['batches'] for i in b['cells']) == list(range(10))
+
+def test_batches_are_grouped_by_model():
+    plan = plan_sweep(sweep(axes={'model': ['b', 'a', 'b', 'a']}))
+    assert [b['params']['model'] for b in plan['batches']] == ['a', 'b']
+
+def test_lora_weight_axis():
+    plan = plan_sweep(sweep(loras=[{'name': 'x', 'weight': 1.0}], axes={'lora_weight': [0.5, 1.0]}))
+    assert [c['params']['loras'][0]['weight'] for c in plan['cells']] == [0.5, 1.0]
+    with pytest.raises(ValueError):
+        plan_sweep(sweep(axes={'lora_weight': [0.5]}))
+
+@pytest.mark.parametrize('axes', [None, {}, {'bogus': [1]}, {'steps': []}, {'steps': 5},
+                                  {'seed': [1, 'x']}, {'seed': list(range(100))}])
+def test_invalid_axes(axes):
+    with pytest.raises(ValueError):
+        plan_sweep(sweep(axes=axes), max_cells=64)
+
+def test_seed_strings():
+    assert prepare_sweep(sweep(seed='3', axes={'steps': [1]}))['seed'] == 3
+    assert plan_sweep(sweep(seed='3', axes={'seed': ['1', 2]}))['cells'][0]['seed'] == 1
+    for seed in ('abc', [1]):
+        with pytest.raises(ValueError):
+            prepare_sweep(sweep(seed=seed, axes={'steps': [1]}))
+
+def test_random_base_seed_is_fixed_by_prepare():
+    params = prepare_sweep(sweep(seed=-1, axes={'steps': [1, 2]}))
+    assert params['seed'] >= 0
+    assert plan_sweep(params)['cells'] == plan_sweep(params)['cells']
+
+def test_grid_layout():
+    from PIL import Image
+
+    plan = plan_sweep(sweep(axes={'cfg_scale': [4, 7], 'steps': [10, 20, 30]}))
+    images = {c['index']: Image.new('RGB', (16, 16)) for c in plan['cells']}
+    grid = compose_grid(plan, images)
+    assert grid.size == (220 + 2 * 16, 28 + 3 * 16)
+    assert len(sweep_summary(plan)['cells']) == 6
@@ -0,0 +1,142 @@
+"""
+Per-job span tracing with Chrome trace / Perfetto export
+
+Every job gets a trace id when it is submitted; the id is returned in
+'queued' and 'complete' events and in the job status. A trace is sampled
+(TRACE_SAMPLE_RATE, or a request with 'trace': true) or not; only sampled
+traces record spans, so tracing can stay on in production at a low rate.
+
+Spans go to a bounded ring buffer (TRACE_BUFFER_SIZE spans) and are
+exported on demand as Chrome trace JSON (GET /api/traces, or
+/api/jobs/<id>/trace), which chrome://tracing and ui.perfetto.dev open.
+
+The current trace is thread-local: activate() it on the thread that works
+on the job and span() anywhere below records into it. Span times are
+perf_counter() values, converted to wall-clock microseconds on export so
+spans from inference worker processes (sent back with drain()) line up.
+"""
+
+import os
+import time
+import uuid
+import random
+import threading
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', 0.1))
+TRACE_BUFFER_SIZE = int(os.environ.get('TRACE_BUFFER_SIZE', 20000))
+
+# perf_counter() + _WALL_OFFSET = time.time(), fixed per process
+_WALL_OFFSET = time.time() - time.perf_counter()
+
+_local = threading.local()
+
+def new_trace(sampled: Optional[bool] = None, job_id: Optional[str] = None) -> Dict:
+    """Trace context for a new job: {'id', 'sampled', 'job_id'}; serializable, travels with the job"""
+    if sampled is None:
+        sampled = random.random() < tracer.sample_rate
+    return {'id': uuid.uuid4().hex[:16], 'sampled': bool(sampled), 'job_id': job_id}
+
+def current() -> Optional[Dict]:
+    return getattr(_local, 'trace', None)
+
+@contextmanager
+def activate(trace: Optional[Dict]):
+    """Make `trace` the current trace of this thread inside the block"""
+    previous = current()
+    _local.trace = trace
+    try:
+        yield trace
+    finally:
+        _local.trace = previous
+
+def from_wall(timestamp: float) -> float:
+    """time.time() value -> perf_counter() scale"""
+    return timestamp - _WALL_OFFSET
+
+class Tracer:
+    """Bounded span buffer of this process"""
+
+    def __init__(self, buffer_size: Optional[int] = None, sample_rate: Optional[float] = None):
+        self.sample_rate = TRACE_SAMPLE_RATE if sample_rate is None else sample_rate
+        self.spans = deque(maxlen=buffer_size or TRACE_BUFFER_SIZE)
+        self.recorded = 0
+        self._threads = {}  # (pid, thread id) -> name, for the trace viewer
+        self._lock = threading.Lock()
+
+    def record(self, name: str, start: float, end: float, trace: Optional[Dict] = None, **args):
+        """Record a finished span (perf_counter() times) into `trace`, or the current one"""
+        trace = trace or current()
+        if not trace or not trace.get('sampled'):
+            return
+        thread = threading.current_thread()
+        pid = os.getpid()
+        with self._lock:
+            self._threads.setdefault((pid, thread.ident), thread.name)
+            self.spans.append((trace['id'], name, start + _WALL_OFFSET, end - start, pid, thread.ident,
+                               args or None))
+            self.recorded += 1
+
+    @contextmanager
+    def span(self, name: str, **args):
+        """Time the block as a span of the current trace (no-op when unsampled)"""
+        trace = current()
+        if not trace or not trace.get('sampled'):
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.perf_counter(), trace, **args)
+
+    def drain(self, trace_id: str) -> List:
+        """Remove and return the spans of one trace (worker process -> parent)"""
+        with self._lock:
+            spans = [s for s in self.spans if s[0] == trace_id]
+            if spans:
+                kept = [s for s in self.spans if s[0] != trace_id]
+                self.spans.clear()
+                self.spans.extend(kept)
+            return [list(s) + [self._threads.get((s[4], s[5]))] for s in spans]
+
+    def extend(self, spans: Optional[List]):
+        """Add spans drained in another process"""
+        with self._lock:
+            for *span, thread_name in spans or ():
+                if thread_name:
+                    self._threads.setdefault((span[4], span[5]), thread_name)
+                self.spans.append(tuple(span))
+            self.recorded += len(spans or ())
+
+    def export(self, trace_id: Optional[str] = None, limit: Optional[int] = None) -> Dict:
+        """Chrome trace JSON of one trace, or of the last `limit` spans"""
+        with self._lock:
+            spans = [s for s in self.spans if trace_id is None or s[0] == trace_id]
+        if limit:
+            spans = spans[-limit:]
+        events = []
+        threads = set()
+        for span_trace, name, start, duration, pid, tid, args in spans:
+            event_args = dict(args or {}, trace_id=span_trace)
+            events.append({'name': name, 'cat': 'job', 'ph': 'X', 'ts': round(start * 1e6, 1),
+                           'dur': round(duration * 1e6, 1), 'pid': pid, 'tid': tid, 'args': event_args})
+            threads.add((pid, tid))
+        for pid, tid in threads:
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid,
+                           'args': {'name': self._threads.get((pid, tid), str(tid))}})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def status(self) -> Dict:
+        return {
+            'sample_rate': self.sample_rate,
+            'buffered_spans': len(self.spans),
+            'buffer_size': self.spans.maxlen,
+            'recorded': self.recorded
+        }
+
+tracer = Tracer()
+span = tracer.span
+record = tracer.record
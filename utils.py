@@ -4,8 +4,10 @@ Utility functions and helpers
 
 import os
 import json
+import math
 import hashlib
-from datetime import datetime
+import threading
+from collections import deque
 from pathlib import Path
 
 def get_system_info():
@@ -57,10 +59,10 @@ def load_config(config_path='.env'):
     return config
 
 def log_to_file(message, log_file='server.log'):
-    """Log message to file"""
-    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    with open(log_file, 'a') as f:
-        f.write(f"[{timestamp}] {message}\n")
+    """Log message to file (queued; a background thread writes and rotates the file)"""
+    from structured_logging import file_logger
+    
+    file_logger(log_file).info(message)
 
 def cleanup_old_files(directory, days=30):
     """Remove files older than specified days"""
@@ -77,23 +79,67 @@ def cleanup_old_files(directory, days=30):
     
     return count
 
-def estimate_memory_requirement(width, height, steps, model_type='sd15'):
-    """Estimate VRAM requirement for generation"""
-    # Base memory for model
-    base_memory = {
-        'sd15': 4,      # GB
-        'sd21': 5,
-        'sdxl': 7,
-        'flux': 12
-    }
-    
-    model_mem = base_memory.get(model_type, 4)
-    
-    # Additional for inference
-    batch_mem = (width * height * 4 * steps) / (1024**3)  # Rough estimate
-    
-    total = model_mem + batch_mem
-    return round(total, 2)
+# Per-architecture memory profile used by estimate_memory_requirement:
+# fp16 weights (GB), attention heads and channels at the highest-resolution
+# attention level, and the latent downscale of that level (SDXL has no
+# attention at full latent resolution)
+MODEL_MEMORY_PROFILES = {
+    'sd15': {'weights_gb': 2.0, 'heads': 8, 'channels': 320, 'attn_downscale': 1},
+    'sd21': {'weights_gb': 2.6, 'heads': 5, 'channels': 320, 'attn_downscale': 1},
+    'sdxl': {'weights_gb': 6.9, 'heads': 10, 'channels': 640, 'attn_downscale': 2},
+    'flux': {'weights_gb': 23.8, 'heads': 24, 'channels': 3072, 'attn_downscale': 2},
+}
+
+def detect_model_type(model_name):
+    """Guess the architecture key of MODEL_MEMORY_PROFILES from a model name"""
+    name = model_name.lower()
+    if 'flux' in name:
+        return 'flux'
+    if 'xl' in name:
+        return 'sdxl'
+    if '2-1' in name or '2.1' in name or 'sd21' in name:
+        return 'sd21'
+    return 'sd15'
+
+def estimate_memory_requirement(width, height, steps, model_type='sd15', batch_size=1,
+                                dtype_bytes=2, attention='sdpa', vae_slicing=False,
+                                vae_tiling=False, weights_gb=None, calibration=1.0):
+    """Estimate peak memory (GB) for a generation
+
+    Peak = resident weights + the larger of UNet and VAE-decoder activations.
+    UNet activations are dominated by self-attention at the highest latent
+    resolution: quadratic in pixels with full attention ('full'), halved with
+    attention slicing ('sliced'), linear with SDPA / xformers ('sdpa').
+    The VAE decoder is linear in pixels and per image in the batch (one image
+    with vae_slicing, one 512x512 tile with vae_tiling). `steps` does not
+    change peak memory. `calibration` scales the result by the ratio of
+    observed to estimated peaks.
+    """
+    profile = MODEL_MEMORY_PROFILES.get(model_type, MODEL_MEMORY_PROFILES['sd15'])
+    if weights_gb is None:
+        weights_gb = profile['weights_gb'] * dtype_bytes / 2
+
+    # Classifier-free guidance doubles the UNet batch
+    unet_batch = batch_size * 2
+    latent_pixels = (width // 8) * (height // 8)
+    tokens = latent_pixels / profile['attn_downscale'] ** 2
+    heads = profile['heads']
+
+    if attention == 'full':
+        attention_bytes = unet_batch * heads * tokens ** 2 * dtype_bytes * 2
+    elif attention == 'sliced':
+        attention_bytes = unet_batch * max(heads // 2, 1) * tokens ** 2 * dtype_bytes * 2
+    else:
+        attention_bytes = unet_batch * profile['channels'] * tokens * dtype_bytes * 4
+    feature_bytes = unet_batch * profile['channels'] * latent_pixels * dtype_bytes * 40
+    unet_bytes = attention_bytes + feature_bytes
+
+    vae_width, vae_height = (min(width, 512), min(height, 512)) if vae_tiling else (width, height)
+    vae_batch = 1 if vae_slicing else batch_size
+    vae_bytes = vae_batch * vae_width * vae_height * 256 * 6 * dtype_bytes
+
+    total = weights_gb + max(unet_bytes, vae_bytes) / (1024**3)
+    return round(total * calibration, 2)
 
 def validate_image_path(filepath):
     """Validate image file"""
@@ -123,37 +169,218 @@ def compress_image(filepath, quality=85):
     
     return output_path
 
-class PerformanceMonitor:
-    """Monitor performance metrics"""
-    
-    def __init__(self):
-        self.metrics = {
-            'generation_time': [],
-            'average_time': 0,
-            'total_generations': 0,
-            'failed_generations': 0,
-            'average_memory': 0,
+class QuantileSketch:
+    """Mergeable quantile sketch with bounded relative error (DDSketch)
+
+    Values are counted in logarithmic buckets of ratio gamma = (1+a)/(1-a), so
+    any quantile is within `relative_accuracy` of the true value whatever the
+    distribution. Memory is bounded by `max_buckets` (the lowest buckets are
+    collapsed first); two sketches merge by adding bucket counts.
+    """
+
+    def __init__(self, relative_accuracy=0.01, max_buckets=2048):
+        self.relative_accuracy = relative_accuracy
+        self.max_buckets = max_buckets
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._inv_log_gamma = 1 / math.log(self.gamma)
+        self.bins = {}
+        self.zero_count = 0  # values too small for a log bucket
+        self.count = 0
+
+    def add(self, value, count=1):
+        if value > 1e-9:
+            index = math.ceil(math.log(value) * self._inv_log_gamma)
+            bins = self.bins
+            bins[index] = bins.get(index, 0) + count
+            if len(bins) > self.max_buckets:
+                self._collapse()
+        else:
+            self.zero_count += count
+        self.count += count
+
+    def _collapse(self):
+        keys = sorted(self.bins)
+        extra = keys[:len(keys) - self.max_buckets + 1]
+        lowest = extra[-1]
+        self.bins[lowest] += sum(self.bins.pop(k) for k in extra[:-1])
+
+    def quantile(self, q):
+        """Value at quantile q (0..1), or None when empty"""
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0.0
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if seen > rank:
+                return 2 * self.gamma ** index / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.bins) / (self.gamma + 1)
+
+    def merge(self, other):
+        """Add another sketch (or its to_dict()) with the same relative accuracy"""
+        if isinstance(other, dict):
+            other = QuantileSketch.from_dict(other)
+        if abs(other.gamma - self.gamma) > 1e-12:
+            raise ValueError("Cannot merge sketches with different relative accuracy")
+        for index, count in other.bins.items():
+            self.bins[index] = self.bins.get(index, 0) + count
+        while len(self.bins) > self.max_buckets:
+            self._collapse()
+        self.zero_count += other.zero_count
+        self.count += other.count
+
+    def to_dict(self):
+        return {'relative_accuracy': self.relative_accuracy, 'max_buckets': self.max_buckets,
+                'bins': [[k, v] for k, v in self.bins.items()], 'zero_count': self.zero_count,
+                'count': self.count}
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data['relative_accuracy'], data['max_buckets'])
+        sketch.bins = {int(k): v for k, v in data['bins']}
+        sketch.zero_count = data['zero_count']
+        sketch.count = data['count']
+        return sketch
+
+class _Series:
+    """Streaming statistics of one (task, model, resolution)"""
+
+    __slots__ = ('sketch', 'window', 'count', 'failed', 'total', 'min', 'max')
+
+    def __init__(self, window_size, relative_accuracy):
+        self.sketch = QuantileSketch(relative_accuracy)
+        self.window = deque(maxlen=window_size)
+        self.count = 0
+        self.failed = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, duration):
+        self.sketch.add(duration)
+        self.window.append(duration)
+        self.count += 1
+        self.total += duration
+        if duration < self.min:
+            self.min = duration
+        if duration > self.max:
+            self.max = duration
+
+    def merge(self, data):
+        self.sketch.merge(data['sketch'])
+        self.window.extend(data['window'])
+        self.count += data['count']
+        self.failed += data['failed']
+        self.total += data['total']
+        if data['count']:
+            self.min = min(self.min, data['min'])
+            self.max = max(self.max, data['max'])
+
+    def to_dict(self):
+        return {'sketch': self.sketch.to_dict(), 'window': list(self.window), 'count': self.count,
+                'failed': self.failed, 'total': self.total,
+                'min': self.min if self.count else None, 'max': self.max if self.count else None}
+
+    def report(self):
+        recent = sorted(self.window)
+        sketch = self.sketch
+        return {
+            'count': self.count,
+            'failed': self.failed,
+            'mean': round(self.total / self.count, 3) if self.count else 0,
+            'min': round(self.min, 3) if self.count else 0,
+            'max': round(self.max, 3) if self.count else 0,
+            'p50': round(sketch.quantile(0.5), 3) if self.count else None,
+            'p95': round(sketch.quantile(0.95), 3) if self.count else None,
+            'p99': round(sketch.quantile(0.99), 3) if self.count else None,
+            # Exact over the sliding window: what the last N jobs looked like
+            'recent_mean': round(sum(recent) / len(recent), 3) if recent else None,
+            'recent_p95': round(recent[int(0.95 * (len(recent) - 1))], 3) if recent else None,
         }
-    
-    def record_generation(self, duration, success=True):
+
+class PerformanceMonitor:
+    """Monitor performance metrics
+
+    Constant memory whatever the number of generations: each (task, model,
+    resolution) keeps running totals, a QuantileSketch for p50/p95/p99 and a
+    ring buffer of its last `window_size` durations, and so does the overall
+    series that every record also updates, so a report costs the same whatever
+    the number of series. snapshot() / merge() move statistics between
+    processes (inference workers, other nodes).
+    """
+
+    # Joins (task, model, resolution) in report labels; hub ids and paths use '/'
+    LABEL_SEPARATOR = '|'
+
+    def __init__(self, window_size=1024, relative_accuracy=0.01, max_series=256):
+        self.window_size = window_size
+        self.relative_accuracy = relative_accuracy
+        self.max_series = max_series
+        self.series = {}
+        # All series together; its window holds the last durations of any series, in order
+        self.overall = _Series(window_size, relative_accuracy)
+        self._lock = threading.Lock()
+
+    def _series(self, key):
+        series = self.series.get(key)
+        if series is None:
+            if len(self.series) >= self.max_series:
+                # Unbounded label values (custom resolutions, models) share one series
+                key = ('other', 'other', 'other')
+                series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = _Series(self.window_size, self.relative_accuracy)
+        return series
+
+    def record_generation(self, duration, success=True, task=None, model=None, resolution=None):
         """Record generation metrics"""
-        if success:
-            self.metrics['generation_time'].append(duration)
-            self.metrics['total_generations'] += 1
-            self.metrics['average_time'] = sum(self.metrics['generation_time']) / len(self.metrics['generation_time'])
-        else:
-            self.metrics['failed_generations'] += 1
-    
-    def get_report(self):
+        key = (task or 'unknown', model or 'unknown', resolution or 'unknown')
+        with self._lock:
+            series = self.series.get(key) or self._series(key)
+            if success:
+                series.add(duration)
+                self.overall.add(duration)
+            else:
+                series.failed += 1
+                self.overall.failed += 1
+
+    def snapshot(self):
+        """Serializable state for merge() in another process"""
+        with self._lock:
+            return [[list(key), series.to_dict()] for key, series in self.series.items()]
+
+    def merge(self, snapshot):
+        """Add the statistics of another monitor's snapshot()"""
+        with self._lock:
+            for key, data in snapshot:
+                self._series(tuple(key)).merge(data)
+                self.overall.merge(data)
+
+    def get_report(self, by_series=False):
         """Get performance report"""
-        return {
-            'total_generations': self.metrics['total_generations'],
-            'failed_generations': self.metrics['failed_generations'],
-            'success_rate': (self.metrics['total_generations'] / (self.metrics['total_generations'] + self.metrics['failed_generations']) * 100) if (self.metrics['total_generations'] + self.metrics['failed_generations']) > 0 else 0,
-            'average_generation_time': round(self.metrics['average_time'], 2),
-            'fastest_generation': round(min(self.metrics['generation_time']), 2) if self.metrics['generation_time'] else 0,
-            'slowest_generation': round(max(self.metrics['generation_time']), 2) if self.metrics['generation_time'] else 0,
+        with self._lock:
+            stats = self.overall.report()
+            series = {self.LABEL_SEPARATOR.join(key): s.report()
+                      for key, s in self.series.items()} if by_series else None
+        attempts = stats['count'] + stats['failed']
+        report = {
+            'total_generations': stats['count'],
+            'failed_generations': stats['failed'],
+            'success_rate': stats['count'] / attempts * 100 if attempts else 0,
+            'average_generation_time': round(stats['mean'], 2),
+            'fastest_generation': round(stats['min'], 2),
+            'slowest_generation': round(stats['max'], 2),
+            'p50': stats['p50'],
+            'p95': stats['p95'],
+            'p99': stats['p99'],
+            'recent_average': stats['recent_mean'],
+            'recent_p95': stats['recent_p95'],
         }
+        if series is not None:
+            report['series'] = series
+        return report
 
 class ImageMetadataExtractor:
     """Extract and manage image metadata"""